@@ -9,11 +9,13 @@ setup(
     author_email='mla@mla.im',
     license='GPL',
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
-    install_requires=['keras','sh', 'regex', 'numpy', 'pandas', 'rasterio'],
-    python_requires='>=3',
+    install_requires=['keras','sh', 'regex', 'numpy', 'pandas', 'rasterio', 'lxml', 'scikit-learn'],
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
-            'trainssd=singleshot:console',
+            'trainssd=singleshot.model:console',
+            'predictssd=singleshot.model:predict_console',
+            'benchssd=singleshot.benchmark:main',
         ],
     },
 )
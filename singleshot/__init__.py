@@ -1,992 +1,76 @@
-import os
-from argparse import ArgumentParser
-from math import ceil
-
-import numpy as np
-import pandas
-import rasterio
-import tensorflow as tf
-from keras import Input, backend as K
-from keras.callbacks import ModelCheckpoint, LearningRateScheduler
-from keras.engine import Model, Layer, InputSpec
-from keras.layers import Lambda, Conv2D, MaxPooling2D, Reshape, Concatenate, Activation
-from keras.optimizers import Adam
-
-from singleshot.util import convert_coordinates, SSDBoxEncoder, BatchGenerator, decode_y
-
-w_root = '/osn/share/vgg/'
-if not os.path.exists(w_root):
-    w_root = 'vgg/'
-
-def get_w(n):
-    return [np.load(w_root + '{}_0.npy'.format(n)), np.load(w_root + '{}_1.npy'.format(n))]
-
-
-def SSD(image_size,
-        n_classes,
-        min_scale=0.1,
-        max_scale=0.9,
-        scales=None,
-        aspect_ratios_global=None,
-        aspect_ratios_per_layer=[[0.5, 1.0, 2.0],
-                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                                     [0.5, 1.0, 2.0],
-                                     [0.5, 1.0, 2.0]],
-        two_boxes_for_ar1=True,
-        limit_boxes=False,
-        variances=[0.1, 0.1, 0.2, 0.2],
-        coords='centroids',
-        normalize_coords=False):
-    '''
-    Build a Keras model with SSD_300 architecture, see references.
-
-    The base network is a reduced atrous VGG-16, extended by the SSD architecture,
-    as described in the paper.
-
-    In case you're wondering why this function has so many arguments: All arguments except
-    the first two (`image_size` and `n_classes`) are only needed so that the anchor box
-    layers can produce the correct anchor boxes. In case you're training the network, the
-    parameters passed here must be the same as the ones used to set up `SSDBoxEncoder`.
-    In case you're loading trained weights, the parameters passed here must be the same
-    as the ones used to produce the trained weights.
-
-    Some of these arguments are explained in more detail in the documentation of the
-    `SSDBoxEncoder` class.
-
-    Note: Requires Keras v2.0 or later. Currently works only with the
-    TensorFlow backend (v1.0 or later).
-
-    Arguments:
-        image_size (tuple): The input image size in the format `(height, width, channels)`.
-        n_classes (int): The number of categories for classification including
-            the background class (i.e. the number of positive classes +1 for
-            the background calss).
-        min_scale (float, optional): The smallest scaling factor for the size of the anchor boxes as a fraction
-            of the shorter side of the input images. Defaults to 0.1.
-        max_scale (float, optional): The largest scaling factor for the size of the anchor boxes as a fraction
-            of the shorter side of the input images. All scaling factors between the smallest and the
-            largest will be linearly interpolated. Note that the second to last of the linearly interpolated
-            scaling factors will actually be the scaling factor for the last predictor layer, while the last
-            scaling factor is used for the second box for aspect ratio 1 in the last predictor layer
-            if `two_boxes_for_ar1` is `True`. Defaults to 0.9.
-        scales (list, optional): A list of floats containing scaling factors per convolutional predictor layer.
-            This list must be one element longer than the number of predictor layers. The first `k` elements are the
-            scaling factors for the `k` predictor layers, while the last element is used for the second box
-            for aspect ratio 1 in the last predictor layer if `two_boxes_for_ar1` is `True`. This additional
-            last scaling factor must be passed either way, even if it is not being used.
-            Defaults to `None`. If a list is passed, this argument overrides `min_scale` and
-            `max_scale`. All scaling factors must be greater than zero.
-        aspect_ratios_global (list, optional): The list of aspect ratios for which anchor boxes are to be
-            generated. This list is valid for all prediction layers. Defaults to None.
-        aspect_ratios_per_layer (list, optional): A list containing one aspect ratio list for each prediction layer.
-            This allows you to set the aspect ratios for each predictor layer individually, which is the case for the
-            original SSD300 implementation. If a list is passed, it overrides `aspect_ratios_global`.
-            Defaults to the aspect ratios used in the original SSD300 architecture, i.e.:
-                [[0.5, 1.0, 2.0],
-                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
-                 [0.5, 1.0, 2.0],
-                 [0.5, 1.0, 2.0]]
-        two_boxes_for_ar1 (bool, optional): Only relevant for aspect ratio lists that contain 1. Will be ignored otherwise.
-            If `True`, two anchor boxes will be generated for aspect ratio 1. The first will be generated
-            using the scaling factor for the respective layer, the second one will be generated using
-            geometric mean of said scaling factor and next bigger scaling factor. Defaults to `True`, following the original
-            implementation.
-        limit_boxes (bool, optional): If `True`, limits box coordinates to stay within image boundaries.
-            This would normally be set to `True`, but here it defaults to `False`, following the original
-            implementation.
-        variances (list, optional): A list of 4 floats >0 with scaling factors (actually it's not factors but divisors
-            to be precise) for the encoded predicted box coordinates. A variance value of 1.0 would apply
-            no scaling at all to the predictions, while values in (0,1) upscale the encoded predictions and values greater
-            than 1.0 downscale the encoded predictions. Defaults to `[0.1, 0.1, 0.2, 0.2]`, following the original implementation.
-            The coordinate format must be 'centroids'.
-        coords (str, optional): The box coordinate format to be used. Can be either 'centroids' for the format
-            `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax' for the format
-            `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids', following the original implementation.
-        normalize_coords (bool, optional): Set to `True` if the model is supposed to use relative instead of absolute coordinates,
-            i.e. if the model predicts box coordinates within [0,1] instead of absolute coordinates. Defaults to `False`.
-
-    Returns:
-        model: The Keras SSD model.
-        predictor_sizes: A Numpy array containing the `(height, width)` portion
-            of the output tensor shape for each convolutional predictor layer. During
-            training, the generator function needs this in order to transform
-            the ground truth labels into tensors of identical structure as the
-            output tensors of the model, which is in turn needed for the cost
-            function.
-
-    References:
-        https://arxiv.org/abs/1512.02325v5
-    '''
-
-    n_predictor_layers = 6 # The number of predictor conv layers in the network is 6 for the original SSD300
-
-    # Get a few exceptions out of the way first
-    if aspect_ratios_global is None and aspect_ratios_per_layer is None:
-        raise ValueError("`aspect_ratios_global` and `aspect_ratios_per_layer` cannot both be None. At least one needs to be specified.")
-    if aspect_ratios_per_layer:
-        if len(aspect_ratios_per_layer) != n_predictor_layers:
-            raise ValueError("It must be either aspect_ratios_per_layer is None or len(aspect_ratios_per_layer) == {}, but len(aspect_ratios_per_layer) == {}.".format(n_predictor_layers, len(aspect_ratios_per_layer)))
-
-    if (min_scale is None or max_scale is None) and scales is None:
-        raise ValueError("Either `min_scale` and `max_scale` or `scales` need to be specified.")
-    if scales:
-        if len(scales) != n_predictor_layers+1:
-            raise ValueError("It must be either scales is None or len(scales) == {}, but len(scales) == {}.".format(n_predictor_layers+1, len(scales)))
-    else: # If no explicit list of scaling factors was passed, compute the list of scaling factors from `min_scale` and `max_scale`
-        scales = np.linspace(min_scale, max_scale, n_predictor_layers+1)
-
-    if len(variances) != 4:
-        raise ValueError("4 variance values must be pased, but {} values were received.".format(len(variances)))
-    variances = np.array(variances)
-    if np.any(variances <= 0):
-        raise ValueError("All variances must be >0, but the variances given are {}".format(variances))
-
-    # Set the aspect ratios for each predictor layer. These are only needed for the anchor box layers.
-    if aspect_ratios_per_layer:
-        aspect_ratios_conv4_3 = aspect_ratios_per_layer[0]
-        aspect_ratios_fc7 = aspect_ratios_per_layer[1]
-        aspect_ratios_conv6_2 = aspect_ratios_per_layer[2]
-        aspect_ratios_conv7_2 = aspect_ratios_per_layer[3]
-        aspect_ratios_conv8_2 = aspect_ratios_per_layer[4]
-        aspect_ratios_conv9_2 = aspect_ratios_per_layer[5]
-    else:
-        aspect_ratios_conv4_3 = aspect_ratios_global
-        aspect_ratios_fc7 = aspect_ratios_global
-        aspect_ratios_conv6_2 = aspect_ratios_global
-        aspect_ratios_conv7_2 = aspect_ratios_global
-        aspect_ratios_conv8_2 = aspect_ratios_global
-        aspect_ratios_conv9_2 = aspect_ratios_global
-
-    # Compute the number of boxes to be predicted per cell for each predictor layer.
-    # We need this so that we know how many channels the predictor layers need to have.
-    if aspect_ratios_per_layer:
-        n_boxes = []
-        for aspect_ratios in aspect_ratios_per_layer:
-            if (1 in aspect_ratios) & two_boxes_for_ar1:
-                n_boxes.append(len(aspect_ratios) + 1) # +1 for the second box for aspect ratio 1
-            else:
-                n_boxes.append(len(aspect_ratios))
-        n_boxes_conv4_3 = n_boxes[0] # 4 boxes per cell for the original implementation
-        n_boxes_fc7 = n_boxes[1] # 6 boxes per cell for the original implementation
-        n_boxes_conv6_2 = n_boxes[2] # 6 boxes per cell for the original implementation
-        n_boxes_conv7_2 = n_boxes[3] # 6 boxes per cell for the original implementation
-        n_boxes_conv8_2 = n_boxes[4] # 4 boxes per cell for the original implementation
-        n_boxes_conv9_2 = n_boxes[5] # 4 boxes per cell for the original implementation
-    else: # If only a global aspect ratio list was passed, then the number of boxes is the same for each predictor layer
-        if (1 in aspect_ratios_global) & two_boxes_for_ar1:
-            n_boxes = len(aspect_ratios_global) + 1
-        else:
-            n_boxes = len(aspect_ratios_global)
-        n_boxes_conv4_3 = n_boxes
-        n_boxes_fc7 = n_boxes
-        n_boxes_conv6_2 = n_boxes
-        n_boxes_conv7_2 = n_boxes
-        n_boxes_conv8_2 = n_boxes
-        n_boxes_conv9_2 = n_boxes
-
-    # Input image format
-    img_height, img_width, img_channels = image_size[0], image_size[1], image_size[2]
-
-    ### Design the actual network
-
-    x = Input(shape=(img_height, img_width, img_channels))
-    normed = Lambda(lambda z: z/127.5 - 1.0, # Convert input feature range to [-1,1]
-                    output_shape=(img_height, img_width, img_channels),
-                    name='lambda1')(x)
-
-    conv1_1 = Conv2D(64, (3, 3), activation='relu', padding='same', name='conv1_1', weights=get_w(1), trainable=False)(normed)
-    conv1_2 = Conv2D(64, (3, 3), activation='relu', padding='same', name='conv1_2', weights=get_w(2), trainable=False)(conv1_1)
-    pool1 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool1')(conv1_2)
-
-    conv2_1 = Conv2D(128, (3, 3), activation='relu', padding='same', name='conv2_1', trainable=False, weights=get_w(4))(pool1)
-    conv2_2 = Conv2D(128, (3, 3), activation='relu', padding='same', name='conv2_2', trainable=False, weights=get_w(5))(conv2_1)
-    pool2 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool2')(conv2_2)
-
-    conv3_1 = Conv2D(256, (3, 3), activation='relu', padding='same', name='conv3_1', trainable=False, weights=get_w(7))(pool2)
-    conv3_2 = Conv2D(256, (3, 3), activation='relu', padding='same', name='conv3_2', trainable=False, weights=get_w(8))(conv3_1)
-    conv3_3 = Conv2D(256, (3, 3), activation='relu', padding='same', name='conv3_3', trainable=False, weights=get_w(9))(conv3_2)
-    pool3 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool3')(conv3_3)
-
-    conv4_1 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv4_1', weights=get_w(11))(pool3)
-    conv4_2 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv4_2', weights=get_w(12))(conv4_1)
-    conv4_3 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv4_3', weights=get_w(13))(conv4_2)
-    pool4 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool4')(conv4_3)
-
-    conv5_1 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv5_1', weights=get_w(15))(pool4)
-    conv5_2 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv5_2', weights=get_w(16))(conv5_1)
-    conv5_3 = Conv2D(512, (3, 3), activation='relu', padding='same', name='conv5_3', weights=get_w(17))(conv5_2)
-    pool5 = MaxPooling2D(pool_size=(3, 3), strides=(1, 1), padding='same', name='pool5')(conv5_3)
-
-    fc6 = Conv2D(1024, (3, 3), dilation_rate=(6, 6), activation='relu', padding='same', name='fc6')(pool5)
-
-    fc7 = Conv2D(1024, (1, 1), activation='relu', padding='same', name='fc7')(fc6)
-
-    conv6_1 = Conv2D(256, (1, 1), activation='relu', padding='same', name='conv6_1')(fc7)
-    conv6_2 = Conv2D(512, (3, 3), strides=(2, 2), activation='relu', padding='same', name='conv6_2')(conv6_1)
-
-    conv7_1 = Conv2D(128, (1, 1), activation='relu', padding='same', name='conv7_1')(conv6_2)
-    conv7_2 = Conv2D(256, (3, 3), strides=(2, 2), activation='relu', padding='same', name='conv7_2')(conv7_1)
-
-    conv8_1 = Conv2D(128, (1, 1), activation='relu', padding='same', name='conv8_1')(conv7_2)
-    conv8_2 = Conv2D(256, (3, 3), strides=(1, 1), activation='relu', padding='valid', name='conv8_2')(conv8_1)
-
-    conv9_1 = Conv2D(128, (1, 1), activation='relu', padding='same', name='conv9_1')(conv8_2)
-    conv9_2 = Conv2D(256, (3, 3), strides=(1, 1), activation='relu', padding='valid', name='conv9_2')(conv9_1)
-
-    # Feed conv4_3 into the L2 normalization layer
-    conv4_3_norm = L2Normalization(gamma_init=20, name='conv4_3_norm')(conv4_3)
-
-    ### Build the convolutional predictor layers on top of the base network
-
-    # We precidt `n_classes` confidence values for each box, hence the confidence predictors have depth `n_boxes * n_classes`
-    # Output shape of the confidence layers: `(batch, height, width, n_boxes * n_classes)`
-    conv4_3_norm_mbox_conf = Conv2D(n_boxes_conv4_3 * n_classes, (3, 3), padding='same', name='conv4_3_norm_mbox_conf')(conv4_3_norm)
-    fc7_mbox_conf = Conv2D(n_boxes_fc7 * n_classes, (3, 3), padding='same', name='fc7_mbox_conf')(fc7)
-    conv6_2_mbox_conf = Conv2D(n_boxes_conv6_2 * n_classes, (3, 3), padding='same', name='conv6_2_mbox_conf')(conv6_2)
-    conv7_2_mbox_conf = Conv2D(n_boxes_conv7_2 * n_classes, (3, 3), padding='same', name='conv7_2_mbox_conf')(conv7_2)
-    conv8_2_mbox_conf = Conv2D(n_boxes_conv8_2 * n_classes, (3, 3), padding='same', name='conv8_2_mbox_conf')(conv8_2)
-    conv9_2_mbox_conf = Conv2D(n_boxes_conv9_2 * n_classes, (3, 3), padding='same', name='conv9_2_mbox_conf')(conv9_2)
-    # We predict 4 box coordinates for each box, hence the localization predictors have depth `n_boxes * 4`
-    # Output shape of the localization layers: `(batch, height, width, n_boxes * 4)`
-    conv4_3_norm_mbox_loc = Conv2D(n_boxes_conv4_3 * 4, (3, 3), padding='same', name='conv4_3_norm_mbox_loc')(conv4_3_norm)
-    fc7_mbox_loc = Conv2D(n_boxes_fc7 * 4, (3, 3), padding='same', name='fc7_mbox_loc')(fc7)
-    conv6_2_mbox_loc = Conv2D(n_boxes_conv6_2 * 4, (3, 3), padding='same', name='conv6_2_mbox_loc')(conv6_2)
-    conv7_2_mbox_loc = Conv2D(n_boxes_conv7_2 * 4, (3, 3), padding='same', name='conv7_2_mbox_loc')(conv7_2)
-    conv8_2_mbox_loc = Conv2D(n_boxes_conv8_2 * 4, (3, 3), padding='same', name='conv8_2_mbox_loc')(conv8_2)
-    conv9_2_mbox_loc = Conv2D(n_boxes_conv9_2 * 4, (3, 3), padding='same', name='conv9_2_mbox_loc')(conv9_2)
-
-    ### Generate the anchor boxes (called "priors" in the original Caffe/C++ implementation, so I'll keep their layer names)
-
-    # Output shape of anchors: `(batch, height, width, n_boxes, 8)`
-    conv4_3_norm_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[0], next_scale=scales[1], aspect_ratios=aspect_ratios_conv4_3,
-                                             two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv4_3_norm_mbox_priorbox')(conv4_3_norm_mbox_loc)
-    fc7_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[1], next_scale=scales[2], aspect_ratios=aspect_ratios_fc7,
-                                    two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='fc7_mbox_priorbox')(fc7_mbox_loc)
-    conv6_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[2], next_scale=scales[3], aspect_ratios=aspect_ratios_conv6_2,
-                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv6_2_mbox_priorbox')(conv6_2_mbox_loc)
-    conv7_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[3], next_scale=scales[4], aspect_ratios=aspect_ratios_conv7_2,
-                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv7_2_mbox_priorbox')(conv7_2_mbox_loc)
-    conv8_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[4], next_scale=scales[5], aspect_ratios=aspect_ratios_conv8_2,
-                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv8_2_mbox_priorbox')(conv8_2_mbox_loc)
-    conv9_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[5], next_scale=scales[6], aspect_ratios=aspect_ratios_conv9_2,
-                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv9_2_mbox_priorbox')(conv9_2_mbox_loc)
-
-    ### Reshape
-
-    # Reshape the class predictions, yielding 3D tensors of shape `(batch, height * width * n_boxes, n_classes)`
-    # We want the classes isolated in the last axis to perform softmax on them
-    conv4_3_norm_mbox_conf_reshape = Reshape((-1, n_classes), name='conv4_3_norm_mbox_conf_reshape')(conv4_3_norm_mbox_conf)
-    fc7_mbox_conf_reshape = Reshape((-1, n_classes), name='fc7_mbox_conf_reshape')(fc7_mbox_conf)
-    conv6_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv6_2_mbox_conf_reshape')(conv6_2_mbox_conf)
-    conv7_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv7_2_mbox_conf_reshape')(conv7_2_mbox_conf)
-    conv8_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv8_2_mbox_conf_reshape')(conv8_2_mbox_conf)
-    conv9_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv9_2_mbox_conf_reshape')(conv9_2_mbox_conf)
-    # Reshape the box predictions, yielding 3D tensors of shape `(batch, height * width * n_boxes, 4)`
-    # We want the four box coordinates isolated in the last axis to compute the smooth L1 loss
-    conv4_3_norm_mbox_loc_reshape = Reshape((-1, 4), name='conv4_3_norm_mbox_loc_reshape')(conv4_3_norm_mbox_loc)
-    fc7_mbox_loc_reshape = Reshape((-1, 4), name='fc7_mbox_loc_reshape')(fc7_mbox_loc)
-    conv6_2_mbox_loc_reshape = Reshape((-1, 4), name='conv6_2_mbox_loc_reshape')(conv6_2_mbox_loc)
-    conv7_2_mbox_loc_reshape = Reshape((-1, 4), name='conv7_2_mbox_loc_reshape')(conv7_2_mbox_loc)
-    conv8_2_mbox_loc_reshape = Reshape((-1, 4), name='conv8_2_mbox_loc_reshape')(conv8_2_mbox_loc)
-    conv9_2_mbox_loc_reshape = Reshape((-1, 4), name='conv9_2_mbox_loc_reshape')(conv9_2_mbox_loc)
-    # Reshape the anchor box tensors, yielding 3D tensors of shape `(batch, height * width * n_boxes, 8)`
-    conv4_3_norm_mbox_priorbox_reshape = Reshape((-1, 8), name='conv4_3_norm_mbox_priorbox_reshape')(conv4_3_norm_mbox_priorbox)
-    fc7_mbox_priorbox_reshape = Reshape((-1, 8), name='fc7_mbox_priorbox_reshape')(fc7_mbox_priorbox)
-    conv6_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv6_2_mbox_priorbox_reshape')(conv6_2_mbox_priorbox)
-    conv7_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv7_2_mbox_priorbox_reshape')(conv7_2_mbox_priorbox)
-    conv8_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv8_2_mbox_priorbox_reshape')(conv8_2_mbox_priorbox)
-    conv9_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv9_2_mbox_priorbox_reshape')(conv9_2_mbox_priorbox)
-
-    ### Concatenate the predictions from the different layers
-
-    # Axis 0 (batch) and axis 2 (n_classes or 4, respectively) are identical for all layer predictions,
-    # so we want to concatenate along axis 1, the number of boxes per layer
-    # Output shape of `mbox_conf`: (batch, n_boxes_total, n_classes)
-    mbox_conf = Concatenate(axis=1, name='mbox_conf')([conv4_3_norm_mbox_conf_reshape,
-                                                       fc7_mbox_conf_reshape,
-                                                       conv6_2_mbox_conf_reshape,
-                                                       conv7_2_mbox_conf_reshape,
-                                                       conv8_2_mbox_conf_reshape,
-                                                       conv9_2_mbox_conf_reshape])
-
-    # Output shape of `mbox_loc`: (batch, n_boxes_total, 4)
-    mbox_loc = Concatenate(axis=1, name='mbox_loc')([conv4_3_norm_mbox_loc_reshape,
-                                                     fc7_mbox_loc_reshape,
-                                                     conv6_2_mbox_loc_reshape,
-                                                     conv7_2_mbox_loc_reshape,
-                                                     conv8_2_mbox_loc_reshape,
-                                                     conv9_2_mbox_loc_reshape])
-
-    # Output shape of `mbox_priorbox`: (batch, n_boxes_total, 8)
-    mbox_priorbox = Concatenate(axis=1, name='mbox_priorbox')([conv4_3_norm_mbox_priorbox_reshape,
-                                                               fc7_mbox_priorbox_reshape,
-                                                               conv6_2_mbox_priorbox_reshape,
-                                                               conv7_2_mbox_priorbox_reshape,
-                                                               conv8_2_mbox_priorbox_reshape,
-                                                               conv9_2_mbox_priorbox_reshape])
-
-    # The box coordinate predictions will go into the loss function just the way they are,
-    # but for the class predictions, we'll apply a softmax activation layer first
-    mbox_conf_softmax = Activation('softmax', name='mbox_conf_softmax')(mbox_conf)
-
-    # Concatenate the class and box predictions and the anchors to one large predictions vector
-    # Output shape of `predictions`: (batch, n_boxes_total, n_classes + 4 + 8)
-    predictions = Concatenate(axis=2, name='predictions')([mbox_conf_softmax, mbox_loc, mbox_priorbox])
-
-    model = Model(inputs=x, outputs=predictions)
-
-    # Get the spatial dimensions (height, width) of the predictor conv layers, we need them to
-    # be able to generate the default boxes for the matching process outside of the model during training.
-    # Note that the original implementation performs anchor box matching inside the loss function. We don't do that.
-    # Instead, we'll do it in the batch generator function.
-    # The spatial dimensions are the same for the confidence and localization predictors, so we just take those of the conf layers.
-    predictor_sizes = np.array([conv4_3_norm_mbox_conf._keras_shape[1:3],
-                                 fc7_mbox_conf._keras_shape[1:3],
-                                 conv6_2_mbox_conf._keras_shape[1:3],
-                                 conv7_2_mbox_conf._keras_shape[1:3],
-                                 conv8_2_mbox_conf._keras_shape[1:3],
-                                 conv9_2_mbox_conf._keras_shape[1:3]])
-
-    return model, predictor_sizes
-
-
-class SSDLoss:
-    '''
-    The SSD loss, see https://arxiv.org/abs/1512.02325.
-    '''
-
-    def __init__(self,
-                 neg_pos_ratio=3,
-                 n_neg_min=0,
-                 alpha=1.0):
-        '''
-        Arguments:
-            neg_pos_ratio (int, optional): The maximum ratio of negative (i.e. background)
-                to positive ground truth boxes to include in the loss computation.
-                There are no actual background ground truth boxes of course, but `y_true`
-                contains anchor boxes labeled with the background class. Since
-                the number of background boxes in `y_true` will usually exceed
-                the number of positive boxes by far, it is necessary to balance
-                their influence on the loss. Defaults to 3 following the paper.
-            n_neg_min (int, optional): The minimum number of negative ground truth boxes to
-                enter the loss computation *per batch*. This argument can be used to make
-                sure that the model learns from a minimum number of negatives in batches
-                in which there are very few, or even none at all, positive ground truth
-                boxes. It defaults to 0 and if used, it should be set to a value that
-                stands in reasonable proportion to the batch size used for training.
-            alpha (float, optional): A factor to weight the localization loss in the
-                computation of the total loss. Defaults to 1.0 following the paper.
-        '''
-        self.neg_pos_ratio = tf.constant(neg_pos_ratio)
-        self.n_neg_min = tf.constant(n_neg_min)
-        self.alpha = tf.constant(alpha)
-
-    def smooth_L1_loss(self, y_true, y_pred):
-        '''
-        Compute smooth L1 loss, see references.
-
-        Arguments:
-            y_true (nD tensor): A TensorFlow tensor of any shape containing the ground truth data.
-                In this context, the expected tensor has shape `(batch_size, #boxes, 4)` and
-                contains the ground truth bounding box coordinates, where the last dimension
-                contains `(xmin, xmax, ymin, ymax)`.
-            y_pred (nD tensor): A TensorFlow tensor of identical structure to `y_true` containing
-                the predicted data, in this context the predicted bounding box coordinates.
-
-        Returns:
-            The smooth L1 loss, a nD-1 Tensorflow tensor. In this context a 2D tensor
-            of shape (batch, n_boxes_total).
-
-        References:
-            https://arxiv.org/abs/1504.08083
-        '''
-        absolute_loss = tf.abs(y_true - y_pred)
-        square_loss = 0.5 * (y_true - y_pred)**2
-        l1_loss = tf.where(tf.less(absolute_loss, 1.0), square_loss, absolute_loss - 0.5)
-        return tf.reduce_sum(l1_loss, axis=-1)
-
-    def log_loss(self, y_true, y_pred):
-        '''
-        Compute the softmax log loss.
-
-        Arguments:
-            y_true (nD tensor): A TensorFlow tensor of any shape containing the ground truth data.
-                In this context, the expected tensor has shape (batch_size, #boxes, #classes)
-                and contains the ground truth bounding box categories.
-            y_pred (nD tensor): A TensorFlow tensor of identical structure to `y_true` containing
-                the predicted data, in this context the predicted bounding box categories.
-
-        Returns:
-            The softmax log loss, a nD-1 Tensorflow tensor. In this context a 2D tensor
-            of shape (batch, n_boxes_total).
-        '''
-        # Make sure that `y_pred` doesn't contain any zeros (which would break the log function)
-        y_pred = tf.maximum(y_pred, 1e-15)
-        # Compute the log loss
-        log_loss = -tf.reduce_sum(y_true * tf.log(y_pred), axis=-1)
-        return log_loss
-
-    def compute_loss(self, y_true, y_pred):
-        '''
-        Compute the loss of the SSD model prediction against the ground truth.
-
-        Arguments:
-            y_true (array): A Numpy array of shape `(batch_size, #boxes, #classes + 8)`,
-                where `#boxes` is the total number of boxes that the model predicts
-                per image. Be careful to make sure that the index of each given
-                box in `y_true` is the same as the index for the corresponding
-                box in `y_pred`. The last axis must have length `#classes + 8` and contain
-                `[classes one-hot encoded, 4 ground truth box coordinates, 4 arbitrary entries]`
-                in this order, including the background class. The last four entries of the
-                last axis are not used by this function and therefore their contents are
-                irrelevant, they only exist so that `y_true` has the same shape as `y_pred`,
-                where the last four entries of the last axis contain the anchor box
-                coordinates, which are needed during inference. Important: Boxes that
-                you want the cost function to ignore need to have a one-hot
-                class vector of all zeros.
-            y_pred (Keras tensor): The model prediction. The shape is identical
-                to that of `y_true`.
-
-        Returns:
-            A scalar, the total multitask loss for classification and localization.
-        '''
-        batch_size = tf.shape(y_pred)[0] # Output dtype: tf.int32
-        n_boxes = tf.shape(y_pred)[1] # Output dtype: tf.int32, note that `n_boxes` in this context denotes the total number of boxes per image, not the number of boxes per cell
-
-        # 1: Compute the losses for class and box predictions for every box
-
-        classification_loss = tf.to_float(self.log_loss(y_true[:,:,:-12], y_pred[:,:,:-12])) # Output shape: (batch_size, n_boxes)
-        localization_loss = tf.to_float(self.smooth_L1_loss(y_true[:,:,-12:-8], y_pred[:,:,-12:-8])) # Output shape: (batch_size, n_boxes)
-
-        # 2: Compute the classification losses for the positive and negative targets
-
-        # Create masks for the positive and negative ground truth classes
-        negatives = y_true[:,:,0] # Tensor of shape (batch_size, n_boxes)
-        positives = tf.to_float(tf.reduce_max(y_true[:,:,1:-12], axis=-1)) # Tensor of shape (batch_size, n_boxes)
-
-        # Count the number of positive boxes (classes 1 to n) in y_true across the whole batch
-        n_positive = tf.reduce_sum(positives)
-
-        # Now mask all negative boxes and sum up the losses for the positive boxes PER batch item
-        # (Keras loss functions must output one scalar loss value PER batch item, rather than just
-        # one scalar for the entire batch, that's why we're not summing across all axes)
-        pos_class_loss = tf.reduce_sum(classification_loss * positives, axis=-1) # Tensor of shape (batch_size,)
-
-        # Compute the classification loss for the negative default boxes (if there are any)
-
-        # First, compute the classification loss for all negative boxes
-        neg_class_loss_all = classification_loss * negatives # Tensor of shape (batch_size, n_boxes)
-        n_neg_losses = tf.count_nonzero(neg_class_loss_all, dtype=tf.int32) # The number of non-zero loss entries in `neg_class_loss_all`
-        # What's the point of `n_neg_losses`? For the next step, which will be to compute which negative boxes enter the classification
-        # loss, we don't just want to know how many negative ground truth boxes there are, but for how many of those there actually is
-        # a positive (i.e. non-zero) loss. This is necessary because `tf.nn.top-k()` in the function below will pick the top k boxes with
-        # the highest losses no matter what, even if it receives a vector where all losses are zero. In the unlikely event that all negative
-        # classification losses ARE actually zero though, this behavior might lead to `tf.nn.top-k()` returning the indices of positive
-        # boxes, leading to an incorrect negative classification loss computation, and hence an incorrect overall loss computation.
-        # We therefore need to make sure that `n_negative_keep`, which assumes the role of the `k` argument in `tf.nn.top-k()`,
-        # is at most the number of negative boxes for which there is a positive classification loss.
-
-        # Compute the number of negative examples we want to account for in the loss
-        # We'll keep at most `self.neg_pos_ratio` times the number of positives in `y_true`, but at least `self.n_neg_min` (unless `n_neg_loses` is smaller)
-        n_negative_keep = tf.minimum(tf.maximum(self.neg_pos_ratio * tf.to_int32(n_positive), self.n_neg_min), n_neg_losses)
-
-        # In the unlikely case when either (1) there are no negative ground truth boxes at all
-        # or (2) the classification loss for all negative boxes is zero, return zero as the `neg_class_loss`
-        def f1():
-            return tf.zeros([batch_size])
-        # Otherwise compute the negative loss
-        def f2():
-            # Now we'll identify the top-k (where k == `n_negative_keep`) boxes with the highest confidence loss that
-            # belong to the background class in the ground truth data. Note that this doesn't necessarily mean that the model
-            # predicted the wrong class for those boxes, it just means that the loss for those boxes is the highest.
-
-            # To do this, we reshape `neg_class_loss_all` to 1D...
-            neg_class_loss_all_1D = tf.reshape(neg_class_loss_all, [-1]) # Tensor of shape (batch_size * n_boxes,)
-            # ...and then we get the indices for the `n_negative_keep` boxes with the highest loss out of those...
-            values, indices = tf.nn.top_k(neg_class_loss_all_1D, n_negative_keep, False) # We don't need sorting
-            # ...and with these indices we'll create a mask...
-            negatives_keep = tf.scatter_nd(tf.expand_dims(indices, axis=1), updates=tf.ones_like(indices, dtype=tf.int32), shape=tf.shape(neg_class_loss_all_1D)) # Tensor of shape (batch_size * n_boxes,)
-            negatives_keep = tf.to_float(tf.reshape(negatives_keep, [batch_size, n_boxes])) # Tensor of shape (batch_size, n_boxes)
-            # ...and use it to keep only those boxes and mask all other classification losses
-            neg_class_loss = tf.reduce_sum(classification_loss * negatives_keep, axis=-1) # Tensor of shape (batch_size,)
-            return neg_class_loss
-
-        neg_class_loss = tf.cond(tf.equal(n_neg_losses, tf.constant(0)), f1, f2)
-
-        class_loss = pos_class_loss + neg_class_loss # Tensor of shape (batch_size,)
-
-        # 3: Compute the localization loss for the positive targets
-        #    We don't penalize localization loss for negative predicted boxes (obviously: there are no ground truth boxes they would correspond to)
-
-        loc_loss = tf.reduce_sum(localization_loss * positives, axis=-1) # Tensor of shape (batch_size,)
-
-        # 4: Compute the total loss
-
-        total_loss = (class_loss + self.alpha * loc_loss) # In case `n_positive == 0`
-
-        return total_loss
-
-
-class L2Normalization(Layer):
-    '''
-    Performs L2 normalization on the input tensor with a learnable scaling parameter
-    as described in the paper "Parsenet: Looking Wider to See Better" (see references)
-    and as used in the original SSD model.
-
-    Arguments:
-        gamma_init (int): The initial scaling parameter. Defaults to 20 following the
-            SSD paper.
-
-    Input shape:
-        4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
-        or `(batch, height, width, channels)` if `dim_ordering = 'tf'`.
-
-    Returns:
-        The scaled tensor. Same shape as the input tensor.
-
-    References:
-        http://cs.unc.edu/~wliu/papers/parsenet.pdf
-    '''
-
-    def __init__(self, gamma_init=20, **kwargs):
-        if K.image_dim_ordering() == 'tf':
-            self.axis = 3
-        else:
-            self.axis = 1
-        self.gamma_init = gamma_init
-        super(L2Normalization, self).__init__(**kwargs)
-
-    def build(self, input_shape):
-        self.input_spec = [InputSpec(shape=input_shape)]
-        gamma = self.gamma_init * np.ones((input_shape[self.axis],))
-        self.gamma = K.variable(gamma, name='{}_gamma'.format(self.name))
-        self.trainable_weights = [self.gamma]
-        super(L2Normalization, self).build(input_shape)
-
-    def call(self, x, mask=None):
-        output = K.l2_normalize(x, self.axis)
-        output *= self.gamma
-        return output
-
-
-class AnchorBoxes(Layer):
-    '''
-    A Keras layer to create an output tensor containing anchor box coordinates based on the
-    input tensor and the passed arguments.
-
-    A set of 2D anchor boxes of different aspect ratios is created for each spatial unit of
-    the input tensor. The number of anchor boxes created per unit depends on the arguments
-    `aspect_ratios` and `two_boxes_for_ar1`, in the default case it is 4. The boxes
-    are parameterized by the coordinate tuple `(xmin, xmax, ymin, ymax)`.
-
-    The logic implemented by this layer is identical to the logic in the module
-    `ssd_box_encode_decode_utils.py`.
-
-    The purpose of having this layer in the network is to make the model self-sufficient
-    at inference time. Since the model is predicting offsets to the anchor boxes
-    (rather than predicting absolute box coordinates directly), one needs to know the anchor
-    box coordinates in order to construct the final prediction boxes from the predicted offsets.
-    If the model's output tensor did not contain the anchor box coordinates, the necessary
-    information to convert the predicted offsets back to absolute coordinates would be missing
-    in the model output. The reason why it is necessary to predict offsets to the anchor boxes
-    rather than to predict absolute box coordinates directly is explained in `README.md`.
-
-    Input shape:
-        4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
-        or `(batch, height, width, channels)` if `dim_ordering = 'tf'`.
-
-    Output shape:
-        5D tensor of shape `(batch, height, width, n_boxes, 4)`.
-    '''
-
-    def __init__(self,
-                 img_height,
-                 img_width,
-                 this_scale,
-                 next_scale,
-                 aspect_ratios=[0.5, 1.0, 2.0],
-                 two_boxes_for_ar1=True,
-                 limit_boxes=True,
-                 variances=[1.0, 1.0, 1.0, 1.0],
-                 coords='centroids',
-                 normalize_coords=False,
-                 **kwargs):
-        '''
-        All arguments need to be set to the same values as in the box encoding process, otherwise the behavior is undefined.
-        Some of these arguments are explained in more detail in the documentation of the `SSDBoxEncoder` class.
-
-        Arguments:
-            img_height (int): The height of the input images.
-            img_width (int): The width of the input images.
-            this_scale (float): A float in [0, 1], the scaling factor for the size of the generated anchor boxes
-                as a fraction of the shorter side of the input image.
-            next_scale (float): A float in [0, 1], the next larger scaling factor. Only relevant if
-                `self.two_boxes_for_ar1 == True`.
-            aspect_ratios (list, optional): The list of aspect ratios for which default boxes are to be
-                generated for this layer. Defaults to [0.5, 1.0, 2.0].
-            two_boxes_for_ar1 (bool, optional): Only relevant if `aspect_ratios` contains 1.
-                If `True`, two default boxes will be generated for aspect ratio 1. The first will be generated
-                using the scaling factor for the respective layer, the second one will be generated using
-                geometric mean of said scaling factor and next bigger scaling factor. Defaults to `True`.
-            limit_boxes (bool, optional): If `True`, limits box coordinates to stay within image boundaries.
-                Defaults to `True`.
-            variances (list, optional): A list of 4 floats >0 with scaling factors (actually it's not factors but divisors
-                to be precise) for the encoded predicted box coordinates. A variance value of 1.0 would apply
-                no scaling at all to the predictions, while values in (0,1) upscale the encoded predictions and values greater
-                than 1.0 downscale the encoded predictions. If you want to reproduce the configuration of the original SSD,
-                set this to `[0.1, 0.1, 0.2, 0.2]`, provided the coordinate format is 'centroids'. Defaults to `[1.0, 1.0, 1.0, 1.0]`.
-            coords (str, optional): The box coordinate format to be used. Can be either 'centroids' for the format
-                `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax' for the format
-                `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
-            normalize_coords (bool, optional): Set to `True` if the model uses relative instead of absolute coordinates,
-                i.e. if the model predicts box coordinates within [0,1] instead of absolute coordinates. Defaults to `False`.
-        '''
-        if K.backend() != 'tensorflow':
-            raise TypeError("This layer only supports TensorFlow at the moment, but you are using the {} backend.".format(K.backend()))
-
-        if (this_scale < 0) or (next_scale < 0) or (this_scale > 1):
-            raise ValueError("`this_scale` must be in [0, 1] and `next_scale` must be >0, but `this_scale` == {}, `next_scale` == {}".format(this_scale, next_scale))
-
-        if len(variances) != 4:
-            raise ValueError("4 variance values must be pased, but {} values were received.".format(len(variances)))
-        variances = np.array(variances)
-        if np.any(variances <= 0):
-            raise ValueError("All variances must be >0, but the variances given are {}".format(variances))
-
-        self.img_height = img_height
-        self.img_width = img_width
-        self.this_scale = this_scale
-        self.next_scale = next_scale
-        self.aspect_ratios = aspect_ratios
-        self.two_boxes_for_ar1 = two_boxes_for_ar1
-        self.limit_boxes = limit_boxes
-        self.variances = variances
-        self.coords = coords
-        self.normalize_coords = normalize_coords
-        # Compute the number of boxes per cell
-        if (1 in aspect_ratios) & two_boxes_for_ar1:
-            self.n_boxes = len(aspect_ratios) + 1
-        else:
-            self.n_boxes = len(aspect_ratios)
-        super(AnchorBoxes, self).__init__(**kwargs)
-
-    def build(self, input_shape):
-        self.input_spec = [InputSpec(shape=input_shape)]
-        super(AnchorBoxes, self).build(input_shape)
-
-    def call(self, x, mask=None):
-        '''
-        Return an anchor box tensor based on the shape of the input tensor.
-
-        The logic implemented here is identical to the logic in the module `ssd_box_encode_decode_utils.py`.
-
-        Note that this tensor does not participate in any graph computations at runtime. It is being created
-        as a constant once during graph creation and is just being output along with the rest of the model output
-        during runtime. Because of this, all logic is implemented as Numpy array operations and it is sufficient
-        to convert the resulting Numpy array into a Keras tensor at the very end before outputting it.
-
-        Arguments:
-            x (tensor): 4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
-                or `(batch, height, width, channels)` if `dim_ordering = 'tf'`. The input for this
-                layer must be the output of the localization predictor layer.
-        '''
-
-        # Compute box width and height for each aspect ratio
-        # The shorter side of the image will be used to compute `w` and `h` using `scale` and `aspect_ratios`.
-        self.aspect_ratios = np.sort(self.aspect_ratios)
-        size = min(self.img_height, self.img_width)
-        # Compute the box widths and and heights for all aspect ratios
-        wh_list = []
-        for ar in self.aspect_ratios:
-            if (ar == 1) & self.two_boxes_for_ar1:
-                # Compute the regular default box for aspect ratio 1 and...
-                w = self.this_scale * size * np.sqrt(ar)
-                h = self.this_scale * size / np.sqrt(ar)
-                wh_list.append((w,h))
-                # ...also compute one slightly larger version using the geometric mean of this scale value and the next
-                w = np.sqrt(self.this_scale * self.next_scale) * size * np.sqrt(ar)
-                h = np.sqrt(self.this_scale * self.next_scale) * size / np.sqrt(ar)
-                wh_list.append((w,h))
-            else:
-                w = self.this_scale * size * np.sqrt(ar)
-                h = self.this_scale * size / np.sqrt(ar)
-                wh_list.append((w,h))
-        wh_list = np.array(wh_list)
-
-        # We need the shape of the input tensor
-        if K.image_dim_ordering() == 'tf':
-            batch_size, feature_map_height, feature_map_width, feature_map_channels = x._keras_shape
-        else: # Not yet relevant since TensorFlow is the only supported backend right now, but it can't harm to have this in here for the future
-            batch_size, feature_map_channels, feature_map_height, feature_map_width = x._keras_shape
-
-        # Compute the grid of box center points. They are identical for all aspect ratios
-        cell_height = self.img_height / feature_map_height
-        cell_width = self.img_width / feature_map_width
-        cx = np.linspace(cell_width/2, self.img_width-cell_width/2, feature_map_width)
-        cy = np.linspace(cell_height/2, self.img_height-cell_height/2, feature_map_height)
-        cx_grid, cy_grid = np.meshgrid(cx, cy)
-        cx_grid = np.expand_dims(cx_grid, -1) # This is necessary for np.tile() to do what we want further down
-        cy_grid = np.expand_dims(cy_grid, -1) # This is necessary for np.tile() to do what we want further down
-
-        # Create a 4D tensor template of shape `(feature_map_height, feature_map_width, n_boxes, 4)`
-        # where the last dimension will contain `(cx, cy, w, h)`
-        boxes_tensor = np.zeros((feature_map_height, feature_map_width, self.n_boxes, 4))
-
-        boxes_tensor[:, :, :, 0] = np.tile(cx_grid, (1, 1, self.n_boxes)) # Set cx
-        boxes_tensor[:, :, :, 1] = np.tile(cy_grid, (1, 1, self.n_boxes)) # Set cy
-        boxes_tensor[:, :, :, 2] = wh_list[:, 0] # Set w
-        boxes_tensor[:, :, :, 3] = wh_list[:, 1] # Set h
-
-        # Convert `(cx, cy, w, h)` to `(xmin, xmax, ymin, ymax)`
-        boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='centroids2minmax')
-
-        # If `limit_boxes` is enabled, clip the coordinates to lie within the image boundaries
-        if self.limit_boxes:
-            x_coords = boxes_tensor[:,:,:,[0, 1]]
-            x_coords[x_coords >= self.img_width] = self.img_width - 1
-            x_coords[x_coords < 0] = 0
-            boxes_tensor[:,:,:,[0, 1]] = x_coords
-            y_coords = boxes_tensor[:,:,:,[2, 3]]
-            y_coords[y_coords >= self.img_height] = self.img_height - 1
-            y_coords[y_coords < 0] = 0
-            boxes_tensor[:,:,:,[2, 3]] = y_coords
-
-        # `normalize_coords` is enabled, normalize the coordinates to be within [0,1]
-        if self.normalize_coords:
-            boxes_tensor[:, :, :, :2] /= self.img_width
-            boxes_tensor[:, :, :, 2:] /= self.img_height
-
-        if self.coords == 'centroids':
-            # TODO: Implement box limiting directly for `(cx, cy, w, h)` so that we don't have to unnecessarily convert back and forth
-            # Convert `(xmin, xmax, ymin, ymax)` back to `(cx, cy, w, h)`
-            boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='minmax2centroids')
-
-        # 4: Create a tensor to contain the variances and append it to `boxes_tensor`. This tensor has the same shape
-        #    as `boxes_tensor` and simply contains the same 4 variance values for every position in the last axis.
-        variances_tensor = np.zeros_like(boxes_tensor) # Has shape `(feature_map_height, feature_map_width, n_boxes, 4)`
-        variances_tensor += self.variances # Long live broadcasting
-        # Now `boxes_tensor` becomes a tensor of shape `(feature_map_height, feature_map_width, n_boxes, 8)`
-        boxes_tensor = np.concatenate((boxes_tensor, variances_tensor), axis=-1)
-
-        # Now prepend one dimension to `boxes_tensor` to account for the batch size and tile it along
-        # The result will be a 5D tensor of shape `(batch_size, feature_map_height, feature_map_width, n_boxes, 8)`
-        boxes_tensor = np.expand_dims(boxes_tensor, axis=0)
-        boxes_tensor = K.tile(K.constant(boxes_tensor, dtype='float32'), (K.shape(x)[0], 1, 1, 1, 1))
-
-        return boxes_tensor
-
-    def compute_output_shape(self, input_shape):
-        if K.image_dim_ordering() == 'tf':
-            batch_size, feature_map_height, feature_map_width, feature_map_channels = input_shape
-        else: # Not yet relevant since TensorFlow is the only supported backend right now, but it can't harm to have this in here for the future
-            batch_size, feature_map_channels, feature_map_height, feature_map_width = input_shape
-        return (batch_size, feature_map_height, feature_map_width, self.n_boxes, 8)
-
-
-def console():
-    parser = ArgumentParser()
-    parser.add_argument('--model')
-    parser.add_argument('--name', default='ssd')
-    parser.add_argument('--scale', type=float)
-    parser.add_argument('--classes', type=lambda ss: [int(s) for s in ss.split(',')])
-    parser.add_argument('--min_scale', type=float)
-    parser.add_argument('--max_scale', type=float)
-    parser.add_argument('--epochs', type=int, default=1000)
-    parser.add_argument('--rgb_to_gray', type=bool, default=False)
-    parser.add_argument('--gray_to_rgb', type=bool, default=False)
-    parser.add_argument('--multispectral_to_rgb', type=bool, default=False)
-    parser.add_argument('--batch_size', type=int, default=4)
-    parser.add_argument('--outcsv', default='ssd_results.csv')
-    parser.add_argument('--split_ratio', type=float, default=1.0)
-    parser.add_argument('--gpus', default='0,1,2,3')
-    parser.add_argument('csv', default='/osn/share/rail.csv')
-    args = parser.parse_args()
-
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
-
-    def append_to_aspect_ratio_list(aspect_ratios = None,
-                              max_aspect_ratio = None):
-
-        ratios = list(1 / np.linspace(1.0, max_aspect_ratio, 6))
-        ratios.reverse()
-        ratios += list(np.linspace(1.0, max_aspect_ratio, 6))[1:]
-
-        aspect_ratios.append(ratios)
-
-    print(args.min_scale, args.max_scale)
-    img_height = 300  # Height of the input images
-    img_width = 300  # Width of the input images
-    img_channels = 3  # Number of color channels of the input images
-    n_classes = len(args.classes)+1 if args.classes else 2
-    # Number of classes including the background class, e.g. 21 for the Pascal VOC datasets
-    #scales = [0.01, 0.04, 0.07, 0.1, 0.13, 0.17, 0.5 ] #[args.scale] * 7 if args.scale else None
-    scales = [args.scale] * 7 if args.scale else None
-    aspect_ratios = [[1.0]] * 6
-    #aspect_ratios = [] #[[1.0]] * 6
-    #append_to_aspect_ratio_list(aspect_ratios, 15.0)
-    #append_to_aspect_ratio_list(aspect_ratios, 12.0)
-    #append_to_aspect_ratio_list(aspect_ratios, 10.0)
-    #append_to_aspect_ratio_list(aspect_ratios, 6.0)
-    #append_to_aspect_ratio_list(aspect_ratios, 4.5)
-    #append_to_aspect_ratio_list(aspect_ratios, 4.0)
-    two_boxes_for_ar1 = True
-    limit_boxes = False
-    variances = [0.1, 0.1, 0.2, 0.2]
-    coords = 'minmax'
-    normalize_coords = False
-
-    K.clear_session()
-    model, predictor_sizes = SSD(image_size=(img_height, img_width, img_channels),
-                                     n_classes=n_classes,
-                                     min_scale=args.min_scale,
-                                     max_scale=args.max_scale,
-                                     scales=scales,
-                                     aspect_ratios_global=None,
-                                     aspect_ratios_per_layer=aspect_ratios,
-                                     two_boxes_for_ar1=two_boxes_for_ar1,
-                                     limit_boxes=limit_boxes,
-                                     variances=variances,
-                                     coords=coords,
-                                     normalize_coords=normalize_coords)
-    if args.model:
-        model.load_weights(args.model, by_name=True)
-
-
-    model.compile(optimizer=(Adam(lr=0.01, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=5e-05)),
-                  loss=SSDLoss(neg_pos_ratio=3, n_neg_min=0, alpha=0.1).compute_loss)
-
-
-    ssd_box_encoder = SSDBoxEncoder(img_height=img_height,
-                                    img_width=img_width,
-                                    n_classes=n_classes,
-                                    predictor_sizes=predictor_sizes,
-                                    min_scale=args.min_scale,
-                                    max_scale=args.max_scale,
-                                    scales=scales,
-                                    aspect_ratios_global=None,
-                                    aspect_ratios_per_layer=aspect_ratios,
-                                    two_boxes_for_ar1=two_boxes_for_ar1,
-                                    limit_boxes=limit_boxes,
-                                    variances=variances,
-                                    pos_iou_threshold=0.4,
-                                    neg_iou_threshold=0.2,
-                                    coords=coords,
-                                    normalize_coords=normalize_coords)
-
-
-    dataset_generator = BatchGenerator(include_classes=args.classes)
-
-    if not os.path.exists(args.name):
-        os.mkdir(args.name)
-
-    dataset_generator.parse_csv(labels_path=args.csv,
-                                input_format=['image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id'],
-                                split_ratio=args.split_ratio,
-                                checkpoints_path=args.name)
-
-    train_generator = dataset_generator.generate(batch_size=args.batch_size,
-                                             train=True,
-                                             ssd_box_encoder=ssd_box_encoder,
-                                             limit_boxes=True,  # While the anchor boxes are not being clipped,
-                                             include_thresh=0.4,
-                                             diagnostics=False,
-                                             rgb_to_gray=args.rgb_to_gray,
-                                             gray_to_rgb=args.gray_to_rgb,
-                                             multispectral_to_rgb=args.multispectral_to_rgb)
-
-    val_generator = dataset_generator.generate(batch_size=args.batch_size,
-                                         train=True,
-                                         ssd_box_encoder=ssd_box_encoder,
-                                         equalize=False,
-                                         brightness=False,
-                                         flip=False,
-                                         translate=False,
-                                         scale=False,
-                                         crop=False,
-                                         resize=False,
-                                         limit_boxes=True,
-                                         include_thresh=0.4,
-                                         diagnostics=False,
-                                         val=True,
-                                         rgb_to_gray=args.rgb_to_gray,
-                                         gray_to_rgb=args.gray_to_rgb,
-                                         multispectral_to_rgb=args.multispectral_to_rgb)
-
-    def lr_schedule(epoch):
-        if epoch <= 500:
-            #return 0.01
-            return 0.0001
-        else:
-            return 0.00001
-
-    history = model.fit_generator(generator=train_generator,
-                                  steps_per_epoch=ceil(dataset_generator.count / args.batch_size),
-                                  epochs=args.epochs,
-                                  callbacks=[ModelCheckpoint('./' + args.name + '/epoch{epoch:04d}_loss{loss:.4f}.h5',
-                                                             monitor='val_loss',
-                                                             verbose=1,
-                                                             save_best_only=False,
-                                                             save_weights_only=False,
-                                                             mode='auto',
-                                                             period=1),
-                                             LearningRateScheduler(lr_schedule),
-                                             ],
-                                  validation_data=val_generator,
-                                  validation_steps=ceil(dataset_generator.count / args.batch_size))
-
-    model.save('./' + args.name + '/{}.h5'.format(args.name))
-    model.save_weights('./' + args.name + '/{}_weights.h5'.format(args.name))
-
-    print("Model and weights saved as {}[_weights].h5".format(args.name))
-
-    predict_generator = dataset_generator.generate(batch_size=1,
-                                             train=False,
-                                             equalize=False,
-                                             brightness=False,
-                                             flip=False,
-                                             translate=False,
-                                             scale=False,
-                                             crop=False,
-                                             resize=False,
-                                             limit_boxes=True,
-                                             include_thresh=0.4,
-                                             diagnostics=False,
-                                             val=True,
-                                             rgb_to_gray=False,
-                                             gray_to_rgb=False,
-                                             multipectral_to_rgb=True)
-
-
-    val_dir = '/osn/SpaceNet-MOD/testing/rgb-ps-dra/300/'
-
-    results = []
-    for r, d, filenames in os.walk(val_dir):
-        for filename in filenames:
-            if filename.endswith('png'):
-                with rasterio.open(os.path.join(r, filename)) as f:
-                    x = f.read().transpose([1, 2, 0])[np.newaxis, :]
-                    p = model.predict(x)
-                    try:
-                        y = decode_y(p,
-                                     confidence_thresh=0.15,
-                                     iou_threshold=0.35,
-                                     top_k=200,
-                                     input_coords='minmax',
-                                     normalize_coords=normalize_coords,
-                                     img_height=img_height,
-                                     img_width=img_width)
-                        for row in y[0]:
-                            results.append([filename] + row.tolist())
-                    except ValueError as e:
-                        pass
-    df = pandas.DataFrame(results, columns=['file_name', 'class_id', 'conf', 'xmin', 'xmax', 'ymin', 'ymax'])
-    df['class_id'] = df['class_id'].apply(lambda xx: dataset_generator.class_map_inv[xx])
-    df.to_csv('./' + args.name + '/' + args.outcsv)
-
-
-if __name__ == '__main__':
-    console()
\ No newline at end of file
+"""
+A Keras implementation of the Single-Shot MultiBox Detector.
+
+The package is split into modules by their dependencies, so that each use only pays for the imports it needs:
+* `singleshot.boxes`: The box geometry, non-maximum suppression and decoding, only depends on Numpy
+* `singleshot.anchors`: The anchor box generator, only depends on Numpy
+* `singleshot.inference`: Batched and sliding window prediction and writing detections, adds pandas and rasterio
+* `singleshot.util`: The batch generator, the label parsers and the box encoder for training, adds OpenCV, pandas and rasterio
+* `singleshot.sequence`: The `keras.utils.Sequence` of training batches, adds Keras
+* `singleshot.model`: The SSD model, its loss and the command line tools, adds TensorFlow
+
+All their public names are also available from `singleshot` itself, e.g. `singleshot.SSD`, but a module is only
+imported when one of its names is first accessed, so `import singleshot` alone imports nothing heavy.
+"""
+
+import importlib
+
+
+# The module that each name exported by the package is imported from on first access
+_exports = {
+    'iou': 'singleshot.boxes',
+    'iou_matrix': 'singleshot.boxes',
+    'convert_coordinates': 'singleshot.boxes',
+    'convert_coordinates2': 'singleshot.boxes',
+    'greedy_nms': 'singleshot.boxes',
+    'decode_y': 'singleshot.boxes',
+    'decode_y2': 'singleshot.boxes',
+    'anchor_boxes': 'singleshot.anchors',
+    'n_boxes_per_cell': 'singleshot.anchors',
+    'expand_inputs': 'singleshot.inference',
+    'find_images': 'singleshot.inference',
+    'predict_files': 'singleshot.inference',
+    'predict_batch': 'singleshot.inference',
+    'predict_scene': 'singleshot.inference',
+    'write_detections': 'singleshot.inference',
+    'split_shard': 'singleshot.util',
+    'BatchGenerator': 'singleshot.util',
+    'BatchSequence': 'singleshot.sequence',
+    'SSDBoxEncoder': 'singleshot.util',
+    'SSD': 'singleshot.model',
+    'lean_output_model': 'singleshot.model',
+    'detection_model': 'singleshot.model',
+    'SSDLoss': 'singleshot.model',
+    'L2Normalization': 'singleshot.model',
+    'AnchorBoxes': 'singleshot.model',
+    'DecodeDetections': 'singleshot.model',
+    'MixedPrecisionConv2D': 'singleshot.model',
+    'Cast': 'singleshot.model',
+    'LossScaledAdam': 'singleshot.model',
+    'TemplateCheckpoint': 'singleshot.model',
+    'w_roots': 'singleshot.model',
+    'VGG_LAYERS': 'singleshot.model',
+    'load_vgg_weights': 'singleshot.model',
+    'save_vgg_weights': 'singleshot.model',
+    'get_w': 'singleshot.model',
+    'console': 'singleshot.model',
+    'predict_console': 'singleshot.model',
+}
+
+
+# The submodules, which are imported on first access as well
+_submodules = ('anchors', 'benchmark', 'boxes', 'inference', 'model', 'sequence', 'transforms', 'util')
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('singleshot.' + name)
+    if name not in _exports:
+        raise AttributeError("module 'singleshot' has no attribute '{}'".format(name))
+    value = getattr(importlib.import_module(_exports[name]), name)
+    globals()[name] = value # Later accesses don't go through `__getattr__()` anymore
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | set(_submodules))
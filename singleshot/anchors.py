@@ -0,0 +1,159 @@
+"""
+Includes:
+* The anchor box generator shared by the `AnchorBoxes` layers of the SSD model and by `SSDBoxEncoder`, so that
+  the anchor boxes in the model output and in the encoded labels are computed by the same code and always match
+"""
+
+import numpy as np
+
+
+# The anchor boxes computed by `anchor_boxes()`, keyed on its arguments
+_anchor_boxes_cache = {}
+
+
+def n_boxes_per_cell(aspect_ratios, two_boxes_for_ar1=True):
+    '''
+    Returns:
+        The number of anchor boxes per cell of a predictor layer with the given aspect ratios.
+    '''
+    if (1 in aspect_ratios) & two_boxes_for_ar1:
+        return len(aspect_ratios) + 1 # +1 for the second box for aspect ratio 1
+    return len(aspect_ratios)
+
+
+def anchor_sizes(img_height, img_width, aspect_ratios, this_scale, next_scale, two_boxes_for_ar1=True):
+    '''
+    Compute the widths and heights of the anchor boxes of one cell of a predictor layer.
+
+    Arguments:
+        See `anchor_boxes()`.
+
+    Returns:
+        A Numpy array of shape `(n_boxes, 2)` with `(w, h)` for each anchor box of a cell, in the order of the sorted
+        aspect ratios.
+    '''
+    # The shorter side of the image will be used to compute `w` and `h` using `scale` and `aspect_ratios`.
+    size = min(img_height, img_width)
+    wh_list = []
+    for ar in np.sort(aspect_ratios):
+        if (ar == 1) & two_boxes_for_ar1:
+            # Compute the regular anchor box for aspect ratio 1 and...
+            w = this_scale * size * np.sqrt(ar)
+            h = this_scale * size / np.sqrt(ar)
+            wh_list.append((w,h))
+            # ...also compute one slightly larger version using the geometric mean of this scale value and the next
+            w = np.sqrt(this_scale * next_scale) * size * np.sqrt(ar)
+            h = np.sqrt(this_scale * next_scale) * size / np.sqrt(ar)
+            wh_list.append((w,h))
+        else:
+            w = this_scale * size * np.sqrt(ar)
+            h = this_scale * size / np.sqrt(ar)
+            wh_list.append((w,h))
+    return np.array(wh_list)
+
+
+def anchor_boxes(img_height,
+                 img_width,
+                 feature_map_size,
+                 aspect_ratios,
+                 this_scale,
+                 next_scale,
+                 two_boxes_for_ar1=True,
+                 limit_boxes=True,
+                 variances=(1.0, 1.0, 1.0, 1.0),
+                 coords='centroids',
+                 normalize_coords=False):
+    '''
+    Compute the anchor boxes of one predictor layer of size `feature_map_size == [feature_map_height, feature_map_width]`.
+
+    The anchor boxes only depend on the arguments, so they are computed once per process for any given arguments
+    and the same read-only array is returned for every further call.
+
+    Arguments:
+        img_height (int): The height of the input images.
+        img_width (int): The width of the input images.
+        feature_map_size (tuple): A list or tuple `[feature_map_height, feature_map_width]` with the spatial
+            dimensions of the feature map for which to generate the anchor boxes.
+        aspect_ratios (list): A list of floats, the aspect ratios for which anchor boxes are to be generated.
+            All list elements must be unique.
+        this_scale (float): A float in [0, 1], the scaling factor for the size of the generate anchor boxes
+            as a fraction of the shorter side of the input image.
+        next_scale (float): A float in [0, 1], the next larger scaling factor. Only relevant if
+            `two_boxes_for_ar1 == True`.
+        two_boxes_for_ar1 (bool, optional): If `True` and `aspect_ratios` contains 1, two anchor boxes are generated
+            for aspect ratio 1, the second one using the geometric mean of `this_scale` and `next_scale`. Defaults to `True`.
+        limit_boxes (bool, optional): If `True`, limits box coordinates to stay within image boundaries.
+            Defaults to `True`.
+        variances (list, optional): The 4 variances that are appended to the coordinates of each anchor box.
+            Defaults to `(1.0, 1.0, 1.0, 1.0)`.
+        coords (str, optional): The box coordinate format, either 'centroids' for `(cx, cy, w, h)` or 'minmax'
+            for `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+        normalize_coords (bool, optional): If `True`, the coordinates are relative to the image size, i.e. within [0,1],
+            instead of absolute. Defaults to `False`.
+
+    Returns:
+        A read-only float64 Numpy array of shape `(feature_map_height, feature_map_width, n_boxes, 8)` where the last
+        axis contains the 4 anchor box coordinates in the format given by `coords` followed by the 4 variances.
+    '''
+    key = (int(img_height),
+           int(img_width),
+           tuple(int(size) for size in feature_map_size),
+           tuple(float(ar) for ar in aspect_ratios),
+           float(this_scale),
+           float(next_scale),
+           bool(two_boxes_for_ar1),
+           bool(limit_boxes),
+           tuple(float(variance) for variance in variances),
+           coords,
+           bool(normalize_coords))
+    if key in _anchor_boxes_cache:
+        return _anchor_boxes_cache[key]
+
+    wh_list = anchor_sizes(img_height, img_width, aspect_ratios, this_scale, next_scale, two_boxes_for_ar1)
+    n_boxes = len(wh_list)
+
+    # Compute the grid of box center points. They are identical for all aspect ratios
+    feature_map_height, feature_map_width = int(feature_map_size[0]), int(feature_map_size[1])
+    cell_height = img_height / feature_map_height
+    cell_width = img_width / feature_map_width
+    cx = np.linspace(cell_width/2, img_width-cell_width/2, feature_map_width)
+    cy = np.linspace(cell_height/2, img_height-cell_height/2, feature_map_height)
+    cx_grid, cy_grid = np.meshgrid(cx, cy)
+
+    # Create a 4D tensor of shape `(feature_map_height, feature_map_width, n_boxes, 8)` where the last
+    # dimension will contain `(xmin, xmax, ymin, ymax)` followed by the variances
+    boxes_tensor = np.zeros((feature_map_height, feature_map_width, n_boxes, 8))
+    boxes_tensor[:, :, :, 0] = cx_grid[:, :, None] - wh_list[:, 0] / 2.0 # Set xmin
+    boxes_tensor[:, :, :, 1] = cx_grid[:, :, None] + wh_list[:, 0] / 2.0 # Set xmax
+    boxes_tensor[:, :, :, 2] = cy_grid[:, :, None] - wh_list[:, 1] / 2.0 # Set ymin
+    boxes_tensor[:, :, :, 3] = cy_grid[:, :, None] + wh_list[:, 1] / 2.0 # Set ymax
+
+    # If `limit_boxes` is enabled, clip the coordinates to lie within the image boundaries
+    if limit_boxes:
+        x_coords = boxes_tensor[:,:,:,[0, 1]]
+        x_coords[x_coords >= img_width] = img_width - 1
+        x_coords[x_coords < 0] = 0
+        boxes_tensor[:,:,:,[0, 1]] = x_coords
+        y_coords = boxes_tensor[:,:,:,[2, 3]]
+        y_coords[y_coords >= img_height] = img_height - 1
+        y_coords[y_coords < 0] = 0
+        boxes_tensor[:,:,:,[2, 3]] = y_coords
+
+    # `normalize_coords` is enabled, normalize the coordinates to be within [0,1]
+    if normalize_coords:
+        boxes_tensor[:, :, :, :2] /= img_width
+        boxes_tensor[:, :, :, 2:4] /= img_height
+
+    if coords == 'centroids':
+        # Convert `(xmin, xmax, ymin, ymax)` back to `(cx, cy, w, h)`. Limiting happens in the minmax format.
+        minmax = boxes_tensor[:, :, :, :4].copy()
+        boxes_tensor[:, :, :, 0] = (minmax[..., 0] + minmax[..., 1]) / 2.0 # Set cx
+        boxes_tensor[:, :, :, 1] = (minmax[..., 2] + minmax[..., 3]) / 2.0 # Set cy
+        boxes_tensor[:, :, :, 2] = minmax[..., 1] - minmax[..., 0] # Set w
+        boxes_tensor[:, :, :, 3] = minmax[..., 3] - minmax[..., 2] # Set h
+
+    boxes_tensor[:, :, :, 4:] = variances # Long live broadcasting
+
+    boxes_tensor.flags.writeable = False
+    _anchor_boxes_cache[key] = boxes_tensor
+    return boxes_tensor
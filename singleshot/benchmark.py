@@ -0,0 +1,560 @@
+"""
+Includes:
+* An import time benchmark that measures the cost of importing parts of the package in fresh interpreters
+* A benchmark of the hot paths of training and inference, i.e. `BatchGenerator.generate()`, `SSDBoxEncoder.encode_y()`,
+  `iou()`, `iou_matrix()`, `decode_y()`, `decode_y2()` and `greedy_nms()`, on synthetic rasters and boxes
+* A comparison of two saved benchmark results
+
+Run them with `benchssd imports`, `benchssd pipeline` and `benchssd compare`. The results are printed and optionally
+saved as JSON, so that they can be compared across commits.
+"""
+
+import datetime
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+# The imports measured by `import_times()` by default, from the lightest to the heaviest
+IMPORT_STATEMENTS = ['import singleshot',
+                     'from singleshot.boxes import iou, convert_coordinates, greedy_nms, decode_y',
+                     'from singleshot import decode_y',
+                     'from singleshot.anchors import anchor_boxes',
+                     'from singleshot.inference import predict_files',
+                     'from singleshot.util import BatchGenerator, SSDBoxEncoder',
+                     'from singleshot.sequence import BatchSequence',
+                     'from singleshot import SSD']
+
+# The third party modules that are reported if an import pulled them in
+HEAVY_MODULES = ['tensorflow', 'keras', 'cv2', 'sklearn', 'pandas', 'rasterio', 'PIL', 'lxml']
+
+# The script that runs one import in a fresh interpreter and prints its duration and the heavy modules it loaded
+_IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': [name for name in {heavy_modules!r} if name in sys.modules]}}))
+'''
+
+
+def import_time(statement, repeat=5):
+    '''
+    Measure how long an import statement takes in a fresh interpreter, i.e. with nothing imported yet.
+
+    Arguments:
+        statement (str): The import statement, e.g. `'from singleshot.boxes import decode_y'`.
+        repeat (int, optional): The number of fresh interpreters to time the statement in. Defaults to 5.
+
+    Returns:
+        A dictionary with the median and the minimum duration in seconds and the list of the `HEAVY_MODULES` that the
+        statement imported, or with the error message if the statement failed.
+    '''
+    script = _IMPORT_SCRIPT.format(statement=statement, heavy_modules=HEAVY_MODULES)
+    seconds = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'exit code {}'.format(process.returncode)}
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        seconds.append(result['seconds'])
+    return {'median_s': float(np.median(seconds)), 'min_s': float(np.min(seconds)), 'modules': result['modules']}
+
+
+def import_times(statements=None, repeat=5):
+    '''
+    Run `import_time()` for several import statements.
+
+    Arguments:
+        statements (list, optional): The import statements. Defaults to `None`, i.e. `IMPORT_STATEMENTS`.
+        repeat (int, optional): See `import_time()`. Defaults to 5.
+
+    Returns:
+        A dictionary that maps each statement to its result from `import_time()`.
+    '''
+    return {statement: import_time(statement, repeat=repeat) for statement in (statements or IMPORT_STATEMENTS)}
+
+
+# The stages measured by `run_pipeline()`, in the order of the data flow
+STAGES = ['generate', 'encode', 'iou', 'iou_matrix', 'decode', 'decode2', 'nms']
+
+
+def predictor_sizes(img_height, img_width):
+    '''
+    Compute the spatial sizes of the six predictor layers of `SSD()` for input images of the given size, i.e. what
+    `SSD()` returns as `predictor_sizes`, without building the model.
+
+    Returns:
+        A list of six tuples `(height, width)`.
+    '''
+    height, width = img_height // 8, img_width // 8 # conv4_3, after three 2x2 'valid' poolings
+    sizes = [(height, width)]
+    height, width = height // 2, width // 2 # fc7, after the fourth pooling
+    sizes.append((height, width))
+    for _ in range(2): # conv6_2 and conv7_2, 'same' convolutions with stride 2
+        height, width = -(-height // 2), -(-width // 2)
+        sizes.append((height, width))
+    for _ in range(2): # conv8_2 and conv9_2, 3x3 'valid' convolutions
+        height, width = height - 2, width - 2
+        sizes.append((height, width))
+    if height < 1 or width < 1:
+        raise ValueError("Images of size {}x{} are too small for the six predictor layers of `SSD()`.".format(img_height, img_width))
+    return sizes
+
+
+def synthetic_labels(n_images, img_height, img_width, boxes_per_image=10, n_classes=5, rng=None):
+    '''
+    Draw random ground truth boxes.
+
+    Arguments:
+        n_images (int): The number of images.
+        img_height (int): The height of the images.
+        img_width (int): The width of the images.
+        boxes_per_image (float, optional): The mean number of boxes per image. The number of boxes of each image is
+            Poisson distributed, but at least 1. Defaults to 10.
+        n_classes (int, optional): The number of positive classes. The class IDs are 1 to `n_classes`. Defaults to 5.
+        rng (RandomState, optional): The random number generator. Defaults to `None`, i.e. `np.random`.
+
+    Returns:
+        A list with one Numpy array of shape `(k, 5)` per image, each row a box `[class_id, xmin, xmax, ymin, ymax]`
+        with integer pixel coordinates between 8 and a quarter of the shorter image side in size.
+    '''
+    rng = np.random if rng is None else rng
+    max_size = max(9, min(img_height, img_width) // 4)
+    labels = []
+    for _ in range(n_images):
+        k = max(1, rng.poisson(boxes_per_image))
+        w = rng.randint(8, max_size, k)
+        h = rng.randint(8, max_size, k)
+        xmin = rng.randint(0, img_width - w)
+        ymin = rng.randint(0, img_height - h)
+        labels.append(np.stack([rng.randint(1, n_classes + 1, k), xmin, xmin + w, ymin, ymin + h], axis=1).astype(np.float64))
+    return labels
+
+
+def write_synthetic_dataset(directory, labels, img_height, img_width, channels=3, rng=None):
+    '''
+    Write one random uint8 GeoTIFF per image and a labels CSV file in the format that `trainssd` reads.
+
+    Arguments:
+        directory (str): The directory to write to. It must exist.
+        labels (list): The boxes of the images as returned by `synthetic_labels()`.
+        img_height (int): The height of the images.
+        img_width (int): The width of the images.
+        channels (int, optional): The number of bands of the images. Defaults to 3.
+        rng (RandomState, optional): The random number generator. Defaults to `None`, i.e. `np.random`.
+
+    Returns:
+        The path of the labels CSV file, with the columns `image_name, xmin, xmax, ymin, ymax, class_id`.
+    '''
+    import rasterio
+
+    rng = np.random if rng is None else rng
+    labels_path = os.path.join(directory, 'labels.csv')
+    with open(labels_path, 'w') as f:
+        f.write('image_name,xmin,xmax,ymin,ymax,class_id\n')
+        for i, boxes in enumerate(labels):
+            filename = os.path.join(directory, 'image_{:05d}.tif'.format(i))
+            with rasterio.open(filename, 'w', driver='GTiff', height=img_height, width=img_width, count=channels, dtype='uint8') as img:
+                img.write(rng.randint(0, 256, (channels, img_height, img_width)).astype(np.uint8))
+            for class_id, xmin, xmax, ymin, ymax in boxes.astype(np.int64):
+                f.write('{},{},{},{},{},{}\n'.format(filename, xmin, xmax, ymin, ymax, class_id))
+    return labels_path
+
+
+def synthetic_predictions(ssd_box_encoder, labels, rng=None):
+    '''
+    Fake the output of an SSD model for the given ground truth: The anchor boxes that match a ground truth box predict
+    its class with high confidence and its offsets with some noise, all other anchor boxes predict the background
+    with varying confidence.
+
+    Arguments:
+        ssd_box_encoder (SSDBoxEncoder): The encoder for the model. It must not use `lean_output`.
+        labels (list): The ground truth boxes of a batch as returned by `synthetic_labels()`.
+        rng (RandomState, optional): The random number generator. Defaults to `None`, i.e. `np.random`.
+
+    Returns:
+        A Numpy array in the format of the model output, see `SSDBoxEncoder.encode_y()`.
+    '''
+    rng = np.random if rng is None else rng
+    n_classes = ssd_box_encoder.n_classes
+    y_pred = ssd_box_encoder.encode_y(labels)
+    logits = 4.0 * y_pred[:,:,:n_classes] + rng.randn(*y_pred.shape[:2] + (n_classes,))
+    confidences = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    y_pred[:,:,:n_classes] = confidences / confidences.sum(axis=-1, keepdims=True)
+    offsets = y_pred[:,:,n_classes:n_classes+4]
+    y_pred[:,:,n_classes:n_classes+4] = np.where(np.isfinite(offsets), offsets, 0) + 0.1 * rng.randn(*offsets.shape)
+    return y_pred
+
+
+def synthetic_detections(labels, n_candidates=10, rng=None):
+    '''
+    Fake the candidate detections of a batch before non-maximum suppression: `n_candidates` scored boxes scattered
+    around each ground truth box.
+
+    Arguments:
+        labels (list): The ground truth boxes of a batch as returned by `synthetic_labels()`.
+        n_candidates (int, optional): The number of candidates per ground truth box. Defaults to 10.
+        rng (RandomState, optional): The random number generator. Defaults to `None`, i.e. `np.random`.
+
+    Returns:
+        A list with one Numpy array of shape `(k * n_candidates, 6)` per image, each row a detection
+        `[class_id, confidence, xmin, xmax, ymin, ymax]`, as `greedy_nms()` takes them.
+    '''
+    rng = np.random if rng is None else rng
+    detections = []
+    for boxes in labels:
+        boxes = np.repeat(boxes, n_candidates, axis=0)
+        size = np.stack([boxes[:,2] - boxes[:,1], boxes[:,2] - boxes[:,1], boxes[:,4] - boxes[:,3], boxes[:,4] - boxes[:,3]], axis=1)
+        coordinates = boxes[:,1:] + 0.15 * size * rng.randn(len(boxes), 4)
+        detections.append(np.concatenate([boxes[:,:1], rng.uniform(0.1, 1.0, (len(boxes), 1)), coordinates], axis=1))
+    return detections
+
+
+def measure(function, iterations=20, warmup=2):
+    '''
+    Measure the latency, the throughput and the peak memory of a function.
+
+    The function is called `warmup` times without measuring, then `iterations` times with a timer around each call and
+    finally once more with `tracemalloc` tracing the memory, which would slow down the timed calls.
+
+    Arguments:
+        function (callable): A function without arguments that runs one batch and returns the tuple
+            `(n_samples, n_boxes)` with the numbers of samples and boxes it processed.
+        iterations (int, optional): The number of timed calls. Defaults to 20.
+        warmup (int, optional): The number of calls before the timed calls. Defaults to 2.
+
+    Returns:
+        A dictionary with the throughput in samples and boxes per second, the median, 99th percentile and mean latency
+        in milliseconds and the peak memory that one call allocated in megabytes.
+    '''
+    for _ in range(warmup):
+        function()
+
+    latencies = []
+    n_samples = n_boxes = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        samples, boxes = function()
+        latencies.append(time.perf_counter() - start)
+        n_samples += samples
+        n_boxes += boxes
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    total = sum(latencies)
+    return {'iterations': iterations,
+            'samples_per_s': n_samples / total,
+            'boxes_per_s': n_boxes / total,
+            'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+            'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+            'mean_ms': 1000 * total / iterations,
+            'peak_memory_mb': peak / 2**20}
+
+
+def run_pipeline(n_images=64,
+                 img_height=300,
+                 img_width=300,
+                 channels=3,
+                 boxes_per_image=10,
+                 n_classes=5,
+                 batch_size=16,
+                 iterations=20,
+                 warmup=2,
+                 n_candidates=10,
+                 stages=None,
+                 seed=0,
+                 directory=None):
+    '''
+    Benchmark the stages of training and inference on a synthetic dataset.
+
+    The box encoder is configured like in `trainssd`. The stages are:
+        'generate': `BatchGenerator.generate()` in training mode with random flips, i.e. reading, augmenting and
+            encoding a batch. Reads a synthetic dataset of `n_images` rasters that is written to `directory` first.
+        'encode': `SSDBoxEncoder.encode_y()` on a batch of ground truth boxes.
+        'iou': `iou()` of each ground truth box of a batch with all anchor boxes, like the sequential box matching.
+        'iou_matrix': `iou_matrix()` of the ground truth boxes of each image of a batch with all anchor boxes.
+        'decode': `decode_y()` on a batch of synthetic model output, see `synthetic_predictions()`.
+        'decode2': `decode_y2()` on the same synthetic model output.
+        'nms': `greedy_nms()` on `n_candidates` candidate detections per ground truth box of a batch.
+    For the decoding stages the boxes are the anchor boxes, for 'nms' the candidates and for all other stages the ground truth boxes.
+
+    Arguments:
+        n_images (int, optional): The number of synthetic images. Defaults to 64.
+        img_height (int, optional): The height of the images. Defaults to 300.
+        img_width (int, optional): The width of the images. Defaults to 300.
+        channels (int, optional): The number of bands of the images. Defaults to 3.
+        boxes_per_image (float, optional): The mean number of ground truth boxes per image. Defaults to 10.
+        n_classes (int, optional): The number of positive classes. Defaults to 5.
+        batch_size (int, optional): The number of images per batch. Defaults to 16.
+        iterations (int, optional): See `measure()`. Defaults to 20.
+        warmup (int, optional): See `measure()`. Defaults to 2.
+        n_candidates (int, optional): See `synthetic_detections()`. Defaults to 10.
+        stages (list, optional): The stages to run. Defaults to `None`, i.e. all of `STAGES`.
+        seed (int, optional): The seed for the synthetic data. Defaults to 0.
+        directory (str, optional): The directory for the synthetic dataset of the 'generate' stage. Defaults to `None`,
+            i.e. a temporary directory that is removed afterwards.
+
+    Returns:
+        A dictionary with the configuration, the environment and the results of `measure()` for each stage.
+    '''
+    from singleshot.boxes import iou, iou_matrix, decode_y, decode_y2, greedy_nms
+    from singleshot.util import BatchGenerator, SSDBoxEncoder
+
+    stages = STAGES if stages is None else stages
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError("Unknown stages {}, the stages are {}.".format(unknown, STAGES))
+
+    rng = np.random.RandomState(seed)
+    labels = synthetic_labels(n_images, img_height, img_width, boxes_per_image=boxes_per_image, n_classes=n_classes, rng=rng)
+    label_batches = [labels[start:start + batch_size] for start in range(0, n_images, batch_size)]
+    batches = itertools.cycle(label_batches)
+
+    ssd_box_encoder = SSDBoxEncoder(img_height=img_height,
+                                    img_width=img_width,
+                                    n_classes=n_classes + 1,
+                                    predictor_sizes=predictor_sizes(img_height, img_width),
+                                    aspect_ratios_per_layer=[[1.0]] * 6,
+                                    two_boxes_for_ar1=True,
+                                    limit_boxes=False,
+                                    variances=[0.1, 0.1, 0.2, 0.2],
+                                    pos_iou_threshold=0.4,
+                                    neg_iou_threshold=0.2,
+                                    coords='minmax')
+    anchors = ssd_box_encoder.anchors[:,:4]
+
+    def count(batch):
+        return len(batch), sum(len(boxes) for boxes in batch)
+
+    def run_encode():
+        batch = next(batches)
+        ssd_box_encoder.encode_y(batch)
+        return count(batch)
+
+    def run_iou():
+        batch = next(batches)
+        for boxes in batch:
+            for box in boxes:
+                iou(anchors, box[1:], coords='minmax')
+        return count(batch)
+
+    def run_iou_matrix():
+        batch = next(batches)
+        for boxes in batch:
+            iou_matrix(boxes[:,1:], anchors, coords='minmax')
+        return count(batch)
+
+    predictions = itertools.cycle([synthetic_predictions(ssd_box_encoder, batch, rng=rng) for batch in label_batches])
+
+    def run_decode():
+        y_pred = next(predictions)
+        decode_y(y_pred, confidence_thresh=0.15, iou_threshold=0.35, top_k=200, input_coords='minmax', img_height=img_height, img_width=img_width)
+        return len(y_pred), y_pred.shape[0] * y_pred.shape[1]
+
+    def run_decode2():
+        y_pred = next(predictions)
+        decode_y2(y_pred, confidence_thresh=0.15, iou_threshold=0.35, top_k=200, input_coords='minmax', img_height=img_height, img_width=img_width)
+        return len(y_pred), y_pred.shape[0] * y_pred.shape[1]
+
+    detections = itertools.cycle([synthetic_detections(batch, n_candidates=n_candidates, rng=rng) for batch in label_batches])
+
+    def run_nms():
+        batch = next(detections)
+        greedy_nms(batch, iou_threshold=0.35, coords='minmax', top_k=200)
+        return count(batch)
+
+    functions = {'encode': run_encode, 'iou': run_iou, 'iou_matrix': run_iou_matrix, 'decode': run_decode, 'decode2': run_decode2, 'nms': run_nms}
+
+    results = {'config': {'n_images': n_images,
+                          'img_height': img_height,
+                          'img_width': img_width,
+                          'channels': channels,
+                          'boxes_per_image': boxes_per_image,
+                          'n_classes': n_classes,
+                          'batch_size': batch_size,
+                          'iterations': iterations,
+                          'warmup': warmup,
+                          'n_candidates': n_candidates,
+                          'seed': seed,
+                          'n_anchors': len(anchors)},
+               'environment': environment(),
+               'stages': {}}
+
+    temporary = directory is None and 'generate' in stages
+    if temporary:
+        directory = tempfile.mkdtemp(prefix='singleshot_benchmark_')
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='Dataset has no geotransform') # The synthetic images aren't georeferenced
+        try:
+            if 'generate' in stages:
+                labels_path = write_synthetic_dataset(directory, labels, img_height, img_width, channels=channels, rng=rng)
+                batch_generator = BatchGenerator()
+                batch_generator.parse_csv(labels_path=labels_path,
+                                          input_format=['image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id'],
+                                          seed=seed)
+                generator = batch_generator.generate(batch_size=batch_size,
+                                                     train=True,
+                                                     ssd_box_encoder=ssd_box_encoder,
+                                                     flip=0.5,
+                                                     limit_boxes=True,
+                                                     include_thresh=0.4,
+                                                     y_dtype='float32',
+                                                     n_buffers=2)
+                labels_per_image = len(batch_generator.boxes) / max(1, len(batch_generator.filenames))
+
+                def run_generate():
+                    batch_X, y_true = next(generator)
+                    return len(batch_X), int(round(len(batch_X) * labels_per_image))
+
+                functions['generate'] = run_generate
+
+            for stage in STAGES:
+                if stage in stages:
+                    results['stages'][stage] = measure(functions[stage], iterations=iterations, warmup=warmup)
+        finally:
+            if temporary:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def environment():
+    '''
+    Returns:
+        A dictionary that describes where a benchmark ran: the time, the host, the Python and Numpy versions and the git
+        commit of the package if it is a git checkout.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'commit': commit}
+
+
+def compare(baseline, results):
+    '''
+    Compare the stage results of two `run_pipeline()` runs.
+
+    Arguments:
+        baseline (dict): The results to compare against, e.g. those of the previous commit.
+        results (dict): The new results.
+
+    Returns:
+        A dictionary that maps each stage that is in both results to the ratios new / baseline of the throughput in
+        samples per second, the median and 99th percentile latency and the peak memory. A throughput ratio above 1
+        and latency and memory ratios below 1 are improvements.
+    '''
+    ratios = {}
+    for stage, new in results['stages'].items():
+        old = baseline['stages'].get(stage)
+        if old is None:
+            continue
+        ratios[stage] = {key: new[key] / old[key] if old[key] else float('nan')
+                         for key in ('samples_per_s', 'p50_ms', 'p99_ms', 'peak_memory_mb')}
+    return ratios
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='benchmarks of the singleshot package')
+    commands = parser.add_subparsers(dest='command')
+
+    imports = commands.add_parser('imports', help='time the imports of the package in fresh interpreters')
+    imports.add_argument('statements', nargs='*', help='import statements to time, default a set from light to heavy')
+    imports.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters per statement, default 5')
+    imports.add_argument('--out', help='JSON file to save the results to')
+
+    pipeline = commands.add_parser('pipeline', help='benchmark the data, encode, decode and NMS stages on synthetic data')
+    pipeline.add_argument('--stages', type=lambda ss: ss.split(','), default=STAGES, help='comma separated list of stages, default all: ' + ','.join(STAGES))
+    pipeline.add_argument('--images', type=int, default=64, help='number of synthetic images, default 64')
+    pipeline.add_argument('--height', type=int, default=300, help='image height, default 300')
+    pipeline.add_argument('--width', type=int, default=300, help='image width, default 300')
+    pipeline.add_argument('--channels', type=int, default=3, help='image bands, default 3')
+    pipeline.add_argument('--boxes', type=float, default=10, help='mean number of boxes per image, default 10')
+    pipeline.add_argument('--classes', type=int, default=5, help='number of classes without the background, default 5')
+    pipeline.add_argument('--candidates', type=int, default=10, help='candidate detections per box for nms, default 10')
+    pipeline.add_argument('--batch_size', type=int, default=16)
+    pipeline.add_argument('--iterations', type=int, default=20, help='timed batches per stage, default 20')
+    pipeline.add_argument('--warmup', type=int, default=2, help='untimed batches per stage before, default 2')
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--dir', help='directory for the synthetic images, default a temporary directory')
+    pipeline.add_argument('--out', help='JSON file to save the results to')
+
+    comparison = commands.add_parser('compare', help='compare two JSON results of pipeline')
+    comparison.add_argument('baseline', help='JSON results to compare against')
+    comparison.add_argument('results', help='new JSON results')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a benchmark is required')
+
+    if args.command == 'imports':
+        results = {'python': sys.version.split()[0],
+                   'imports': import_times(args.statements, repeat=args.repeat)}
+        width = max(len(statement) for statement in results['imports'])
+        for statement, result in results['imports'].items():
+            if 'error' in result:
+                print('{:<{}}  failed: {}'.format(statement, width, result['error']))
+            else:
+                print('{:<{}}  {:7.3f} s  {}'.format(statement, width, result['median_s'], ', '.join(result['modules']) or '-'))
+
+    elif args.command == 'pipeline':
+        results = run_pipeline(n_images=args.images,
+                               img_height=args.height,
+                               img_width=args.width,
+                               channels=args.channels,
+                               boxes_per_image=args.boxes,
+                               n_classes=args.classes,
+                               batch_size=args.batch_size,
+                               iterations=args.iterations,
+                               warmup=args.warmup,
+                               n_candidates=args.candidates,
+                               stages=args.stages,
+                               seed=args.seed,
+                               directory=args.dir)
+        print('{:<12}{:>12}{:>14}{:>10}{:>10}{:>10}'.format('stage', 'samples/s', 'boxes/s', 'p50 ms', 'p99 ms', 'peak MB'))
+        for stage, result in results['stages'].items():
+            print('{:<12}{:>12.1f}{:>14.0f}{:>10.2f}{:>10.2f}{:>10.1f}'.format(stage, result['samples_per_s'], result['boxes_per_s'],
+                                                                             result['p50_ms'], result['p99_ms'], result['peak_memory_mb']))
+
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+        print('{:<12}{:>12}{:>10}{:>10}{:>10}   (new / baseline)'.format('stage', 'samples/s', 'p50', 'p99', 'memory'))
+        for stage, ratios in compare(baseline, results).items():
+            print('{:<12}{:>12.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(stage, ratios['samples_per_s'], ratios['p50_ms'], ratios['p99_ms'], ratios['peak_memory_mb']))
+        return
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
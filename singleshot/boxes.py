@@ -0,0 +1,601 @@
+"""
+Includes:
+* Intersection over union for pairs of boxes and for all pairs of two sets of boxes
+* Conversions between the box coordinate formats
+* Greedy non-maximum suppression
+* Decoders that turn the raw output of an SSD model into the final detections
+
+Only depends on Numpy, so that the predictions of a model can be post-processed without importing TensorFlow or Keras.
+
+Copyright (C) 2017 Pierluigi Ferrari
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+def iou(boxes1, boxes2, coords='centroids'):
+    '''
+    Compute the intersection-over-union similarity (also known as Jaccard similarity)
+    of two axis-aligned 2D rectangular boxes or of multiple axis-aligned 2D rectangular
+    boxes contained in two arrays with broadcast-compatible shapes.
+
+    Three common use cases would be to compute the similarities for 1 vs. 1, 1 vs. `n`,
+    or `n` vs. `n` boxes. The two arguments are symmetric.
+
+    Arguments:
+        boxes1 (np.array): Either a 1D Numpy array of shape `(4, )` containing the coordinates for one box in the
+            format specified by `coords` or a 2D Numpy array of shape `(n, 4)` containing the coordinates for `n` boxes.
+            Shape must be broadcast-compatible to `boxes2`.
+        boxes2 (np.array): Either a 1D Numpy array of shape `(4, )` containing the coordinates for one box in the
+            format specified by `coords` or a 2D Numpy array of shape `(n, 4)` containing the coordinates for `n` boxes.
+            Shape must be broadcast-compatible to `boxes1`.
+        coords (str, optional): The coordinate format in the input arrays. Can be either 'centroids' for the format
+            `(cx, cy, w, h)` or 'minmax' for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+
+    Returns:
+        A 1D Numpy array of dtype float containing values in [0,1], the Jaccard similarity of the boxes in `boxes1` and `boxes2`.
+        0 means there is no overlap between two given boxes, 1 means their coordinates are identical.
+    '''
+
+    if len(boxes1.shape) > 2: raise ValueError("boxes1 must have rank either 1 or 2, but has rank {}.".format(len(boxes1.shape)))
+    if len(boxes2.shape) > 2: raise ValueError("boxes2 must have rank either 1 or 2, but has rank {}.".format(len(boxes2.shape)))
+
+    if len(boxes1.shape) == 1: boxes1 = np.expand_dims(boxes1, axis=0)
+    if len(boxes2.shape) == 1: boxes2 = np.expand_dims(boxes2, axis=0)
+
+    if not (boxes1.shape[1] == boxes2.shape[1] == 4): raise ValueError("It must be boxes1.shape[1] == boxes2.shape[1] == 4, but it is boxes1.shape[1] == {}, boxes2.shape[1] == {}.".format(boxes1.shape[1], boxes2.shape[1]))
+
+    if coords == 'centroids':
+        # TODO: Implement a version that uses fewer computation steps (that doesn't need conversion)
+        boxes1 = convert_coordinates(boxes1, start_index=0, conversion='centroids2minmax')
+        boxes2 = convert_coordinates(boxes2, start_index=0, conversion='centroids2minmax')
+    elif coords != 'minmax':
+        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
+
+    intersection = np.maximum(0, np.minimum(boxes1[:,1], boxes2[:,1]) - np.maximum(boxes1[:,0], boxes2[:,0])) * np.maximum(0, np.minimum(boxes1[:,3], boxes2[:,3]) - np.maximum(boxes1[:,2], boxes2[:,2]))
+    union = (boxes1[:,1] - boxes1[:,0]) * (boxes1[:,3] - boxes1[:,2]) + (boxes2[:,1] - boxes2[:,0]) * (boxes2[:,3] - boxes2[:,2]) - intersection
+
+    return intersection / union
+
+
+def iou_matrix(boxes1, boxes2, coords='centroids'):
+    '''
+    Compute the pairwise intersection-over-union similarities of two sets of axis-aligned 2D rectangular boxes.
+
+    Unlike `iou()`, which compares boxes element-wise, this function compares every box in `boxes1` with every box in
+    `boxes2`. The arithmetic is identical to that of `iou()`, so the similarity of any given pair of boxes is exactly
+    the same value that `iou()` would compute for it.
+
+    Arguments:
+        boxes1 (np.array): A Numpy nD array of shape `(..., m, 4)` containing the coordinates for `m` boxes in the
+            format specified by `coords`. Any leading axes (e.g. a batch axis) must be broadcast-compatible with
+            those of `boxes2`.
+        boxes2 (np.array): A Numpy nD array of shape `(..., n, 4)` containing the coordinates for `n` boxes in the
+            format specified by `coords`.
+        coords (str, optional): The coordinate format in the input arrays. Can be either 'centroids' for the format
+            `(cx, cy, w, h)` or 'minmax' for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+
+    Returns:
+        A Numpy nD array of shape `(..., m, n)` and dtype float, where the element `[..., i, j]` is the Jaccard
+        similarity of the `i`-th box in `boxes1` and the `j`-th box in `boxes2`.
+    '''
+
+    if not (boxes1.shape[-1] == boxes2.shape[-1] == 4): raise ValueError("It must be boxes1.shape[-1] == boxes2.shape[-1] == 4, but it is boxes1.shape[-1] == {}, boxes2.shape[-1] == {}.".format(boxes1.shape[-1], boxes2.shape[-1]))
+
+    if coords == 'centroids':
+        boxes1 = convert_coordinates(boxes1, start_index=0, conversion='centroids2minmax')
+        boxes2 = convert_coordinates(boxes2, start_index=0, conversion='centroids2minmax')
+    elif coords != 'minmax':
+        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
+
+    # Split the coordinates into contiguous arrays of shape `(..., m, 1)` and `(..., 1, n)` so that all of the
+    # element-wise operations below broadcast to shape `(..., m, n)` without strided memory access
+    xmin1, xmax1, ymin1, ymax1 = [np.ascontiguousarray(boxes1[...,k])[...,np.newaxis] for k in range(4)]
+    xmin2, xmax2, ymin2, ymax2 = [np.ascontiguousarray(boxes2[...,k])[...,np.newaxis,:] for k in range(4)]
+
+    # Every intermediate result has the full shape `(..., m, n)`, so compute them in place in as few buffers as possible
+    intersection = np.minimum(xmax1, xmax2)
+    buffer = np.maximum(xmin1, xmin2)
+    intersection -= buffer
+    np.maximum(intersection, 0, out=intersection)
+    intersection_h = np.minimum(ymax1, ymax2)
+    np.maximum(ymin1, ymin2, out=buffer)
+    intersection_h -= buffer
+    np.maximum(intersection_h, 0, out=intersection_h)
+    intersection *= intersection_h
+
+    union = np.add((xmax1 - xmin1) * (ymax1 - ymin1), (xmax2 - xmin2) * (ymax2 - ymin2), out=buffer)
+    union -= intersection
+
+    return np.divide(intersection, union, out=intersection)
+
+
+def convert_coordinates(tensor, start_index, conversion='minmax2centroids'):
+    '''
+    Convert coordinates for axis-aligned 2D boxes between two coordinate formats.
+
+    Creates a copy of `tensor`, i.e. does not operate in place. Currently there are
+    two supported coordinate formats that can be converted from and to each other:
+        1) (xmin, xmax, ymin, ymax) - the 'minmax' format
+        2) (cx, cy, w, h) - the 'centroids' format
+
+    Note that converting from one of the supported formats to another and back is
+    an identity operation up to possible rounding errors for integer tensors.
+
+    Arguments:
+        tensor (np.array): A Numpy nD array containing the four consecutive coordinates
+            to be converted somewhere in the last axis.
+        start_index (int): The index of the first coordinate in the last axis of `tensor`.
+        conversion (str, optional): The conversion direction. Can be 'minmax2centroids'
+            or 'centroids2minmax'. Defaults to 'minmax2centroids'.
+
+    Returns:
+        A Numpy nD array, a copy of the input tensor with the converted coordinates
+        in place of the original coordinates and the unaltered elements of the original
+        tensor elsewhere.
+    '''
+    ind = start_index
+    tensor1 = np.copy(tensor).astype(np.float64)
+    if conversion == 'minmax2centroids':
+        tensor1[..., ind] = (tensor[..., ind] + tensor[..., ind+1]) / 2.0 # Set cx
+        tensor1[..., ind+1] = (tensor[..., ind+2] + tensor[..., ind+3]) / 2.0 # Set cy
+        tensor1[..., ind+2] = tensor[..., ind+1] - tensor[..., ind] # Set w
+        tensor1[..., ind+3] = tensor[..., ind+3] - tensor[..., ind+2] # Set h
+    elif conversion == 'centroids2minmax':
+        tensor1[..., ind] = tensor[..., ind] - tensor[..., ind+2] / 2.0 # Set xmin
+        tensor1[..., ind+1] = tensor[..., ind] + tensor[..., ind+2] / 2.0 # Set xmax
+        tensor1[..., ind+2] = tensor[..., ind+1] - tensor[..., ind+3] / 2.0 # Set ymin
+        tensor1[..., ind+3] = tensor[..., ind+1] + tensor[..., ind+3] / 2.0 # Set ymax
+    else:
+        raise ValueError("Unexpected conversion value. Supported values are 'minmax2centroids' and 'centroids2minmax'.")
+
+    return tensor1
+
+
+def convert_coordinates2(tensor, start_index, conversion='minmax2centroids'):
+    '''
+    A pure matrix multiplication implementation of `convert_coordinates()`.
+
+    Although elegant, it turns out to be marginally slower on average than
+    `convert_coordinates()`. Note that the two matrices below are each other's
+    multiplicative inverse.
+
+    For details please refer to the documentation of `convert_coordinates()`.
+    '''
+    ind = start_index
+    tensor1 = np.copy(tensor).astype(np.float64)
+    if conversion == 'minmax2centroids':
+        M = np.array([[0.5, 0. , -1.,  0.],
+                      [0.5, 0. ,  1.,  0.],
+                      [0. , 0.5,  0., -1.],
+                      [0. , 0.5,  0.,  1.]])
+        tensor1[..., ind:ind+4] = np.dot(tensor1[..., ind:ind+4], M)
+    elif conversion == 'centroids2minmax':
+        M = np.array([[ 1. , 1. ,  0. , 0. ],
+                      [ 0. , 0. ,  1. , 1. ],
+                      [-0.5, 0.5,  0. , 0. ],
+                      [ 0. , 0. , -0.5, 0.5]])
+        tensor1[..., ind:ind+4] = np.dot(tensor1[..., ind:ind+4], M)
+    else:
+        raise ValueError("Unexpected conversion value. Supported values are 'minmax2centroids' and 'centroids2minmax'.")
+
+    return tensor1
+
+
+def greedy_nms(y_pred_decoded, iou_threshold=0.45, coords='minmax', top_k=None):
+    '''
+    Perform greedy non-maximum suppression on the input boxes.
+
+    Greedy NMS works by selecting the box with the highest score and
+    removing all boxes around it that are too close to it measured by IoU-similarity.
+    Out of the boxes that are left over, once again the one with the highest
+    score is selected and so on, until no boxes with too much overlap are left.
+
+    This is a basic, straight-forward NMS algorithm that is relatively efficient,
+    but it has a number of downsides. One of those downsides is that the box with
+    the highest score might not always be the box with the best fit to the object.
+    There are more sophisticated NMS techniques like [this one](https://lirias.kuleuven.be/bitstream/123456789/506283/1/3924_postprint.pdf)
+    that use a combination of nearby boxes, but in general there will probably
+    always be a trade-off between speed and quality for any given NMS technique.
+
+    Arguments:
+        y_pred_decoded (list): A batch of decoded predictions. For a given batch size `n` this
+            is a list of length `n` where each list element is a 2D Numpy array.
+            For a batch item with `k` predicted boxes this 2D Numpy array has
+            shape `(k, 6)`, where each row contains the coordinates of the respective
+            box in the format `[class_id, score, xmin, xmax, ymin, ymax]`.
+            Technically, the number of columns doesn't have to be 6, it can be
+            arbitrary as long as the first four elements of each row are
+            `xmin`, `xmax`, `ymin`, `ymax` (in this order) and the last element
+            is the score assigned to the prediction. Note that this function is
+            agnostic to the scale of the score or what it represents.
+        iou_threshold (float, optional): All boxes with a Jaccard similarity of
+            greater than `iou_threshold` with a locally maximal box will be removed
+            from the set of predictions, where 'maximal' refers to the box score.
+            Defaults to 0.45 following the paper.
+        coords (str, optional): The coordinate format of `y_pred_decoded`.
+            Can be one of the formats supported by `iou()`. Defaults to 'minmax'.
+        top_k (int, optional): `None` or the maximum number of boxes to keep per batch item. If given, the
+            suppression stops as soon as `top_k` boxes have been selected, which yields the same boxes
+            as keeping the `top_k` first boxes of the full result, but saves the work for the rest.
+            Defaults to `None`.
+
+    Returns:
+        The predictions after removing non-maxima. The format is the same as the input format.
+    '''
+    return [_greedy_nms2(batch_item, iou_threshold=iou_threshold, coords=coords, top_k=top_k) for batch_item in y_pred_decoded]
+
+
+def _nms_indices(boxes, scores, iou_threshold=0.45, coords='minmax', top_k=None, block_size=128, groups=None):
+    '''
+    The greedy non-maximum suppression engine behind `greedy_nms()`, `_greedy_nms()` and `_greedy_nms2()`.
+
+    Instead of repeatedly searching for the maximum and deleting it from the remaining boxes, the boxes are
+    sorted by score once and suppressed by means of a boolean mask. The IoU similarities are computed in blocks
+    of `block_size` consecutive boxes (in score order) against all boxes after them that haven't been suppressed
+    yet, so that most of the work happens in a few large array operations. Box areas are computed only once.
+
+    The result is identical to that of the straight-forward algorithm described in `greedy_nms()`, including the
+    order of the selected boxes and the tie-breaking between boxes with equal scores (the earlier box wins).
+
+    If `groups` is given, boxes can only suppress other boxes of the same group, i.e. the IoU similarity of two boxes
+    of different groups counts as zero. This performs independent non-maximum suppressions for all groups (e.g. for
+    all classes of all images of a batch) in one pass. The boxes are then processed group by group, so that each block
+    is compared only against the remaining boxes of the groups it touches.
+
+    Arguments:
+        boxes (array): A 2D Numpy array of shape `(n, 4)` with the box coordinates in the format given by `coords`.
+        scores (array): A 1D Numpy array of shape `(n,)` with the box scores.
+        iou_threshold (float, optional): All boxes with a Jaccard similarity of greater than `iou_threshold`
+            with a selected box are suppressed. Defaults to 0.45.
+        coords (str, optional): The coordinate format of `boxes`. Can be one of the formats supported by `iou()`.
+            Defaults to 'minmax'.
+        top_k (int, optional): `None` or the maximum number of boxes to select. Defaults to `None`.
+        block_size (int, optional): The number of boxes for which to compute the IoU similarities at once.
+            Defaults to 128.
+        groups (array, optional): `None` or a 1D Numpy array of shape `(n,)` with an integer group ID for each box.
+            If given, `top_k` applies to the total number of selected boxes across all groups. Defaults to `None`.
+
+    Returns:
+        A 1D Numpy array with the indices of the selected boxes in the order in which they were selected,
+        i.e. in descending order of their scores, or, if `groups` is given, in ascending order of the group IDs
+        and in descending order of the scores within each group.
+    '''
+    if coords == 'centroids':
+        boxes = convert_coordinates(boxes, start_index=0, conversion='centroids2minmax')
+    elif coords != 'minmax':
+        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
+
+    if groups is None:
+        order = np.argsort(-scores, kind='stable') # A stable sort keeps boxes with equal scores in their original order, just like `np.argmax()` would pick them
+    else:
+        order = np.lexsort((-scores, groups)) # Sort by group first, then by descending score, stable just like above
+        groups = np.asarray(groups)[order]
+        group_ends = np.searchsorted(groups, groups, side='right') # For every box, the position in `order` right after the last box of its group
+    xmin, xmax, ymin, ymax = [np.ascontiguousarray(boxes[order,k]) for k in range(4)]
+    areas = (xmax - xmin) * (ymax - ymin)
+
+    n_boxes = len(order)
+    suppressed = np.zeros(n_boxes, dtype=bool)
+    keep = [] # The positions in `order` of the boxes that make it through the non-maximum suppression
+    for start in range(0, n_boxes, block_size):
+        if top_k is not None and len(keep) >= top_k: break
+        block = start + np.nonzero(~suppressed[start:start+block_size])[0] # The boxes in this block that are still left
+        if len(block) == 0: continue
+        end = n_boxes if groups is None else group_ends[block[-1]] # Boxes of later groups can't be suppressed by this block
+        candidates = block[0] + np.nonzero(~suppressed[block[0]:end])[0] # All boxes from the first one in this block onwards that are still left
+        # Compute the IoU similarities of the block boxes with the candidates, shape `(len(block), len(candidates))`
+        intersection = np.maximum(0, np.minimum(xmax[block,np.newaxis], xmax[candidates]) - np.maximum(xmin[block,np.newaxis], xmin[candidates])) * np.maximum(0, np.minimum(ymax[block,np.newaxis], ymax[candidates]) - np.maximum(ymin[block,np.newaxis], ymin[candidates]))
+        similarities = intersection / (areas[block,np.newaxis] + areas[candidates] - intersection)
+        overlapping = ~(similarities <= iou_threshold) # Boxes with a similarity that isn't a number count as overlapping, too
+        if groups is not None and groups[block[0]] != groups[block[-1]]: # Only blocks that span several groups need the group mask, all other candidates are in the block's group already
+            overlapping &= groups[block,np.newaxis] == groups[candidates]
+        # The first `len(block)` candidates are the block boxes themselves. Within the block, the boxes still have to be
+        # processed one after the other, but that only takes a lookup in the small `(len(block), len(block))` part of `overlapping`.
+        n_block = len(block)
+        kept = np.zeros(n_block, dtype=bool)
+        block_suppressed = np.zeros(n_block, dtype=bool)
+        for row in range(n_block):
+            if block_suppressed[row]: continue
+            kept[row] = True
+            keep.append(block[row])
+            if top_k is not None and len(keep) >= top_k: break
+            block_suppressed[row+1:] |= overlapping[row,row+1:n_block]
+        # All candidates after the block are suppressed by the kept block boxes at once
+        suppressed[candidates[n_block:]] |= np.any(overlapping[kept,n_block:], axis=0)
+
+    return order[np.array(keep, dtype=np.int64)]
+
+
+def _greedy_nms(predictions, iou_threshold=0.45, coords='minmax', top_k=None):
+    '''
+    The same greedy non-maximum suppression algorithm as above, but slightly modified for use as an internal
+    function for per-class NMS in `decode_y()`: Each row of `predictions` has the format `[score, xmin, xmax, ymin, ymax]`.
+    '''
+    if predictions.shape[0] == 0: return np.array([])
+    return predictions[_nms_indices(predictions[:,1:], predictions[:,0], iou_threshold=iou_threshold, coords=coords, top_k=top_k)]
+
+
+def _greedy_nms2(predictions, iou_threshold=0.45, coords='minmax', top_k=None):
+    '''
+    The same greedy non-maximum suppression algorithm as above, but slightly modified for use as an internal
+    function in `decode_y2()`: Each row of `predictions` has the format `[class_id, score, xmin, xmax, ymin, ymax]`.
+    '''
+    if predictions.shape[0] == 0: return np.array([])
+    return predictions[_nms_indices(predictions[:,2:], predictions[:,1], iou_threshold=iou_threshold, coords=coords, top_k=top_k)]
+
+
+def decode_y(y_pred,
+             confidence_thresh=0.01,
+             iou_threshold=0.45,
+             top_k=200,
+             input_coords='centroids',
+             normalize_coords=False,
+             img_height=None,
+             img_width=None,
+             batched_nms=True,
+             anchors=None):
+    '''
+    Convert model prediction output back to a format that contains only the positive box predictions
+    (i.e. the same format that `enconde_y()` takes as input).
+
+    After the decoding, two stages of prediction filtering are performed for each class individually:
+    First confidence thresholding, then greedy non-maximum suppression. The filtering results for all
+    classes are concatenated and the `top_k` overall highest confidence results constitute the final
+    predictions for a given batch item. This procedure follows the original Caffe implementation.
+    For a slightly different and more efficient alternative to decode raw model output that performs
+    non-maximum suppresion globally instead of per class, see `decode_y2()` below.
+
+    Arguments:
+        y_pred (array): The prediction output of the SSD model, expected to be a Numpy array
+            of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)`, where `#boxes` is the total number of
+            boxes predicted by the model per image and the last axis contains
+            `[one-hot vector for the classes, 4 predicted coordinate offsets, 4 anchor box coordinates, 4 variances]`.
+        confidence_thresh (float, optional): A float in [0,1), the minimum classification confidence in a specific
+            positive class in order to be considered for the non-maximum suppression stage for the respective class.
+            A lower value will result in a larger part of the selection process being done by the non-maximum suppression
+            stage, while a larger value will result in a larger part of the selection process happening in the confidence
+            thresholding stage. Defaults to 0.01, following the paper.
+        iou_threshold (float, optional): A float in [0,1]. All boxes with a Jaccard similarity of greater than `iou_threshold`
+            with a locally maximal box will be removed from the set of predictions for a given class, where 'maximal' refers
+            to the box score. Defaults to 0.45 following the paper.
+        top_k (int, optional): The number of highest scoring predictions to be kept for each batch item after the
+            non-maximum suppression stage. Defaults to 200, following the paper.
+        input_coords (str, optional): The box coordinate format that the model outputs. Can be either 'centroids'
+            for the format `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax'
+            for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+        normalize_coords (bool, optional): Set to `True` if the model outputs relative coordinates (i.e. coordinates in [0,1])
+            and you wish to transform these relative coordinates back to absolute coordinates. If the model outputs
+            relative coordinates, but you do not want to convert them back to absolute coordinates, set this to `False`.
+            Do not set this to `True` if the model already outputs absolute coordinates, as that would result in incorrect
+            coordinates. Requires `img_height` and `img_width` if set to `True`. Defaults to `False`.
+        img_height (int, optional): The height of the input images. Only needed if `normalize_coords` is `True`.
+        img_width (int, optional): The width of the input images. Only needed if `normalize_coords` is `True`.
+        batched_nms (bool, optional): If `True`, the confidence thresholding and the non-maximum suppression for all
+            classes of all images in the batch are done in one vectorized pass, in which boxes can only suppress boxes
+            of the same class in the same image. The results are the same as those of the per-class loop that is used
+            if `False`, except that a batch item without any predictions gets an empty array of shape `(0, 6)`
+            instead of raising a `ValueError`. Defaults to `True`.
+        anchors (array, optional): The anchor box table of shape `(#boxes, 8)` with the 4 anchor box coordinates and the
+            4 variances of each box, e.g. `SSDBoxEncoder.anchors`. Required for the output of a model built with
+            `lean_output=True`, which has shape `(batch_size, #boxes, #classes + 4)` because it doesn't contain the
+            anchor boxes and variances. Defaults to `None`, in which case they are taken from `y_pred`.
+
+    Returns:
+        A python list of length `batch_size` where each list element represents the predicted boxes
+        for one image and contains a Numpy array of shape `(boxes, 6)` where each row is a box prediction for
+        a non-background class for the respective image in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`.
+    '''
+    if normalize_coords and ((img_height is None) or (img_width is None)):
+        raise ValueError("If relative box coordinates are supposed to be converted to absolute coordinates, the decoder needs the image size in order to decode the predictions, but `img_height == {}` and `img_width == {}`".format(img_height, img_width))
+
+    # 1: Convert the box coordinates from the predicted anchor box offsets to predicted absolute coordinates
+
+    if anchors is None:
+        anchors = y_pred[:,:,-8:] # The anchor coordinates and variances
+        y_pred_decoded_raw = np.copy(y_pred[:,:,:-8]) # Slice out the classes and the four offsets, throw away the anchor coordinates and variances, resulting in a tensor of shape `[batch, n_boxes, n_classes + 4 coordinates]`
+    else:
+        anchors = np.expand_dims(anchors, axis=0) # The same anchor boxes for every batch item
+        y_pred_decoded_raw = np.array(y_pred, dtype=np.result_type(y_pred, anchors)) # The lean model output already is a tensor of shape `[batch, n_boxes, n_classes + 4 coordinates]`
+
+    if input_coords == 'centroids':
+        y_pred_decoded_raw[:,:,[-2,-1]] = np.exp(y_pred_decoded_raw[:,:,[-2,-1]] * anchors[:,:,[-2,-1]]) # exp(ln(w(pred)/w(anchor)) / w_variance * w_variance) == w(pred) / w(anchor), exp(ln(h(pred)/h(anchor)) / h_variance * h_variance) == h(pred) / h(anchor)
+        y_pred_decoded_raw[:,:,[-2,-1]] *= anchors[:,:,[-6,-5]] # (w(pred) / w(anchor)) * w(anchor) == w(pred), (h(pred) / h(anchor)) * h(anchor) == h(pred)
+        y_pred_decoded_raw[:,:,[-4,-3]] *= anchors[:,:,[-4,-3]] * anchors[:,:,[-6,-5]] # (delta_cx(pred) / w(anchor) / cx_variance) * cx_variance * w(anchor) == delta_cx(pred), (delta_cy(pred) / h(anchor) / cy_variance) * cy_variance * h(anchor) == delta_cy(pred)
+        y_pred_decoded_raw[:,:,[-4,-3]] += anchors[:,:,[-8,-7]] # delta_cx(pred) + cx(anchor) == cx(pred), delta_cy(pred) + cy(anchor) == cy(pred)
+        y_pred_decoded_raw = convert_coordinates(y_pred_decoded_raw, start_index=-4, conversion='centroids2minmax')
+    elif input_coords == 'minmax':
+        y_pred_decoded_raw[:,:,-4:] *= anchors[:,:,-4:] # delta(pred) / size(anchor) / variance * variance == delta(pred) / size(anchor) for all four coordinates, where 'size' refers to w or h, respectively
+        y_pred_decoded_raw[:,:,[-4,-3]] *= np.expand_dims(anchors[:,:,-7] - anchors[:,:,-8], axis=-1) # delta_xmin(pred) / w(anchor) * w(anchor) == delta_xmin(pred), delta_xmax(pred) / w(anchor) * w(anchor) == delta_xmax(pred)
+        y_pred_decoded_raw[:,:,[-2,-1]] *= np.expand_dims(anchors[:,:,-5] - anchors[:,:,-6], axis=-1) # delta_ymin(pred) / h(anchor) * h(anchor) == delta_ymin(pred), delta_ymax(pred) / h(anchor) * h(anchor) == delta_ymax(pred)
+        y_pred_decoded_raw[:,:,-4:] += anchors[:,:,-8:-4] # delta(pred) + anchor == pred for all four coordinates
+    else:
+        raise ValueError("Unexpected value for `input_coords`. Supported input coordinate formats are 'minmax' and 'centroids'.")
+
+    # 2: If the model predicts normalized box coordinates and they are supposed to be converted back to absolute coordinates, do that
+
+    if normalize_coords:
+        y_pred_decoded_raw[:,:,-4:-2] *= img_width # Convert xmin, xmax back to absolute coordinates
+        y_pred_decoded_raw[:,:,-2:] *= img_height # Convert ymin, ymax back to absolute coordinates
+
+    # 3: Apply confidence thresholding and non-maximum suppression per class
+
+    n_classes = y_pred_decoded_raw.shape[-1] - 4 # The number of classes is the length of the last axis minus the four box coordinates
+
+    if batched_nms:
+        return _decode_y_batched(y_pred_decoded_raw, n_classes, confidence_thresh, iou_threshold, top_k)
+
+    y_pred_decoded = [] # Store the final predictions in this list
+    for batch_item in y_pred_decoded_raw: # `batch_item` has shape `[n_boxes, n_classes + 4 coords]`
+        pred = [] # Store the final predictions for this batch item here
+        for class_id in range(1, n_classes): # For each class except the background class (which has class ID 0)...
+            single_class = batch_item[:,[class_id, -4, -3, -2, -1]] # ...keep only the confidences for that class, making this an array of shape `[n_boxes, 5]` and...
+            threshold_met = single_class[single_class[:,0] > confidence_thresh] # ...keep only those boxes with a confidence above the set threshold.
+            if threshold_met.shape[0] > 0: # If any boxes made the threshold...
+                maxima = _greedy_nms(threshold_met, iou_threshold=iou_threshold, coords='minmax') # ...perform NMS on them.
+                maxima_output = np.zeros((maxima.shape[0], maxima.shape[1] + 1)) # Expand the last dimension by one element to have room for the class ID. This is now an arrray of shape `[n_boxes, 6]`
+                maxima_output[:,0] = class_id # Write the class ID to the first column...
+                maxima_output[:,1:] = maxima # ...and write the maxima to the other columns...
+                pred.append(maxima_output) # ...and append the maxima for this class to the list of maxima for this batch item.
+        # Once we're through with all classes, keep only the `top_k` maxima with the highest scores
+        pred = np.concatenate(pred, axis=0)
+        if pred.shape[0] > top_k: # If we have more than `top_k` results left at this point, otherwise there is nothing to filter,...
+            top_k_indices = np.argpartition(pred[:,1], kth=pred.shape[0]-top_k, axis=0)[pred.shape[0]-top_k:] # ...get the indices of the `top_k` highest-score maxima...
+            pred = pred[top_k_indices] # ...and keep only those entries of `pred`...
+        y_pred_decoded.append(pred) # ...and now that we're done, append the array of final predictions for this batch item to the output list
+
+    return y_pred_decoded
+
+
+def _decode_y_batched(y_pred_decoded_raw, n_classes, confidence_thresh, iou_threshold, top_k):
+    '''
+    The confidence thresholding, non-maximum suppression and top-k selection stage of `decode_y()` for all
+    classes of all batch items at once.
+
+    Every (image, box, class) triple that meets the confidence threshold becomes one candidate, and a single run of
+    `_nms_indices()` with the group ID `image * n_classes + class` suppresses the candidates of all groups
+    independently of each other. Masking the IoU by group rather than offsetting the box coordinates by class
+    leaves the coordinates, and hence the IoU similarities, exactly the same as in the per-class loop.
+
+    Arguments:
+        y_pred_decoded_raw (array): The decoded model output of shape `(batch_size, #boxes, #classes + 4)`
+            with the box coordinates in the format `(xmin, xmax, ymin, ymax)`.
+        n_classes (int): The number of classes including the background class.
+        confidence_thresh (float): See `decode_y()`.
+        iou_threshold (float): See `decode_y()`.
+        top_k (int): See `decode_y()`.
+
+    Returns:
+        The same list of per-image prediction arrays as `decode_y()`.
+    '''
+    # Enumerate the candidates in image-major, then class-major, then box order, so that the stable sort in `_nms_indices()`
+    # breaks ties between equal scores the same way as the per-class loop and the selected boxes come out ordered by image and class
+    confidences = y_pred_decoded_raw[:,:,1:n_classes].transpose(0,2,1) # Shape `(batch_size, n_classes - 1, n_boxes)`, the background class is skipped
+    image_ids, class_ids, box_ids = np.nonzero(confidences > confidence_thresh)
+    class_ids += 1
+    scores = y_pred_decoded_raw[image_ids, box_ids, class_ids]
+    boxes = y_pred_decoded_raw[image_ids, box_ids, -4:]
+
+    maxima = _nms_indices(boxes, scores, iou_threshold=iou_threshold, coords='minmax', groups=image_ids * n_classes + class_ids)
+
+    pred_all = np.column_stack((class_ids[maxima], scores[maxima], boxes[maxima])).astype(np.float64) # Shape `(n_maxima, 6)` in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`
+    splits = np.searchsorted(image_ids[maxima], np.arange(1, len(y_pred_decoded_raw))) # The maxima are sorted by image, so the predictions of every image are contiguous
+
+    y_pred_decoded = [] # Store the final predictions in this list
+    for pred in np.split(pred_all, splits):
+        if pred.shape[0] > top_k: # Keep only the `top_k` maxima with the highest scores, exactly like `decode_y()` does
+            top_k_indices = np.argpartition(pred[:,1], kth=pred.shape[0]-top_k, axis=0)[pred.shape[0]-top_k:]
+            pred = pred[top_k_indices]
+        y_pred_decoded.append(pred)
+
+    return y_pred_decoded
+
+
+def decode_y2(y_pred,
+              confidence_thresh=0.5,
+              iou_threshold=0.45,
+              top_k='all',
+              input_coords='centroids',
+              normalize_coords=False,
+              img_height=None,
+              img_width=None):
+    '''
+    Convert model prediction output back to a format that contains only the positive box predictions
+    (i.e. the same format that `enconde_y()` takes as input).
+
+    Optionally performs confidence thresholding and greedy non-maximum suppression afte the decoding stage.
+
+    Note that the decoding procedure used here is not the same as the procedure used in the original Caffe implementation.
+    The procedure used here assigns every box its highest confidence as the class and then removes all boxes fro which
+    the highest confidence is the background class. This results in less work for the subsequent non-maximum suppression,
+    because the vast majority of the predictions will be filtered out just by the fact that their highest confidence is
+    for the background class. It is much more efficient than the procedure of the original implementation, but the
+    results may also differ.
+
+    Arguments:
+        y_pred (array): The prediction output of the SSD model, expected to be a Numpy array
+            of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)`, where `#boxes` is the total number of
+            boxes predicted by the model per image and the last axis contains
+            `[one-hot vector for the classes, 4 predicted coordinate offsets, 4 anchor box coordinates, 4 variances]`.
+        confidence_thresh (float, optional): A float in [0,1), the minimum classification confidence in any positive
+            class required for a given box to be considered a positive prediction. A lower value will result
+            in better recall, while a higher value will result in better precision. Do not use this parameter with the
+            goal to combat the inevitably many duplicates that an SSD will produce, the subsequent non-maximum suppression
+            stage will take care of those. Defaults to 0.5.
+        iou_threshold (float, optional): `None` or a float in [0,1]. If `None`, no non-maximum suppression will be
+            performed. If not `None`, greedy NMS will be performed after the confidence thresholding stage, meaning
+            all boxes with a Jaccard similarity of greater than `iou_threshold` with a locally maximal box will be removed
+            from the set of predictions, where 'maximal' refers to the box score. Defaults to 0.45.
+        top_k (int, optional): 'all' or an integer with number of highest scoring predictions to be kept for each batch item
+            after the non-maximum suppression stage. Defaults to 'all', in which case all predictions left after the NMS stage
+            will be kept.
+        input_coords (str, optional): The box coordinate format that the model outputs. Can be either 'centroids'
+            for the format `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax'
+            for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+        normalize_coords (bool, optional): Set to `True` if the model outputs relative coordinates (i.e. coordinates in [0,1])
+            and you wish to transform these relative coordinates back to absolute coordinates. If the model outputs
+            relative coordinates, but you do not want to convert them back to absolute coordinates, set this to `False`.
+            Do not set this to `True` if the model already outputs absolute coordinates, as that would result in incorrect
+            coordinates. Requires `img_height` and `img_width` if set to `True`. Defaults to `False`.
+        img_height (int, optional): The height of the input images. Only needed if `normalize_coords` is `True`.
+        img_width (int, optional): The width of the input images. Only needed if `normalize_coords` is `True`.
+
+    Returns:
+        A python list of length `batch_size` where each list element represents the predicted boxes
+        for one image and contains a Numpy array of shape `(boxes, 6)` where each row is a box prediction for
+        a non-background class for the respective image in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`.
+    '''
+    if normalize_coords and ((img_height is None) or (img_width is None)):
+        raise ValueError("If relative box coordinates are supposed to be converted to absolute coordinates, the decoder needs the image size in order to decode the predictions, but `img_height == {}` and `img_width == {}`".format(img_height, img_width))
+
+    # 1: Convert the classes from one-hot encoding to their class ID
+    y_pred_converted = np.copy(y_pred[:,:,-14:-8]) # Slice out the four offset predictions plus two elements whereto we'll write the class IDs and confidences in the next step
+    y_pred_converted[:,:,0] = np.argmax(y_pred[:,:,:-12], axis=-1) # The indices of the highest confidence values in the one-hot class vectors are the class ID
+    y_pred_converted[:,:,1] = np.amax(y_pred[:,:,:-12], axis=-1) # Store the confidence values themselves, too
+
+    # 2: Convert the box coordinates from the predicted anchor box offsets to predicted absolute coordinates
+    if input_coords == 'centroids':
+        y_pred_converted[:,:,[4,5]] = np.exp(y_pred_converted[:,:,[4,5]] * y_pred[:,:,[-2,-1]]) # exp(ln(w(pred)/w(anchor)) / w_variance * w_variance) == w(pred) / w(anchor), exp(ln(h(pred)/h(anchor)) / h_variance * h_variance) == h(pred) / h(anchor)
+        y_pred_converted[:,:,[4,5]] *= y_pred[:,:,[-6,-5]] # (w(pred) / w(anchor)) * w(anchor) == w(pred), (h(pred) / h(anchor)) * h(anchor) == h(pred)
+        y_pred_converted[:,:,[2,3]] *= y_pred[:,:,[-4,-3]] * y_pred[:,:,[-6,-5]] # (delta_cx(pred) / w(anchor) / cx_variance) * cx_variance * w(anchor) == delta_cx(pred), (delta_cy(pred) / h(anchor) / cy_variance) * cy_variance * h(anchor) == delta_cy(pred)
+        y_pred_converted[:,:,[2,3]] += y_pred[:,:,[-8,-7]] # delta_cx(pred) + cx(anchor) == cx(pred), delta_cy(pred) + cy(anchor) == cy(pred)
+        y_pred_converted = convert_coordinates(y_pred_converted, start_index=-4, conversion='centroids2minmax')
+    elif input_coords == 'minmax':
+        y_pred_converted[:,:,2:] *= y_pred[:,:,-4:] # delta(pred) / size(anchor) / variance * variance == delta(pred) / size(anchor) for all four coordinates, where 'size' refers to w or h, respectively
+        y_pred_converted[:,:,[2,3]] *= np.expand_dims(y_pred[:,:,-7] - y_pred[:,:,-8], axis=-1) # delta_xmin(pred) / w(anchor) * w(anchor) == delta_xmin(pred), delta_xmax(pred) / w(anchor) * w(anchor) == delta_xmax(pred)
+        y_pred_converted[:,:,[4,5]] *= np.expand_dims(y_pred[:,:,-5] - y_pred[:,:,-6], axis=-1) # delta_ymin(pred) / h(anchor) * h(anchor) == delta_ymin(pred), delta_ymax(pred) / h(anchor) * h(anchor) == delta_ymax(pred)
+        y_pred_converted[:,:,2:] += y_pred[:,:,-8:-4] # delta(pred) + anchor == pred for all four coordinates
+    else:
+        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
+
+    # 3: If the model predicts normalized box coordinates and they are supposed to be converted back to absolute coordinates, do that
+    if normalize_coords:
+        y_pred_converted[:,:,2:4] *= img_width # Convert xmin, xmax back to absolute coordinates
+        y_pred_converted[:,:,4:] *= img_height # Convert ymin, ymax back to absolute coordinates
+
+    # 4: Decode our huge `(batch, #boxes, 6)` tensor into a list of length `batch` where each list entry is an array containing only the positive predictions
+    y_pred_decoded = []
+    for batch_item in y_pred_converted: # For each image in the batch...
+        boxes = batch_item[np.nonzero(batch_item[:,0])] # ...get all boxes that don't belong to the background class,...
+        boxes = boxes[boxes[:,1] >= confidence_thresh] # ...then filter out those positive boxes for which the prediction confidence is too low and after that...
+        if iou_threshold: # ...if an IoU threshold is set...
+            boxes = _greedy_nms2(boxes, iou_threshold=iou_threshold, coords='minmax') # ...perform NMS on the remaining boxes.
+        if top_k != 'all' and boxes.shape[0] > top_k: # If we have more than `top_k` results left at this point...
+            top_k_indices = np.argpartition(boxes[:,1], kth=boxes.shape[0]-top_k, axis=0)[boxes.shape[0]-top_k:] # ...get the indices of the `top_k` highest-scoring boxes...
+            boxes = boxes[top_k_indices] # ...and keep only those boxes...
+        y_pred_decoded.append(boxes) # ...and now that we're done, append the array of final predictions for this batch item to the output list
+
+    return y_pred_decoded
@@ -0,0 +1,437 @@
+"""
+Includes:
+* A helper that expands file paths, directories, glob patterns and CSV files into a list of image files
+* A batched predictor for lists of image files that reads the images on a background thread
+* A writer that appends detections to a CSV or Parquet file batch by batch
+* A sliding window generator that covers a large raster with overlapping windows of the model's input size
+* A streaming predictor that runs these windows through an SSD model in batches and merges the detections
+  across the window seams with a global non-maximum suppression
+"""
+
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+
+from singleshot.boxes import decode_y, iou_matrix, _nms_indices
+
+
+# The columns of the detection files written by `write_detections()`
+DETECTION_COLUMNS = ['file_name', 'class_id', 'conf', 'xmin', 'xmax', 'ymin', 'ymax']
+
+
+def find_images(directory, extensions=('png',)):
+    '''
+    Find all image files in a directory and its subdirectories.
+
+    Arguments:
+        directory (str): The directory to search.
+        extensions (tuple, optional): The file name extensions of the images. Defaults to `('png',)`.
+
+    Returns:
+        A sorted list of the image file paths.
+    '''
+    return sorted(os.path.join(root, filename)
+                  for root, dirs, filenames in os.walk(directory)
+                  for filename in filenames if filename.endswith(tuple(extensions)))
+
+
+def expand_inputs(inputs, extensions=('png', 'tif', 'tiff', 'jpg')):
+    '''
+    Expand a list of inputs into a list of image file paths.
+
+    Every input can be the path of an image file, a directory, which contributes all images in it and
+    its subdirectories (see `find_images()`), a glob pattern, or a CSV file, which contributes the distinct
+    values in its first column in their order of appearance, e.g. the image names of a labels CSV file.
+
+    Arguments:
+        inputs (list): The inputs.
+        extensions (tuple, optional): The file name extensions of the images in directories.
+            Defaults to `('png', 'tif', 'tiff', 'jpg')`.
+
+    Returns:
+        A list of image file paths.
+    '''
+    filenames = []
+    for item in inputs:
+        if item.endswith('.csv'):
+            filenames.extend(pd.read_csv(item, usecols=[0], dtype=str).iloc[:,0].str.strip().drop_duplicates().tolist())
+        elif os.path.isdir(item):
+            filenames.extend(find_images(item, extensions))
+        elif any(char in item for char in '*?['):
+            filenames.extend(sorted(glob.glob(item)))
+        else:
+            filenames.append(item)
+    return filenames
+
+
+def load_batches(filenames, batch_size=16, bands=None, prefetch=2):
+    '''
+    Read images in batches on a background thread.
+
+    While the caller processes one batch, e.g. runs it through the model, the next `prefetch` batches
+    are read from disk. Any error in the background thread is raised in the caller. The thread exits
+    when the generator is exhausted or closed, e.g. when the caller breaks out of the loop early.
+
+    Arguments:
+        filenames (list): The image file paths. All images must have the same size.
+        batch_size (int, optional): The number of images per batch. Defaults to 16.
+        bands (list, optional): `None` or a list of the 1-based indices of the bands to read. Defaults to `None`, i.e. all bands.
+        prefetch (int, optional): The maximum number of batches that are read ahead. Defaults to 2.
+
+    Yields:
+        Tuples `(batch_filenames, batch_X)`, where `batch_X` is a Numpy array of shape `(batch_size, height, width, channels)`.
+    '''
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()  # Set when the caller stops iterating, so that the thread doesn't wait on a full queue forever
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load():
+        try:
+            for start in range(0, len(filenames), batch_size):
+                batch_filenames = filenames[start:start + batch_size]
+                batch_X = []
+                for filename in batch_filenames:
+                    if stop.is_set():
+                        return
+                    with rasterio.open('{}'.format(filename)) as img:
+                        batch_X.append(img.read(indexes=bands).transpose([1, 2, 0]))
+                if not put((batch_filenames, np.stack(batch_X))):
+                    return
+        except Exception as e:
+            put(e)
+        put(None)
+
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        loader.join()
+
+
+def predict_files(model,
+                  filenames,
+                  batch_size=16,
+                  bands=None,
+                  prefetch=2,
+                  confidence_thresh=0.15,
+                  iou_threshold=0.35,
+                  top_k=200,
+                  input_coords='minmax',
+                  normalize_coords=False,
+                  anchors=None):
+    '''
+    Detect objects in a list of image files, batch by batch.
+
+    The images are read by `load_batches()` on a background thread while the model processes the previous batch,
+    and the predictions of each batch are decoded with one call to `decode_y()`, see `predict_batch()`.
+
+    Arguments:
+        model (Model): The SSD model.
+        filenames (list): The image file paths. All images must have the model's input size.
+        batch_size (int, optional): The number of images per model batch. Defaults to 16.
+        bands (list, optional): `None` or a list of the 1-based indices of the bands to feed the model. Defaults to `None`.
+        prefetch (int, optional): The maximum number of batches that are read ahead. Defaults to 2.
+        confidence_thresh (float, optional): See `decode_y()`. Defaults to 0.15.
+        iou_threshold (float, optional): See `decode_y()`. Defaults to 0.35.
+        top_k (int, optional): See `decode_y()`. Defaults to 200.
+        input_coords (str, optional): See `decode_y()`. Defaults to 'minmax'.
+        normalize_coords (bool, optional): See `decode_y()`. Defaults to `False`.
+        anchors (array, optional): The anchor box table for a model built with `lean_output=True`, see `decode_y()`.
+            Defaults to `None`.
+
+    Yields:
+        Tuples `(batch_filenames, y_pred_decoded)`, where `y_pred_decoded` is the list of detection arrays
+        for the images in `batch_filenames` as returned by `decode_y()`.
+    '''
+    for batch_filenames, batch_X in load_batches(filenames, batch_size=batch_size, bands=bands, prefetch=prefetch):
+        y_pred_decoded = predict_batch(model,
+                                       batch_X,
+                                       confidence_thresh=confidence_thresh,
+                                       iou_threshold=iou_threshold,
+                                       top_k=top_k,
+                                       input_coords=input_coords,
+                                       normalize_coords=normalize_coords,
+                                       img_height=batch_X.shape[1],
+                                       img_width=batch_X.shape[2],
+                                       anchors=anchors)
+        yield batch_filenames, y_pred_decoded
+
+
+def predict_batch(model, batch_X, **kwargs):
+    '''
+    Detect objects in one batch of images.
+
+    The predictions are decoded with `decode_y()`, unless the model ends in a `DecodeDetections` layer (see
+    `detection_model()`). Such a model already outputs the decoded detections, padded with rows of class ID 0,
+    so only the padding is removed and `kwargs` are ignored; the layer's own thresholds apply.
+
+    Arguments:
+        model (Model): The SSD model.
+        batch_X (array): The batch of images.
+        **kwargs: The arguments of `decode_y()`.
+
+    Returns:
+        The list of detection arrays for the images in `batch_X` as returned by `decode_y()`.
+    '''
+    y_pred = model.predict(batch_X, batch_size=len(batch_X))
+    if type(model.layers[-1]).__name__ == 'DecodeDetections':
+        return [detections[detections[:,0] > 0] for detections in y_pred]
+    return decode_y(y_pred, **kwargs)
+
+
+def write_detections(results, out_path, class_map_inv=None):
+    '''
+    Write detections to a CSV or Parquet file incrementally, one batch at a time.
+
+    The file has the columns in `DETECTION_COLUMNS`, one row per detection. It is a Parquet file if `out_path`
+    ends on '.parquet', which requires `pyarrow`, and a CSV file otherwise.
+
+    Arguments:
+        results (iterable): Tuples `(batch_filenames, y_pred_decoded)` as yielded by `predict_files()`.
+        out_path (str): The path of the output file.
+        class_map_inv (dict, optional): A dictionary that maps the model's class IDs to the class IDs to be written,
+            e.g. `BatchGenerator.class_map_inv`. Defaults to `None`, i.e. the model's class IDs are written.
+
+    Returns:
+        The number of detections written.
+    '''
+    parquet = out_path.endswith('.parquet')
+    if parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([('file_name', pa.string()), ('class_id', pa.int64())] + [(column, pa.float64()) for column in DETECTION_COLUMNS[2:]])
+        writer = pq.ParquetWriter(out_path, schema)
+    else:
+        writer = open(out_path, 'w', newline='')
+        writer.write(','.join(DETECTION_COLUMNS) + '\n')
+
+    n_detections = 0
+    try:
+        for batch_filenames, y_pred_decoded in results:
+            detections = np.concatenate([np.reshape(pred, (-1, 6)) for pred in y_pred_decoded], axis=0)
+            class_ids = detections[:,0].astype(np.int64)
+            if class_map_inv:
+                class_ids = np.array([class_map_inv[class_id] for class_id in class_ids], dtype=np.int64)
+            frame = pd.DataFrame({'file_name': np.repeat(np.array(batch_filenames, dtype=object), [len(pred) for pred in y_pred_decoded]),
+                                  'class_id': class_ids,
+                                  'conf': detections[:,1],
+                                  'xmin': detections[:,2],
+                                  'xmax': detections[:,3],
+                                  'ymin': detections[:,4],
+                                  'ymax': detections[:,5]},
+                                 columns=DETECTION_COLUMNS)
+            if parquet:
+                writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            else:
+                frame.to_csv(writer, header=False, index=False)
+            n_detections += len(frame)
+    finally:
+        writer.close()
+
+    return n_detections
+
+
+def window_offsets(size, window_size, overlap):
+    '''
+    Compute the offsets of overlapping windows of length `window_size` that cover the range `[0, size)`.
+
+    The windows are `window_size - overlap` apart. The last window is aligned with the end of the range, so no
+    window reaches beyond `size`, unless `size` is smaller than `window_size`, in which case there is just one window.
+
+    Arguments:
+        size (int): The length of the range to be covered, e.g. the width or height of a scene.
+        window_size (int): The length of the windows.
+        overlap (int): The minimum number of pixels by which two neighboring windows overlap.
+
+    Returns:
+        A list of the window offsets in ascending order.
+    '''
+    stride = window_size - overlap
+    if stride <= 0:
+        raise ValueError("`overlap` must be smaller than `window_size`, but `overlap` == {}, `window_size` == {}".format(overlap, window_size))
+
+    if size <= window_size:
+        return [0]
+    offsets = list(range(0, size - window_size, stride))
+    offsets.append(size - window_size)
+    return offsets
+
+
+def scene_windows(height, width, window_size=(300, 300), overlap=60):
+    '''
+    Cover a scene with overlapping windows.
+
+    Arguments:
+        height (int): The height of the scene in pixels.
+        width (int): The width of the scene in pixels.
+        window_size (tuple, optional): The window size in the format `(height, width)`. Defaults to `(300, 300)`.
+        overlap (int, optional): The minimum number of pixels by which two neighboring windows overlap. This should be
+            at least the size of the largest objects, so that every object lies entirely inside some window. Defaults to 60.
+
+    Returns:
+        A list of `rasterio.windows.Window` objects in row-major order, i.e. sorted by their row offsets.
+    '''
+    window_height, window_width = window_size
+    return [Window(col_off, row_off, window_width, window_height)
+            for row_off in window_offsets(height, window_height, overlap)
+            for col_off in window_offsets(width, window_width, overlap)]
+
+
+def predict_scene(model,
+                  scene_path,
+                  window_size=(300, 300),
+                  overlap=60,
+                  batch_size=16,
+                  bands=None,
+                  confidence_thresh=0.15,
+                  iou_threshold=0.35,
+                  top_k=200,
+                  input_coords='minmax',
+                  normalize_coords=False,
+                  anchors=None):
+    '''
+    Detect objects in a scene of arbitrary size with a sliding window.
+
+    The scene is covered with overlapping windows of the model's input size (see `scene_windows()`) that are read
+    from the raster with windowed reads and passed through the model in batches of `batch_size` windows. The
+    predictions for each window are decoded with `decode_y()` (see `predict_batch()`), clipped to the window, and shifted into scene
+    coordinates. Objects along the window seams are detected in several windows, so the detections of all windows
+    go through one more class-aware greedy non-maximum suppression.
+
+    The scene is processed as a stream: Only one batch of windows is read at a time, and detections are yielded as
+    soon as their fate in the global non-maximum suppression is settled, i.e. as soon as neither any window that is
+    still to come nor any other pending detection can overlap them. Hence the memory use is bounded by a few rows
+    of windows no matter how large the scene is. The yielded detections are exactly those that a single non-maximum
+    suppression over the detections of all windows at once would keep.
+
+    Arguments:
+        model (Model): The SSD model. Its input size must be `window_size`.
+        scene_path (str): The path of the raster, anything that `rasterio.open()` can open.
+        window_size (tuple, optional): The model's input size in the format `(height, width)`. Defaults to `(300, 300)`.
+        overlap (int, optional): The minimum number of pixels by which two neighboring windows overlap. Defaults to 60.
+        batch_size (int, optional): The number of windows per model batch. Defaults to 16.
+        bands (list, optional): `None` or a list of the 1-based indices of the raster bands to feed the model,
+            in the order of the model's input channels. Defaults to `None`, i.e. all bands.
+        confidence_thresh (float, optional): See `decode_y()`. Defaults to 0.15.
+        iou_threshold (float, optional): The IoU threshold for both the per-window and the global non-maximum
+            suppression, see `decode_y()`. Defaults to 0.35.
+        top_k (int, optional): The maximum number of detections per window, see `decode_y()`. Defaults to 200.
+        input_coords (str, optional): The box coordinate format that the model outputs, see `decode_y()`.
+            Defaults to 'minmax'.
+        normalize_coords (bool, optional): Whether the model outputs relative coordinates, see `decode_y()`.
+            Defaults to `False`.
+        anchors (array, optional): The anchor box table for a model built with `lean_output=True`, see `decode_y()`.
+            Defaults to `None`.
+
+    Yields:
+        Numpy arrays of shape `(n, 6)` with final detections in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`,
+        where the box coordinates are pixel coordinates in the scene.
+    '''
+    window_height, window_width = window_size
+
+    with rasterio.open(scene_path) as scene:
+        windows = scene_windows(scene.height, scene.width, window_size, overlap)
+
+        pending = np.zeros((0, 6)) # The detections whose fate in the global non-maximum suppression is not settled yet
+        for start in range(0, len(windows), batch_size):
+            batch_windows = windows[start:start + batch_size]
+            batch_X = np.stack([_read_window(scene, window, bands) for window in batch_windows])
+
+            y_pred_decoded = predict_batch(model,
+                                           batch_X,
+                                           confidence_thresh=confidence_thresh,
+                                           iou_threshold=iou_threshold,
+                                           top_k=top_k,
+                                           input_coords=input_coords,
+                                           normalize_coords=normalize_coords,
+                                           img_height=window_height,
+                                           img_width=window_width,
+                                           anchors=anchors)
+
+            pending = np.concatenate([pending] + [_to_scene_coordinates(detections, window, scene.height, scene.width)
+                                                  for detections, window in zip(y_pred_decoded, batch_windows)], axis=0)
+
+            # No box from the windows that are still to come can reach above the row offset of the next window
+            bound = windows[start + batch_size].row_off if start + batch_size < len(windows) else np.inf
+            settled = _settled(pending, bound, iou_threshold)
+            if np.any(settled):
+                detections = pending[settled]
+                yield detections[_nms_indices(detections[:,2:], detections[:,1], iou_threshold=iou_threshold, coords='minmax', groups=detections[:,0].astype(np.int64))]
+                pending = pending[~settled]
+
+
+def _read_window(scene, window, bands=None):
+    '''
+    Read a window from an open raster in HWC order. The parts of the window that lie outside of the raster,
+    which only happens for rasters that are smaller than the window, are filled with zeros.
+    '''
+    height = min(window.height, scene.height - window.row_off)
+    width = min(window.width, scene.width - window.col_off)
+    image = scene.read(indexes=bands, window=Window(window.col_off, window.row_off, width, height)).transpose([1, 2, 0])
+    if (height, width) == (window.height, window.width):
+        return image
+    padded = np.zeros((window.height, window.width, image.shape[2]), dtype=image.dtype)
+    padded[:height,:width] = image
+    return padded
+
+
+def _to_scene_coordinates(detections, window, scene_height, scene_width):
+    '''
+    Clip the detections of one window to the part of the window that lies within the scene and shift them from
+    window coordinates into scene coordinates. Detections that are clipped to zero area are removed.
+    '''
+    detections = np.array(detections, dtype=np.float64).reshape(-1, 6)
+    detections[:,[2,3]] = np.clip(detections[:,[2,3]], 0, min(window.width, scene_width - window.col_off)) + window.col_off
+    detections[:,[4,5]] = np.clip(detections[:,[4,5]], 0, min(window.height, scene_height - window.row_off)) + window.row_off
+    return detections[(detections[:,3] > detections[:,2]) & (detections[:,5] > detections[:,4])]
+
+
+def _settled(detections, bound, iou_threshold):
+    '''
+    Find the detections whose fate in the global non-maximum suppression can't change anymore.
+
+    Greedy non-maximum suppression decomposes into independent problems for the connected components of the
+    graph in which two detections of the same class are connected if their IoU similarity exceeds `iou_threshold`.
+    A detection is settled if it lies entirely above `bound`, where no future detection can reach it, and if it
+    isn't connected to any unsettled detection.
+
+    Arguments:
+        detections (array): A 2D Numpy array of shape `(n, 6)` with detections in the format
+            `[class_id, confidence, xmin, xmax, ymin, ymax]`.
+        bound (float): The smallest `ymin` that any future detection can have.
+        iou_threshold (float): The IoU threshold of the non-maximum suppression.
+
+    Returns:
+        A boolean Numpy array of shape `(n,)` that is `True` for the settled detections.
+    '''
+    settled = detections[:,5] <= bound
+    while np.any(settled) and not np.all(settled):
+        similarities = iou_matrix(detections[settled,2:], detections[~settled,2:], coords='minmax')
+        same_class = detections[settled,0][:,np.newaxis] == detections[~settled,0]
+        connected = np.any(~(similarities <= iou_threshold) & same_class, axis=1)
+        if not np.any(connected):
+            break
+        settled[np.nonzero(settled)[0][connected]] = False
+    return settled
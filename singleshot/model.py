@@ -0,0 +1,1524 @@
+"""
+Includes:
+* The SSD300 model with its custom layers, the SSD loss and the optimizer and checkpoint helpers for training it
+* The `trainssd` and `predictssd` command line tools
+"""
+
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+from keras import Input, backend as K
+from keras.callbacks import ModelCheckpoint, LearningRateScheduler
+from keras.engine import Model, Layer, InputSpec
+from keras.layers import Lambda, Conv2D, MaxPooling2D, Reshape, Concatenate, Activation
+from keras.models import load_model
+from keras.optimizers import Adam
+from keras.utils import multi_gpu_model
+
+from singleshot.anchors import anchor_boxes, n_boxes_per_cell
+from singleshot.boxes import convert_coordinates, decode_y
+from singleshot.inference import expand_inputs, find_images, predict_files, predict_scene, write_detections
+from singleshot.sequence import BatchSequence
+from singleshot.util import PACK_WAIT_TIMEOUT, SSDBoxEncoder, BatchGenerator
+
+# The directories that are searched for the pretrained VGG-16 weights, in this order
+w_roots = ['/osn/share/vgg/', 'vgg/']
+# The numbers of the VGG-16 layers whose weights are used by `SSD()`
+VGG_LAYERS = (1, 2, 4, 5, 7, 8, 9, 11, 12, 13, 15, 16, 17)
+# The names of the layers of `SSD()` that are initialized with the VGG-16 weights
+VGG_LAYER_NAMES = ('conv1_1', 'conv1_2', 'conv2_1', 'conv2_2', 'conv3_1', 'conv3_2', 'conv3_3',
+                   'conv4_1', 'conv4_2', 'conv4_3', 'conv5_1', 'conv5_2', 'conv5_3')
+# The VGG-16 weights, loaded once per process by `get_w()`
+_vgg_weights = {}
+
+
+def load_vgg_weights(w_root=None):
+    '''
+    Load the pretrained VGG-16 weights.
+
+    The weights are read from the consolidated archive `vgg16.npz` in `w_root` (see `save_vgg_weights()`) with one read
+    if it exists, and from the individual files `{n}_0.npy` (kernel) and `{n}_1.npy` (bias) of each layer `n` otherwise.
+
+    Arguments:
+        w_root (str, optional): The directory of the weights. Defaults to `None`, i.e. the first directory in `w_roots`
+            that exists.
+
+    Returns:
+        A dictionary that maps `'{n}_0'` and `'{n}_1'` to the kernel and the bias of VGG-16 layer `n`.
+    '''
+    if w_root is None:
+        w_root = next((root for root in w_roots if os.path.exists(root)), w_roots[-1])
+    archive_path = os.path.join(w_root, 'vgg16.npz')
+    if os.path.exists(archive_path):
+        with np.load(archive_path) as archive:
+            return {key: archive[key] for key in archive.files}
+    return {'{}_{}'.format(n, i): np.load(os.path.join(w_root, '{}_{}.npy'.format(n, i))) for n in VGG_LAYERS for i in (0, 1)}
+
+
+def save_vgg_weights(archive_path, w_root=None):
+    '''
+    Consolidate the per-layer VGG-16 weight files into one archive, so that `get_w()` reads them with one request,
+    e.g. `save_vgg_weights('/osn/share/vgg/vgg16.npz', '/osn/share/vgg/')`.
+
+    Arguments:
+        archive_path (str): The path of the `.npz` archive to write.
+        w_root (str, optional): The directory of the weights, see `load_vgg_weights()`. Defaults to `None`.
+
+    Returns:
+        None.
+    '''
+    np.savez(archive_path, **load_vgg_weights(w_root))
+
+
+def has_vgg_weights(checkpoint_path):
+    '''
+    Tell whether a Keras HDF5 file, saved by `Model.save()` or `Model.save_weights()`, contains the weights of all
+    layers in `VGG_LAYER_NAMES`, so that loading it with `by_name=True` overwrites the VGG-16 weights of `SSD()`.
+
+    Arguments:
+        checkpoint_path (str): The path of the HDF5 file.
+
+    Returns:
+        `True` if the file contains weights for every VGG-16 layer, `False` otherwise.
+    '''
+    import h5py
+
+    with h5py.File(checkpoint_path, 'r') as f:
+        weights = f['model_weights'] if 'model_weights' in f else f  # `Model.save()` puts the weights into a group
+        layer_names = {name.decode('utf8') if isinstance(name, bytes) else name for name in weights.attrs.get('layer_names', [])}
+        return all(name in layer_names and len(weights[name].attrs.get('weight_names', [])) > 0 for name in VGG_LAYER_NAMES)
+
+
+def get_w(n):
+    '''
+    Returns:
+        The list `[kernel, bias]` of the pretrained weights of VGG-16 layer `n`. All weights are loaded on the first call,
+        later calls return them from memory.
+    '''
+    if not _vgg_weights:
+        _vgg_weights.update(load_vgg_weights())
+    return [_vgg_weights['{}_0'.format(n)], _vgg_weights['{}_1'.format(n)]]
+
+
+def SSD(image_size,
+        n_classes,
+        min_scale=0.1,
+        max_scale=0.9,
+        scales=None,
+        aspect_ratios_global=None,
+        aspect_ratios_per_layer=[[0.5, 1.0, 2.0],
+                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                                     [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                                     [0.5, 1.0, 2.0],
+                                     [0.5, 1.0, 2.0]],
+        two_boxes_for_ar1=True,
+        limit_boxes=False,
+        variances=[0.1, 0.1, 0.2, 0.2],
+        coords='centroids',
+        normalize_coords=False,
+        mixed_precision=False,
+        lean_output=False,
+        vgg_weights=True):
+    '''
+    Build a Keras model with SSD_300 architecture, see references.
+
+    The base network is a reduced atrous VGG-16, extended by the SSD architecture,
+    as described in the paper.
+
+    In case you're wondering why this function has so many arguments: All arguments except
+    the first two (`image_size` and `n_classes`) are only needed so that the anchor box
+    layers can produce the correct anchor boxes. In case you're training the network, the
+    parameters passed here must be the same as the ones used to set up `SSDBoxEncoder`.
+    In case you're loading trained weights, the parameters passed here must be the same
+    as the ones used to produce the trained weights.
+
+    Some of these arguments are explained in more detail in the documentation of the
+    `SSDBoxEncoder` class.
+
+    Note: Requires Keras v2.0 or later. Currently works only with the
+    TensorFlow backend (v1.0 or later).
+
+    Arguments:
+        image_size (tuple): The input image size in the format `(height, width, channels)`.
+        n_classes (int): The number of categories for classification including
+            the background class (i.e. the number of positive classes +1 for
+            the background calss).
+        min_scale (float, optional): The smallest scaling factor for the size of the anchor boxes as a fraction
+            of the shorter side of the input images. Defaults to 0.1.
+        max_scale (float, optional): The largest scaling factor for the size of the anchor boxes as a fraction
+            of the shorter side of the input images. All scaling factors between the smallest and the
+            largest will be linearly interpolated. Note that the second to last of the linearly interpolated
+            scaling factors will actually be the scaling factor for the last predictor layer, while the last
+            scaling factor is used for the second box for aspect ratio 1 in the last predictor layer
+            if `two_boxes_for_ar1` is `True`. Defaults to 0.9.
+        scales (list, optional): A list of floats containing scaling factors per convolutional predictor layer.
+            This list must be one element longer than the number of predictor layers. The first `k` elements are the
+            scaling factors for the `k` predictor layers, while the last element is used for the second box
+            for aspect ratio 1 in the last predictor layer if `two_boxes_for_ar1` is `True`. This additional
+            last scaling factor must be passed either way, even if it is not being used.
+            Defaults to `None`. If a list is passed, this argument overrides `min_scale` and
+            `max_scale`. All scaling factors must be greater than zero.
+        aspect_ratios_global (list, optional): The list of aspect ratios for which anchor boxes are to be
+            generated. This list is valid for all prediction layers. Defaults to None.
+        aspect_ratios_per_layer (list, optional): A list containing one aspect ratio list for each prediction layer.
+            This allows you to set the aspect ratios for each predictor layer individually, which is the case for the
+            original SSD300 implementation. If a list is passed, it overrides `aspect_ratios_global`.
+            Defaults to the aspect ratios used in the original SSD300 architecture, i.e.:
+                [[0.5, 1.0, 2.0],
+                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                 [1.0/3.0, 0.5, 1.0, 2.0, 3.0],
+                 [0.5, 1.0, 2.0],
+                 [0.5, 1.0, 2.0]]
+        two_boxes_for_ar1 (bool, optional): Only relevant for aspect ratio lists that contain 1. Will be ignored otherwise.
+            If `True`, two anchor boxes will be generated for aspect ratio 1. The first will be generated
+            using the scaling factor for the respective layer, the second one will be generated using
+            geometric mean of said scaling factor and next bigger scaling factor. Defaults to `True`, following the original
+            implementation.
+        limit_boxes (bool, optional): If `True`, limits box coordinates to stay within image boundaries.
+            This would normally be set to `True`, but here it defaults to `False`, following the original
+            implementation.
+        variances (list, optional): A list of 4 floats >0 with scaling factors (actually it's not factors but divisors
+            to be precise) for the encoded predicted box coordinates. A variance value of 1.0 would apply
+            no scaling at all to the predictions, while values in (0,1) upscale the encoded predictions and values greater
+            than 1.0 downscale the encoded predictions. Defaults to `[0.1, 0.1, 0.2, 0.2]`, following the original implementation.
+            The coordinate format must be 'centroids'.
+        coords (str, optional): The box coordinate format to be used. Can be either 'centroids' for the format
+            `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax' for the format
+            `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids', following the original implementation.
+        normalize_coords (bool, optional): Set to `True` if the model is supposed to use relative instead of absolute coordinates,
+            i.e. if the model predicts box coordinates within [0,1] instead of absolute coordinates. Defaults to `False`.
+        mixed_precision (bool, optional): If `True`, the convolutions and their activations are computed in float16, while
+            the weights, the L2 normalization, the softmax, the anchor boxes and thus the output of the model stay
+            float32. Train such a model with `LossScaledAdam`. Works on the CPU, too, but is only faster on GPUs with
+            fast float16 arithmetic. Defaults to `False`.
+        lean_output (bool, optional): If `True`, the model outputs only the class confidences and the box offsets, but not
+            the anchor boxes and variances, see `lean_output_model()`. Defaults to `False`.
+        vgg_weights (bool, optional): If `True`, the base network is initialized with the pretrained VGG-16 weights,
+            see `get_w()`. Set it to `False` if all weights are loaded from a checkpoint right after, so that the VGG-16
+            weights aren't read just to be overwritten. Defaults to `True`.
+
+    Returns:
+        model: The Keras SSD model.
+        predictor_sizes: A Numpy array containing the `(height, width)` portion
+            of the output tensor shape for each convolutional predictor layer. During
+            training, the generator function needs this in order to transform
+            the ground truth labels into tensors of identical structure as the
+            output tensors of the model, which is in turn needed for the cost
+            function.
+
+    References:
+        https://arxiv.org/abs/1512.02325v5
+    '''
+
+    n_predictor_layers = 6 # The number of predictor conv layers in the network is 6 for the original SSD300
+
+    # Get a few exceptions out of the way first
+    if aspect_ratios_global is None and aspect_ratios_per_layer is None:
+        raise ValueError("`aspect_ratios_global` and `aspect_ratios_per_layer` cannot both be None. At least one needs to be specified.")
+    if aspect_ratios_per_layer:
+        if len(aspect_ratios_per_layer) != n_predictor_layers:
+            raise ValueError("It must be either aspect_ratios_per_layer is None or len(aspect_ratios_per_layer) == {}, but len(aspect_ratios_per_layer) == {}.".format(n_predictor_layers, len(aspect_ratios_per_layer)))
+
+    if (min_scale is None or max_scale is None) and scales is None:
+        raise ValueError("Either `min_scale` and `max_scale` or `scales` need to be specified.")
+    if scales:
+        if len(scales) != n_predictor_layers+1:
+            raise ValueError("It must be either scales is None or len(scales) == {}, but len(scales) == {}.".format(n_predictor_layers+1, len(scales)))
+    else: # If no explicit list of scaling factors was passed, compute the list of scaling factors from `min_scale` and `max_scale`
+        scales = np.linspace(min_scale, max_scale, n_predictor_layers+1)
+
+    if len(variances) != 4:
+        raise ValueError("4 variance values must be pased, but {} values were received.".format(len(variances)))
+    variances = np.array(variances)
+    if np.any(variances <= 0):
+        raise ValueError("All variances must be >0, but the variances given are {}".format(variances))
+
+    # Set the aspect ratios for each predictor layer. These are only needed for the anchor box layers.
+    if aspect_ratios_per_layer:
+        aspect_ratios_conv4_3 = aspect_ratios_per_layer[0]
+        aspect_ratios_fc7 = aspect_ratios_per_layer[1]
+        aspect_ratios_conv6_2 = aspect_ratios_per_layer[2]
+        aspect_ratios_conv7_2 = aspect_ratios_per_layer[3]
+        aspect_ratios_conv8_2 = aspect_ratios_per_layer[4]
+        aspect_ratios_conv9_2 = aspect_ratios_per_layer[5]
+    else:
+        aspect_ratios_conv4_3 = aspect_ratios_global
+        aspect_ratios_fc7 = aspect_ratios_global
+        aspect_ratios_conv6_2 = aspect_ratios_global
+        aspect_ratios_conv7_2 = aspect_ratios_global
+        aspect_ratios_conv8_2 = aspect_ratios_global
+        aspect_ratios_conv9_2 = aspect_ratios_global
+
+    # Compute the number of boxes to be predicted per cell for each predictor layer.
+    # We need this so that we know how many channels the predictor layers need to have.
+    if aspect_ratios_per_layer:
+        n_boxes = []
+        for aspect_ratios in aspect_ratios_per_layer:
+            if (1 in aspect_ratios) & two_boxes_for_ar1:
+                n_boxes.append(len(aspect_ratios) + 1) # +1 for the second box for aspect ratio 1
+            else:
+                n_boxes.append(len(aspect_ratios))
+        n_boxes_conv4_3 = n_boxes[0] # 4 boxes per cell for the original implementation
+        n_boxes_fc7 = n_boxes[1] # 6 boxes per cell for the original implementation
+        n_boxes_conv6_2 = n_boxes[2] # 6 boxes per cell for the original implementation
+        n_boxes_conv7_2 = n_boxes[3] # 6 boxes per cell for the original implementation
+        n_boxes_conv8_2 = n_boxes[4] # 4 boxes per cell for the original implementation
+        n_boxes_conv9_2 = n_boxes[5] # 4 boxes per cell for the original implementation
+    else: # If only a global aspect ratio list was passed, then the number of boxes is the same for each predictor layer
+        if (1 in aspect_ratios_global) & two_boxes_for_ar1:
+            n_boxes = len(aspect_ratios_global) + 1
+        else:
+            n_boxes = len(aspect_ratios_global)
+        n_boxes_conv4_3 = n_boxes
+        n_boxes_fc7 = n_boxes
+        n_boxes_conv6_2 = n_boxes
+        n_boxes_conv7_2 = n_boxes
+        n_boxes_conv8_2 = n_boxes
+        n_boxes_conv9_2 = n_boxes
+
+    # Input image format
+    img_height, img_width, img_channels = image_size[0], image_size[1], image_size[2]
+
+    ### Design the actual network
+
+    conv2d = MixedPrecisionConv2D if mixed_precision else Conv2D
+    w = get_w if vgg_weights else lambda n: None # `weights=None` keeps the default initialization
+
+    x = Input(shape=(img_height, img_width, img_channels))
+    normed = Lambda(lambda z: z/127.5 - 1.0, # Convert input feature range to [-1,1]
+                    output_shape=(img_height, img_width, img_channels),
+                    name='lambda1')(x)
+
+    conv1_1 = conv2d(64, (3, 3), activation='relu', padding='same', name='conv1_1', weights=w(1), trainable=False)(normed)
+    conv1_2 = conv2d(64, (3, 3), activation='relu', padding='same', name='conv1_2', weights=w(2), trainable=False)(conv1_1)
+    pool1 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool1')(conv1_2)
+
+    conv2_1 = conv2d(128, (3, 3), activation='relu', padding='same', name='conv2_1', trainable=False, weights=w(4))(pool1)
+    conv2_2 = conv2d(128, (3, 3), activation='relu', padding='same', name='conv2_2', trainable=False, weights=w(5))(conv2_1)
+    pool2 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool2')(conv2_2)
+
+    conv3_1 = conv2d(256, (3, 3), activation='relu', padding='same', name='conv3_1', trainable=False, weights=w(7))(pool2)
+    conv3_2 = conv2d(256, (3, 3), activation='relu', padding='same', name='conv3_2', trainable=False, weights=w(8))(conv3_1)
+    conv3_3 = conv2d(256, (3, 3), activation='relu', padding='same', name='conv3_3', trainable=False, weights=w(9))(conv3_2)
+    pool3 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool3')(conv3_3)
+
+    conv4_1 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv4_1', weights=w(11))(pool3)
+    conv4_2 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv4_2', weights=w(12))(conv4_1)
+    conv4_3 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv4_3', weights=w(13))(conv4_2)
+    pool4 = MaxPooling2D(pool_size=(2, 2), strides=(2, 2), padding='valid', name='pool4')(conv4_3)
+
+    conv5_1 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv5_1', weights=w(15))(pool4)
+    conv5_2 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv5_2', weights=w(16))(conv5_1)
+    conv5_3 = conv2d(512, (3, 3), activation='relu', padding='same', name='conv5_3', weights=w(17))(conv5_2)
+    pool5 = MaxPooling2D(pool_size=(3, 3), strides=(1, 1), padding='same', name='pool5')(conv5_3)
+
+    fc6 = conv2d(1024, (3, 3), dilation_rate=(6, 6), activation='relu', padding='same', name='fc6')(pool5)
+
+    fc7 = conv2d(1024, (1, 1), activation='relu', padding='same', name='fc7')(fc6)
+
+    conv6_1 = conv2d(256, (1, 1), activation='relu', padding='same', name='conv6_1')(fc7)
+    conv6_2 = conv2d(512, (3, 3), strides=(2, 2), activation='relu', padding='same', name='conv6_2')(conv6_1)
+
+    conv7_1 = conv2d(128, (1, 1), activation='relu', padding='same', name='conv7_1')(conv6_2)
+    conv7_2 = conv2d(256, (3, 3), strides=(2, 2), activation='relu', padding='same', name='conv7_2')(conv7_1)
+
+    conv8_1 = conv2d(128, (1, 1), activation='relu', padding='same', name='conv8_1')(conv7_2)
+    conv8_2 = conv2d(256, (3, 3), strides=(1, 1), activation='relu', padding='valid', name='conv8_2')(conv8_1)
+
+    conv9_1 = conv2d(128, (1, 1), activation='relu', padding='same', name='conv9_1')(conv8_2)
+    conv9_2 = conv2d(256, (3, 3), strides=(1, 1), activation='relu', padding='valid', name='conv9_2')(conv9_1)
+
+    # Feed conv4_3 into the L2 normalization layer
+    conv4_3_norm = L2Normalization(gamma_init=20, name='conv4_3_norm')(conv4_3)
+
+    ### Build the convolutional predictor layers on top of the base network
+
+    # We precidt `n_classes` confidence values for each box, hence the confidence predictors have depth `n_boxes * n_classes`
+    # Output shape of the confidence layers: `(batch, height, width, n_boxes * n_classes)`
+    conv4_3_norm_mbox_conf = conv2d(n_boxes_conv4_3 * n_classes, (3, 3), padding='same', name='conv4_3_norm_mbox_conf')(conv4_3_norm)
+    fc7_mbox_conf = conv2d(n_boxes_fc7 * n_classes, (3, 3), padding='same', name='fc7_mbox_conf')(fc7)
+    conv6_2_mbox_conf = conv2d(n_boxes_conv6_2 * n_classes, (3, 3), padding='same', name='conv6_2_mbox_conf')(conv6_2)
+    conv7_2_mbox_conf = conv2d(n_boxes_conv7_2 * n_classes, (3, 3), padding='same', name='conv7_2_mbox_conf')(conv7_2)
+    conv8_2_mbox_conf = conv2d(n_boxes_conv8_2 * n_classes, (3, 3), padding='same', name='conv8_2_mbox_conf')(conv8_2)
+    conv9_2_mbox_conf = conv2d(n_boxes_conv9_2 * n_classes, (3, 3), padding='same', name='conv9_2_mbox_conf')(conv9_2)
+    # We predict 4 box coordinates for each box, hence the localization predictors have depth `n_boxes * 4`
+    # Output shape of the localization layers: `(batch, height, width, n_boxes * 4)`
+    conv4_3_norm_mbox_loc = conv2d(n_boxes_conv4_3 * 4, (3, 3), padding='same', name='conv4_3_norm_mbox_loc')(conv4_3_norm)
+    fc7_mbox_loc = conv2d(n_boxes_fc7 * 4, (3, 3), padding='same', name='fc7_mbox_loc')(fc7)
+    conv6_2_mbox_loc = conv2d(n_boxes_conv6_2 * 4, (3, 3), padding='same', name='conv6_2_mbox_loc')(conv6_2)
+    conv7_2_mbox_loc = conv2d(n_boxes_conv7_2 * 4, (3, 3), padding='same', name='conv7_2_mbox_loc')(conv7_2)
+    conv8_2_mbox_loc = conv2d(n_boxes_conv8_2 * 4, (3, 3), padding='same', name='conv8_2_mbox_loc')(conv8_2)
+    conv9_2_mbox_loc = conv2d(n_boxes_conv9_2 * 4, (3, 3), padding='same', name='conv9_2_mbox_loc')(conv9_2)
+
+    ### Generate the anchor boxes (called "priors" in the original Caffe/C++ implementation, so I'll keep their layer names)
+
+    # Output shape of anchors: `(batch, height, width, n_boxes, 8)`
+    conv4_3_norm_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[0], next_scale=scales[1], aspect_ratios=aspect_ratios_conv4_3,
+                                             two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv4_3_norm_mbox_priorbox')(conv4_3_norm_mbox_loc)
+    fc7_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[1], next_scale=scales[2], aspect_ratios=aspect_ratios_fc7,
+                                    two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='fc7_mbox_priorbox')(fc7_mbox_loc)
+    conv6_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[2], next_scale=scales[3], aspect_ratios=aspect_ratios_conv6_2,
+                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv6_2_mbox_priorbox')(conv6_2_mbox_loc)
+    conv7_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[3], next_scale=scales[4], aspect_ratios=aspect_ratios_conv7_2,
+                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv7_2_mbox_priorbox')(conv7_2_mbox_loc)
+    conv8_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[4], next_scale=scales[5], aspect_ratios=aspect_ratios_conv8_2,
+                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv8_2_mbox_priorbox')(conv8_2_mbox_loc)
+    conv9_2_mbox_priorbox = AnchorBoxes(img_height, img_width, this_scale=scales[5], next_scale=scales[6], aspect_ratios=aspect_ratios_conv9_2,
+                                        two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances, coords=coords, normalize_coords=normalize_coords, name='conv9_2_mbox_priorbox')(conv9_2_mbox_loc)
+
+    ### Reshape
+
+    # Reshape the class predictions, yielding 3D tensors of shape `(batch, height * width * n_boxes, n_classes)`
+    # We want the classes isolated in the last axis to perform softmax on them
+    conv4_3_norm_mbox_conf_reshape = Reshape((-1, n_classes), name='conv4_3_norm_mbox_conf_reshape')(conv4_3_norm_mbox_conf)
+    fc7_mbox_conf_reshape = Reshape((-1, n_classes), name='fc7_mbox_conf_reshape')(fc7_mbox_conf)
+    conv6_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv6_2_mbox_conf_reshape')(conv6_2_mbox_conf)
+    conv7_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv7_2_mbox_conf_reshape')(conv7_2_mbox_conf)
+    conv8_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv8_2_mbox_conf_reshape')(conv8_2_mbox_conf)
+    conv9_2_mbox_conf_reshape = Reshape((-1, n_classes), name='conv9_2_mbox_conf_reshape')(conv9_2_mbox_conf)
+    # Reshape the box predictions, yielding 3D tensors of shape `(batch, height * width * n_boxes, 4)`
+    # We want the four box coordinates isolated in the last axis to compute the smooth L1 loss
+    conv4_3_norm_mbox_loc_reshape = Reshape((-1, 4), name='conv4_3_norm_mbox_loc_reshape')(conv4_3_norm_mbox_loc)
+    fc7_mbox_loc_reshape = Reshape((-1, 4), name='fc7_mbox_loc_reshape')(fc7_mbox_loc)
+    conv6_2_mbox_loc_reshape = Reshape((-1, 4), name='conv6_2_mbox_loc_reshape')(conv6_2_mbox_loc)
+    conv7_2_mbox_loc_reshape = Reshape((-1, 4), name='conv7_2_mbox_loc_reshape')(conv7_2_mbox_loc)
+    conv8_2_mbox_loc_reshape = Reshape((-1, 4), name='conv8_2_mbox_loc_reshape')(conv8_2_mbox_loc)
+    conv9_2_mbox_loc_reshape = Reshape((-1, 4), name='conv9_2_mbox_loc_reshape')(conv9_2_mbox_loc)
+    # Reshape the anchor box tensors, yielding 3D tensors of shape `(batch, height * width * n_boxes, 8)`
+    conv4_3_norm_mbox_priorbox_reshape = Reshape((-1, 8), name='conv4_3_norm_mbox_priorbox_reshape')(conv4_3_norm_mbox_priorbox)
+    fc7_mbox_priorbox_reshape = Reshape((-1, 8), name='fc7_mbox_priorbox_reshape')(fc7_mbox_priorbox)
+    conv6_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv6_2_mbox_priorbox_reshape')(conv6_2_mbox_priorbox)
+    conv7_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv7_2_mbox_priorbox_reshape')(conv7_2_mbox_priorbox)
+    conv8_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv8_2_mbox_priorbox_reshape')(conv8_2_mbox_priorbox)
+    conv9_2_mbox_priorbox_reshape = Reshape((-1, 8), name='conv9_2_mbox_priorbox_reshape')(conv9_2_mbox_priorbox)
+
+    ### Concatenate the predictions from the different layers
+
+    # Axis 0 (batch) and axis 2 (n_classes or 4, respectively) are identical for all layer predictions,
+    # so we want to concatenate along axis 1, the number of boxes per layer
+    # Output shape of `mbox_conf`: (batch, n_boxes_total, n_classes)
+    mbox_conf = Concatenate(axis=1, name='mbox_conf')([conv4_3_norm_mbox_conf_reshape,
+                                                       fc7_mbox_conf_reshape,
+                                                       conv6_2_mbox_conf_reshape,
+                                                       conv7_2_mbox_conf_reshape,
+                                                       conv8_2_mbox_conf_reshape,
+                                                       conv9_2_mbox_conf_reshape])
+
+    # Output shape of `mbox_loc`: (batch, n_boxes_total, 4)
+    mbox_loc = Concatenate(axis=1, name='mbox_loc')([conv4_3_norm_mbox_loc_reshape,
+                                                     fc7_mbox_loc_reshape,
+                                                     conv6_2_mbox_loc_reshape,
+                                                     conv7_2_mbox_loc_reshape,
+                                                     conv8_2_mbox_loc_reshape,
+                                                     conv9_2_mbox_loc_reshape])
+
+    # Output shape of `mbox_priorbox`: (batch, n_boxes_total, 8)
+    mbox_priorbox = Concatenate(axis=1, name='mbox_priorbox')([conv4_3_norm_mbox_priorbox_reshape,
+                                                               fc7_mbox_priorbox_reshape,
+                                                               conv6_2_mbox_priorbox_reshape,
+                                                               conv7_2_mbox_priorbox_reshape,
+                                                               conv8_2_mbox_priorbox_reshape,
+                                                               conv9_2_mbox_priorbox_reshape])
+
+    if mixed_precision:  # Compute the softmax and the loss in float32
+        mbox_conf = Cast('float32', name='mbox_conf_float32')(mbox_conf)
+        mbox_loc = Cast('float32', name='mbox_loc_float32')(mbox_loc)
+
+    # The box coordinate predictions will go into the loss function just the way they are,
+    # but for the class predictions, we'll apply a softmax activation layer first
+    mbox_conf_softmax = Activation('softmax', name='mbox_conf_softmax')(mbox_conf)
+
+    # Concatenate the class and box predictions and the anchors to one large predictions vector
+    # Output shape of `predictions`: (batch, n_boxes_total, n_classes + 4 + 8)
+    predictions = Concatenate(axis=2, name='predictions')([mbox_conf_softmax, mbox_loc, mbox_priorbox])
+
+    model = Model(inputs=x, outputs=predictions)
+    if lean_output:
+        model = lean_output_model(model)
+
+    # Get the spatial dimensions (height, width) of the predictor conv layers, we need them to
+    # be able to generate the default boxes for the matching process outside of the model during training.
+    # Note that the original implementation performs anchor box matching inside the loss function. We don't do that.
+    # Instead, we'll do it in the batch generator function.
+    # The spatial dimensions are the same for the confidence and localization predictors, so we just take those of the conf layers.
+    predictor_sizes = np.array([conv4_3_norm_mbox_conf._keras_shape[1:3],
+                                 fc7_mbox_conf._keras_shape[1:3],
+                                 conv6_2_mbox_conf._keras_shape[1:3],
+                                 conv7_2_mbox_conf._keras_shape[1:3],
+                                 conv8_2_mbox_conf._keras_shape[1:3],
+                                 conv9_2_mbox_conf._keras_shape[1:3]])
+
+    return model, predictor_sizes
+
+
+def lean_output_model(model):
+    '''
+    Return a model that shares all layers and weights with an SSD model, but only outputs the class confidences
+    and the box offsets.
+
+    The last 8 values per box of the output of `SSD()` are the anchor box coordinates and variances. They are the
+    same for every image, but they are copied from the device for every batch, and `y_true` has to carry 8 dummy
+    values per box to match. The lean model leaves them out. Its output has shape `(batch, n_boxes_total, n_classes + 4)`.
+    Train it with `SSDLoss(lean_output=True)` and `SSDBoxEncoder(lean_output=True)`, and decode its output with
+    `decode_y(anchors=...)`, where the anchor boxes come from `SSDBoxEncoder.anchors`.
+
+    Since the weights are shared, the original model can be saved instead of the lean one, e.g. with `TemplateCheckpoint`,
+    so that the saved model still contains the anchor boxes for inference.
+
+    Arguments:
+        model (Model): A model built by `SSD()`.
+
+    Returns:
+        The lean model.
+    '''
+    mbox_conf_softmax, mbox_loc, mbox_priorbox = model.get_layer('predictions').input
+    predictions = Concatenate(axis=2, name='predictions_lean')([mbox_conf_softmax, mbox_loc])
+    return Model(inputs=model.input, outputs=predictions)
+
+
+def detection_model(model, **kwargs):
+    '''
+    Return a model that shares all layers and weights with an SSD model, but ends in a `DecodeDetections` layer,
+    so that it outputs the final detections instead of the raw predictions.
+
+    Save this model for inference to have the decoding and the non-maximum suppression run in the graph.
+    `predict_files()`, `predict_scene()` and `predictssd` recognize such a model and use its detections as they are.
+
+    Arguments:
+        model (Model): A model built by `SSD()` without `lean_output`, since the decoding needs the anchor boxes.
+        **kwargs: The arguments of `DecodeDetections`, e.g. `confidence_thresh`, `iou_threshold`, `top_k` and `coords`.
+
+    Returns:
+        The detection model. Its output has shape `(batch, top_k, 6)`, see `DecodeDetections`.
+    '''
+    detections = DecodeDetections(name='detections', **kwargs)(model.output)
+    return Model(inputs=model.input, outputs=detections)
+
+
+class SSDLoss:
+    '''
+    The SSD loss, see https://arxiv.org/abs/1512.02325.
+    '''
+
+    def __init__(self,
+                 neg_pos_ratio=3,
+                 n_neg_min=0,
+                 alpha=1.0,
+                 lean_output=False):
+        '''
+        Arguments:
+            neg_pos_ratio (int, optional): The maximum ratio of negative (i.e. background)
+                to positive ground truth boxes to include in the loss computation.
+                There are no actual background ground truth boxes of course, but `y_true`
+                contains anchor boxes labeled with the background class. Since
+                the number of background boxes in `y_true` will usually exceed
+                the number of positive boxes by far, it is necessary to balance
+                their influence on the loss. Defaults to 3 following the paper.
+            n_neg_min (int, optional): The minimum number of negative ground truth boxes to
+                enter the loss computation *per batch*. This argument can be used to make
+                sure that the model learns from a minimum number of negatives in batches
+                in which there are very few, or even none at all, positive ground truth
+                boxes. It defaults to 0 and if used, it should be set to a value that
+                stands in reasonable proportion to the batch size used for training.
+            alpha (float, optional): A factor to weight the localization loss in the
+                computation of the total loss. Defaults to 1.0 following the paper.
+            lean_output (bool, optional): Set to `True` for a model built with `lean_output=True`, whose output
+                and `y_true` don't have the last 8 values per box. Defaults to `False`.
+        '''
+        self.neg_pos_ratio = tf.constant(neg_pos_ratio)
+        self.n_neg_min = tf.constant(n_neg_min)
+        self.alpha = tf.constant(alpha)
+        self.lean_output = lean_output
+
+    def smooth_L1_loss(self, y_true, y_pred):
+        '''
+        Compute smooth L1 loss, see references.
+
+        Arguments:
+            y_true (nD tensor): A TensorFlow tensor of any shape containing the ground truth data.
+                In this context, the expected tensor has shape `(batch_size, #boxes, 4)` and
+                contains the ground truth bounding box coordinates, where the last dimension
+                contains `(xmin, xmax, ymin, ymax)`.
+            y_pred (nD tensor): A TensorFlow tensor of identical structure to `y_true` containing
+                the predicted data, in this context the predicted bounding box coordinates.
+
+        Returns:
+            The smooth L1 loss, a nD-1 Tensorflow tensor. In this context a 2D tensor
+            of shape (batch, n_boxes_total).
+
+        References:
+            https://arxiv.org/abs/1504.08083
+        '''
+        absolute_loss = tf.abs(y_true - y_pred)
+        square_loss = 0.5 * (y_true - y_pred)**2
+        l1_loss = tf.where(tf.less(absolute_loss, 1.0), square_loss, absolute_loss - 0.5)
+        return tf.reduce_sum(l1_loss, axis=-1)
+
+    def log_loss(self, y_true, y_pred):
+        '''
+        Compute the softmax log loss.
+
+        Arguments:
+            y_true (nD tensor): A TensorFlow tensor of any shape containing the ground truth data.
+                In this context, the expected tensor has shape (batch_size, #boxes, #classes)
+                and contains the ground truth bounding box categories.
+            y_pred (nD tensor): A TensorFlow tensor of identical structure to `y_true` containing
+                the predicted data, in this context the predicted bounding box categories.
+
+        Returns:
+            The softmax log loss, a nD-1 Tensorflow tensor. In this context a 2D tensor
+            of shape (batch, n_boxes_total).
+        '''
+        # Make sure that `y_pred` doesn't contain any zeros (which would break the log function)
+        y_pred = tf.maximum(y_pred, 1e-15)
+        # Compute the log loss
+        log_loss = -tf.reduce_sum(y_true * tf.log(y_pred), axis=-1)
+        return log_loss
+
+    def compute_loss(self, y_true, y_pred):
+        '''
+        Compute the loss of the SSD model prediction against the ground truth.
+
+        Arguments:
+            y_true (array): A Numpy array of shape `(batch_size, #boxes, #classes + 8)`,
+                where `#boxes` is the total number of boxes that the model predicts
+                per image. Be careful to make sure that the index of each given
+                box in `y_true` is the same as the index for the corresponding
+                box in `y_pred`. The last axis must have length `#classes + 8` and contain
+                `[classes one-hot encoded, 4 ground truth box coordinates, 4 arbitrary entries]`
+                in this order, including the background class. The last four entries of the
+                last axis are not used by this function and therefore their contents are
+                irrelevant, they only exist so that `y_true` has the same shape as `y_pred`,
+                where the last four entries of the last axis contain the anchor box
+                coordinates, which are needed during inference. Important: Boxes that
+                you want the cost function to ignore need to have a one-hot
+                class vector of all zeros.
+                If `lean_output` is `True`, the last axis has length `#classes + 4` instead.
+            y_pred (Keras tensor): The model prediction. The shape is identical
+                to that of `y_true`.
+
+        Returns:
+            A scalar, the total multitask loss for classification and localization.
+        '''
+        y_true = tf.cast(y_true, tf.float32) # Always compute the loss in float32, even for mixed precision models
+        y_pred = tf.cast(y_pred, tf.float32)
+        if not self.lean_output: # Throw away the anchor box coordinates and variances, which the loss doesn't use
+            y_true = y_true[:,:,:-8]
+            y_pred = y_pred[:,:,:-8]
+
+        batch_size = tf.shape(y_pred)[0] # Output dtype: tf.int32
+        n_boxes = tf.shape(y_pred)[1] # Output dtype: tf.int32, note that `n_boxes` in this context denotes the total number of boxes per image, not the number of boxes per cell
+
+        # 1: Compute the losses for class and box predictions for every box
+
+        classification_loss = tf.to_float(self.log_loss(y_true[:,:,:-4], y_pred[:,:,:-4])) # Output shape: (batch_size, n_boxes)
+        localization_loss = tf.to_float(self.smooth_L1_loss(y_true[:,:,-4:], y_pred[:,:,-4:])) # Output shape: (batch_size, n_boxes)
+
+        # 2: Compute the classification losses for the positive and negative targets
+
+        # Create masks for the positive and negative ground truth classes
+        negatives = y_true[:,:,0] # Tensor of shape (batch_size, n_boxes)
+        positives = tf.to_float(tf.reduce_max(y_true[:,:,1:-4], axis=-1)) # Tensor of shape (batch_size, n_boxes)
+
+        # Count the number of positive boxes (classes 1 to n) in y_true across the whole batch
+        n_positive = tf.reduce_sum(positives)
+
+        # Now mask all negative boxes and sum up the losses for the positive boxes PER batch item
+        # (Keras loss functions must output one scalar loss value PER batch item, rather than just
+        # one scalar for the entire batch, that's why we're not summing across all axes)
+        pos_class_loss = tf.reduce_sum(classification_loss * positives, axis=-1) # Tensor of shape (batch_size,)
+
+        # Compute the classification loss for the negative default boxes (if there are any)
+
+        # First, compute the classification loss for all negative boxes
+        neg_class_loss_all = classification_loss * negatives # Tensor of shape (batch_size, n_boxes)
+        n_neg_losses = tf.count_nonzero(neg_class_loss_all, dtype=tf.int32) # The number of non-zero loss entries in `neg_class_loss_all`
+        # What's the point of `n_neg_losses`? For the next step, which will be to compute which negative boxes enter the classification
+        # loss, we don't just want to know how many negative ground truth boxes there are, but for how many of those there actually is
+        # a positive (i.e. non-zero) loss. This is necessary because `tf.nn.top-k()` in the function below will pick the top k boxes with
+        # the highest losses no matter what, even if it receives a vector where all losses are zero. In the unlikely event that all negative
+        # classification losses ARE actually zero though, this behavior might lead to `tf.nn.top-k()` returning the indices of positive
+        # boxes, leading to an incorrect negative classification loss computation, and hence an incorrect overall loss computation.
+        # We therefore need to make sure that `n_negative_keep`, which assumes the role of the `k` argument in `tf.nn.top-k()`,
+        # is at most the number of negative boxes for which there is a positive classification loss.
+
+        # Compute the number of negative examples we want to account for in the loss
+        # We'll keep at most `self.neg_pos_ratio` times the number of positives in `y_true`, but at least `self.n_neg_min` (unless `n_neg_loses` is smaller)
+        n_negative_keep = tf.minimum(tf.maximum(self.neg_pos_ratio * tf.to_int32(n_positive), self.n_neg_min), n_neg_losses)
+
+        # In the unlikely case when either (1) there are no negative ground truth boxes at all
+        # or (2) the classification loss for all negative boxes is zero, return zero as the `neg_class_loss`
+        def f1():
+            return tf.zeros([batch_size])
+        # Otherwise compute the negative loss
+        def f2():
+            # Now we'll identify the top-k (where k == `n_negative_keep`) boxes with the highest confidence loss that
+            # belong to the background class in the ground truth data. Note that this doesn't necessarily mean that the model
+            # predicted the wrong class for those boxes, it just means that the loss for those boxes is the highest.
+
+            # To do this, we reshape `neg_class_loss_all` to 1D...
+            neg_class_loss_all_1D = tf.reshape(neg_class_loss_all, [-1]) # Tensor of shape (batch_size * n_boxes,)
+            # ...and then we get the indices for the `n_negative_keep` boxes with the highest loss out of those...
+            values, indices = tf.nn.top_k(neg_class_loss_all_1D, n_negative_keep, False) # We don't need sorting
+            # ...and with these indices we'll create a mask...
+            negatives_keep = tf.scatter_nd(tf.expand_dims(indices, axis=1), updates=tf.ones_like(indices, dtype=tf.int32), shape=tf.shape(neg_class_loss_all_1D)) # Tensor of shape (batch_size * n_boxes,)
+            negatives_keep = tf.to_float(tf.reshape(negatives_keep, [batch_size, n_boxes])) # Tensor of shape (batch_size, n_boxes)
+            # ...and use it to keep only those boxes and mask all other classification losses
+            neg_class_loss = tf.reduce_sum(classification_loss * negatives_keep, axis=-1) # Tensor of shape (batch_size,)
+            return neg_class_loss
+
+        neg_class_loss = tf.cond(tf.equal(n_neg_losses, tf.constant(0)), f1, f2)
+
+        class_loss = pos_class_loss + neg_class_loss # Tensor of shape (batch_size,)
+
+        # 3: Compute the localization loss for the positive targets
+        #    We don't penalize localization loss for negative predicted boxes (obviously: there are no ground truth boxes they would correspond to)
+
+        loc_loss = tf.reduce_sum(localization_loss * positives, axis=-1) # Tensor of shape (batch_size,)
+
+        # 4: Compute the total loss
+
+        total_loss = (class_loss + self.alpha * loc_loss) # In case `n_positive == 0`
+
+        return total_loss
+
+
+class L2Normalization(Layer):
+    '''
+    Performs L2 normalization on the input tensor with a learnable scaling parameter
+    as described in the paper "Parsenet: Looking Wider to See Better" (see references)
+    and as used in the original SSD model.
+
+    Arguments:
+        gamma_init (int): The initial scaling parameter. Defaults to 20 following the
+            SSD paper.
+
+    Input shape:
+        4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
+        or `(batch, height, width, channels)` if `dim_ordering = 'tf'`.
+
+    Returns:
+        The scaled tensor. Same shape as the input tensor.
+
+    References:
+        http://cs.unc.edu/~wliu/papers/parsenet.pdf
+    '''
+
+    def __init__(self, gamma_init=20, **kwargs):
+        if K.image_dim_ordering() == 'tf':
+            self.axis = 3
+        else:
+            self.axis = 1
+        self.gamma_init = gamma_init
+        super(L2Normalization, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.input_spec = [InputSpec(shape=input_shape)]
+        gamma = self.gamma_init * np.ones((input_shape[self.axis],))
+        self.gamma = K.variable(gamma, name='{}_gamma'.format(self.name))
+        self.trainable_weights = [self.gamma]
+        super(L2Normalization, self).build(input_shape)
+
+    def call(self, x, mask=None):
+        output = K.l2_normalize(K.cast(x, 'float32'), self.axis) # The sum of squares easily overflows in float16
+        output *= self.gamma
+        return output
+
+    def get_config(self):
+        config = {'gamma_init': self.gamma_init}
+        base_config = super(L2Normalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class AnchorBoxes(Layer):
+    '''
+    A Keras layer to create an output tensor containing anchor box coordinates based on the
+    input tensor and the passed arguments.
+
+    A set of 2D anchor boxes of different aspect ratios is created for each spatial unit of
+    the input tensor. The number of anchor boxes created per unit depends on the arguments
+    `aspect_ratios` and `two_boxes_for_ar1`, in the default case it is 4. The boxes
+    are parameterized by the coordinate tuple `(xmin, xmax, ymin, ymax)`.
+
+    The anchor boxes are computed by `singleshot.anchors.anchor_boxes()`, which `SSDBoxEncoder` uses as well,
+    so the anchor boxes of the model and of the encoded labels always match.
+
+    The purpose of having this layer in the network is to make the model self-sufficient
+    at inference time. Since the model is predicting offsets to the anchor boxes
+    (rather than predicting absolute box coordinates directly), one needs to know the anchor
+    box coordinates in order to construct the final prediction boxes from the predicted offsets.
+    If the model's output tensor did not contain the anchor box coordinates, the necessary
+    information to convert the predicted offsets back to absolute coordinates would be missing
+    in the model output. The reason why it is necessary to predict offsets to the anchor boxes
+    rather than to predict absolute box coordinates directly is explained in `README.md`.
+
+    Input shape:
+        4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
+        or `(batch, height, width, channels)` if `dim_ordering = 'tf'`.
+
+    Output shape:
+        5D tensor of shape `(batch, height, width, n_boxes, 4)`.
+    '''
+
+    def __init__(self,
+                 img_height,
+                 img_width,
+                 this_scale,
+                 next_scale,
+                 aspect_ratios=[0.5, 1.0, 2.0],
+                 two_boxes_for_ar1=True,
+                 limit_boxes=True,
+                 variances=[1.0, 1.0, 1.0, 1.0],
+                 coords='centroids',
+                 normalize_coords=False,
+                 **kwargs):
+        '''
+        All arguments need to be set to the same values as in the box encoding process, otherwise the behavior is undefined.
+        Some of these arguments are explained in more detail in the documentation of the `SSDBoxEncoder` class.
+
+        Arguments:
+            img_height (int): The height of the input images.
+            img_width (int): The width of the input images.
+            this_scale (float): A float in [0, 1], the scaling factor for the size of the generated anchor boxes
+                as a fraction of the shorter side of the input image.
+            next_scale (float): A float in [0, 1], the next larger scaling factor. Only relevant if
+                `self.two_boxes_for_ar1 == True`.
+            aspect_ratios (list, optional): The list of aspect ratios for which default boxes are to be
+                generated for this layer. Defaults to [0.5, 1.0, 2.0].
+            two_boxes_for_ar1 (bool, optional): Only relevant if `aspect_ratios` contains 1.
+                If `True`, two default boxes will be generated for aspect ratio 1. The first will be generated
+                using the scaling factor for the respective layer, the second one will be generated using
+                geometric mean of said scaling factor and next bigger scaling factor. Defaults to `True`.
+            limit_boxes (bool, optional): If `True`, limits box coordinates to stay within image boundaries.
+                Defaults to `True`.
+            variances (list, optional): A list of 4 floats >0 with scaling factors (actually it's not factors but divisors
+                to be precise) for the encoded predicted box coordinates. A variance value of 1.0 would apply
+                no scaling at all to the predictions, while values in (0,1) upscale the encoded predictions and values greater
+                than 1.0 downscale the encoded predictions. If you want to reproduce the configuration of the original SSD,
+                set this to `[0.1, 0.1, 0.2, 0.2]`, provided the coordinate format is 'centroids'. Defaults to `[1.0, 1.0, 1.0, 1.0]`.
+            coords (str, optional): The box coordinate format to be used. Can be either 'centroids' for the format
+                `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax' for the format
+                `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+            normalize_coords (bool, optional): Set to `True` if the model uses relative instead of absolute coordinates,
+                i.e. if the model predicts box coordinates within [0,1] instead of absolute coordinates. Defaults to `False`.
+        '''
+        if K.backend() != 'tensorflow':
+            raise TypeError("This layer only supports TensorFlow at the moment, but you are using the {} backend.".format(K.backend()))
+
+        if (this_scale < 0) or (next_scale < 0) or (this_scale > 1):
+            raise ValueError("`this_scale` must be in [0, 1] and `next_scale` must be >0, but `this_scale` == {}, `next_scale` == {}".format(this_scale, next_scale))
+
+        if len(variances) != 4:
+            raise ValueError("4 variance values must be pased, but {} values were received.".format(len(variances)))
+        variances = np.array(variances)
+        if np.any(variances <= 0):
+            raise ValueError("All variances must be >0, but the variances given are {}".format(variances))
+
+        self.img_height = img_height
+        self.img_width = img_width
+        self.this_scale = this_scale
+        self.next_scale = next_scale
+        self.aspect_ratios = aspect_ratios
+        self.two_boxes_for_ar1 = two_boxes_for_ar1
+        self.limit_boxes = limit_boxes
+        self.variances = variances
+        self.coords = coords
+        self.normalize_coords = normalize_coords
+        # Compute the number of boxes per cell
+        self.n_boxes = n_boxes_per_cell(aspect_ratios, two_boxes_for_ar1)
+        super(AnchorBoxes, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.input_spec = [InputSpec(shape=input_shape)]
+
+        # The anchor boxes only depend on the arguments and the size of the feature map, so compute them once here
+        # with the same function that `SSDBoxEncoder` uses and keep them as a non-trainable constant
+        if K.image_dim_ordering() == 'tf':
+            batch_size, feature_map_height, feature_map_width, feature_map_channels = input_shape
+        else: # Not yet relevant since TensorFlow is the only supported backend right now, but it can't harm to have this in here for the future
+            batch_size, feature_map_channels, feature_map_height, feature_map_width = input_shape
+        boxes_tensor = anchor_boxes(self.img_height,
+                                    self.img_width,
+                                    feature_map_size=(feature_map_height, feature_map_width),
+                                    aspect_ratios=self.aspect_ratios,
+                                    this_scale=self.this_scale,
+                                    next_scale=self.next_scale,
+                                    two_boxes_for_ar1=self.two_boxes_for_ar1,
+                                    limit_boxes=self.limit_boxes,
+                                    variances=self.variances,
+                                    coords=self.coords,
+                                    normalize_coords=self.normalize_coords)
+        # Prepend one dimension for the batch size, the result has shape `(1, feature_map_height, feature_map_width, n_boxes, 8)`
+        self.boxes_tensor = K.constant(np.expand_dims(boxes_tensor, axis=0), dtype='float32')
+
+        super(AnchorBoxes, self).build(input_shape)
+
+    def call(self, x, mask=None):
+        '''
+        Return an anchor box tensor based on the shape of the input tensor.
+
+        The anchor boxes were computed once in `build()`, see `anchor_boxes()`. Note that this tensor does not
+        participate in any graph computations at runtime, it is just tiled along the batch axis and output along with
+        the rest of the model output.
+
+        Arguments:
+            x (tensor): 4D tensor of shape `(batch, channels, height, width)` if `dim_ordering = 'th'`
+                or `(batch, height, width, channels)` if `dim_ordering = 'tf'`. The input for this
+                layer must be the output of the localization predictor layer.
+        '''
+        # The result will be a 5D tensor of shape `(batch_size, feature_map_height, feature_map_width, n_boxes, 8)`
+        return K.tile(self.boxes_tensor, (K.shape(x)[0], 1, 1, 1, 1))
+
+    def compute_output_shape(self, input_shape):
+        if K.image_dim_ordering() == 'tf':
+            batch_size, feature_map_height, feature_map_width, feature_map_channels = input_shape
+        else: # Not yet relevant since TensorFlow is the only supported backend right now, but it can't harm to have this in here for the future
+            batch_size, feature_map_channels, feature_map_height, feature_map_width = input_shape
+        return (batch_size, feature_map_height, feature_map_width, self.n_boxes, 8)
+
+    def get_config(self):
+        config = {'img_height': self.img_height,
+                  'img_width': self.img_width,
+                  'this_scale': float(self.this_scale),
+                  'next_scale': float(self.next_scale),
+                  'aspect_ratios': [float(ar) for ar in self.aspect_ratios],
+                  'two_boxes_for_ar1': self.two_boxes_for_ar1,
+                  'limit_boxes': self.limit_boxes,
+                  'variances': [float(v) for v in self.variances],
+                  'coords': self.coords,
+                  'normalize_coords': self.normalize_coords}
+        base_config = super(AnchorBoxes, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class DecodeDetections(Layer):
+    '''
+    A Keras layer to decode the raw SSD prediction output inside the graph, so that the model
+    emits final detections instead of the raw predictions tensor.
+
+    The layer performs the same steps as `decode_y()`: It converts the predicted offsets back to absolute box
+    coordinates using the anchor box coordinates and variances that the `AnchorBoxes` layers append to the
+    predictions, then performs confidence thresholding and greedy non-maximum suppression for each class
+    individually and finally keeps the `top_k` highest scoring detections of all classes. Since Keras tensors need
+    a fixed shape, the output for every image is padded with all-zero rows up to `top_k` detections. Padding rows
+    are recognizable by their class ID 0, the background class.
+
+    The layer is meant to be appended to a trained model for inference with `detection_model()`, e.g.:
+
+        inference_model = detection_model(model, coords=coords, normalize_coords=normalize_coords,
+                                          img_height=img_height, img_width=img_width)
+
+    Input shape:
+        3D tensor of shape `(batch, n_boxes_total, n_classes + 4 + 8)`, the output of the `SSD()` model.
+
+    Output shape:
+        3D tensor of shape `(batch, top_k, 6)`, where the last axis contains
+        `[class_id, confidence, xmin, xmax, ymin, ymax]`, sorted by descending confidence.
+    '''
+
+    def __init__(self,
+                 confidence_thresh=0.01,
+                 iou_threshold=0.45,
+                 top_k=200,
+                 nms_max_output_size=400,
+                 coords='centroids',
+                 normalize_coords=False,
+                 img_height=None,
+                 img_width=None,
+                 **kwargs):
+        '''
+        All arguments except `nms_max_output_size` have the same meaning as the respective arguments of `decode_y()`.
+
+        Arguments:
+            confidence_thresh (float, optional): A float in [0,1), the minimum classification confidence in a specific
+                positive class in order to be considered for the non-maximum suppression stage for the respective class.
+                Defaults to 0.01.
+            iou_threshold (float, optional): A float in [0,1]. All boxes with a Jaccard similarity of greater than `iou_threshold`
+                with a locally maximal box will be removed from the set of predictions for a given class. Defaults to 0.45.
+            top_k (int, optional): The number of highest scoring detections to be kept for each image. Defaults to 200.
+            nms_max_output_size (int, optional): The maximum number of boxes that the non-maximum suppression can select
+                per class. Defaults to 400.
+            coords (str, optional): The box coordinate format that the model outputs. Can be either 'centroids'
+                for the format `(cx, cy, w, h)` or 'minmax' for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
+            normalize_coords (bool, optional): Set to `True` if the model outputs relative coordinates and you wish to
+                transform these back to absolute coordinates. Requires `img_height` and `img_width`. Defaults to `False`.
+            img_height (int, optional): The height of the input images. Only needed if `normalize_coords` is `True`.
+            img_width (int, optional): The width of the input images. Only needed if `normalize_coords` is `True`.
+        '''
+        if K.backend() != 'tensorflow':
+            raise TypeError("This layer only supports TensorFlow at the moment, but you are using the {} backend.".format(K.backend()))
+
+        if normalize_coords and ((img_height is None) or (img_width is None)):
+            raise ValueError("If relative box coordinates are supposed to be converted to absolute coordinates, the decoder needs the image size in order to decode the predictions, but `img_height == {}` and `img_width == {}`".format(img_height, img_width))
+
+        if coords not in ('centroids', 'minmax'):
+            raise ValueError("Unexpected value for `coords`. Supported input coordinate formats are 'minmax' and 'centroids'.")
+
+        self.confidence_thresh = confidence_thresh
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+        self.nms_max_output_size = nms_max_output_size
+        self.coords = coords
+        self.normalize_coords = normalize_coords
+        self.img_height = img_height
+        self.img_width = img_width
+        super(DecodeDetections, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.input_spec = [InputSpec(shape=input_shape)]
+        super(DecodeDetections, self).build(input_shape)
+
+    def call(self, y_pred, mask=None):
+        '''
+        Return the padded detections tensor for the raw predictions tensor `y_pred`.
+
+        The coordinate conversion is the same as in `decode_y()`. The last 12 elements of the last axis
+        of `y_pred` are the 4 predicted offsets, the 4 anchor box coordinates and the 4 variances.
+        '''
+        n_classes = K.int_shape(y_pred)[-1] - 12
+
+        # 1: Convert the box coordinates from the predicted anchor box offsets to predicted absolute coordinates
+
+        if self.coords == 'centroids':
+            cx = y_pred[...,-12] * y_pred[...,-4] * y_pred[...,-6] + y_pred[...,-8] # delta_cx(pred) / w(anchor) / cx_variance * cx_variance * w(anchor) + cx(anchor) == cx(pred)
+            cy = y_pred[...,-11] * y_pred[...,-3] * y_pred[...,-5] + y_pred[...,-7] # delta_cy(pred) / h(anchor) / cy_variance * cy_variance * h(anchor) + cy(anchor) == cy(pred)
+            w = tf.exp(y_pred[...,-10] * y_pred[...,-2]) * y_pred[...,-6] # exp(ln(w(pred)/w(anchor)) / w_variance * w_variance) * w(anchor) == w(pred)
+            h = tf.exp(y_pred[...,-9] * y_pred[...,-1]) * y_pred[...,-5] # exp(ln(h(pred)/h(anchor)) / h_variance * h_variance) * h(anchor) == h(pred)
+            xmin, xmax, ymin, ymax = cx - w / 2.0, cx + w / 2.0, cy - h / 2.0, cy + h / 2.0
+        else:
+            anchor_w = y_pred[...,-7] - y_pred[...,-8]
+            anchor_h = y_pred[...,-5] - y_pred[...,-6]
+            xmin = y_pred[...,-12] * y_pred[...,-4] * anchor_w + y_pred[...,-8] # delta(pred) / size(anchor) / variance * variance * size(anchor) + anchor == pred
+            xmax = y_pred[...,-11] * y_pred[...,-3] * anchor_w + y_pred[...,-7]
+            ymin = y_pred[...,-10] * y_pred[...,-2] * anchor_h + y_pred[...,-6]
+            ymax = y_pred[...,-9] * y_pred[...,-1] * anchor_h + y_pred[...,-5]
+
+        # 2: If the model predicts normalized box coordinates and they are supposed to be converted back to absolute coordinates, do that
+
+        if self.normalize_coords:
+            xmin, xmax = xmin * self.img_width, xmax * self.img_width
+            ymin, ymax = ymin * self.img_height, ymax * self.img_height
+
+        boxes = tf.stack([xmin, xmax, ymin, ymax], axis=-1) # Shape `(batch, n_boxes_total, 4)`
+
+        # 3: Apply confidence thresholding and non-maximum suppression per class, then keep the `top_k` detections of each image
+
+        def filter_predictions(inputs):
+            confidences, image_boxes = inputs # Shapes `(n_boxes_total, n_classes)` and `(n_boxes_total, 4)`
+            nms_boxes = tf.stack([image_boxes[:,2], image_boxes[:,0], image_boxes[:,3], image_boxes[:,1]], axis=-1) # `tf.image.non_max_suppression()` expects `(ymin, xmin, ymax, xmax)`
+            detections = []
+            for class_id in range(1, n_classes): # For each class except the background class...
+                threshold_met = tf.where(confidences[:,class_id] > self.confidence_thresh)[:,0] # ...keep only the boxes with a confidence above the threshold...
+                scores = tf.gather(confidences[:,class_id], threshold_met)
+                maxima = tf.image.non_max_suppression(tf.gather(nms_boxes, threshold_met), scores, # ...and perform NMS on them.
+                                                      max_output_size=self.nms_max_output_size,
+                                                      iou_threshold=self.iou_threshold)
+                maxima_boxes = tf.gather(tf.gather(image_boxes, threshold_met), maxima)
+                maxima_scores = tf.expand_dims(tf.gather(scores, maxima), axis=-1)
+                class_ids = tf.fill(tf.shape(maxima_scores), float(class_id))
+                detections.append(tf.concat([class_ids, maxima_scores, maxima_boxes], axis=-1))
+            detections = tf.concat(detections, axis=0) # Shape `(n_maxima, 6)`
+            # Keep only the `top_k` maxima with the highest scores and pad the result to exactly `top_k` rows
+            n_detections = tf.minimum(self.top_k, tf.shape(detections)[0])
+            top_k_indices = tf.nn.top_k(detections[:,1], k=n_detections, sorted=True).indices
+            detections = tf.gather(detections, top_k_indices)
+            return tf.pad(detections, [[0, self.top_k - n_detections], [0, 0]])
+
+        y_pred_decoded = tf.map_fn(filter_predictions, (y_pred[...,:n_classes], boxes), dtype=tf.float32)
+        y_pred_decoded.set_shape((None, self.top_k, 6))
+
+        return y_pred_decoded
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.top_k, 6)
+
+    def get_config(self):
+        config = {'confidence_thresh': self.confidence_thresh,
+                  'iou_threshold': self.iou_threshold,
+                  'top_k': self.top_k,
+                  'nms_max_output_size': self.nms_max_output_size,
+                  'coords': self.coords,
+                  'normalize_coords': self.normalize_coords,
+                  'img_height': self.img_height,
+                  'img_width': self.img_width}
+        base_config = super(DecodeDetections, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class MixedPrecisionConv2D(Conv2D):
+    '''
+    A `Conv2D` layer that computes the convolution and the activation in float16, but keeps its weights in float32.
+
+    The inputs and the weights are cast to float16 for every call, the output is float16. The weights are
+    updated in float32, so that small updates don't get lost to the limited precision of float16.
+    Takes the same arguments as `Conv2D`.
+    '''
+
+    def call(self, inputs):
+        outputs = K.conv2d(K.cast(inputs, 'float16'),
+                           K.cast(self.kernel, 'float16'),
+                           strides=self.strides,
+                           padding=self.padding,
+                           data_format=self.data_format,
+                           dilation_rate=self.dilation_rate)
+        if self.use_bias:
+            outputs = K.bias_add(outputs, K.cast(self.bias, 'float16'), data_format=self.data_format)
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
+
+
+class Cast(Layer):
+    '''
+    A Keras layer that casts its input to another data type.
+
+    Arguments:
+        target_dtype (str): The data type of the output, e.g. 'float32'.
+
+    Input shape:
+        A tensor of any shape.
+
+    Output shape:
+        The same shape as the input.
+    '''
+
+    def __init__(self, target_dtype, **kwargs):
+        self.target_dtype = target_dtype
+        super(Cast, self).__init__(**kwargs)
+
+    def call(self, x, mask=None):
+        return K.cast(x, self.target_dtype)
+
+    def get_config(self):
+        config = {'target_dtype': self.target_dtype}
+        base_config = super(Cast, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class LossScaledAdam(Adam):
+    '''
+    The Adam optimizer with dynamic loss scaling for mixed precision models.
+
+    Small gradients underflow to zero in float16. To prevent that, the loss is multiplied by the loss scale
+    before the gradients are computed, and the gradients are divided by it afterwards. If any gradient is not finite,
+    the step is skipped: the weights and the optimizer state, i.e. the iteration count that drives the bias correction
+    and the learning rate decay and the moment estimates, are left unchanged, and only the loss scale is halved.
+    After `growth_interval` batches in a row with finite gradients, the loss scale is doubled.
+    '''
+
+    def __init__(self, initial_scale=2.0**15, growth_interval=2000, **kwargs):
+        '''
+        Arguments:
+            initial_scale (float, optional): The initial loss scale. Defaults to 2**15.
+            growth_interval (int, optional): The number of batches with finite gradients after which the loss scale
+                is doubled. Defaults to 2000.
+            **kwargs: The arguments of `Adam`.
+        '''
+        super(LossScaledAdam, self).__init__(**kwargs)
+        self.initial_scale = initial_scale
+        self.growth_interval = growth_interval
+        with K.name_scope(self.__class__.__name__):
+            self.loss_scale = K.variable(initial_scale, name='loss_scale')
+            self.good_steps = K.variable(0, name='good_steps')
+
+    def get_gradients(self, loss, params):
+        grads = K.gradients(loss * self.loss_scale, params)
+        if None in grads:
+            raise ValueError("An operation has `None` for gradient. Please make sure that all of your ops have a gradient defined (i.e. are differentiable).")
+        grads = [g / self.loss_scale for g in grads]
+        self.finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in grads])
+        grads = [K.switch(self.finite, g, K.zeros_like(g)) for g in grads]
+        if getattr(self, 'clipnorm', 0) > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [g * self.clipnorm / K.maximum(norm, self.clipnorm) for g in grads]
+        if getattr(self, 'clipvalue', 0) > 0:
+            grads = [K.clip(g, -self.clipvalue, self.clipvalue) for g in grads]
+        return grads
+
+    def get_updates(self, loss, params):
+        '''
+        The updates of `Adam`, except that every update keeps the old value if the gradients are not finite.
+        '''
+        grads = self.get_gradients(loss, params)
+
+        def update(x, new_x):
+            return K.update(x, K.switch(self.finite, new_x, x))
+
+        self.updates = [update(self.iterations, self.iterations + 1)]
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr = lr * (1. / (1. + self.decay * K.cast(self.iterations, K.dtype(self.decay))))
+
+        t = K.cast(self.iterations, K.floatx()) + 1
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        amsgrad = getattr(self, 'amsgrad', False)
+        epsilon = K.epsilon() if self.epsilon is None else self.epsilon
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params] if amsgrad else [K.zeros(1) for _ in params]
+        self.weights = [self.iterations] + ms + vs + vhats
+
+        for p, g, m, v, vhat in zip(params, grads, ms, vs, vhats):
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+            if amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + epsilon)
+                self.updates.append(update(vhat, vhat_t))
+            else:
+                p_t = p - lr_t * m_t / (K.sqrt(v_t) + epsilon)
+            self.updates.append(update(m, m_t))
+            self.updates.append(update(v, v_t))
+            if getattr(p, 'constraint', None) is not None:
+                p_t = p.constraint(p_t)
+            self.updates.append(update(p, p_t))
+
+        good_steps = K.switch(self.finite, self.good_steps + 1, K.zeros_like(self.good_steps))
+        grow = K.greater_equal(good_steps, self.growth_interval)
+        loss_scale = K.switch(self.finite, K.switch(grow, self.loss_scale * 2, self.loss_scale), self.loss_scale / 2)
+        self.updates.append(K.update(self.loss_scale, K.maximum(loss_scale, 1.0)))
+        self.updates.append(K.update(self.good_steps, K.switch(grow, K.zeros_like(good_steps), good_steps)))
+        return self.updates
+
+    def get_config(self):
+        config = {'initial_scale': self.initial_scale,
+                  'growth_interval': self.growth_interval}
+        base_config = super(LossScaledAdam, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class TemplateCheckpoint(ModelCheckpoint):
+    '''
+    A `ModelCheckpoint` that saves a template model instead of the model that is being trained.
+
+    `multi_gpu_model()` returns a model that replicates the template model on every GPU and shares its weights.
+    Saving that model would save the replicas and the splitting of the batches along with the weights, so
+    the checkpoints could only be loaded on a machine with as many GPUs. This callback saves the single-device
+    template instead. Likewise, it can save the full SSD model while its `lean_output_model()` is being trained.
+    '''
+
+    def __init__(self, template, filepath, **kwargs):
+        '''
+        Arguments:
+            template (Model): The model to save.
+            filepath (str): See `ModelCheckpoint`.
+            **kwargs: The other arguments of `ModelCheckpoint`.
+        '''
+        super(TemplateCheckpoint, self).__init__(filepath, **kwargs)
+        self.template = template
+
+    def set_model(self, model):
+        super(TemplateCheckpoint, self).set_model(self.template)
+
+
+def count_gpus(gpus):
+    '''
+    Count the GPUs to train on. Must be called after `CUDA_VISIBLE_DEVICES` has been set.
+
+    Arguments:
+        gpus (str): The comma separated list of the requested GPUs, e.g. the value of `--gpus`.
+
+    Returns:
+        The number of GPUs that TensorFlow can see, but at most the number of requested GPUs, and at least 1,
+        i.e. 1 on a machine without GPUs.
+    '''
+    from tensorflow.python.client import device_lib
+
+    n_requested = len([gpu for gpu in gpus.split(',') if gpu.strip()])
+    n_visible = len([device for device in device_lib.list_local_devices() if device.device_type == 'GPU'])
+    return max(min(n_requested, n_visible), 1)
+
+
+def console():
+    parser = ArgumentParser()
+    parser.add_argument('--model')
+    parser.add_argument('--name', default='ssd')
+    parser.add_argument('--scale', type=float)
+    parser.add_argument('--classes', type=lambda ss: [int(s) for s in ss.split(',')])
+    parser.add_argument('--min_scale', type=float)
+    parser.add_argument('--max_scale', type=float)
+    parser.add_argument('--epochs', type=int, default=1000)
+    parser.add_argument('--rgb_to_gray', type=bool, default=False)
+    parser.add_argument('--gray_to_rgb', type=bool, default=False)
+    parser.add_argument('--multispectral_to_rgb', type=bool, default=False)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--outcsv', default='ssd_results.csv')
+    parser.add_argument('--split_ratio', type=float, default=1.0)
+    parser.add_argument('--gpus', default='0,1,2,3')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--multiprocessing', action='store_true')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--pack')
+    parser.add_argument('--pack_timeout', type=float, default=PACK_WAIT_TIMEOUT)
+    parser.add_argument('--index')
+    parser.add_argument('--rank', type=int, default=0)
+    parser.add_argument('--world_size', type=int, default=1)
+    parser.add_argument('--stratify', action='store_true')
+    parser.add_argument('--mixed_precision', action='store_true')
+    parser.add_argument('--lean_output', action='store_true')
+    parser.add_argument('--export_detections', action='store_true')
+    parser.add_argument('csv', default='/osn/share/rail.csv')
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+    n_gpus = count_gpus(args.gpus)
+    batch_size = args.batch_size * n_gpus  # `--batch_size` is per GPU, every GPU gets one slice of the global batch
+
+    def append_to_aspect_ratio_list(aspect_ratios = None,
+                              max_aspect_ratio = None):
+
+        ratios = list(1 / np.linspace(1.0, max_aspect_ratio, 6))
+        ratios.reverse()
+        ratios += list(np.linspace(1.0, max_aspect_ratio, 6))[1:]
+
+        aspect_ratios.append(ratios)
+
+    print(args.min_scale, args.max_scale)
+    img_height = 300  # Height of the input images
+    img_width = 300  # Width of the input images
+    img_channels = 3  # Number of color channels of the input images
+    n_classes = len(args.classes)+1 if args.classes else 2
+    # Number of classes including the background class, e.g. 21 for the Pascal VOC datasets
+    #scales = [0.01, 0.04, 0.07, 0.1, 0.13, 0.17, 0.5 ] #[args.scale] * 7 if args.scale else None
+    scales = [args.scale] * 7 if args.scale else None
+    aspect_ratios = [[1.0]] * 6
+    #aspect_ratios = [] #[[1.0]] * 6
+    #append_to_aspect_ratio_list(aspect_ratios, 15.0)
+    #append_to_aspect_ratio_list(aspect_ratios, 12.0)
+    #append_to_aspect_ratio_list(aspect_ratios, 10.0)
+    #append_to_aspect_ratio_list(aspect_ratios, 6.0)
+    #append_to_aspect_ratio_list(aspect_ratios, 4.5)
+    #append_to_aspect_ratio_list(aspect_ratios, 4.0)
+    two_boxes_for_ar1 = True
+    limit_boxes = False
+    variances = [0.1, 0.1, 0.2, 0.2]
+    coords = 'minmax'
+    normalize_coords = False
+
+    K.clear_session()
+    with tf.device('/cpu:0' if n_gpus > 1 else None):  # With several GPUs, the template model and its weights live on the CPU and the replicas on the GPUs
+        model, predictor_sizes = SSD(image_size=(img_height, img_width, img_channels),
+                                         n_classes=n_classes,
+                                         min_scale=args.min_scale,
+                                         max_scale=args.max_scale,
+                                         scales=scales,
+                                         aspect_ratios_global=None,
+                                         aspect_ratios_per_layer=aspect_ratios,
+                                         two_boxes_for_ar1=two_boxes_for_ar1,
+                                         limit_boxes=limit_boxes,
+                                         variances=variances,
+                                         coords=coords,
+                                         normalize_coords=normalize_coords,
+                                         mixed_precision=args.mixed_precision,
+                                         vgg_weights=not (args.model and has_vgg_weights(args.model)))  # Unless the checkpoint overwrites them anyway
+    if args.model:
+        model.load_weights(args.model, by_name=True)
+
+    # Replicate the model on every GPU. Every replica gets a slice of each batch, the outputs are concatenated on the CPU,
+    # so the loss and thus the gradients are computed over the whole batch, and the shared weights are updated once.
+    # The lean model shares all weights with `model`, so the checkpoints below can save `model` with its anchor boxes
+    lean_model = lean_output_model(model) if args.lean_output else model
+    training_model = multi_gpu_model(lean_model, gpus=n_gpus) if n_gpus > 1 else lean_model
+
+    optimizer = LossScaledAdam if args.mixed_precision else Adam
+    training_model.compile(optimizer=(optimizer(lr=0.01 * n_gpus, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=5e-05)),
+                           loss=SSDLoss(neg_pos_ratio=3, n_neg_min=0, alpha=0.1, lean_output=args.lean_output).compute_loss)
+
+
+    ssd_box_encoder = SSDBoxEncoder(img_height=img_height,
+                                    img_width=img_width,
+                                    n_classes=n_classes,
+                                    predictor_sizes=predictor_sizes,
+                                    min_scale=args.min_scale,
+                                    max_scale=args.max_scale,
+                                    scales=scales,
+                                    aspect_ratios_global=None,
+                                    aspect_ratios_per_layer=aspect_ratios,
+                                    two_boxes_for_ar1=two_boxes_for_ar1,
+                                    limit_boxes=limit_boxes,
+                                    variances=variances,
+                                    pos_iou_threshold=0.4,
+                                    neg_iou_threshold=0.2,
+                                    coords=coords,
+                                    normalize_coords=normalize_coords,
+                                    anchors_cache_dir=args.name,
+                                    lean_output=args.lean_output)
+
+
+    dataset_generator = BatchGenerator(include_classes=args.classes)
+
+    if not os.path.exists(args.name):
+        os.mkdir(args.name)
+
+    index_path = args.index
+    if index_path is None and args.world_size > 1:
+        # Only rank 0 parses the CSV file if there is an index, see `BatchGenerator.parse_csv()`
+        index_path = os.path.join(args.name, 'index')
+
+    dataset_generator.parse_csv(labels_path=args.csv,
+                                input_format=['image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id'],
+                                split_ratio=args.split_ratio,
+                                checkpoints_path=args.name,
+                                seed=args.seed,
+                                rank=args.rank,
+                                world_size=args.world_size,
+                                stratify=args.stratify,
+                                index_path=index_path,
+                                pack_path=args.pack,
+                                pack_timeout=args.pack_timeout)
+
+    train_generator = BatchSequence(dataset_generator,
+                                    batch_size=batch_size,
+                                    ssd_box_encoder=ssd_box_encoder,
+                                    seed=args.seed,
+                                    limit_boxes=True,  # While the anchor boxes are not being clipped,
+                                    include_thresh=0.4,
+                                    rgb_to_gray=args.rgb_to_gray,
+                                    gray_to_rgb=args.gray_to_rgb,
+                                    multispectral_to_rgb=args.multispectral_to_rgb,
+                                    y_dtype='float32',
+                                    n_buffers=10 + args.workers + 2)  # `max_queue_size` of `fit_generator()` + workers + the batch being trained on
+
+    val_generator = BatchSequence(dataset_generator,
+                                  batch_size=batch_size,
+                                  ssd_box_encoder=ssd_box_encoder,
+                                  val=True,
+                                  seed=args.seed,
+                                  equalize=False,
+                                  brightness=False,
+                                  flip=False,
+                                  translate=False,
+                                  scale=False,
+                                  crop=False,
+                                  resize=False,
+                                  limit_boxes=True,
+                                  include_thresh=0.4,
+                                  rgb_to_gray=args.rgb_to_gray,
+                                  gray_to_rgb=args.gray_to_rgb,
+                                  multispectral_to_rgb=args.multispectral_to_rgb,
+                                  y_dtype='float32',
+                                  n_buffers=10 + args.workers + 2)
+
+    def lr_schedule(epoch):
+        # The learning rate grows linearly with the global batch size, i.e. with the number of GPUs
+        if epoch <= 500:
+            #return 0.01
+            return 0.0001 * n_gpus
+        else:
+            return 0.00001 * n_gpus
+
+    history = training_model.fit_generator(generator=train_generator,
+                                           steps_per_epoch=len(train_generator),
+                                           epochs=args.epochs,
+                                           callbacks=[TemplateCheckpoint(model,
+                                                                         './' + args.name + '/epoch{epoch:04d}_loss{loss:.4f}.h5',
+                                                                         monitor='val_loss',
+                                                                         verbose=1,
+                                                                         save_best_only=False,
+                                                                         save_weights_only=False,
+                                                                         mode='auto',
+                                                                         period=1),
+                                                      LearningRateScheduler(lr_schedule),
+                                                      ],
+                                           validation_data=val_generator,
+                                           validation_steps=len(val_generator),
+                                           workers=args.workers,
+                                           use_multiprocessing=args.multiprocessing)
+
+    model.save('./' + args.name + '/{}.h5'.format(args.name))
+    model.save_weights('./' + args.name + '/{}_weights.h5'.format(args.name))
+
+    print("Model and weights saved as {}[_weights].h5".format(args.name))
+
+    if args.export_detections:
+        detection_model(model,
+                        confidence_thresh=0.15,
+                        iou_threshold=0.35,
+                        top_k=200,
+                        coords=coords,
+                        normalize_coords=normalize_coords,
+                        img_height=img_height,
+                        img_width=img_width).save('./' + args.name + '/{}_detections.h5'.format(args.name))
+        print("Model with in-graph decoding saved as {}_detections.h5".format(args.name))
+
+    val_dir = '/osn/SpaceNet-MOD/testing/rgb-ps-dra/300/'
+
+    filenames = find_images(val_dir, extensions=('png',))
+    results = predict_files(model,
+                            filenames,
+                            batch_size=args.batch_size,
+                            confidence_thresh=0.15,
+                            iou_threshold=0.35,
+                            top_k=200,
+                            input_coords='minmax',
+                            normalize_coords=normalize_coords)
+    results = (([os.path.basename(filename) for filename in batch_filenames], y_pred_decoded) for batch_filenames, y_pred_decoded in results) # Write the file names without the directory
+    write_detections(results,
+                     './' + args.name + '/' + args.outcsv,
+                     class_map_inv=dataset_generator.class_map_inv)
+
+
+def predict_console():
+    parser = ArgumentParser()
+    parser.add_argument('model', help='trained model .h5 file')
+    parser.add_argument('inputs', nargs='+', help='image files, directories, glob patterns or CSV files with the image paths in the first column')
+    parser.add_argument('--out', default='detections.csv', help='output file, .csv or .parquet')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--conf', type=float, default=0.15, help='confidence threshold')
+    parser.add_argument('--iou', type=float, default=0.35, help='IoU threshold of the non-maximum suppression')
+    parser.add_argument('--top_k', type=int, default=200, help='maximum number of detections per image')
+    parser.add_argument('--classes', type=lambda ss: [int(s) for s in ss.split(',')], help='the --classes the model was trained with, to write the original class ids')
+    parser.add_argument('--bands', type=lambda ss: [int(s) for s in ss.split(',')], help='comma separated list of the bands to read, default all')
+    parser.add_argument('--coords', default='minmax', help='box coordinate format of the model, minmax or centroids')
+    parser.add_argument('--normalize_coords', action='store_true', help='the model predicts relative coordinates')
+    parser.add_argument('--scene', action='store_true', help='the inputs are large scenes, detect with a sliding window')
+    parser.add_argument('--overlap', type=int, default=60, help='overlap of the sliding windows in pixels')
+    args = parser.parse_args()
+
+    # The model is loaded as saved, so none of the training setup is needed
+    model = load_model(args.model,
+                       custom_objects={'L2Normalization': L2Normalization, 'AnchorBoxes': AnchorBoxes, 'DecodeDetections': DecodeDetections,
+                                       'MixedPrecisionConv2D': MixedPrecisionConv2D, 'Cast': Cast},
+                       compile=False)
+
+    filenames = expand_inputs(args.inputs)
+    class_map_inv = {k+1: v for k, v in enumerate(args.classes)} if args.classes else None
+
+    if args.scene:
+        results = (([filename], [detections])
+                   for filename in filenames
+                   for detections in predict_scene(model,
+                                                   filename,
+                                                   window_size=model.input_shape[1:3],
+                                                   overlap=args.overlap,
+                                                   batch_size=args.batch_size,
+                                                   bands=args.bands,
+                                                   confidence_thresh=args.conf,
+                                                   iou_threshold=args.iou,
+                                                   top_k=args.top_k,
+                                                   input_coords=args.coords,
+                                                   normalize_coords=args.normalize_coords))
+    else:
+        results = predict_files(model,
+                                filenames,
+                                batch_size=args.batch_size,
+                                bands=args.bands,
+                                confidence_thresh=args.conf,
+                                iou_threshold=args.iou,
+                                top_k=args.top_k,
+                                input_coords=args.coords,
+                                normalize_coords=args.normalize_coords)
+
+    n_detections = write_detections(results, args.out, class_map_inv=class_map_inv)
+
+    print("Saved {} detections in {} files to {}".format(n_detections, len(filenames), args.out))
+
+
+if __name__ == '__main__':
+    console()
\ No newline at end of file
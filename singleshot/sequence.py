@@ -0,0 +1,105 @@
+"""
+Includes:
+* A `keras.utils.Sequence` version of `BatchGenerator.generate()` that lets Keras produce batches in parallel workers
+
+This is the only part of the data pipeline that needs Keras, so it is kept apart from `singleshot.util`.
+"""
+
+import itertools
+
+import numpy as np
+from keras.utils import Sequence
+
+from singleshot.util import RingBuffer
+
+
+class BatchSequence(Sequence):
+    '''
+    A `keras.utils.Sequence` version of `BatchGenerator.generate()` in training mode.
+
+    Instead of one generator that loads, transforms and encodes the batches one after the other, this
+    class produces each batch independently by its index. This allows Keras to produce several batches
+    in parallel worker threads or processes and to keep up to `max_queue_size` ready batches in its
+    prefetch queue while the model trains, e.g.:
+
+        model.fit_generator(generator=BatchSequence(...), workers=4, use_multiprocessing=True, max_queue_size=10)
+
+    The samples are shuffled at the beginning of every epoch. Both the shuffling and the random image
+    transformations are seeded deterministically by `seed`, the epoch and the batch index, so the batches
+    are the same no matter which worker produces them or in which order.
+    '''
+
+    def __init__(self,
+                 batch_generator,
+                 batch_size=32,
+                 ssd_box_encoder=None,
+                 val=False,
+                 seed=None,
+                 image_dtype=None,
+                 y_dtype=None,
+                 n_buffers=0,
+                 **kwargs):
+        '''
+        Arguments:
+            batch_generator (BatchGenerator): The `BatchGenerator` that holds the dataset. `parse_csv()`
+                must have been called on it already.
+            batch_size (int, optional): The size of the batches to be generated. Defaults to 32.
+            ssd_box_encoder (SSDBoxEncoder): An SSDBoxEncoder object to encode the ground truth labels
+                to the required format for training an SSD model.
+            val (bool, optional): If `True`, the batches are generated from the validation samples,
+                otherwise from the training samples. Defaults to `False`.
+            seed (int, optional): The seed for the shuffling and the random image transformations. If `None`,
+                a random seed is drawn once when the sequence is created. Defaults to `None`.
+            image_dtype (str, optional): See `generate()`. Defaults to `None`.
+            y_dtype (str, optional): See `generate()`. Defaults to `None`.
+            n_buffers (int, optional): See `generate()`. The batches are written into the ring in the order in which they
+                are requested, so with worker threads, `n_buffers` must be larger than `max_queue_size` plus the number of
+                workers. Worker processes each have their own ring. Defaults to 0.
+            **kwargs: The image transformation arguments of `generate()`, i.e. `equalize`, `brightness`,
+                `flip`, `translate`, `scale`, `random_crop`, `crop`, `resize`, `rgb_to_gray`, `gray_to_rgb`,
+                `multispectral_to_rgb`, `limit_boxes` and `include_thresh`.
+        '''
+        if ssd_box_encoder is None:
+            raise ValueError("`ssd_box_encoder` cannot be `None`.")
+
+        self.batch_generator = batch_generator
+        if val:
+            self.filenames, self.labels = batch_generator.val_filenames, batch_generator.val_labels
+        else:
+            self.filenames, self.labels = batch_generator.train_filenames, batch_generator.train_labels
+        self.batch_size = batch_size
+        self.ssd_box_encoder = ssd_box_encoder
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.transforms = batch_generator.build_transforms(**kwargs)
+        self.image_buffers = RingBuffer(n_buffers, image_dtype)
+        self.y_buffers = RingBuffer(n_buffers, y_dtype)
+        self.slots = itertools.count() # `next()` is atomic, so worker threads never get the same slot
+        self.epoch = 0
+        self.order = self._permutation()
+
+    def _permutation(self):
+        '''
+        Returns:
+            The order of the samples for the current epoch.
+        '''
+        return np.random.RandomState([self.seed, self.epoch]).permutation(len(self.filenames))
+
+    def __len__(self):
+        return int(np.ceil(len(self.filenames) / self.batch_size))
+
+    def __getitem__(self, index):
+        rng = np.random.RandomState([self.seed, self.epoch, index]) # Every batch gets its own random number generator, so that it doesn't matter which worker produces it
+
+        indices = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        images = self.batch_generator.load_images([self.filenames[i] for i in indices])
+        batch_X, batch_y = self.transforms(images, [self.labels[i] for i in indices], rng=rng) # Samples for which no valid random crop was found are removed from the batch, just like in `generate()`
+
+        slot = next(self.slots)
+        batch_X = self.image_buffers.put(slot, batch_X)
+        y_true = self.ssd_box_encoder.encode_y(batch_y, out=self.y_buffers.get(slot, (len(batch_y),) + self.ssd_box_encoder.y_shape, np.float64)) # Encode the labels into the `y_true` tensor that the cost function needs
+
+        return batch_X, y_true
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self._permutation()
@@ -0,0 +1,646 @@
+"""
+Includes:
+* Composable image transforms that augment and convert a whole batch of images together with its ground truth boxes
+* A pipeline that chains these transforms and is shared by `BatchGenerator.generate()`, `BatchSequence`
+  and `BatchGenerator.process_offline()`
+
+The transforms work on a batch as a whole: The images are one Numpy array of shape `(batch_size, height, width, channels)`,
+and the boxes of all images are concatenated into one 2D Numpy array `boxes`, in which the boxes of image `i` are the rows
+`boxes[offsets[i]:offsets[i+1]]`. The first four columns of `boxes` are `xmin, xmax, ymin, ymax`, any other label
+columns such as the class ID follow. The random parameters of a transform are drawn for all images at once, and the
+boxes are moved, limited to the image boundaries and filtered with array operations over all boxes of the batch.
+The pixels are processed with OpenCV, with one call per image where OpenCV has no batched version of an operation.
+"""
+
+import numpy as np
+import cv2
+
+
+class Compose:
+    '''
+    A pipeline of transforms that is applied to batches of images and their labels.
+
+    `Compose` packs the labels of a batch into one box array with per-image offsets, moves the box coordinates
+    into the first four columns, runs all transforms in order and unpacks the result again. Consecutive affine
+    transforms are fused into one `AffineChain`, so e.g. in
+
+        transforms = Compose([Flip(0.5), Scale(0.9, 1.1, 0.5), Resize(300, 300)], box_output_format)
+        batch_X, batch_y = transforms(images, labels, rng=np.random.RandomState(42))
+
+    every image is warped only once for the flip and the scaling.
+    '''
+
+    def __init__(self, transforms, box_output_format=['class_id', 'xmin', 'xmax', 'ymin', 'ymax']):
+        '''
+        Arguments:
+            transforms (list): The `Transform` objects in the order in which they are to be applied.
+            box_output_format (list, optional): The column order of the labels, see `BatchGenerator`.
+                Defaults to `['class_id', 'xmin', 'xmax', 'ymin', 'ymax']`.
+        '''
+        self.transforms = []
+        for transform in transforms:
+            if self.transforms and isinstance(self.transforms[-1], AffineChain) and self.transforms[-1].accepts(transform):
+                self.transforms[-1].transforms.append(transform)
+            elif isinstance(transform, AffineTransform):
+                self.transforms.append(AffineChain([transform])) # Consecutive affine transforms are fused into one chain
+            else:
+                self.transforms.append(transform)
+        coords = ['xmin', 'xmax', 'ymin', 'ymax']
+        self.n_columns = len(box_output_format)
+        self.order = [box_output_format.index(coord) for coord in coords] + [i for i, column in enumerate(box_output_format) if column not in coords]
+        self.inverse_order = np.argsort(self.order)
+
+    def __call__(self, images, labels, rng=np.random):
+        '''
+        Transform a batch.
+
+        Arguments:
+            images (list): The images as Numpy arrays of shape `(height, width, channels)`, or one Numpy array of shape
+                `(batch_size, height, width, channels)`. The images are copied, the arrays that are passed are not modified.
+            labels (list): A 2D Numpy array per image with its ground truth boxes in the format given by `box_output_format`.
+                The labels are copied, the arrays that are passed are not modified.
+            rng (RandomState, optional): The random number generator to draw all random transformation parameters from.
+                Defaults to the global Numpy random number generator.
+
+        Returns:
+            The transformed images as one Numpy array of shape `(batch_size, height, width, channels)` and a list with
+            the transformed labels of each image as 2D Numpy arrays. Images for which `RandomCrop` could not find a
+            valid crop are removed from the batch.
+        '''
+        if len(set(image.shape for image in images)) > 1:
+            # Images of different sizes can't be stacked into one batch array, so they are transformed one at a time
+            transformed = [self([image], [image_labels], rng=rng) for image, image_labels in zip(images, labels)]
+            return np.concatenate([batch_X for batch_X, batch_y in transformed]), [y for batch_X, batch_y in transformed for y in batch_y]
+
+        images = np.stack(images) # This copy is the only one, all transforms may work on it in place
+        labels = [np.reshape(image_labels, (-1, self.n_columns)) for image_labels in labels]
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(image_labels) for image_labels in labels])
+        boxes = np.concatenate(labels, axis=0)[:, self.order]
+
+        for transform in self.transforms:
+            images, boxes, offsets = transform(images, boxes, offsets, rng=rng)
+
+        boxes = boxes[:, self.inverse_order]
+        return images, [boxes[offsets[i]:offsets[i+1]] for i in range(len(images))]
+
+
+class Transform:
+    '''
+    The base class of all transforms.
+
+    A transform is called with a batch of images, the concatenated boxes and the box offsets of the batch
+    as described at the top of this module, and the random number generator to draw its random parameters
+    from. It returns the transformed images, boxes and offsets and may modify the arrays that are passed in place.
+    '''
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        raise NotImplementedError
+
+
+class Equalize(Transform):
+    '''
+    Perform histogram equalization on the first three channels of all images, see `util.histogram_eq()`.
+    '''
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        for i in range(len(images)):
+            channels = list(cv2.split(images[i]))
+            channels[:3] = [cv2.equalizeHist(channel) for channel in channels[:3]]
+            images[i] = np.reshape(cv2.merge(channels), images.shape[1:])
+        return images, boxes, offsets
+
+
+class Brightness(Transform):
+    '''
+    Change the brightness of the images by random factors picked from a uniform distribution over [min, max].
+
+    Protected against overflow.
+    '''
+
+    def __init__(self, min=0.5, max=2.0, prob=0.5):
+        '''
+        Arguments:
+            min (float, optional): The minimum brightness factor. Defaults to 0.5.
+            max (float, optional): The maximum brightness factor. Defaults to 2.0.
+            prob (float, optional): The probability with which the brightness of any given image is changed. Defaults to 0.5.
+        '''
+        self.min = min
+        self.max = max
+        self.prob = prob
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        selected = np.nonzero(rng.uniform(0, 1, len(images)) >= (1 - self.prob))[0]
+        factors = rng.uniform(self.min, self.max, len(selected))
+
+        for i, factor in zip(selected, factors):
+            hsv = cv2.cvtColor(images[i], cv2.COLOR_RGB2HSV)
+            # To protect against overflow: Calculate a mask for all pixels
+            # where adjustment of the brightness would exceed the maximum
+            # brightness value and set the value to the maximum at those pixels.
+            v_channel = hsv[:, :, 2] * factor
+            hsv[:, :, 2] = np.where(v_channel > 255, 255, v_channel)
+            images[i] = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+        return images, boxes, offsets
+
+
+class AffineTransform(Transform):
+    '''
+    The base class of the geometric transforms that are affine transformations of the images.
+
+    An affine transform only draws a transformation matrix per image. `Compose` fuses every run of consecutive
+    affine transforms into one `AffineChain`, which multiplies their matrices, so that every image is warped only
+    once and its boxes are transformed, limited to the image boundaries and filtered only once.
+    '''
+
+    limit_boxes = False
+    include_thresh = 0.3
+
+    def matrices(self, n_images, img_height, img_width, rng=np.random):
+        '''
+        Draw the random transformations for a batch.
+
+        Arguments:
+            n_images (int): The number of images in the batch.
+            img_height (int): The height of the images.
+            img_width (int): The width of the images.
+            rng (RandomState, optional): The random number generator to draw the random parameters from.
+                Defaults to the global Numpy random number generator.
+
+        Returns:
+            A Numpy array of shape `(n_images, 3, 3)` with one affine transformation matrix per image in homogeneous
+            pixel coordinates, in which the center of the top left pixel is `(0, 0)`, a boolean mask of the images that
+            are transformed, and a boolean mask of the images whose boxes need to be limited to the image boundaries.
+        '''
+        raise NotImplementedError
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        return AffineChain([self])(images, boxes, offsets, rng=rng)
+
+
+class AffineChain(Transform):
+    '''
+    A sequence of affine transforms that is applied as one affine transformation per image.
+
+    Warping an image once instead of once per transform saves time and avoids the blur of repeated resampling.
+    The boxes are limited to the image boundaries only once at the end, for all images for which any of the
+    transforms requires it, and boxes that lost too much of their area overall are removed.
+    '''
+
+    def __init__(self, transforms):
+        '''
+        Arguments:
+            transforms (list): The `AffineTransform` objects in the order in which they are to be applied. All of them
+                that limit boxes must use the same `include_thresh`.
+        '''
+        self.transforms = transforms
+
+    @property
+    def include_thresh(self):
+        return next((transform.include_thresh for transform in self.transforms if transform.limit_boxes), AffineTransform.include_thresh)
+
+    def accepts(self, transform):
+        '''
+        Returns:
+            `True` if `transform` can be appended to the chain, i.e. if it is an affine transform that doesn't
+            limit boxes with a different `include_thresh`.
+        '''
+        return isinstance(transform, AffineTransform) and (not transform.limit_boxes or
+                                                           not any(member.limit_boxes for member in self.transforms) or
+                                                           transform.include_thresh == self.include_thresh)
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        n_images, img_height, img_width = images.shape[:3]
+        matrices = np.tile(np.eye(3), (n_images, 1, 1))
+        selected = np.zeros(n_images, dtype=bool)
+        limited = np.zeros(n_images, dtype=bool)
+        for transform in self.transforms:
+            transform_matrices, transform_selected, transform_limited = transform.matrices(n_images, img_height, img_width, rng=rng)
+            matrices[transform_selected] = np.matmul(transform_matrices[transform_selected], matrices[transform_selected]) # Later transforms are applied after earlier ones
+            selected |= transform_selected
+            limited |= transform_limited
+
+        return _apply_affine(images, boxes, offsets, matrices[:, :2], selected, limited, self.include_thresh)
+
+
+class Flip(AffineTransform):
+    '''
+    Flip images horizontally.
+
+    Could easily be extended to also allow vertical flipping, but I'm not convinced of the
+    usefulness of vertical flipping either empirically or theoretically, so I'm going for simplicity.
+    '''
+
+    def __init__(self, prob=0.5):
+        '''
+        Arguments:
+            prob (float, optional): The probability with which any given image is flipped. Defaults to 0.5.
+        '''
+        self.prob = prob
+
+    def matrices(self, n_images, img_height, img_width, rng=np.random):
+        flipped = rng.uniform(0, 1, n_images) >= (1 - self.prob)
+        matrices = np.tile(np.eye(3), (n_images, 1, 1))
+        matrices[:, 0, 0] = -1
+        matrices[:, 0, 2] = img_width - 1
+        return matrices, flipped, np.zeros(n_images, dtype=bool)
+
+
+class Translate(AffineTransform):
+    '''
+    Translate images horizontally and vertically by random amounts.
+    '''
+
+    def __init__(self, horizontal=(0, 40), vertical=(0, 10), prob=0.5, limit_boxes=True, include_thresh=0.3):
+        '''
+        Arguments:
+            horizontal (int tuple, optinal): A 2-tuple `(min, max)` with the minimum and maximum horizontal
+                translation. A random translation value will be picked from a uniform distribution over
+                [min, max] and applied to the left or to the right with equal probability. Defaults to `(0, 40)`.
+            vertical (int tuple, optional): Analog to `horizontal`. Defaults to `(0, 10)`.
+            prob (float, optional): The probability with which any given image is translated. Defaults to 0.5.
+            limit_boxes (bool, optional): If `True`, limits box coordinates to stay within the image boundaries,
+                see `BatchGenerator.generate()`. Defaults to `True`.
+            include_thresh (float, optional): The minimum fraction of the area of a box that must be left after
+                limiting for the box to be kept, see `BatchGenerator.generate()`. Defaults to 0.3.
+        '''
+        self.horizontal = horizontal
+        self.vertical = vertical
+        self.prob = prob
+        self.limit_boxes = limit_boxes
+        self.include_thresh = include_thresh
+
+    def matrices(self, n_images, img_height, img_width, rng=np.random):
+        selected = rng.uniform(0, 1, n_images) >= (1 - self.prob)
+        matrices = np.tile(np.eye(3), (n_images, 1, 1))
+        matrices[:, 0, 2] = rng.randint(self.horizontal[0], self.horizontal[1] + 1, n_images) * rng.choice([-1, 1], n_images)
+        matrices[:, 1, 2] = rng.randint(self.vertical[0], self.vertical[1] + 1, n_images) * rng.choice([-1, 1], n_images)
+        return matrices, selected, selected & self.limit_boxes
+
+
+class Scale(AffineTransform):
+    '''
+    Scale images about their centers by random factors picked from a uniform distribution over [min, max].
+    '''
+
+    def __init__(self, min=0.9, max=1.1, prob=0.5, limit_boxes=True, include_thresh=0.3):
+        '''
+        Arguments:
+            min (float, optional): The minimum scaling factor. Defaults to 0.9.
+            max (float, optional): The maximum scaling factor. Defaults to 1.1.
+            prob (float, optional): The probability with which any given image is scaled. Defaults to 0.5.
+            limit_boxes (bool, optional): See `Translate`. Defaults to `True`.
+            include_thresh (float, optional): See `Translate`. Defaults to 0.3.
+        '''
+        self.min = min
+        self.max = max
+        self.prob = prob
+        self.limit_boxes = limit_boxes
+        self.include_thresh = include_thresh
+
+    def matrices(self, n_images, img_height, img_width, rng=np.random):
+        selected = rng.uniform(0, 1, n_images) >= (1 - self.prob)
+        scales = rng.uniform(self.min, self.max, n_images)
+
+        # The matrices of `cv2.getRotationMatrix2D((img_width / 2, img_height / 2), 0, scale)`
+        matrices = np.tile(np.eye(3), (n_images, 1, 1))
+        matrices[:, 0, 0] = scales
+        matrices[:, 1, 1] = scales
+        matrices[:, 0, 2] = (1 - scales) * (img_width / 2)
+        matrices[:, 1, 2] = (1 - scales) * (img_height / 2)
+
+        # We don't need to do any limiting in case we shrunk the image
+        return matrices, selected, selected & (scales > 1) & self.limit_boxes
+
+
+class RandomCrop(Transform):
+    '''
+    Crop patches of a fixed size out of the images at random positions.
+
+    If the patch is larger than an image in a dimension, the image is instead placed at a random position on
+    a black background canvas of the patch size. Up to `max_trials` random positions are tried for every image
+    until the patch contains at least one box. The trials are run for all images of the batch at once.
+    '''
+
+    def __init__(self, height, width, min_1_object=1, max_trials=3, limit_boxes=True, include_thresh=0.3):
+        '''
+        Arguments:
+            height (int): The height of the patches.
+            width (int): The width of the patches.
+            min_1_object (int, optional): If 1, a patch must contain at least one box after limiting to be valid,
+                and images for which no valid patch is found within `max_trials` trials are removed from the batch.
+                If 0, the first random patch is taken. Defaults to 1.
+            max_trials (int, optional): The maximum number of random positions to try per image. Defaults to 3.
+            limit_boxes (bool, optional): See `Translate`. Defaults to `True`.
+            include_thresh (float, optional): See `Translate`. Defaults to 0.3.
+        '''
+        self.height = height
+        self.width = width
+        self.min_1_object = min_1_object
+        self.max_trials = max_trials
+        self.limit_boxes = limit_boxes
+        self.include_thresh = include_thresh
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        n_images, img_height, img_width, channels = images.shape
+        # Compute how much room we have in both dimensions to make a random crop.
+        # A negative number here means that we want to crop out a patch that is larger than the original image in the respective dimension.
+        y_range = img_height - self.height
+        x_range = img_width - self.width
+
+        accepted = np.zeros(n_images, dtype=bool)
+        crop_ymin = np.zeros(n_images, dtype=np.int64)
+        crop_xmin = np.zeros(n_images, dtype=np.int64)
+        for trial in range(self.max_trials):
+            # Select new random crop positions for all images that don't have a valid patch yet
+            pending = ~accepted
+            crop_ymin[pending] = rng.randint(0, abs(y_range) + 1, np.count_nonzero(pending))
+            crop_xmin[pending] = rng.randint(0, abs(x_range) + 1, np.count_nonzero(pending))
+            if self.min_1_object == 0: # We are fine with whatever crop we got
+                accepted[:] = True
+                break
+            patch_boxes, patch_offsets = self._patch_boxes(boxes, offsets, crop_ymin, crop_xmin, y_range, x_range)
+            accepted |= np.diff(patch_offsets) > 0 # If we have at least one object left, the crop is valid
+            if np.all(accepted):
+                break
+
+        # Images for which no valid crop was found within `max_trials` trials are removed from the batch
+        kept = np.nonzero(accepted)[0]
+        patch_boxes, patch_offsets = self._patch_boxes(boxes, offsets, crop_ymin, crop_xmin, y_range, x_range)
+        patch_boxes, patch_offsets = _select_images(patch_boxes, patch_offsets, kept)
+
+        # Cut the patches out by slicing, or place the images on the canvas
+        height, width = min(img_height, self.height), min(img_width, self.width)
+        patches = np.zeros((len(kept), self.height, self.width, channels), dtype=images.dtype)
+        for k, i in enumerate(kept):
+            src_y, dst_y = (crop_ymin[i], 0) if y_range >= 0 else (0, crop_ymin[i])
+            src_x, dst_x = (crop_xmin[i], 0) if x_range >= 0 else (0, crop_xmin[i])
+            patches[k, dst_y:dst_y + height, dst_x:dst_x + width] = images[i, src_y:src_y + height, src_x:src_x + width]
+
+        return patches, patch_boxes, patch_offsets
+
+    def _patch_boxes(self, boxes, offsets, crop_ymin, crop_xmin, y_range, x_range):
+        '''
+        Returns:
+            The boxes and offsets of the patches at the given crop positions, limited to the patch boundaries.
+        '''
+        image_indices = _image_indices(offsets)
+        # Translate the box coordinates into the new coordinate system. A regular crop shifts the origin by `(crop_ymin, crop_xmin)`,
+        # placing the image on a canvas shifts it by `(-crop_ymin, -crop_xmin)`.
+        patch_boxes = np.copy(boxes)
+        patch_boxes[:, [0, 1]] += (-1 if x_range >= 0 else 1) * crop_xmin[image_indices, np.newaxis]
+        patch_boxes[:, [2, 3]] += (-1 if y_range >= 0 else 1) * crop_ymin[image_indices, np.newaxis]
+        # Only the dimensions in which we actually crop might need to be limited
+        if self.limit_boxes and (y_range >= 0 or x_range >= 0):
+            return _limit_boxes(patch_boxes, offsets, self.height, self.width, self.include_thresh,
+                                limit_x=x_range >= 0,
+                                limit_y=y_range >= 0)
+        return patch_boxes, offsets
+
+
+class Crop(Transform):
+    '''
+    Crop fixed numbers of pixels off the sides of all images.
+    '''
+
+    def __init__(self, top=0, bottom=0, left=0, right=0, limit_boxes=True, include_thresh=0.3):
+        '''
+        Arguments:
+            top (int, optional): The number of pixels to crop off the top. Defaults to 0.
+            bottom (int, optional): The number of pixels to crop off the bottom. Defaults to 0.
+            left (int, optional): The number of pixels to crop off the left. Defaults to 0.
+            right (int, optional): The number of pixels to crop off the right. Defaults to 0.
+            limit_boxes (bool, optional): See `Translate`. Defaults to `True`.
+            include_thresh (float, optional): See `Translate`. Defaults to 0.3.
+        '''
+        self.top = top
+        self.bottom = bottom
+        self.left = left
+        self.right = right
+        self.limit_boxes = limit_boxes
+        self.include_thresh = include_thresh
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        img_height, img_width = images.shape[1:3]
+        images = images[:, self.top:img_height - self.bottom, self.left:img_width - self.right]
+        # Translate the box coordinates into the new coordinate system: The origin is shifted by `(top, left)`
+        boxes[:, [0, 1]] -= self.left
+        boxes[:, [2, 3]] -= self.top
+        if self.limit_boxes:
+            # We only need to check those box coordinates that could possibly have been affected by the cropping
+            boxes, offsets = _limit_boxes(boxes, offsets, images.shape[1], images.shape[2], self.include_thresh,
+                                          limit_left=self.left > 0,
+                                          limit_right=self.right > 0,
+                                          limit_top=self.top > 0,
+                                          limit_bottom=self.bottom > 0)
+        return images, boxes, offsets
+
+
+class Resize(Transform):
+    '''
+    Resize all images to a fixed size.
+
+    The images of the batch are stacked along the channel axis, so that up to 128 channels are resized with a single
+    `cv2.resize()` call. OpenCV 4 resizes up to 512 channels at once, OpenCV 5 only up to 128.
+    '''
+
+    def __init__(self, width, height):
+        '''
+        Arguments:
+            width (int): The width of the resized images.
+            height (int): The height of the resized images.
+        '''
+        self.width = width
+        self.height = height
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        n_images, img_height, img_width, channels = images.shape
+        chunk_size = max(1, 128 // channels)
+        resized = np.empty((n_images, self.height, self.width, channels), dtype=images.dtype)
+        for start in range(0, n_images, chunk_size):
+            chunk = images[start:start + chunk_size]
+            stacked = np.ascontiguousarray(chunk.transpose(1, 2, 0, 3)).reshape(img_height, img_width, len(chunk) * channels)
+            stacked = cv2.resize(stacked, dsize=(self.width, self.height)).reshape(self.height, self.width, len(chunk), channels)
+            resized[start:start + chunk_size] = stacked.transpose(2, 0, 1, 3)
+
+        boxes[:, [0, 1]] = np.trunc(boxes[:, [0, 1]] * (self.width / img_width))
+        boxes[:, [2, 3]] = np.trunc(boxes[:, [2, 3]] * (self.height / img_height))
+        return resized, boxes, offsets
+
+
+class RGBToGray(Transform):
+    '''
+    Convert RGB images to grayscale with a single `cv2.cvtColor()` call for the whole batch.
+    '''
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        n_images, img_height, img_width = images.shape[:3]
+        gray = cv2.cvtColor(np.ascontiguousarray(images).reshape(n_images * img_height, img_width, 3), cv2.COLOR_RGB2GRAY)
+        return gray.reshape(n_images, img_height, img_width, 1), boxes, offsets
+
+
+class GrayToRGB(Transform):
+    '''
+    Convert grayscale images to RGB. The conversion interpolates between neighboring pixels, so the images are
+    converted one at a time.
+    '''
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        rgb = np.empty(images.shape[:3] + (3,), dtype=images.dtype)
+        for i in range(len(images)):
+            rgb[i] = cv2.cvtColor(np.ascontiguousarray(images[i]), cv2.COLOR_BayerGR2RGB)
+        return rgb, boxes, offsets
+
+
+class MultispectralToRGB(Transform):
+    '''
+    Convert 8-band multispectral images to RGB by selecting the red, green and blue bands.
+    '''
+
+    def __call__(self, images, boxes, offsets, rng=np.random):
+        return images[..., np.r_[-4:-5:-1, -6:-8:-1]], boxes, offsets
+
+
+def _image_indices(offsets):
+    '''
+    Returns:
+        The index of the image that each box belongs to.
+    '''
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _select_boxes(boxes, offsets, keep):
+    '''
+    Returns:
+        The boxes for which the boolean mask `keep` is `True` and their offsets.
+    '''
+    counts = np.bincount(_image_indices(offsets)[keep], minlength=len(offsets) - 1)
+    new_offsets = np.zeros_like(offsets)
+    new_offsets[1:] = np.cumsum(counts)
+    return boxes[keep], new_offsets
+
+
+def _select_images(boxes, offsets, indices):
+    '''
+    Returns:
+        The boxes of the images with the given ascending indices and their offsets.
+    '''
+    keep = np.isin(_image_indices(offsets), indices)
+    new_offsets = np.zeros(len(indices) + 1, dtype=offsets.dtype)
+    new_offsets[1:] = np.cumsum(np.diff(offsets)[indices])
+    return boxes[keep], new_offsets
+
+
+def _limit_boxes(boxes,
+                 offsets,
+                 img_height,
+                 img_width,
+                 include_thresh=0.3,
+                 rows=None,
+                 limit_x=True,
+                 limit_y=True,
+                 limit_left=None,
+                 limit_right=None,
+                 limit_top=None,
+                 limit_bottom=None):
+    '''
+    Limit the box coordinates to lie within the image boundaries and remove all boxes that had to be limited so
+    much that their area is less than `include_thresh` of their area before limiting.
+
+    Some objects might have gotten pushed so far outside the image boundaries in a transformation that they don't
+    serve as useful training examples anymore, because too little of them is visible.
+
+    Arguments:
+        boxes (array): The boxes of the batch. They are limited in place.
+        offsets (array): The box offsets of the batch.
+        img_height (int): The height of the images.
+        img_width (int): The width of the images.
+        include_thresh (float, optional): The minimum fraction of the area of a box that must be left after limiting
+            for the box to be kept. If 0, only boxes with an area of 0 after limiting are removed. Defaults to 0.3.
+        rows (array, optional): A boolean mask of the boxes to be limited and filtered. All other boxes are left
+            as they are. Defaults to `None`, i.e. all boxes.
+        limit_x (bool, optional): Whether to limit the x-coordinates. Defaults to `True`.
+        limit_y (bool, optional): Whether to limit the y-coordinates. Defaults to `True`.
+        limit_left, limit_right, limit_top, limit_bottom (bool, optional): Whether to limit the coordinates at the
+            respective image boundary. Default to `limit_x` and `limit_y`, respectively.
+
+    Returns:
+        The boxes that are kept and their offsets.
+    '''
+    if rows is None:
+        rows = np.ones(len(boxes), dtype=bool)
+    limits = [(0, 1, limit_x if limit_left is None else limit_left, limit_x if limit_right is None else limit_right, img_width),
+              (2, 3, limit_y if limit_top is None else limit_top, limit_y if limit_bottom is None else limit_bottom, img_height)]
+
+    before_area = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+    for start, stop, limit_low, limit_high, size in limits:
+        coords = boxes[:, start:stop + 1] # A view, so the boxes are limited in place
+        if limit_low:
+            coords[(coords < 0) & rows[:, np.newaxis]] = 0
+        if limit_high:
+            coords[(coords >= size) & rows[:, np.newaxis]] = size - 1
+    after_area = (boxes[:, 1] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 2])
+
+    if include_thresh == 0:
+        keep = after_area > include_thresh * before_area # If `include_thresh == 0`, we want to make sure that boxes with area 0 get thrown out, hence the ">" sign instead of the ">=" sign
+    else:
+        keep = after_area >= include_thresh * before_area # Especially for the case `include_thresh == 1` we want the ">=" sign, otherwise no boxes would be left at all
+    return _select_boxes(boxes, offsets, keep | ~rows)
+
+
+def _apply_affine(images, boxes, offsets, matrices, selected, limited, include_thresh=0.3):
+    '''
+    Warp the selected images and their boxes with their 2x3 affine transformation matrices.
+
+    The matrices act on pixel coordinates, in which the center of the top left pixel is `(0, 0)`. The box
+    coordinates are coordinates of pixel edges, in which the top left corner of the image is `(0, 0)`,
+    so the boxes are transformed with the equivalent matrices for edge coordinates. For example, a horizontal
+    flip maps the pixel `x` to `img_width - 1 - x` and the box coordinate `x` to `img_width - x`.
+
+    Arguments:
+        images (array): The images of the batch.
+        boxes (array): The boxes of the batch.
+        offsets (array): The box offsets of the batch.
+        matrices (array): An array of shape `(batch_size, 2, 3)` with one affine transformation matrix per image.
+        selected (array): A boolean mask of the images to be transformed.
+        limited (array): A boolean mask of the images whose boxes are to be limited to the image boundaries
+            after the transformation, see `_limit_boxes()`.
+        include_thresh (float, optional): See `_limit_boxes()`. Defaults to 0.3.
+
+    Returns:
+        The transformed images, boxes and offsets.
+    '''
+    img_height, img_width = images.shape[1:3]
+    _warp_affine(images, matrices, selected)
+
+    # The translation part of the matrices for edge coordinates: Shift by half a pixel, transform, and shift back
+    box_matrices = np.copy(matrices)
+    box_matrices[:, :, 2] += 0.5 * (1 - matrices[:, :, :2].sum(axis=2))
+
+    # Transform two opposite corner points of the rectangular boxes, all boxes of the batch at once
+    image_indices = _image_indices(offsets)
+    rows = selected[image_indices]
+    row_matrices = box_matrices[image_indices[rows]]
+    corners = np.stack([boxes[rows][:, [0, 2]], boxes[rows][:, [1, 3]]], axis=1) # Shape `(n_boxes, 2, 2)`: The top left and bottom right `(x, y)` of every box
+    corners = np.matmul(corners, np.transpose(row_matrices[:, :, :2], (0, 2, 1))) + row_matrices[:, np.newaxis, :, 2]
+    # Any transformation that mirrors an axis swaps the minimum and maximum coordinates
+    boxes[np.ix_(rows, [0, 2])] = np.minimum(corners[:, 0], corners[:, 1])
+    boxes[np.ix_(rows, [1, 3])] = np.maximum(corners[:, 0], corners[:, 1])
+
+    boxes, offsets = _limit_boxes(boxes, offsets, img_height, img_width, include_thresh, rows=limited[image_indices])
+    return images, boxes, offsets
+
+
+def _warp_affine(images, matrices, selected):
+    '''
+    Warp the selected images in place, every image with its own 2x3 affine transformation matrix.
+    OpenCV has no batched warp, so this is one `cv2.warpAffine()` per image. Pure horizontal flips
+    are done with `cv2.flip()` instead, which is much faster and gives the same result.
+    '''
+    img_height, img_width = images.shape[1:3]
+    flip = np.array([[-1, 0, img_width - 1], [0, 1, 0]])
+    for i in np.nonzero(selected)[0]:
+        if np.array_equal(matrices[i], flip):
+            images[i] = np.reshape(cv2.flip(images[i], 1), images.shape[1:])
+        else:
+            images[i] = np.reshape(cv2.warpAffine(images[i], matrices[i], (img_width, img_height)), images.shape[1:])
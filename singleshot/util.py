@@ -1,6 +1,7 @@
 """
 Includes:
 * A batch generator for SSD model training and inference which can perform online data agumentation
+  (its `keras.utils.Sequence` version `BatchSequence` is in `singleshot.sequence`, so that this module doesn't need Keras)
 * An offline image processor that saves processed images and adjusted labels to disk
 
 Copyright (C) 2017 Pierluigi Ferrari
@@ -22,111 +23,162 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import numpy as np
 import pandas as pd
 import cv2
-import random
-from sklearn.utils import shuffle
-from copy import deepcopy
-from PIL import Image
 import csv
+import hashlib
 import os
-from bs4 import BeautifulSoup
+import json
+import time
+from multiprocessing import Pool
 
-import rasterio
+from singleshot.anchors import anchor_boxes, anchor_sizes, n_boxes_per_cell
+from singleshot.boxes import iou, iou_matrix, convert_coordinates, convert_coordinates2, greedy_nms, decode_y, decode_y2
+from singleshot.transforms import Compose, Equalize, Brightness, Flip, Translate, Scale, RandomCrop, Crop, Resize, RGBToGray, GrayToRGB, MultispectralToRGB
 
 
-# Image processing functions used by the generator to perform the following image manipulations:
-# - Translation
-# - Horizontal flip
-# - Scaling
-# - Brightness change
-# - Histogram contrast equalization
+# The anchor box tables computed by `SSDBoxEncoder.get_anchors()`, keyed on `SSDBoxEncoder.anchors_key()`
+_anchors_cache = {}
 
-def _translate(image, horizontal=(0, 40), vertical=(0, 10)):
-    '''
-    Randomly translate the input image horizontally and vertically.
-
-    Arguments:
-        image (array-like): The image to be translated.
-        horizontal (int tuple, optinal): A 2-tuple `(min, max)` with the minimum
-            and maximum horizontal translation. A random translation value will
-            be picked from a uniform distribution over [min, max].
-        vertical (int tuple, optional): Analog to `horizontal`.
-
-    Returns:
-        The translated image and the horzontal and vertical shift values.
-    '''
-    rows, cols, ch = image.shape
-
-    x = np.random.randint(horizontal[0], horizontal[1] + 1)
-    y = np.random.randint(vertical[0], vertical[1] + 1)
-    x_shift = random.choice([-x, x])
-    y_shift = random.choice([-y, y])
-
-    M = np.float32([[1, 0, x_shift], [0, 1, y_shift]])
-    return cv2.warpAffine(image, M, (cols, rows)), x_shift, y_shift
+# The box fields that `BatchGenerator.parse_xml()` can put into the labels, which are integer arrays
+VOC_BOX_FIELDS = ('class_id', 'truncated', 'difficult', 'xmin', 'ymin', 'xmax', 'ymax')
 
+# How long the other processes wait for the process of rank 0 to save the label index, in seconds
+INDEX_WAIT_TIMEOUT = 3600
 
-def _flip(image, orientation='horizontal'):
-    '''
-    Flip the input image horizontally or vertically.
-    '''
-    if orientation == 'horizontal':
-        return cv2.flip(image, 1)
-    else:
-        return cv2.flip(image, 0)
+# How long the other processes wait for the process of rank 0 to pack the images by default, in seconds.
+# Decoding a large dataset takes much longer than parsing its labels.
+PACK_WAIT_TIMEOUT = 24 * 3600
 
 
-def _scale(image, min=0.9, max=1.1):
+def histogram_eq(image):
     '''
-    Scale the input image by a random factor picked from a uniform distribution
-    over [min, max].
+    Perform histogram equalization on the input image.
 
-    Returns:
-        The scaled image, the associated warp matrix, and the scaling value.
+    See https://en.wikipedia.org/wiki/Histogram_equalization.
     '''
 
-    rows, cols, ch = image.shape
-
-    # Randomly select a scaling factor from the range passed.
-    scale = np.random.uniform(min, max)
+    image1 = np.copy(image)
 
-    M = cv2.getRotationMatrix2D((cols / 2, rows / 2), 0, scale)
-    return cv2.warpAffine(image, M, (cols, rows)), M, scale
+    image1[:, :, 0] = cv2.equalizeHist(image1[:, :, 0])
+    image1[:, :, 1] = cv2.equalizeHist(image1[:, :, 1])
+    image1[:, :, 2] = cv2.equalizeHist(image1[:, :, 2])
 
+    return image1
 
-def _brightness(image, min=0.5, max=2.0):
-    '''
-    Randomly change the brightness of the input image.
 
-    Protected against overflow.
+def split_shard(n_samples, split_ratio=1.0, seed=None, rank=0, world_size=1, strata=None):
     '''
-    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    Shuffle samples, split them into training and validation samples and return the shard `rank` of `world_size`
+    of each.
 
-    random_br = np.random.uniform(min, max)
+    The result only depends on the arguments, so processes that call this with the same `seed` and different ranks get
+    disjoint shards that together contain all samples. The shard sizes differ by at most one sample. If `strata` is
+    given, the samples of every stratum are split and dealt across the shards separately, so that every shard
+    gets the same share of every stratum.
 
-    # To protect against overflow: Calculate a mask for all pixels
-    # where adjustment of the brightness would exceed the maximum
-    # brightness value and set the value to the maximum at those pixels.
-    mask = hsv[:, :, 2] * random_br > 255
-    v_channel = np.where(mask, 255, hsv[:, :, 2] * random_br)
-    hsv[:, :, 2] = v_channel
+    Arguments:
+        n_samples (int): The number of samples.
+        split_ratio (float, optional): The fraction of the samples to use for training, the rest is used for validation.
+            Values outside of [0, 1] are treated as 1. Defaults to 1.0.
+        seed (int, optional): The seed for the shuffling. Must be given if `world_size > 1`. Defaults to `None`.
+        rank (int, optional): The number of the shard, from 0 to `world_size - 1`. Defaults to 0.
+        world_size (int, optional): The number of shards. Defaults to 1.
+        strata (array, optional): An integer array of shape `(n_samples,)` with the stratum of every sample.
+            Defaults to `None`.
 
-    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+    Returns:
+        Two integer arrays with the indices of the training and the validation samples of the shard, in random order.
+    '''
+    if world_size > 1 and seed is None:
+        raise ValueError("`seed` must be given if `world_size > 1`, otherwise the shards of the processes overlap.")
+    if not 0 <= rank < world_size:
+        raise ValueError("`rank` must be between 0 and `world_size - 1`, but it is {} and `world_size` is {}.".format(rank, world_size))
+    if split_ratio > 1.0 or split_ratio < 0:
+        split_ratio = 1.0
+
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(n_samples)
+    if strata is None:
+        strata = np.zeros(n_samples, dtype=np.int64)
+    order = order[np.argsort(strata[order], kind='stable')]  # Group the samples by stratum, but keep them shuffled within each stratum
+    starts = np.flatnonzero(np.diff(strata[order], prepend=-1) != 0) if n_samples > 0 else np.zeros(0, dtype=np.int64)
+    ends = np.append(starts[1:], n_samples)
+
+    train, val = [], []
+    for start, end in zip(starts, ends):
+        n_train = start + int((end - start) * split_ratio)
+        train.append(order[start:n_train])
+        val.append(order[n_train:end])
+    train = np.concatenate(train) if train else np.zeros(0, dtype=np.int64)
+    val = np.concatenate(val) if val else np.zeros(0, dtype=np.int64)
+
+    # Deal the samples across the shards like cards, such that every shard gets every `world_size`-th sample of every stratum
+    train, val = train[rank::world_size], val[(rank - len(train)) % world_size::world_size]
+    return rng.permutation(train), rng.permutation(val)
+
+
+def _save_npy(path, array):
+    '''
+    Save an array to the `.npy` file `path` via a temporary file, so that processes that read or memory-map the file
+    at the same time see either the old or the new file, but never a partially written one.
+    '''
+    tmp_path = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
 
 
-def histogram_eq(image):
+def _wait_for(ready, description, timeout, interval=1.0):
     '''
-    Perform histogram equalization on the input image.
-
-    See https://en.wikipedia.org/wiki/Histogram_equalization.
+    Call `ready()` every `interval` seconds until it returns `True`, and raise a `TimeoutError` mentioning
+    `description` if that takes longer than `timeout` seconds.
     '''
+    start = time.time()
+    while not ready():
+        if time.time() - start > timeout:
+            raise TimeoutError("Gave up waiting for {} after {} seconds.".format(description, timeout))
+        time.sleep(interval)
 
-    image1 = np.copy(image)
 
-    image1[:, :, 0] = cv2.equalizeHist(image1[:, :, 0])
-    image1[:, :, 1] = cv2.equalizeHist(image1[:, :, 1])
-    image1[:, :, 2] = cv2.equalizeHist(image1[:, :, 2])
+def _parse_voc_annotation(task):
+    '''
+    Parse one Pascal VOC annotation XML file for `BatchGenerator.parse_xml()`. This is a module level function so that
+    worker processes can run it.
 
-    return image1
+    Arguments:
+        task (tuple): The path of the XML file, a dictionary that maps the class names to the class IDs, `None` or the
+            set of class IDs to include, `exclude_truncated`, `exclude_difficult` and `box_output_format`.
+
+    Returns:
+        A tuple of the image file name and a Numpy array with one row per box in the format given by `box_output_format`.
+    '''
+    from lxml import etree
+
+    path, class_ids, include_classes, exclude_truncated, exclude_difficult, box_output_format = task
+
+    filename = None
+    boxes = [] # We'll store all boxes for this image here
+    # Stream through the file and handle each object as soon as it is complete, then free it
+    for event, element in etree.iterparse(path, events=('end',)):
+        if element.tag == 'filename' and filename is None:
+            filename = element.text
+        elif element.tag == 'object':
+            class_id = class_ids[element.findtext('name')]
+            # Check if this class is supposed to be included in the dataset
+            if (include_classes is None) or (class_id in include_classes):
+                truncated = int(element.findtext('truncated'))
+                difficult = int(element.findtext('difficult'))
+                if not (exclude_truncated and truncated == 1) and not (exclude_difficult and difficult == 1):
+                    bndbox = element.find('bndbox')
+                    item_dict = {'class_id': class_id,
+                                 'truncated': truncated,
+                                 'difficult': difficult,
+                                 'xmin': int(bndbox.findtext('xmin')),
+                                 'ymin': int(bndbox.findtext('ymin')),
+                                 'xmax': int(bndbox.findtext('xmax')),
+                                 'ymax': int(bndbox.findtext('ymax'))}
+                    boxes.append([item_dict[item] for item in box_output_format])
+            element.clear()
+
+    return filename, np.array(boxes, dtype=np.int64).reshape(-1, len(box_output_format))
 
 
 class BatchGenerator:
@@ -182,13 +234,55 @@ class BatchGenerator:
         # `self.labels` is a list containing one 2D Numpy array per image. For an image with `k` ground truth bounding boxes,
         # the respective 2D array has `k` rows, each row containing `(xmin, xmax, ymin, ymax, class_id)` for the respective bounding box.
         self.labels = []  # Each entry here will contain a 2D Numpy array with all the ground truth boxes for a given image
+        # The parsers store all labels packed into one array, and the arrays in `self.labels` are views into it, see `_pack_labels()`
+        self.boxes = np.zeros((0, len(box_output_format)), dtype=np.float32)  # The labels of all images, one box per row
+        self.offsets = np.zeros(1, dtype=np.int64)  # The labels of image `i` are `self.boxes[self.offsets[i]:self.offsets[i+1]]`
+
+        # These are the variables that we only need if we want to use pack() or load_pack()
+        self.pack_path = None  # The directory of the loaded pack
+        self.pack_images = None  # The memory-mapped array with all decoded images of the pack
+        self.pack_index = {}  # The row of `pack_images` for each packed image filename
+
+    def __getstate__(self):
+        # Pickling the memory-mapped pack would copy all images, e.g. when a `BatchSequence` is sent to worker processes, so reopen it instead
+        state = self.__dict__.copy()
+        state['pack_images'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.pack_path is not None:
+            self.pack_images = np.load(os.path.join(self.pack_path, 'images.npy'), mmap_mode='r')
 
     def parse_csv(self,
                   labels_path=None,
                   input_format=None,
                   split_ratio=1.0,
-                  checkpoints_path=None):
+                  checkpoints_path=None,
+                  seed=None,
+                  rank=0,
+                  world_size=1,
+                  stratify=False,
+                  index_path=None,
+                  pack_path=None,
+                  pack_timeout=PACK_WAIT_TIMEOUT):
         '''
+        Parse the labels CSV file, shuffle the images, split them into training and validation images and optionally
+        keep only the shard of one of several processes, see `split_shard()`.
+
+        With `world_size > 1`, every process parses the same CSV file with the same `seed`, but only creates the
+        filenames and labels of its own shard, so that the shards are disjoint and together cover the whole dataset.
+
+        With `index_path`, the parsed labels of all images are saved to a binary index (see `save_index()`) before they
+        are shuffled and split. Later calls with an unchanged CSV file and the same classes memory-map the index instead
+        of parsing the CSV file again, and only copy the labels of their own shard. With `world_size > 1`, only the
+        process of rank 0 parses the CSV file and saves the index, the others wait for the index and memory-map it. Without
+        `index_path`, every process parses the whole CSV file, so `trainssd` always uses an index with `--world_size`.
+
+        With `pack_path`, the images of the whole dataset, not just of this shard, are packed (see `pack()`) before the
+        dataset is split, so that the same pack serves every seed, rank and world size. The pack is reused as long as it
+        contains the same, unmodified images, otherwise the process of rank 0 packs them again while the others wait.
+
         Arguments:
             labels_path (str, optional): The filepath to a CSV file that contains one ground truth bounding box per line
                 and each line contains the following six items: image file name, class ID, xmin, xmax, ymin, ymax.
@@ -202,11 +296,26 @@ class BatchGenerator:
             input_format (list, optional): A list of six strings representing the order of the six items
                 image file name, class ID, xmin, xmax, ymin, ymax in the input CSV file. The expected strings
                 are 'image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id'. Defaults to `None`.
-            ret (bool, optional): Whether or not the image filenames and labels are to be returned.
-                Defaults to `False`.
+            split_ratio (float, optional): The fraction of the images to use for training, the rest is used for validation.
+                If it is 1.0, the training images are also used for validation. Defaults to 1.0.
+            checkpoints_path (str, optional): The directory to save the list of validation filenames to. Defaults to `None`,
+                in which case the list isn't saved.
+            seed (int, optional): The seed for shuffling, splitting and sharding the images. Must be given if `world_size > 1`,
+                so that all processes agree on the shards. Defaults to `None`.
+            rank (int, optional): The number of the shard to keep, from 0 to `world_size - 1`. Defaults to 0.
+            world_size (int, optional): The number of shards, e.g. the number of processes in data-parallel training.
+                Defaults to 1.
+            stratify (bool, optional): If `True`, the split and the shards are stratified by the rarest class of each image,
+                so that the validation images and every shard contain every class in the same proportion. Defaults to `False`.
+            index_path (str, optional): `None` or the directory of the binary index to load the labels from, or to save
+                them to if it doesn't exist or is out of date. Defaults to `None`.
+            pack_path (str, optional): `None` or the directory of the pack of the decoded images to load, or to create
+                if it doesn't exist or contains other images. Defaults to `None`.
+            pack_timeout (float, optional): How long the processes of rank > 0 wait for rank 0 to pack the images,
+                in seconds. Defaults to `PACK_WAIT_TIMEOUT`.
 
         Returns:
-            None by default, optionally the image filenames and labels.
+            None.
         '''
 
         # If we get arguments in this call, set them
@@ -222,86 +331,139 @@ class BatchGenerator:
         self.filenames = []
         self.labels = []
 
-        # First, just read in the CSV file lines and sort them.
-
-        data = []
-
-        with open(self.labels_path, newline='') as csvfile:
-            csv_reader = csv.reader(csvfile, delimiter=',')
-            k = 0
-            for row in csv_reader:  # For every line (i.e for every bounding box) in the CSV file...
-                if k == 0:  # Skip the header row
-                    k += 1
-                    continue
-                else:
-                    if self.include_classes == 'all' or int(row[self.input_format.index(
-                            'class_id')].strip()) in self.include_classes:  # If the class_id is among the classes that are to be included in the dataset...
-                        obj = [row[self.input_format.index('image_name')].strip()]
-                        # Store the box class and coordinates here
-                        for item in self.box_output_format:
-                            val = int(row[self.input_format.index(item)].strip())
-                            if item == 'class_id' and self.class_map:
-                                obj.append(self.class_map[val])
-                            else:
-                                obj.append(val)
-                                # ...select the respective column in the input format and append it to `obj`
-                        data.append(obj)
-
-        data = sorted(data)  # The data needs to be sorted, otherwise the next step won't give the correct result
-
-        # Now that we've made sure that the data is sorted by file names,
-        # we can compile the actual samples and labels lists
-
-        current_file = ''  # The current image for which we're collecting the ground truth boxes
-        current_labels = []  # The list where we collect all ground truth boxes for a given image
-        bad_boxes = []
-        bad_files = []
-        for idx, row in enumerate(data):
-            if current_file == '':  # If this is the first image file
-                current_file = row[0]
-                self.append_label_to_list(current_labels, row[1:], bad_boxes)
-                if len(data) == 1:  # If there is only one box in the CVS file
-                    self.append_entry_to_dataset(self.filenames, current_file, self.labels, current_labels, bad_files)
+        key = None
+        if index_path is not None:
+            # The index is out of date if the CSV file or any of the options changed
+            key = hashlib.sha1(repr((os.path.abspath(self.labels_path), os.path.getsize(self.labels_path), os.path.getmtime(self.labels_path),
+                                     self.input_format, self.include_classes, self.box_output_format)).encode()).hexdigest()
+        if key is not None and self.load_index(index_path, key, labels=False):
+            print("Loaded the labels of {} images from the index in {}\n".format(len(self.filenames), index_path))
+        elif key is not None and rank != 0:
+            # Rank 0 parses the CSV file and saves the index, so that not every process parses the whole file
+            print("Waiting for rank 0 to save the index in {}\n".format(index_path))
+            _wait_for(lambda: self.load_index(index_path, key, labels=False), "the index in {}".format(index_path), INDEX_WAIT_TIMEOUT)
+            print("Loaded the labels of {} images from the index in {}\n".format(len(self.filenames), index_path))
+        else:
+            self._parse_csv_labels()
+            if key is not None:
+                self.save_index(index_path, key)
+
+        if pack_path is not None:
+            pack_key = self._pack_key()
+            if self._load_pack_key(pack_path) == pack_key:
+                self.load_pack(pack_path)
+            elif rank == 0:
+                self.pack(pack_path)
             else:
-                if row[0] == current_file:
-                    # If this box (i.e. this line of the CSV file) belongs to the current image file
-                    self.append_label_to_list(current_labels, row[1:], bad_boxes)
-                    # current_labels.append(row[1:])
-                    if idx == len(data) - 1:  # If this is the last line of the CSV file
-                        self.append_entry_to_dataset(self.filenames, current_file, self.labels, current_labels, bad_files)
-                else:  # If this box belongs to a new image file
-                    self.append_entry_to_dataset(self.filenames, current_file, self.labels, current_labels, bad_files)
-                    current_labels = []
-                    current_file = row[0]
-                    self.append_label_to_list(current_labels, row[1:], bad_boxes)
-                    # current_labels.append(row[1:])
-        self.count = len(self.filenames)
-        # if ret:  # In case we want to return these
-        #     return self.filenames, self.labels
-
-        self.filenames, self.labels = shuffle(self.filenames, self.labels)  # Shuffle the data before we begin
-
-        if split_ratio > 1.0 or split_ratio < 0:
-            split_ratio = 1.0
-
-        self.train_filenames = self.filenames[:int(len(self.filenames) * split_ratio)]
-        self.val_filenames = self.filenames[int(len(self.filenames) * split_ratio):]
-
-        self.train_labels = self.labels[:int(len(self.labels) * split_ratio)]
-        self.val_labels = self.labels[int(len(self.labels) * split_ratio):]
+                # Rank 0 packs the images, so that the processes don't write to the same pack at the same time
+                print("Waiting for rank 0 to pack the images in {}\n".format(pack_path))
+                _wait_for(lambda: self._load_pack_key(pack_path) == pack_key, "the pack in {}".format(pack_path), pack_timeout)
+                self.load_pack(pack_path)
+
+        # The labels of all images, sorted by file name, are packed into `self.boxes`, see `_pack_labels()`
+        names = self.filenames
+        counts = np.diff(self.offsets)
+
+        self.count = len(names)
+
+        strata = None
+        if stratify:
+            # The stratum of an image is its rarest class. Ties are broken by the smaller class ID.
+            class_ids = self.boxes[:, self.box_output_format.index('class_id')].astype(np.int64)
+            n_ids = class_ids.max() + 1 if len(class_ids) > 0 else 1
+            keys = np.bincount(class_ids)[class_ids] * n_ids + class_ids
+            strata = np.minimum.reduceat(keys, self.offsets[:-1]) % n_ids if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+
+        train_indices, val_indices = split_shard(len(names), split_ratio, seed=seed, rank=rank, world_size=world_size, strata=strata)
+
+        # Only keep the filenames and labels of this shard. Its labels are gathered from the (possibly memory-mapped) packed
+        # labels of all images with one bulk copy.
+        indices = np.concatenate([train_indices, val_indices]).astype(np.int64)
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts[indices])
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], counts[indices]) + np.arange(offsets[-1])
+        self.filenames = [str(names[i]) for i in indices]
+        self.boxes = np.asarray(self.boxes[rows], dtype=np.float32)
+        self.offsets = offsets
+        self.labels = [self.boxes[self.offsets[i]:self.offsets[i+1]] for i in range(len(indices))]
+
+        self.train_filenames = self.filenames[:len(train_indices)]
+        self.val_filenames = self.filenames[len(train_indices):]
+
+        self.train_labels = self.labels[:len(train_indices)]
+        self.val_labels = self.labels[len(train_indices):]
 
         # add values to val_filenames and val_labels if they are empty due to default split_ratio=1.0
         if len(self.val_filenames) == 0:
+            print("There are no validation images, the training images are used for validation\n")
             self.val_filenames = self.train_filenames
             self.val_labels = self.train_labels
 
-        print("Removed {} faulty bounding boxes from dataset\n".format(len(bad_boxes)))
-        print("Removed {} faulty files from dataset\n".format(len(bad_files)))
-        
-        val_image_filenames_df = pd.DataFrame(self.val_filenames)
-        val_image_filenames_df.to_csv(checkpoints_path + '/val_filenames.csv')
-        
-        print('Saved validation filenames')
+        if checkpoints_path is not None:
+            val_image_filenames_df = pd.DataFrame(self.val_filenames)
+            val_image_filenames_df.to_csv(checkpoints_path + ('/val_filenames.csv' if world_size == 1 else '/val_filenames_rank{}.csv'.format(rank)))
+
+            print('Saved validation filenames')
+
+    def _parse_csv_labels(self):
+        '''
+        Read the labels of all images from the CSV file at `self.labels_path` for `parse_csv()`, drop the faulty boxes and files,
+        and set `self.filenames` to the image filenames sorted by name and `self.boxes` and `self.offsets` to their packed labels.
+        '''
+        # First, read in the six columns of the CSV file at once. The first line is the header.
+
+        data = pd.read_csv(self.labels_path, header=None, skiprows=1, usecols=range(6), skipinitialspace=True,
+                           dtype={self.input_format.index('image_name'): str})
+
+        class_ids = data[self.input_format.index('class_id')].values.astype(np.int64)
+        if self.include_classes is None or self.include_classes == 'all':
+            include = np.ones(len(data), dtype=bool)
+        else:
+            include = np.isin(class_ids, self.include_classes)  # Keep only the boxes whose class_id is among the classes that are to be included in the dataset
+
+        image_names = data[self.input_format.index('image_name')].values[include]
+        # Store the box class and coordinates in the order of `box_output_format`, i.e. each row of `boxes` is a label
+        boxes = np.empty((len(image_names), len(self.box_output_format)), dtype=np.int64)
+        for k, item in enumerate(self.box_output_format):
+            if item == 'class_id' and self.class_map:
+                keys = np.array(sorted(self.class_map))
+                boxes[:, k] = np.array([self.class_map[key] for key in keys])[np.searchsorted(keys, class_ids[include])]
+            else:
+                boxes[:, k] = data[self.input_format.index(item)].values[include]
+
+        # Sort the boxes by file name first and by the label values second, just like sorting the rows as lists would.
+        # The file names only need to be stripped once per distinct name, not once per box.
+        raw_ids, raw_names = pd.factorize(image_names)
+        stripped_ids, unique_names = pd.factorize(np.array([name.strip() for name in raw_names], dtype=object), sort=True)
+        file_ids = stripped_ids[raw_ids]
+        order = np.lexsort([boxes[:, k] for k in reversed(range(boxes.shape[1]))] + [file_ids])
+        file_ids, boxes = file_ids[order], boxes[order]
+
+        # Filter out the corrupted boxes, i.e. those with either height = 0 or width = 0, the same way as `append_label_to_list()`
+        good = (np.abs(boxes[:, 2] - boxes[:, 1]) > 0) & (np.abs(boxes[:, 4] - boxes[:, 3]) > 0)
+        n_bad_boxes = np.count_nonzero(~good)
+
+        # Now compile the actual samples and labels lists. Files that have no good boxes left are bad files
+        n_files = len(unique_names)
+        if len(boxes) > 1 and n_files > 0 and np.count_nonzero(file_ids == n_files - 1) == 1:
+            # The previous row-by-row parser never added the last file of the sorted rows if it had just one box, unless that was
+            # the only box in the whole CSV file. Keep doing that so that the dataset and thus the train/val split remain the same.
+            n_files -= 1
+        good &= file_ids < n_files
+        n_good = np.bincount(file_ids[good], minlength=n_files)[:n_files]
+        n_bad_files = np.count_nonzero(n_good == 0)
+        names = unique_names[:n_files][n_good > 0]
+        counts = n_good[n_good > 0]
+
+        # The boxes are sorted by file, so the labels of each file are one contiguous slice
+        self.filenames = [str(name) for name in names]
+        self.boxes = boxes[good].astype(np.float32)
+        self.offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        self.labels = [self.boxes[self.offsets[i]:self.offsets[i+1]] for i in range(len(names))]
+
+        print("Removed {} faulty bounding boxes from dataset\n".format(n_bad_boxes))
+        print("Removed {} faulty files from dataset\n".format(n_bad_files))
 
     def append_label_to_list(self,
                              current_labels=None,
@@ -360,11 +522,18 @@ class BatchGenerator:
                   classes=None,
                   exclude_truncated=False,
                   exclude_difficult=False,
-                  ret=False):
+                  ret=False,
+                  n_workers=None,
+                  index_path=None):
         '''
         This is a parser for the Pascal VOC datasets. It might be used for other datasets with minor changes to
         the code, but in its current form it expects the data format and XML tags of the Pascal VOC datasets.
 
+        The XML files are parsed with lxml's streaming parser by a pool of worker processes. The parsed labels can be
+        saved to a binary index (see `save_index()`), which later calls with the same arguments and unchanged
+        annotation files load instead of parsing the XML files again. The labels are integer arrays, so the
+        `box_output_format` of the generator can only contain the numeric fields in `VOC_BOX_FIELDS`.
+
         Arguments:
             annotations_path (str, optional): The path to the directory that contains the annotation XML files for
                 the images. The directory must contain one XML file per image and name of the XML file must be the
@@ -382,6 +551,10 @@ class BatchGenerator:
                 Defaults to `False`.
             ret (bool, optional): Whether or not the image filenames and labels are to be returned.
                 Defaults to `False`.
+            n_workers (int, optional): The number of worker processes that parse the XML files. If 1, the files are
+                parsed in this process. Defaults to `None`, i.e. the number of CPUs.
+            index_path (str, optional): `None` or the directory of the binary index to load the labels from, or to save
+                them to if it doesn't exist or is out of date. Defaults to `None`.
 
         Returns:
             None by default, optionally the image filenames and labels.
@@ -399,6 +572,10 @@ class BatchGenerator:
         if not image_set is None: self.image_set = image_set
         if not classes is None: self.classes = classes
 
+        unsupported = [item for item in self.box_output_format if item not in VOC_BOX_FIELDS]
+        if unsupported:
+            raise ValueError("`parse_xml()` stores the labels as integer arrays, so `box_output_format` can only contain {}, but it contains {}.".format(list(VOC_BOX_FIELDS), unsupported))
+
         # Erase data that might have been parsed before
         self.filenames = []
         self.labels = []
@@ -407,52 +584,37 @@ class BatchGenerator:
         with open(os.path.join(self.image_set_path, self.image_set)) as f:
             image_ids = [line.strip() for line in f]
 
+        paths = [os.path.join(self.annotations_path, image_id + '.xml') for image_id in image_ids]
+
+        key = None
+        if index_path is not None:
+            # The index is out of date if any annotation file or any of the options changed
+            stats = [(os.path.getsize(path), os.path.getmtime(path)) for path in paths]
+            key = hashlib.sha1(repr((paths, stats, self.classes, self.include_classes, self.box_output_format,
+                                     exclude_truncated, exclude_difficult)).encode()).hexdigest()
+            if self.load_index(index_path, key):
+                if ret:
+                    return self.filenames, self.labels
+                return
+
         # Parse the labels for each image ID from its respective XML file
-        for image_id in image_ids:
-            # Open the XML file for this image
-            with open(os.path.join(self.annotations_path, image_id + '.xml')) as f:
-                soup = BeautifulSoup(f, 'xml')
+        class_ids = {class_name: class_id for class_id, class_name in enumerate(self.classes)}
+        include_classes = None if self.include_classes is None else set(self.include_classes)
+        tasks = [(path, class_ids, include_classes, exclude_truncated, exclude_difficult, self.box_output_format) for path in paths]
+        if n_workers == 1:
+            results = [_parse_voc_annotation(task) for task in tasks]
+        else:
+            with Pool(n_workers) as pool:
+                results = pool.map(_parse_voc_annotation, tasks, chunksize=max(1, min(256, len(tasks) // (4 * (n_workers or os.cpu_count() or 1)))))
 
-            folder = soup.folder.text  # In case we want to return the folder in addition to the image file name. Relevant for determining which dataset an image belongs to.
-            filename = soup.filename.text
+        for filename, boxes in results:
             self.filenames.append(filename)
+            self.labels.append(boxes)
 
-            boxes = []  # We'll store all boxes for this image here
-            objects = soup.find_all('object')  # Get a list of all objects in this image
-
-            # Parse the data for each object
-            for obj in objects:
-                class_name = obj.find('name').text
-                class_id = self.classes.index(class_name)
-                # Check if this class is supposed to be included in the dataset
-                if (self.include_classes is not None) and (class_id not in self.include_classes): continue
-                pose = obj.pose.text
-                truncated = int(obj.truncated.text)
-                if exclude_truncated and (truncated == 1): continue
-                difficult = int(obj.difficult.text)
-                if exclude_difficult and (difficult == 1): continue
-                xmin = int(obj.bndbox.xmin.text)
-                ymin = int(obj.bndbox.ymin.text)
-                xmax = int(obj.bndbox.xmax.text)
-                ymax = int(obj.bndbox.ymax.text)
-                item_dict = {'folder': folder,
-                             'image_name': filename,
-                             'image_id': image_id,
-                             'class_name': class_name,
-                             'class_id': class_id,
-                             'pose': pose,
-                             'truncated': truncated,
-                             'difficult': difficult,
-                             'xmin': xmin,
-                             'ymin': ymin,
-                             'xmax': xmax,
-                             'ymax': ymax}
-                box = []
-                for item in self.box_output_format:
-                    box.append(item_dict[item])
-                boxes.append(box)
+        self._pack_labels()
 
-            self.labels.append(boxes)
+        if index_path is not None:
+            self.save_index(index_path, key)
 
         if ret:
             return self.filenames, self.labels
@@ -475,7 +637,10 @@ class BatchGenerator:
                  limit_boxes=True,
                  include_thresh=0.3,
                  diagnostics=False,
-                 val=False):
+                 val=False,
+                 image_dtype=None,
+                 y_dtype=None,
+                 n_buffers=0):
         '''
         Generate batches of samples and corresponding labels indefinitely from
         lists of filenames and labels.
@@ -557,376 +722,231 @@ class BatchGenerator:
                 2) An array with the original, unaltered images.
                 3) A list with the original, unaltered labels.
                 This can be useful for diagnostic purposes. Defaults to `False`. Only works if `train = True`.
+            val (bool, optional): If `True`, the batches are generated from the validation samples, otherwise from
+                the training samples. Defaults to `False`.
+            image_dtype (str, optional): The data type of the yielded images, e.g. 'uint8' or 'float32'. Defaults to `None`,
+                i.e. the data type of the image files.
+            y_dtype (str, optional): The data type of the yielded `y_true`, e.g. 'float32', which takes half the memory of
+                the default. Defaults to `None`, i.e. 'float64'. Only relevant if `train = True`.
+            n_buffers (int, optional): If greater than 0, the images and `y_true` are written into a ring of `n_buffers`
+                preallocated arrays each instead of into new arrays for every batch (see `RingBuffer`). A yielded batch
+                is then overwritten `n_buffers` batches later, so this must be larger than the number of batches that
+                the consumer holds at the same time, e.g. at least `max_queue_size + 2` for `model.fit_generator()`.
+                Defaults to 0.
 
         Yields:
             The next batch as a tuple containing a Numpy array that contains the images and a python list
             that contains the corresponding labels for each image as 2D Numpy arrays. The output format
             of the labels is according to the `box_output_format` that was specified in the constructor.
         '''
+        from sklearn.utils import shuffle
 
         if not val:
             filenames, labels = shuffle(self.train_filenames, self.train_labels) # Shuffle the data before we begin
         else:
             filenames, labels = shuffle(self.val_filenames, self.val_labels)  # Shuffle the data before we begin
 
-        current = 0
+        transforms = self.build_transforms(equalize=equalize,
+                                           brightness=brightness,
+                                           flip=flip,
+                                           translate=translate,
+                                           scale=scale,
+                                           random_crop=random_crop,
+                                           crop=crop,
+                                           resize=resize,
+                                           rgb_to_gray=rgb_to_gray,
+                                           gray_to_rgb=gray_to_rgb,
+                                           multispectral_to_rgb=multispectral_to_rgb,
+                                           limit_boxes=limit_boxes,
+                                           include_thresh=include_thresh)
+
+        image_buffers = RingBuffer(n_buffers, image_dtype)
+        y_buffers = RingBuffer(n_buffers, y_dtype)
+        n_batches = 0
 
-        # Find out the indices of the box coordinates in the label data
-        xmin = self.box_output_format.index('xmin')
-        xmax = self.box_output_format.index('xmax')
-        ymin = self.box_output_format.index('ymin')
-        ymax = self.box_output_format.index('ymax')
+        current = 0
 
         while True:
 
-            batch_X, batch_y = [], []
-
             # Shuffle the data after each complete pass
             if current >= len(filenames):
                 filenames, labels = shuffle(filenames, labels)
                 current = 0
 
-            for filename in filenames[current:current + batch_size]:
-                with rasterio.open('{}'.format(filename)) as img:
-                #with Image.open('{}'.format(filename)) as img:
-                    #batch_X.append(np.array(img))
-                    img = np.array(img.read())
-                    img = img.transpose([1, 2, 0])
-                    batch_X.append(img)
-            batch_y = deepcopy(labels[current:current + batch_size])
-
             this_filenames = filenames[
                              current:current + batch_size]  # The filenames of the files in the current batch
 
+            images = self.load_images(this_filenames)
+
             if diagnostics:
-                original_images = np.copy(batch_X)  # The original, unaltered images
-                original_labels = deepcopy(batch_y)  # The original, unaltered labels
+                original_images = np.array(images)  # The original, unaltered images
+                original_labels = labels[current:current + batch_size]  # The original, unaltered labels. The pipeline doesn't modify them.
 
-            current += batch_size
+            # Perform the optional image transformations on the whole batch at once. The pipeline gathers the labels
+            # of the batch with one bulk copy into one box array and works on copies of the images, so there's no need
+            # to copy anything here. Images for which no valid random crop was found are removed from the batch.
+            batch_X, batch_y = transforms(images, labels[current:current + batch_size])
+            batch_X = image_buffers.put(n_batches, batch_X)
 
-            # At this point we're done producing the batch. Now perform some
-            # optional image transformations:
-
-            batch_items_to_remove = []  # In case we need to remove any images from the batch because of failed random cropping, store their indices in this list
-
-            for i in range(len(batch_X)):
-  
-                img_height, img_width, ch = batch_X[i].shape
-                batch_y[i] = np.array(batch_y[
-                                          i])  # Convert labels into an array (in case it isn't one already), otherwise the indexing below breaks
-
-                if equalize:
-                    batch_X[i] = histogram_eq(batch_X[i])
-
-                if brightness:
-                    p = np.random.uniform(0, 1)
-                    if p >= (1 - brightness[2]):
-                        batch_X[i] = _brightness(batch_X[i], min=brightness[0], max=brightness[1])
-
-                # Could easily be extended to also allow vertical flipping, but I'm not convinced of the
-                # usefulness of vertical flipping either empirically or theoretically, so I'm going for simplicity.
-                # If you want to allow vertical flipping, just change this function to pass the respective argument
-                # to `_flip()`.
-                if flip:
-                    p = np.random.uniform(0, 1)
-                    if p >= (1 - flip):
-                        batch_X[i] = _flip(batch_X[i])
-                        batch_y[i][:, [xmin, xmax]] = img_width - batch_y[i][:, [xmax,
-                                                                                 xmin]]  # xmin and xmax are swapped when mirrored
-
-                if translate:
-                    p = np.random.uniform(0, 1)
-                    if p >= (1 - translate[2]):
-                        # Translate the image and return the shift values so that we can adjust the labels
-                        batch_X[i], xshift, yshift = _translate(batch_X[i], translate[0], translate[1])
-                        # Adjust the labels
-                        batch_y[i][:, [xmin, xmax]] += xshift
-                        batch_y[i][:, [ymin, ymax]] += yshift
-                        # Limit the box coordinates to lie within the image boundaries
-                        if limit_boxes:
-                            before_limiting = deepcopy(batch_y[i])
-                            x_coords = batch_y[i][:, [xmin, xmax]]
-                            x_coords[x_coords >= img_width] = img_width - 1
-                            x_coords[x_coords < 0] = 0
-                            batch_y[i][:, [xmin, xmax]] = x_coords
-                            y_coords = batch_y[i][:, [ymin, ymax]]
-                            y_coords[y_coords >= img_height] = img_height - 1
-                            y_coords[y_coords < 0] = 0
-                            batch_y[i][:, [ymin, ymax]] = y_coords
-                            # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                            # process that they don't serve as useful training examples anymore, because too little of them is
-                            # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                            # `include_thresh` of the box area before limiting.
-                            before_area = (before_limiting[:, xmax] - before_limiting[:, xmin]) * (
-                            before_limiting[:, ymax] - before_limiting[:, ymin])
-                            after_area = (batch_y[i][:, xmax] - batch_y[i][:, xmin]) * (
-                            batch_y[i][:, ymax] - batch_y[i][:, ymin])
-                            if include_thresh == 0:
-                                batch_y[i] = batch_y[i][
-                                    after_area > include_thresh * before_area]  # If `include_thresh == 0`, we want to make sure that boxes with area 0 get thrown out, hence the ">" sign instead of the ">=" sign
-                            else:
-                                batch_y[i] = batch_y[i][
-                                    after_area >= include_thresh * before_area]  # Especially for the case `include_thresh == 1` we want the ">=" sign, otherwise no boxes would be left at all
-
-                if scale:
-                    p = np.random.uniform(0, 1)
-                    if p >= (1 - scale[2]):
-                        # Rescale the image and return the transformation matrix M so we can use it to adjust the box coordinates
-                        batch_X[i], M, scale_factor = _scale(batch_X[i], scale[0], scale[1])
-                        # Adjust the box coordinates
-                        # Transform two opposite corner points of the rectangular boxes using the transformation matrix `M`
-                        toplefts = np.array([batch_y[i][:, xmin], batch_y[i][:, ymin], np.ones(batch_y[i].shape[0])])
-                        bottomrights = np.array(
-                            [batch_y[i][:, xmax], batch_y[i][:, ymax], np.ones(batch_y[i].shape[0])])
-                        new_toplefts = (np.dot(M, toplefts)).T
-                        new_bottomrights = (np.dot(M, bottomrights)).T
-                        batch_y[i][:, [xmin, ymin]] = new_toplefts.astype(np.int)
-                        batch_y[i][:, [xmax, ymax]] = new_bottomrights.astype(np.int)
-                        # Limit the box coordinates to lie within the image boundaries
-                        if limit_boxes and (
-                            scale_factor > 1):  # We don't need to do any limiting in case we shrunk the image
-                            before_limiting = deepcopy(batch_y[i])
-                            x_coords = batch_y[i][:, [xmin, xmax]]
-                            x_coords[x_coords >= img_width] = img_width - 1
-                            x_coords[x_coords < 0] = 0
-                            batch_y[i][:, [xmin, xmax]] = x_coords
-                            y_coords = batch_y[i][:, [ymin, ymax]]
-                            y_coords[y_coords >= img_height] = img_height - 1
-                            y_coords[y_coords < 0] = 0
-                            batch_y[i][:, [ymin, ymax]] = y_coords
-                            # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                            # process that they don't serve as useful training examples anymore, because too little of them is
-                            # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                            # `include_thresh` of the box area before limiting.
-                            before_area = (before_limiting[:, xmax] - before_limiting[:, xmin]) * (
-                            before_limiting[:, ymax] - before_limiting[:, ymin])
-                            after_area = (batch_y[i][:, xmax] - batch_y[i][:, xmin]) * (
-                            batch_y[i][:, ymax] - batch_y[i][:, ymin])
-                            if include_thresh == 0:
-                                batch_y[i] = batch_y[i][
-                                    after_area > include_thresh * before_area]  # If `include_thresh == 0`, we want to make sure that boxes with area 0 get thrown out, hence the ">" sign instead of the ">=" sign
-                            else:
-                                batch_y[i] = batch_y[i][
-                                    after_area >= include_thresh * before_area]  # Especially for the case `include_thresh == 1` we want the ">=" sign, otherwise no boxes would be left at all
-
-                if random_crop:
-                    # Compute how much room we have in both dimensions to make a random crop.
-                    # A negative number here means that we want to crop out a patch that is larger than the original image in the respective dimension,
-                    # in which case we will create a black background canvas onto which we will randomly place the image.
-                    y_range = img_height - random_crop[0]
-                    x_range = img_width - random_crop[1]
-                    # Keep track of the number of trials and of whether or not the most recent crop contains at least one object
-                    min_1_object_fulfilled = False
-                    trial_counter = 0
-                    while (not min_1_object_fulfilled) and (trial_counter < random_crop[3]):
-                        # Select a random crop position from the possible crop positions
-                        if y_range >= 0:
-                            crop_ymin = np.random.randint(0,
-                                                          y_range + 1)  # There are y_range + 1 possible positions for the crop in the vertical dimension
-                        else:
-                            crop_ymin = np.random.randint(0,
-                                                          -y_range + 1)  # The possible positions for the image on the background canvas in the vertical dimension
-                        if x_range >= 0:
-                            crop_xmin = np.random.randint(0,
-                                                          x_range + 1)  # There are x_range + 1 possible positions for the crop in the horizontal dimension
-                        else:
-                            crop_xmin = np.random.randint(0,
-                                                          -x_range + 1)  # The possible positions for the image on the background canvas in the horizontal dimension
-                        # Perform the crop
-                        if y_range >= 0 and x_range >= 0:  # If the patch to be cropped out is smaller than the original image in both dimenstions, we just perform a regular crop
-                            # Crop the image
-                            patch_X = np.copy(
-                                batch_X[i][crop_ymin:crop_ymin + random_crop[0], crop_xmin:crop_xmin + random_crop[1]])
-                            # Translate the box coordinates into the new coordinate system: Cropping shifts the origin by `(crop_ymin, crop_xmin)`
-                            patch_y = np.copy(batch_y[i])
-                            patch_y[:, [ymin, ymax]] -= crop_ymin
-                            patch_y[:, [xmin, xmax]] -= crop_xmin
-                            # Limit the box coordinates to lie within the new image boundaries
-                            if limit_boxes:
-                                # Both the x- and y-coordinates might need to be limited
-                                before_limiting = np.copy(patch_y)
-                                y_coords = patch_y[:, [ymin, ymax]]
-                                y_coords[y_coords < 0] = 0
-                                y_coords[y_coords >= random_crop[0]] = random_crop[0] - 1
-                                patch_y[:, [ymin, ymax]] = y_coords
-                                x_coords = patch_y[:, [xmin, xmax]]
-                                x_coords[x_coords < 0] = 0
-                                x_coords[x_coords >= random_crop[1]] = random_crop[1] - 1
-                                patch_y[:, [xmin, xmax]] = x_coords
-                        elif y_range >= 0 and x_range < 0:  # If the crop is larger than the original image in the horizontal dimension only,...
-                            # Crop the image
-                            patch_X = np.copy(batch_X[i][crop_ymin:crop_ymin + random_crop[
-                                0]])  # ...crop the vertical dimension just as before,...
-                            canvas = np.zeros((random_crop[0], random_crop[1], patch_X.shape[2]),
-                                              dtype=np.uint8)  # ...generate a blank background image to place the patch onto,...
-                            canvas[:,
-                            crop_xmin:crop_xmin + img_width] = patch_X  # ...and place the patch onto the canvas at the random `crop_xmin` position computed above.
-                            patch_X = canvas
-                            # Translate the box coordinates into the new coordinate system: In this case, the origin is shifted by `(crop_ymin, -crop_xmin)`
-                            patch_y = np.copy(batch_y[i])
-                            patch_y[:, [ymin, ymax]] -= crop_ymin
-                            patch_y[:, [xmin, xmax]] += crop_xmin
-                            # Limit the box coordinates to lie within the new image boundaries
-                            if limit_boxes:
-                                # Only the y-coordinates might need to be limited
-                                before_limiting = np.copy(patch_y)
-                                y_coords = patch_y[:, [ymin, ymax]]
-                                y_coords[y_coords < 0] = 0
-                                y_coords[y_coords >= random_crop[0]] = random_crop[0] - 1
-                                patch_y[:, [ymin, ymax]] = y_coords
-                        elif y_range < 0 and x_range >= 0:  # If the crop is larger than the original image in the vertical dimension only,...
-                            # Crop the image
-                            patch_X = np.copy(batch_X[i][:, crop_xmin:crop_xmin + random_crop[
-                                1]])  # ...crop the horizontal dimension just as in the first case,...
-                            canvas = np.zeros((random_crop[0], random_crop[1], patch_X.shape[2]),
-                                              dtype=np.uint8)  # ...generate a blank background image to place the patch onto,...
-                            canvas[crop_ymin:crop_ymin + img_height,
-                            :] = patch_X  # ...and place the patch onto the canvas at the random `crop_ymin` position computed above.
-                            patch_X = canvas
-                            # Translate the box coordinates into the new coordinate system: In this case, the origin is shifted by `(-crop_ymin, crop_xmin)`
-                            patch_y = np.copy(batch_y[i])
-                            patch_y[:, [ymin, ymax]] += crop_ymin
-                            patch_y[:, [xmin, xmax]] -= crop_xmin
-                            # Limit the box coordinates to lie within the new image boundaries
-                            if limit_boxes:
-                                # Only the x-coordinates might need to be limited
-                                before_limiting = np.copy(patch_y)
-                                x_coords = patch_y[:, [xmin, xmax]]
-                                x_coords[x_coords < 0] = 0
-                                x_coords[x_coords >= random_crop[1]] = random_crop[1] - 1
-                                patch_y[:, [xmin, xmax]] = x_coords
-                        else:  # If the crop is larger than the original image in both dimensions,...
-                            patch_X = np.copy(batch_X[i])
-                            canvas = np.zeros((random_crop[0], random_crop[1], patch_X.shape[2]),
-                                              dtype=np.uint8)  # ...generate a blank background image to place the patch onto,...
-                            canvas[crop_ymin:crop_ymin + img_height,
-                            crop_xmin:crop_xmin + img_width] = patch_X  # ...and place the patch onto the canvas at the random `(crop_ymin, crop_xmin)` position computed above.
-                            patch_X = canvas
-                            # Translate the box coordinates into the new coordinate system: In this case, the origin is shifted by `(-crop_ymin, -crop_xmin)`
-                            patch_y = np.copy(batch_y[i])
-                            patch_y[:, [ymin, ymax]] += crop_ymin
-                            patch_y[:, [xmin, xmax]] += crop_xmin
-                            # Note that no limiting is necessary in this case
-                        # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                        # process that they don't serve as useful training examples anymore, because too little of them is
-                        # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                        # `include_thresh` of the box area before limiting.
-                        if limit_boxes and (y_range >= 0 or x_range >= 0):
-                            before_area = (before_limiting[:, xmax] - before_limiting[:, xmin]) * (
-                            before_limiting[:, ymax] - before_limiting[:, ymin])
-                            after_area = (patch_y[:, xmax] - patch_y[:, xmin]) * (patch_y[:, ymax] - patch_y[:, ymin])
-                            if include_thresh == 0:
-                                patch_y = patch_y[
-                                    after_area > include_thresh * before_area]  # If `include_thresh == 0`, we want to make sure that boxes with area 0 get thrown out, hence the ">" sign instead of the ">=" sign
-                            else:
-                                patch_y = patch_y[
-                                    after_area >= include_thresh * before_area]  # Especially for the case `include_thresh == 1` we want the ">=" sign, otherwise no boxes would be left at all
-                        trial_counter += 1  # We've just used one of our trials
-                        # Check if we have found a valid crop
-                        if random_crop[
-                            2] == 0:  # If `min_1_object == 0`, break out of the while loop after the first loop because we are fine with whatever crop we got
-                            batch_X[i] = patch_X  # The cropped patch becomes our new batch item
-                            batch_y[i] = patch_y  # The adjusted boxes become our new labels for this batch item
-                            # Update the image size so that subsequent transformations can work correctly
-                            img_height = random_crop[0]
-                            img_width = random_crop[1]
-                            break
-                        elif len(
-                                patch_y) > 0:  # If we have at least one object left, this crop is valid and we can stop
-                            min_1_object_fulfilled = True
-                            batch_X[i] = patch_X  # The cropped patch becomes our new batch item
-                            batch_y[i] = patch_y  # The adjusted boxes become our new labels for this batch item
-                            # Update the image size so that subsequent transformations can work correctly
-                            img_height = random_crop[0]
-                            img_width = random_crop[1]
-                        elif (trial_counter >= random_crop[3]) and (
-                        not i in batch_items_to_remove):  # If we've reached the trial limit and still not found a valid crop, remove this image from the batch
-                            batch_items_to_remove.append(i)
-
-                if crop:
-                    # Crop the image
-                    batch_X[i] = np.copy(batch_X[i][crop[0]:img_height - crop[1], crop[2]:img_width - crop[3]])
-                    # Translate the box coordinates into the new coordinate system if necessary: The origin is shifted by `(crop[0], crop[2])` (i.e. by the top and left crop values)
-                    # If nothing was cropped off from the top or left of the image, the coordinate system stays the same as before
-                    if crop[0] > 0:
-                        batch_y[i][:, [ymin, ymax]] -= crop[0]
-                    if crop[2] > 0:
-                        batch_y[i][:, [xmin, xmax]] -= crop[2]
-                    # Update the image size so that subsequent transformations can work correctly
-                    img_height -= crop[0] + crop[1]
-                    img_width -= crop[2] + crop[3]
-                    # Limit the box coordinates to lie within the new image boundaries
-                    if limit_boxes:
-                        before_limiting = np.copy(batch_y[i])
-                        # We only need to check those box coordinates that could possibly have been affected by the cropping
-                        # For example, if we only crop off the top and/or bottom of the image, there is no need to check the x-coordinates
-                        if crop[0] > 0:
-                            y_coords = batch_y[i][:, [ymin, ymax]]
-                            y_coords[y_coords < 0] = 0
-                            batch_y[i][:, [ymin, ymax]] = y_coords
-                        if crop[1] > 0:
-                            y_coords = batch_y[i][:, [ymin, ymax]]
-                            y_coords[y_coords >= img_height] = img_height - 1
-                            batch_y[i][:, [ymin, ymax]] = y_coords
-                        if crop[2] > 0:
-                            x_coords = batch_y[i][:, [xmin, xmax]]
-                            x_coords[x_coords < 0] = 0
-                            batch_y[i][:, [xmin, xmax]] = x_coords
-                        if crop[3] > 0:
-                            x_coords = batch_y[i][:, [xmin, xmax]]
-                            x_coords[x_coords >= img_width] = img_width - 1
-                            batch_y[i][:, [xmin, xmax]] = x_coords
-                        # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                        # process that they don't serve as useful training examples anymore, because too little of them is
-                        # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                        # `include_thresh` of the box area before limiting.
-                        before_area = (before_limiting[:, xmax] - before_limiting[:, xmin]) * (
-                        before_limiting[:, ymax] - before_limiting[:, ymin])
-                        after_area = (batch_y[i][:, xmax] - batch_y[i][:, xmin]) * (
-                        batch_y[i][:, ymax] - batch_y[i][:, ymin])
-                        if include_thresh == 0:
-                            batch_y[i] = batch_y[i][
-                                after_area > include_thresh * before_area]  # If `include_thresh == 0`, we want to make sure that boxes with area 0 get thrown out, hence the ">" sign instead of the ">=" sign
-                        else:
-                            batch_y[i] = batch_y[i][
-                                after_area >= include_thresh * before_area]  # Especially for the case `include_thresh == 1` we want the ">=" sign, otherwise no boxes would be left at all
-
-                if resize:
-                    batch_X[i] = cv2.resize(batch_X[i], dsize=resize)
-                    batch_y[i][:, [xmin, xmax]] = (batch_y[i][:, [xmin, xmax]] * (resize[0] / img_width)).astype(np.int)
-                    batch_y[i][:, [ymin, ymax]] = (batch_y[i][:, [ymin, ymax]] * (resize[1] / img_height)).astype(
-                        np.int)
-                    img_width, img_height = resize  # Updating these at this point is unnecessary, but it's one fewer source of error if this method gets expanded in the future
-
-                if rgb_to_gray and not gray_to_rgb and not multispectral_to_rgb:
-                    batch_X[i] = np.expand_dims(cv2.cvtColor(batch_X[i], cv2.COLOR_RGB2GRAY), 3)
-
-                elif gray_to_rgb and not rgb_to_gray and not multispectral_to_rgb:
-                    batch_X[i] = cv2.cvtColor(batch_X[i], cv2.COLOR_BayerGR2RGB)
-                    
-                elif multispectral_to_rgb and not rgb_to_gray and not gray_to_rgb:
-                    batch_X[i] = batch_X[i][:, :, np.r_[-4:-5:-1, -6:-8:-1]]
-                
-            # If any batch items need to be removed because of failed random cropping, remove them now.
-            for j in sorted(batch_items_to_remove, reverse=True):
-                batch_X.pop(j)
-                batch_y.pop(j)  # This isn't efficient, but this should hopefully not need to be done often anyway
+            current += batch_size
 
             if train:  # During training we need the encoded labels instead of the format that `batch_y` has
                 if ssd_box_encoder is None:
                     raise ValueError("`ssd_box_encoder` cannot be `None` in training mode.")
                 y_true = ssd_box_encoder.encode_y(
-                    batch_y)  # Encode the labels into the `y_true` tensor that the cost function needs
+                    batch_y, out=y_buffers.get(n_batches, (len(batch_y),) + ssd_box_encoder.y_shape, np.float64))  # Encode the labels into the `y_true` tensor that the cost function needs
 
-            # CAUTION: Converting `batch_X` into an array will result in an empty batch if the images have varying sizes.
-            #          At this point, all images have to have the same size, otherwise you will get an error during training.
+            n_batches += 1
+
+            # CAUTION: At this point, all images have to have the same size, otherwise the transform pipeline raises an error.
             if train:
                 if diagnostics:
-                    yield (np.array(batch_X), y_true, batch_y, this_filenames, original_images, original_labels)
+                    yield (batch_X, y_true, batch_y, this_filenames, original_images, original_labels)
                 else:
-                    yield (np.array(batch_X), y_true)
+                    yield (batch_X, y_true)
             else:
-                yield (np.array(batch_X), batch_y, this_filenames)
+                yield (batch_X, batch_y, this_filenames)
+
+    def build_transforms(self,
+                         equalize=False,
+                         brightness=False,
+                         flip=False,
+                         translate=False,
+                         scale=False,
+                         random_crop=False,
+                         crop=False,
+                         resize=False,
+                         rgb_to_gray=False,
+                         gray_to_rgb=False,
+                         multispectral_to_rgb=False,
+                         limit_boxes=True,
+                         include_thresh=0.3):
+        '''
+        Build the transform pipeline that performs the image transformations of `generate()` on whole batches.
+
+        For a description of the arguments, please refer to the documentation of `generate()` above.
+
+        Returns:
+            A `transforms.Compose` object that applies the enabled transformations in the order of the arguments.
+        '''
+        transforms = []
+
+        if equalize:
+            transforms.append(Equalize())
+
+        if brightness:
+            transforms.append(Brightness(brightness[0], brightness[1], brightness[2]))
+
+        if flip:
+            transforms.append(Flip(flip))
+
+        if translate:
+            transforms.append(Translate(translate[0], translate[1], translate[2], limit_boxes=limit_boxes, include_thresh=include_thresh))
+
+        if scale:
+            transforms.append(Scale(scale[0], scale[1], scale[2], limit_boxes=limit_boxes, include_thresh=include_thresh))
+
+        if random_crop:
+            transforms.append(RandomCrop(random_crop[0], random_crop[1], random_crop[2], random_crop[3], limit_boxes=limit_boxes, include_thresh=include_thresh))
+
+        if crop:
+            transforms.append(Crop(crop[0], crop[1], crop[2], crop[3], limit_boxes=limit_boxes, include_thresh=include_thresh))
+
+        if resize:
+            transforms.append(Resize(resize[0], resize[1]))
+
+        if rgb_to_gray and not gray_to_rgb and not multispectral_to_rgb:
+            transforms.append(RGBToGray())
+
+        elif gray_to_rgb and not rgb_to_gray and not multispectral_to_rgb:
+            transforms.append(GrayToRGB())
+
+        elif multispectral_to_rgb and not rgb_to_gray and not gray_to_rgb:
+            transforms.append(MultispectralToRGB())
+
+        return Compose(transforms, self.box_output_format)
+
+    def _pack_labels(self):
+        '''
+        Pack the labels in `self.labels` into one float32 array `self.boxes` with one box per row and the offsets
+        `self.offsets`, such that the labels of image `i` are `self.boxes[self.offsets[i]:self.offsets[i+1]]`, and
+        replace the arrays in `self.labels` by views into `self.boxes`.
+
+        Batches of labels are then gathered with one bulk copy instead of copying one array object per image.
+        '''
+        n_columns = len(self.box_output_format)
+        self.offsets = np.zeros(len(self.labels) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(labels) for labels in self.labels])
+        self.boxes = np.zeros((self.offsets[-1], n_columns), dtype=np.float32)
+        if len(self.labels) > 0:
+            np.concatenate([np.reshape(np.asarray(labels, dtype=np.float32), (-1, n_columns)) for labels in self.labels], axis=0, out=self.boxes)
+        self.labels = [self.boxes[self.offsets[i]:self.offsets[i+1]] for i in range(len(self.labels))]
+
+    def save_index(self, index_path, key):
+        '''
+        Save the parsed dataset as a binary index that `load_index()` memory-maps instead of parsing the labels again.
+
+        The index consists of four files in `index_path`:
+            `filenames.npy`: An array of shape `(n_images,)` with the image filenames.
+            `boxes.npy`: The packed labels of all images, see `_pack_labels()`.
+            `offsets.npy`: An array of shape `(n_images + 1,)`. The labels of image `i` are `boxes[offsets[i]:offsets[i+1]]`.
+            `index.json`: The key and the class map. It is written last, so an interrupted save leaves no valid index behind.
+
+        Every file is written to a temporary file first and then moved into place, so processes that have memory-mapped
+        an older index keep reading the old files.
+
+        Arguments:
+            index_path (str): The directory to write the index to. It is created if it doesn't exist.
+            key (str): A string that identifies the label files and the parse options the dataset was parsed from.
+
+        Returns:
+            None.
+        '''
+        if not os.path.exists(index_path):
+            os.makedirs(index_path)
+        json_path = os.path.join(index_path, 'index.json')
+        if os.path.exists(json_path):
+            os.remove(json_path)
+        _save_npy(os.path.join(index_path, 'filenames.npy'), np.array(self.filenames, dtype=str))
+        _save_npy(os.path.join(index_path, 'boxes.npy'), self.boxes)
+        _save_npy(os.path.join(index_path, 'offsets.npy'), self.offsets)
+        tmp_path = '{}.{}.tmp'.format(json_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key,
+                       'box_output_format': self.box_output_format,
+                       'class_map': None if self.class_map is None else [[k, v] for k, v in self.class_map.items()]}, f)
+        os.replace(tmp_path, json_path)
+
+    def load_index(self, index_path, key, labels=True):
+        '''
+        Load a binary index saved by `save_index()` if it exists and was saved with the same key. The boxes are
+        memory-mapped, not read into memory.
+
+        Arguments:
+            index_path (str): The directory of the index.
+            key (str): The key that the index must have been saved with.
+            labels (bool, optional): If `False`, `self.labels` is left empty, `self.filenames` is a memory-mapped array
+                instead of a list, and only `self.boxes` and `self.offsets` are set, e.g. when only the filenames and labels
+                of a shard are kept afterwards. Defaults to `True`.
+
+        Returns:
+            `True` if the index was loaded, `False` if it doesn't exist or is out of date.
+        '''
+        json_path = os.path.join(index_path, 'index.json')
+        if not os.path.exists(json_path):
+            return False
+        with open(json_path) as f:
+            index = json.load(f)
+        if index['key'] != key or index['box_output_format'] != self.box_output_format:
+            return False
+
+        filenames = np.load(os.path.join(index_path, 'filenames.npy'), mmap_mode='r').view(np.ndarray)
+        self.filenames = filenames.tolist() if labels else filenames
+        # A plain array view of the memory map, since slicing an `np.memmap` is much slower than slicing an array
+        self.boxes = np.load(os.path.join(index_path, 'boxes.npy'), mmap_mode='r').view(np.ndarray)
+        self.offsets = np.load(os.path.join(index_path, 'offsets.npy'))
+        self.labels = [self.boxes[self.offsets[i]:self.offsets[i+1]] for i in range(len(self.filenames))] if labels else []
+        return True
 
     def get_filenames_labels(self):
         '''
@@ -942,6 +962,148 @@ class BatchGenerator:
         '''
         return len(self.filenames)
 
+    def load_images(self, filenames):
+        '''
+        Load images in HWC order, either from the pack loaded by `load_pack()` or from disk.
+
+        If all images are in the pack, they are sliced out of the memory-mapped pack array at once,
+        without any decoding. Otherwise the images are read from disk with rasterio.
+
+        Arguments:
+            filenames (list): The image filenames.
+
+        Returns:
+            A list with one Numpy array of shape `(height, width, channels)` per image.
+        '''
+        if self.pack_images is not None and all(filename in self.pack_index for filename in filenames):
+            return list(self.pack_images[[self.pack_index[filename] for filename in filenames]])
+
+        import rasterio
+
+        images = []
+        for filename in filenames:
+            with rasterio.open('{}'.format(filename)) as img:
+                images.append(np.array(img.read()).transpose([1, 2, 0]))
+        return images
+
+    def pack(self, pack_path):
+        '''
+        Decode all images of the dataset once and store them in a memory-mapped pack, then load the pack.
+
+        Decoding the images with rasterio on every pass over the dataset is expensive. After packing,
+        `generate()` and `BatchSequence` slice the images straight out of the memory-mapped pack instead.
+        The pack consists of four Numpy files in `pack_path`:
+            `images.npy`: An array of shape `(n_images, height, width, channels)` with all decoded images.
+            `boxes.npy`: A 2D array with the labels of all images in the format given by `box_output_format`.
+            `offsets.npy`: An array of shape `(n_images + 1,)`. The labels of image `i` are `boxes[offsets[i]:offsets[i+1]]`.
+            `filenames.npy`: An array of shape `(n_images,)` with the image filenames.
+            `pack.json`: The key of the image files, see `_pack_key()`. It is written last, so an interrupted packing
+                leaves no valid pack behind.
+
+        Every file is written to a temporary file first and then moved into place, so processes that have memory-mapped
+        an older pack keep reading the old files. All images must have the same size, number of channels and data type.
+
+        Arguments:
+            pack_path (str): The directory to write the pack to. It is created if it doesn't exist.
+
+        Returns:
+            None.
+        '''
+        if len(self.filenames) == 0:
+            raise ValueError("The dataset is empty. You need to parse a dataset before you can pack it.")
+
+        import rasterio
+
+        if not os.path.exists(pack_path):
+            os.makedirs(pack_path)
+
+        with rasterio.open('{}'.format(self.filenames[0])) as img:
+            shape = (img.height, img.width, img.count)
+            dtype = img.dtypes[0]
+
+        json_path = os.path.join(pack_path, 'pack.json')
+        if os.path.exists(json_path):
+            os.remove(json_path)
+        # Computed before decoding, so that images modified while packing make the pack out of date
+        pack_key = self._pack_key()
+
+        images_path = os.path.join(pack_path, 'images.npy')
+        tmp_path = '{}.{}.tmp.npy'.format(images_path[:-4], os.getpid())
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(self.filenames),) + shape)
+        for i, filename in enumerate(self.filenames):
+            with rasterio.open('{}'.format(filename)) as img:
+                if (img.height, img.width, img.count) != shape or img.dtypes[0] != dtype:
+                    raise ValueError("All images must have the same size, number of channels and data type to be packed, but {} has shape {} and data type {} while {} has shape {} and data type {}.".format(filename, (img.height, img.width, img.count), img.dtypes[0], self.filenames[0], shape, dtype))
+                images[i] = img.read().transpose([1, 2, 0])
+        images.flush()
+        del images
+
+        if len(self.offsets) != len(self.filenames) + 1:  # The labels haven't been packed by a parser
+            self._pack_labels()
+        _save_npy(os.path.join(pack_path, 'boxes.npy'), self.boxes)
+        _save_npy(os.path.join(pack_path, 'offsets.npy'), self.offsets)
+        _save_npy(os.path.join(pack_path, 'filenames.npy'), np.array(self.filenames, dtype=str))
+        os.replace(tmp_path, images_path)
+        tmp_path = '{}.{}.tmp'.format(json_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': pack_key}, f)
+        os.replace(tmp_path, json_path)
+
+        self.load_pack(pack_path)
+
+    def _pack_key(self):
+        '''
+        Returns:
+            A string that identifies the image files of the dataset by their names, sizes and modification times,
+            to tell whether a pack contains them as they are now.
+        '''
+        stats = [(filename, os.path.getsize(filename), os.path.getmtime(filename)) for filename in self.filenames]
+        return hashlib.sha1(repr(stats).encode()).hexdigest()
+
+    @staticmethod
+    def _load_pack_key(pack_path):
+        '''
+        Returns:
+            The key saved in the pack in `pack_path` by `pack()`, or `None` if there is no complete pack.
+        '''
+        json_path = os.path.join(pack_path, 'pack.json')
+        if not os.path.exists(json_path):
+            return None
+        with open(json_path) as f:
+            return json.load(f)['key']
+
+    def load_pack(self, pack_path):
+        '''
+        Load a pack written by `pack()`. The images are memory-mapped, not read into memory.
+
+        If no dataset has been parsed yet, the packed filenames and labels become the dataset,
+        and both the training and the validation samples are all packed samples. Otherwise a warning is printed if
+        any image of the dataset is missing from the pack, since the batches with such images are read from disk.
+
+        Arguments:
+            pack_path (str): The directory that contains the pack.
+
+        Returns:
+            None.
+        '''
+        self.pack_path = pack_path
+        self.pack_images = np.load(os.path.join(pack_path, 'images.npy'), mmap_mode='r')
+        filenames = np.load(os.path.join(pack_path, 'filenames.npy')).tolist()
+        self.pack_index = {filename: i for i, filename in enumerate(filenames)}
+
+        if len(self.filenames) == 0:
+            self.boxes = np.load(os.path.join(pack_path, 'boxes.npy')).astype(np.float32, copy=False)
+            self.offsets = np.load(os.path.join(pack_path, 'offsets.npy'))
+            self.filenames = filenames
+            self.labels = [self.boxes[self.offsets[i]:self.offsets[i+1]] for i in range(len(filenames))]
+            self.count = len(self.filenames)
+            self.train_filenames, self.train_labels = self.filenames, self.labels
+            self.val_filenames, self.val_labels = self.filenames, self.labels
+        else:
+            n_missing = sum(1 for filename in self.filenames if filename not in self.pack_index)
+            if n_missing > 0:
+                print("Warning: {} of the {} images are not in the pack in {}, the batches that contain them are read from disk\n".format(n_missing, len(self.filenames), pack_path))
+
     def process_offline(self,
                         dest_path='',
                         start=0,
@@ -988,6 +1150,7 @@ class BatchGenerator:
         '''
 
         import gc
+        from PIL import Image
 
         targets_for_csv = []
         if stop == 'all':
@@ -998,141 +1161,29 @@ class BatchGenerator:
             original_images = []
             processed_labels = []
 
-        # Find out the indices of the box coordinates in the label data
-        xmin = self.box_output_format.index('xmin')
-        xmax = self.box_output_format.index('xmax')
-        ymin = self.box_output_format.index('ymin')
-        ymax = self.box_output_format.index('ymax')
+        transforms = self.build_transforms(equalize=equalize,
+                                           brightness=brightness,
+                                           flip=flip,
+                                           translate=translate,
+                                           scale=scale,
+                                           crop=crop,
+                                           resize=resize,
+                                           rgb_to_gray=gray,
+                                           limit_boxes=limit_boxes,
+                                           include_thresh=include_thresh)
 
         for k, filename in enumerate(self.filenames[start:stop]):
             i = k + start
             with Image.open('{}'.format(filename)) as img:
                 image = np.array(img)
-            targets = np.copy(self.labels[i])
 
             if diagnostics:
                 original_images.append(image)
 
-            img_height, img_width, ch = image.shape
-
-            if equalize:
-                image = histogram_eq(image)
-
-            if brightness:
-                p = np.random.uniform(0, 1)
-                if p >= (1 - brightness[2]):
-                    image = _brightness(image, min=brightness[0], max=brightness[1])
-
-            # Could easily be extended to also allow vertical flipping, but I'm not convinced of the
-            # usefulness of vertical flipping either empirically or theoretically, so I'm going for simplicity.
-            # If you want to allow vertical flipping, just change this function to pass the respective argument
-            # to `_flip()`.
-            if flip:
-                p = np.random.uniform(0, 1)
-                if p >= (1 - flip):
-                    image = _flip(image)
-                    targets[:, [0, 1]] = img_width - targets[:, [1, 0]]  # xmin and xmax are swapped when mirrored
-
-            if translate:
-                p = np.random.uniform(0, 1)
-                if p >= (1 - translate[2]):
-                    image, xshift, yshift = _translate(image, translate[0], translate[1])
-                    targets[:, [0, 1]] += xshift
-                    targets[:, [2, 3]] += yshift
-                    if limit_boxes:
-                        before_limiting = np.copy(targets)
-                        x_coords = targets[:, [0, 1]]
-                        x_coords[x_coords >= img_width] = img_width - 1
-                        x_coords[x_coords < 0] = 0
-                        targets[:, [0, 1]] = x_coords
-                        y_coords = targets[:, [2, 3]]
-                        y_coords[y_coords >= img_height] = img_height - 1
-                        y_coords[y_coords < 0] = 0
-                        targets[:, [2, 3]] = y_coords
-                        # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                        # process that they don't serve as useful training examples anymore, because too little of them is
-                        # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                        # `include_thresh` of the box area before limiting.
-                        before_area = (before_limiting[:, 1] - before_limiting[:, 0]) * (
-                        before_limiting[:, 3] - before_limiting[:, 2])
-                        after_area = (targets[:, 1] - targets[:, 0]) * (targets[:, 3] - targets[:, 2])
-                        targets = targets[after_area >= include_thresh * before_area]
-
-            if scale:
-                p = np.random.uniform(0, 1)
-                if p >= (1 - scale[2]):
-                    image, M, scale_factor = _scale(image, scale[0], scale[1])
-                    # Transform two opposite corner points of the rectangular boxes using the transformation matrix `M`
-                    toplefts = np.array([targets[:, 0], targets[:, 2], np.ones(targets.shape[0])])
-                    bottomrights = np.array([targets[:, 1], targets[:, 3], np.ones(targets.shape[0])])
-                    new_toplefts = (np.dot(M, toplefts)).T
-                    new_bottomrights = (np.dot(M, bottomrights)).T
-                    targets[:, [0, 2]] = new_toplefts.astype(np.int)
-                    targets[:, [1, 3]] = new_bottomrights.astype(np.int)
-                    if limit_boxes and (
-                        scale_factor > 1):  # We don't need to do any limiting in case we shrunk the image
-                        before_limiting = np.copy(targets)
-                        x_coords = targets[:, [0, 1]]
-                        x_coords[x_coords >= img_width] = img_width - 1
-                        x_coords[x_coords < 0] = 0
-                        targets[:, [0, 1]] = x_coords
-                        y_coords = targets[:, [2, 3]]
-                        y_coords[y_coords >= img_height] = img_height - 1
-                        y_coords[y_coords < 0] = 0
-                        targets[:, [2, 3]] = y_coords
-                        # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                        # process that they don't serve as useful training examples anymore, because too little of them is
-                        # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                        # `include_thresh` of the box area before limiting.
-                        before_area = (before_limiting[:, 1] - before_limiting[:, 0]) * (
-                        before_limiting[:, 3] - before_limiting[:, 2])
-                        after_area = (targets[:, 1] - targets[:, 0]) * (targets[:, 3] - targets[:, 2])
-                        targets = targets[after_area >= include_thresh * before_area]
-
-            if crop:
-                image = image[crop[0]:img_height - crop[1], crop[2]:img_width - crop[3]]
-                if limit_boxes:  # Adjust boxes affected by cropping and remove those that will no longer be in the image
-                    before_limiting = np.copy(targets)
-                    if crop[0] > 0:
-                        y_coords = targets[:, [2, 3]]
-                        y_coords[y_coords < crop[0]] = crop[0]
-                        targets[:, [2, 3]] = y_coords
-                    if crop[1] > 0:
-                        y_coords = targets[:, [2, 3]]
-                        y_coords[y_coords >= (img_height - crop[1])] = img_height - crop[1] - 1
-                        targets[:, [2, 3]] = y_coords
-                    if crop[2] > 0:
-                        x_coords = targets[:, [0, 1]]
-                        x_coords[x_coords < crop[2]] = crop[2]
-                        targets[:, [0, 1]] = x_coords
-                    if crop[3] > 0:
-                        x_coords = targets[:, [0, 1]]
-                        x_coords[x_coords >= (img_width - crop[3])] = img_width - crop[3] - 1
-                        targets[:, [0, 1]] = x_coords
-                    # Some objects might have gotten pushed so far outside the image boundaries in the transformation
-                    # process that they don't serve as useful training examples anymore, because too little of them is
-                    # visible. We'll remove all boxes that we had to limit so much that their area is less than
-                    # `include_thresh` of the box area before limiting.
-                    before_area = (before_limiting[:, 1] - before_limiting[:, 0]) * (
-                    before_limiting[:, 3] - before_limiting[:, 2])
-                    after_area = (targets[:, 1] - targets[:, 0]) * (targets[:, 3] - targets[:, 2])
-                    targets = targets[after_area >= include_thresh * before_area]
-                # Now adjust the box coordinates for the new image size post cropping
-                if crop[0] > 0:
-                    targets[:, [2, 3]] -= crop[0]
-                if crop[2] > 0:
-                    targets[:, [0, 1]] -= crop[2]
-                img_height -= crop[0] - crop[1]
-                img_width -= crop[2] - crop[3]
-
-            if resize:
-                image = cv2.resize(image, dsize=resize)
-                targets[:, [0, 1]] = (targets[:, [0, 1]] * (resize[0] / img_width)).astype(np.int)
-                targets[:, [2, 3]] = (targets[:, [2, 3]] * (resize[1] / img_height)).astype(np.int)
-
-            if gray:
-                image = np.expand_dims(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), 3)
-                
+            # The images may have different sizes, so every image is transformed as a batch of its own
+            images, targets = transforms([image], [self.labels[i]])
+            image, targets = images[0], targets[0]
+
             if diagnostics:
                 processed_images.append(image)
                 processed_labels.append(targets)
@@ -1145,7 +1196,7 @@ class BatchGenerator:
 
             # Transform the labels back to the original CSV file format:
             # One line per ground truth box, i.e. possibly multiple lines per image
-            for target in targets:
+            for target in targets.astype(np.int64):
                 target = list(target)
                 target = [filename] + target
                 targets_for_csv.append(target)
@@ -1162,411 +1213,54 @@ class BatchGenerator:
             print("Image processing completed.")
 
 
-def iou(boxes1, boxes2, coords='centroids'):
+class RingBuffer:
     '''
-    Compute the intersection-over-union similarity (also known as Jaccard similarity)
-    of two axis-aligned 2D rectangular boxes or of multiple axis-aligned 2D rectangular
-    boxes contained in two arrays with broadcast-compatible shapes.
+    A ring of preallocated arrays that batches are written into in turn, instead of into a new array for every batch.
 
-    Three common use cases would be to compute the similarities for 1 vs. 1, 1 vs. `n`,
-    or `n` vs. `n` boxes. The two arguments are symmetric.
-
-    Arguments:
-        boxes1 (np.array): Either a 1D Numpy array of shape `(4, )` containing the coordinates for one box in the
-            format specified by `coords` or a 2D Numpy array of shape `(n, 4)` containing the coordinates for `n` boxes.
-            Shape must be broadcast-compatible to `boxes2`.
-        boxes2 (np.array): Either a 1D Numpy array of shape `(4, )` containing the coordinates for one box in the
-            format specified by `coords` or a 2D Numpy array of shape `(n, 4)` containing the coordinates for `n` boxes.
-            Shape must be broadcast-compatible to `boxes1`.
-        coords (str, optional): The coordinate format in the input arrays. Can be either 'centroids' for the format
-            `(cx, cy, w, h)` or 'minmax' for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
-
-    Returns:
-        A 1D Numpy array of dtype float containing values in [0,1], the Jaccard similarity of the boxes in `boxes1` and `boxes2`.
-        0 means there is no overlap between two given boxes, 1 means their coordinates are identical.
+    The array of slot `k` is reused for slot `k + size`, so a batch that was written into the ring stays valid until
+    `size` more batches have been written. A ring of size 0 allocates a new array for every batch.
     '''
 
-    if len(boxes1.shape) > 2: raise ValueError("boxes1 must have rank either 1 or 2, but has rank {}.".format(len(boxes1.shape)))
-    if len(boxes2.shape) > 2: raise ValueError("boxes2 must have rank either 1 or 2, but has rank {}.".format(len(boxes2.shape)))
-
-    if len(boxes1.shape) == 1: boxes1 = np.expand_dims(boxes1, axis=0)
-    if len(boxes2.shape) == 1: boxes2 = np.expand_dims(boxes2, axis=0)
-
-    if not (boxes1.shape[1] == boxes2.shape[1] == 4): raise ValueError("It must be boxes1.shape[1] == boxes2.shape[1] == 4, but it is boxes1.shape[1] == {}, boxes2.shape[1] == {}.".format(boxes1.shape[1], boxes2.shape[1]))
-
-    if coords == 'centroids':
-        # TODO: Implement a version that uses fewer computation steps (that doesn't need conversion)
-        boxes1 = convert_coordinates(boxes1, start_index=0, conversion='centroids2minmax')
-        boxes2 = convert_coordinates(boxes2, start_index=0, conversion='centroids2minmax')
-    elif coords != 'minmax':
-        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
-
-    intersection = np.maximum(0, np.minimum(boxes1[:,1], boxes2[:,1]) - np.maximum(boxes1[:,0], boxes2[:,0])) * np.maximum(0, np.minimum(boxes1[:,3], boxes2[:,3]) - np.maximum(boxes1[:,2], boxes2[:,2]))
-    union = (boxes1[:,1] - boxes1[:,0]) * (boxes1[:,3] - boxes1[:,2]) + (boxes2[:,1] - boxes2[:,0]) * (boxes2[:,3] - boxes2[:,2]) - intersection
-
-    return intersection / union
-
-
-def convert_coordinates(tensor, start_index, conversion='minmax2centroids'):
-    '''
-    Convert coordinates for axis-aligned 2D boxes between two coordinate formats.
-
-    Creates a copy of `tensor`, i.e. does not operate in place. Currently there are
-    two supported coordinate formats that can be converted from and to each other:
-        1) (xmin, xmax, ymin, ymax) - the 'minmax' format
-        2) (cx, cy, w, h) - the 'centroids' format
-
-    Note that converting from one of the supported formats to another and back is
-    an identity operation up to possible rounding errors for integer tensors.
-
-    Arguments:
-        tensor (np.array): A Numpy nD array containing the four consecutive coordinates
-            to be converted somewhere in the last axis.
-        start_index (int): The index of the first coordinate in the last axis of `tensor`.
-        conversion (str, optional): The conversion direction. Can be 'minmax2centroids'
-            or 'centroids2minmax'. Defaults to 'minmax2centroids'.
-
-    Returns:
-        A Numpy nD array, a copy of the input tensor with the converted coordinates
-        in place of the original coordinates and the unaltered elements of the original
-        tensor elsewhere.
-    '''
-    ind = start_index
-    tensor1 = np.copy(tensor).astype(np.float)
-    if conversion == 'minmax2centroids':
-        tensor1[..., ind] = (tensor[..., ind] + tensor[..., ind+1]) / 2.0 # Set cx
-        tensor1[..., ind+1] = (tensor[..., ind+2] + tensor[..., ind+3]) / 2.0 # Set cy
-        tensor1[..., ind+2] = tensor[..., ind+1] - tensor[..., ind] # Set w
-        tensor1[..., ind+3] = tensor[..., ind+3] - tensor[..., ind+2] # Set h
-    elif conversion == 'centroids2minmax':
-        tensor1[..., ind] = tensor[..., ind] - tensor[..., ind+2] / 2.0 # Set xmin
-        tensor1[..., ind+1] = tensor[..., ind] + tensor[..., ind+2] / 2.0 # Set xmax
-        tensor1[..., ind+2] = tensor[..., ind+1] - tensor[..., ind+3] / 2.0 # Set ymin
-        tensor1[..., ind+3] = tensor[..., ind+1] + tensor[..., ind+3] / 2.0 # Set ymax
-    else:
-        raise ValueError("Unexpected conversion value. Supported values are 'minmax2centroids' and 'centroids2minmax'.")
-
-    return tensor1
-
-
-def convert_coordinates2(tensor, start_index, conversion='minmax2centroids'):
-    '''
-    A pure matrix multiplication implementation of `convert_coordinates()`.
-
-    Although elegant, it turns out to be marginally slower on average than
-    `convert_coordinates()`. Note that the two matrices below are each other's
-    multiplicative inverse.
-
-    For details please refer to the documentation of `convert_coordinates()`.
-    '''
-    ind = start_index
-    tensor1 = np.copy(tensor).astype(np.float)
-    if conversion == 'minmax2centroids':
-        M = np.array([[0.5, 0. , -1.,  0.],
-                      [0.5, 0. ,  1.,  0.],
-                      [0. , 0.5,  0., -1.],
-                      [0. , 0.5,  0.,  1.]])
-        tensor1[..., ind:ind+4] = np.dot(tensor1[..., ind:ind+4], M)
-    elif conversion == 'centroids2minmax':
-        M = np.array([[ 1. , 1. ,  0. , 0. ],
-                      [ 0. , 0. ,  1. , 1. ],
-                      [-0.5, 0.5,  0. , 0. ],
-                      [ 0. , 0. , -0.5, 0.5]])
-        tensor1[..., ind:ind+4] = np.dot(tensor1[..., ind:ind+4], M)
-    else:
-        raise ValueError("Unexpected conversion value. Supported values are 'minmax2centroids' and 'centroids2minmax'.")
-
-    return tensor1
-
-
-def greedy_nms(y_pred_decoded, iou_threshold=0.45, coords='minmax'):
-    '''
-    Perform greedy non-maximum suppression on the input boxes.
-
-    Greedy NMS works by selecting the box with the highest score and
-    removing all boxes around it that are too close to it measured by IoU-similarity.
-    Out of the boxes that are left over, once again the one with the highest
-    score is selected and so on, until no boxes with too much overlap are left.
-
-    This is a basic, straight-forward NMS algorithm that is relatively efficient,
-    but it has a number of downsides. One of those downsides is that the box with
-    the highest score might not always be the box with the best fit to the object.
-    There are more sophisticated NMS techniques like [this one](https://lirias.kuleuven.be/bitstream/123456789/506283/1/3924_postprint.pdf)
-    that use a combination of nearby boxes, but in general there will probably
-    always be a trade-off between speed and quality for any given NMS technique.
-
-    Arguments:
-        y_pred_decoded (list): A batch of decoded predictions. For a given batch size `n` this
-            is a list of length `n` where each list element is a 2D Numpy array.
-            For a batch item with `k` predicted boxes this 2D Numpy array has
-            shape `(k, 6)`, where each row contains the coordinates of the respective
-            box in the format `[class_id, score, xmin, xmax, ymin, ymax]`.
-            Technically, the number of columns doesn't have to be 6, it can be
-            arbitrary as long as the first four elements of each row are
-            `xmin`, `xmax`, `ymin`, `ymax` (in this order) and the last element
-            is the score assigned to the prediction. Note that this function is
-            agnostic to the scale of the score or what it represents.
-        iou_threshold (float, optional): All boxes with a Jaccard similarity of
-            greater than `iou_threshold` with a locally maximal box will be removed
-            from the set of predictions, where 'maximal' refers to the box score.
-            Defaults to 0.45 following the paper.
-        coords (str, optional): The coordinate format of `y_pred_decoded`.
-            Can be one of the formats supported by `iou()`. Defaults to 'minmax'.
-
-    Returns:
-        The predictions after removing non-maxima. The format is the same as the input format.
-    '''
-    y_pred_decoded_nms = []
-    for batch_item in y_pred_decoded: # For the labels of each batch item...
-        boxes_left = np.copy(batch_item)
-        maxima = [] # This is where we store the boxes that make it through the non-maximum suppression
-        while boxes_left.shape[0] > 0: # While there are still boxes left to compare...
-            maximum_index = np.argmax(boxes_left[:,1]) # ...get the index of the next box with the highest confidence...
-            maximum_box = np.copy(boxes_left[maximum_index]) # ...copy that box and...
-            maxima.append(maximum_box) # ...append it to `maxima` because we'll definitely keep it
-            boxes_left = np.delete(boxes_left, maximum_index, axis=0) # Now remove the maximum box from `boxes_left`
-            if boxes_left.shape[0] == 0: break # If there are no boxes left after this step, break. Otherwise...
-            similarities = iou(boxes_left[:,2:], maximum_box[2:], coords=coords) # ...compare (IoU) the other left over boxes to the maximum box...
-            boxes_left = boxes_left[similarities <= iou_threshold] # ...so that we can remove the ones that overlap too much with the maximum box
-        y_pred_decoded_nms.append(np.array(maxima))
-
-    return y_pred_decoded_nms
-
-
-def _greedy_nms(predictions, iou_threshold=0.45, coords='minmax'):
-    '''
-    The same greedy non-maximum suppression algorithm as above, but slightly modified for use as an internal
-    function for per-class NMS in `decode_y()`.
-    '''
-    boxes_left = np.copy(predictions)
-    maxima = [] # This is where we store the boxes that make it through the non-maximum suppression
-    while boxes_left.shape[0] > 0: # While there are still boxes left to compare...
-        maximum_index = np.argmax(boxes_left[:,0]) # ...get the index of the next box with the highest confidence...
-        maximum_box = np.copy(boxes_left[maximum_index]) # ...copy that box and...
-        maxima.append(maximum_box) # ...append it to `maxima` because we'll definitely keep it
-        boxes_left = np.delete(boxes_left, maximum_index, axis=0) # Now remove the maximum box from `boxes_left`
-        if boxes_left.shape[0] == 0: break # If there are no boxes left after this step, break. Otherwise...
-        similarities = iou(boxes_left[:,1:], maximum_box[1:], coords=coords) # ...compare (IoU) the other left over boxes to the maximum box...
-        boxes_left = boxes_left[similarities <= iou_threshold] # ...so that we can remove the ones that overlap too much with the maximum box
-    return np.array(maxima)
-
-
-def _greedy_nms2(predictions, iou_threshold=0.45, coords='minmax'):
-    '''
-    The same greedy non-maximum suppression algorithm as above, but slightly modified for use as an internal
-    function in `decode_y2()`.
-    '''
-    boxes_left = np.copy(predictions)
-    maxima = [] # This is where we store the boxes that make it through the non-maximum suppression
-    while boxes_left.shape[0] > 0: # While there are still boxes left to compare...
-        maximum_index = np.argmax(boxes_left[:,1]) # ...get the index of the next box with the highest confidence...
-        maximum_box = np.copy(boxes_left[maximum_index]) # ...copy that box and...
-        maxima.append(maximum_box) # ...append it to `maxima` because we'll definitely keep it
-        boxes_left = np.delete(boxes_left, maximum_index, axis=0) # Now remove the maximum box from `boxes_left`
-        if boxes_left.shape[0] == 0: break # If there are no boxes left after this step, break. Otherwise...
-        similarities = iou(boxes_left[:,2:], maximum_box[2:], coords=coords) # ...compare (IoU) the other left over boxes to the maximum box...
-        boxes_left = boxes_left[similarities <= iou_threshold] # ...so that we can remove the ones that overlap too much with the maximum box
-    return np.array(maxima)
-
-
-def decode_y(y_pred,
-             confidence_thresh=0.01,
-             iou_threshold=0.45,
-             top_k=200,
-             input_coords='centroids',
-             normalize_coords=False,
-             img_height=None,
-             img_width=None):
-    '''
-    Convert model prediction output back to a format that contains only the positive box predictions
-    (i.e. the same format that `enconde_y()` takes as input).
-
-    After the decoding, two stages of prediction filtering are performed for each class individually:
-    First confidence thresholding, then greedy non-maximum suppression. The filtering results for all
-    classes are concatenated and the `top_k` overall highest confidence results constitute the final
-    predictions for a given batch item. This procedure follows the original Caffe implementation.
-    For a slightly different and more efficient alternative to decode raw model output that performs
-    non-maximum suppresion globally instead of per class, see `decode_y2()` below.
-
-    Arguments:
-        y_pred (array): The prediction output of the SSD model, expected to be a Numpy array
-            of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)`, where `#boxes` is the total number of
-            boxes predicted by the model per image and the last axis contains
-            `[one-hot vector for the classes, 4 predicted coordinate offsets, 4 anchor box coordinates, 4 variances]`.
-        confidence_thresh (float, optional): A float in [0,1), the minimum classification confidence in a specific
-            positive class in order to be considered for the non-maximum suppression stage for the respective class.
-            A lower value will result in a larger part of the selection process being done by the non-maximum suppression
-            stage, while a larger value will result in a larger part of the selection process happening in the confidence
-            thresholding stage. Defaults to 0.01, following the paper.
-        iou_threshold (float, optional): A float in [0,1]. All boxes with a Jaccard similarity of greater than `iou_threshold`
-            with a locally maximal box will be removed from the set of predictions for a given class, where 'maximal' refers
-            to the box score. Defaults to 0.45 following the paper.
-        top_k (int, optional): The number of highest scoring predictions to be kept for each batch item after the
-            non-maximum suppression stage. Defaults to 200, following the paper.
-        input_coords (str, optional): The box coordinate format that the model outputs. Can be either 'centroids'
-            for the format `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax'
-            for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
-        normalize_coords (bool, optional): Set to `True` if the model outputs relative coordinates (i.e. coordinates in [0,1])
-            and you wish to transform these relative coordinates back to absolute coordinates. If the model outputs
-            relative coordinates, but you do not want to convert them back to absolute coordinates, set this to `False`.
-            Do not set this to `True` if the model already outputs absolute coordinates, as that would result in incorrect
-            coordinates. Requires `img_height` and `img_width` if set to `True`. Defaults to `False`.
-        img_height (int, optional): The height of the input images. Only needed if `normalize_coords` is `True`.
-        img_width (int, optional): The width of the input images. Only needed if `normalize_coords` is `True`.
-
-    Returns:
-        A python list of length `batch_size` where each list element represents the predicted boxes
-        for one image and contains a Numpy array of shape `(boxes, 6)` where each row is a box prediction for
-        a non-background class for the respective image in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`.
-    '''
-    if normalize_coords and ((img_height is None) or (img_width is None)):
-        raise ValueError("If relative box coordinates are supposed to be converted to absolute coordinates, the decoder needs the image size in order to decode the predictions, but `img_height == {}` and `img_width == {}`".format(img_height, img_width))
-
-    # 1: Convert the box coordinates from the predicted anchor box offsets to predicted absolute coordinates
-
-    y_pred_decoded_raw = np.copy(y_pred[:,:,:-8]) # Slice out the classes and the four offsets, throw away the anchor coordinates and variances, resulting in a tensor of shape `[batch, n_boxes, n_classes + 4 coordinates]`
-
-    if input_coords == 'centroids':
-        y_pred_decoded_raw[:,:,[-2,-1]] = np.exp(y_pred_decoded_raw[:,:,[-2,-1]] * y_pred[:,:,[-2,-1]]) # exp(ln(w(pred)/w(anchor)) / w_variance * w_variance) == w(pred) / w(anchor), exp(ln(h(pred)/h(anchor)) / h_variance * h_variance) == h(pred) / h(anchor)
-        y_pred_decoded_raw[:,:,[-2,-1]] *= y_pred[:,:,[-6,-5]] # (w(pred) / w(anchor)) * w(anchor) == w(pred), (h(pred) / h(anchor)) * h(anchor) == h(pred)
-        y_pred_decoded_raw[:,:,[-4,-3]] *= y_pred[:,:,[-4,-3]] * y_pred[:,:,[-6,-5]] # (delta_cx(pred) / w(anchor) / cx_variance) * cx_variance * w(anchor) == delta_cx(pred), (delta_cy(pred) / h(anchor) / cy_variance) * cy_variance * h(anchor) == delta_cy(pred)
-        y_pred_decoded_raw[:,:,[-4,-3]] += y_pred[:,:,[-8,-7]] # delta_cx(pred) + cx(anchor) == cx(pred), delta_cy(pred) + cy(anchor) == cy(pred)
-        y_pred_decoded_raw = convert_coordinates(y_pred_decoded_raw, start_index=-4, conversion='centroids2minmax')
-    elif input_coords == 'minmax':
-        y_pred_decoded_raw[:,:,-4:] *= y_pred[:,:,-4:] # delta(pred) / size(anchor) / variance * variance == delta(pred) / size(anchor) for all four coordinates, where 'size' refers to w or h, respectively
-        y_pred_decoded_raw[:,:,[-4,-3]] *= np.expand_dims(y_pred[:,:,-7] - y_pred[:,:,-8], axis=-1) # delta_xmin(pred) / w(anchor) * w(anchor) == delta_xmin(pred), delta_xmax(pred) / w(anchor) * w(anchor) == delta_xmax(pred)
-        y_pred_decoded_raw[:,:,[-2,-1]] *= np.expand_dims(y_pred[:,:,-5] - y_pred[:,:,-6], axis=-1) # delta_ymin(pred) / h(anchor) * h(anchor) == delta_ymin(pred), delta_ymax(pred) / h(anchor) * h(anchor) == delta_ymax(pred)
-        y_pred_decoded_raw[:,:,-4:] += y_pred[:,:,-8:-4] # delta(pred) + anchor == pred for all four coordinates
-    else:
-        raise ValueError("Unexpected value for `input_coords`. Supported input coordinate formats are 'minmax' and 'centroids'.")
-
-    # 2: If the model predicts normalized box coordinates and they are supposed to be converted back to absolute coordinates, do that
-
-    if normalize_coords:
-        y_pred_decoded_raw[:,:,-4:-2] *= img_width # Convert xmin, xmax back to absolute coordinates
-        y_pred_decoded_raw[:,:,-2:] *= img_height # Convert ymin, ymax back to absolute coordinates
-
-    # 3: Apply confidence thresholding and non-maximum suppression per class
-
-    n_classes = y_pred_decoded_raw.shape[-1] - 4 # The number of classes is the length of the last axis minus the four box coordinates
-
-    y_pred_decoded = [] # Store the final predictions in this list
-    for batch_item in y_pred_decoded_raw: # `batch_item` has shape `[n_boxes, n_classes + 4 coords]`
-        pred = [] # Store the final predictions for this batch item here
-        for class_id in range(1, n_classes): # For each class except the background class (which has class ID 0)...
-            single_class = batch_item[:,[class_id, -4, -3, -2, -1]] # ...keep only the confidences for that class, making this an array of shape `[n_boxes, 5]` and...
-            threshold_met = single_class[single_class[:,0] > confidence_thresh] # ...keep only those boxes with a confidence above the set threshold.
-            if threshold_met.shape[0] > 0: # If any boxes made the threshold...
-                maxima = _greedy_nms(threshold_met, iou_threshold=iou_threshold, coords='minmax') # ...perform NMS on them.
-                maxima_output = np.zeros((maxima.shape[0], maxima.shape[1] + 1)) # Expand the last dimension by one element to have room for the class ID. This is now an arrray of shape `[n_boxes, 6]`
-                maxima_output[:,0] = class_id # Write the class ID to the first column...
-                maxima_output[:,1:] = maxima # ...and write the maxima to the other columns...
-                pred.append(maxima_output) # ...and append the maxima for this class to the list of maxima for this batch item.
-        # Once we're through with all classes, keep only the `top_k` maxima with the highest scores
-        pred = np.concatenate(pred, axis=0)
-        if pred.shape[0] > top_k: # If we have more than `top_k` results left at this point, otherwise there is nothing to filter,...
-            top_k_indices = np.argpartition(pred[:,1], kth=pred.shape[0]-top_k, axis=0)[pred.shape[0]-top_k:] # ...get the indices of the `top_k` highest-score maxima...
-            pred = pred[top_k_indices] # ...and keep only those entries of `pred`...
-        y_pred_decoded.append(pred) # ...and now that we're done, append the array of final predictions for this batch item to the output list
-
-    return y_pred_decoded
-
-
-def decode_y2(y_pred,
-              confidence_thresh=0.5,
-              iou_threshold=0.45,
-              top_k='all',
-              input_coords='centroids',
-              normalize_coords=False,
-              img_height=None,
-              img_width=None):
-    '''
-    Convert model prediction output back to a format that contains only the positive box predictions
-    (i.e. the same format that `enconde_y()` takes as input).
-
-    Optionally performs confidence thresholding and greedy non-maximum suppression afte the decoding stage.
+    def __init__(self, size=0, dtype=None):
+        '''
+        Arguments:
+            size (int, optional): The number of arrays in the ring. Defaults to 0.
+            dtype (str, optional): The data type of the arrays. Defaults to `None`, i.e. the data type of the batches.
+        '''
+        self.size = size
+        self.dtype = dtype
+        self.arrays = None
 
-    Note that the decoding procedure used here is not the same as the procedure used in the original Caffe implementation.
-    The procedure used here assigns every box its highest confidence as the class and then removes all boxes fro which
-    the highest confidence is the background class. This results in less work for the subsequent non-maximum suppression,
-    because the vast majority of the predictions will be filtered out just by the fact that their highest confidence is
-    for the background class. It is much more efficient than the procedure of the original implementation, but the
-    results may also differ.
+    def get(self, slot, shape, dtype=None):
+        '''
+        Arguments:
+            slot (int): The number of the batch. The array of slot `slot % size` is used.
+            shape (tuple): The shape of the batch.
+            dtype (str, optional): The data type to use if the ring has no data type of its own. Defaults to `None`.
 
-    Arguments:
-        y_pred (array): The prediction output of the SSD model, expected to be a Numpy array
-            of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)`, where `#boxes` is the total number of
-            boxes predicted by the model per image and the last axis contains
-            `[one-hot vector for the classes, 4 predicted coordinate offsets, 4 anchor box coordinates, 4 variances]`.
-        confidence_thresh (float, optional): A float in [0,1), the minimum classification confidence in any positive
-            class required for a given box to be considered a positive prediction. A lower value will result
-            in better recall, while a higher value will result in better precision. Do not use this parameter with the
-            goal to combat the inevitably many duplicates that an SSD will produce, the subsequent non-maximum suppression
-            stage will take care of those. Defaults to 0.5.
-        iou_threshold (float, optional): `None` or a float in [0,1]. If `None`, no non-maximum suppression will be
-            performed. If not `None`, greedy NMS will be performed after the confidence thresholding stage, meaning
-            all boxes with a Jaccard similarity of greater than `iou_threshold` with a locally maximal box will be removed
-            from the set of predictions, where 'maximal' refers to the box score. Defaults to 0.45.
-        top_k (int, optional): 'all' or an integer with number of highest scoring predictions to be kept for each batch item
-            after the non-maximum suppression stage. Defaults to 'all', in which case all predictions left after the NMS stage
-            will be kept.
-        input_coords (str, optional): The box coordinate format that the model outputs. Can be either 'centroids'
-            for the format `(cx, cy, w, h)` (box center coordinates, width, and height) or 'minmax'
-            for the format `(xmin, xmax, ymin, ymax)`. Defaults to 'centroids'.
-        normalize_coords (bool, optional): Set to `True` if the model outputs relative coordinates (i.e. coordinates in [0,1])
-            and you wish to transform these relative coordinates back to absolute coordinates. If the model outputs
-            relative coordinates, but you do not want to convert them back to absolute coordinates, set this to `False`.
-            Do not set this to `True` if the model already outputs absolute coordinates, as that would result in incorrect
-            coordinates. Requires `img_height` and `img_width` if set to `True`. Defaults to `False`.
-        img_height (int, optional): The height of the input images. Only needed if `normalize_coords` is `True`.
-        img_width (int, optional): The width of the input images. Only needed if `normalize_coords` is `True`.
+        Returns:
+            An array of shape `shape` with undefined contents to write the batch into.
+        '''
+        dtype = np.dtype(dtype if self.dtype is None else self.dtype)
+        if self.size == 0:
+            return np.empty(shape, dtype=dtype)
+        # The arrays are allocated for the first batch and only reallocated if a batch doesn't fit. Batches that still use the old arrays are left intact.
+        if self.arrays is None or self.arrays.dtype != dtype or self.arrays.shape[2:] != tuple(shape[1:]) or self.arrays.shape[1] < shape[0]:
+            self.arrays = np.empty((self.size,) + tuple(shape), dtype=dtype)
+        return self.arrays[slot % self.size, :shape[0]]
+
+    def put(self, slot, batch):
+        '''
+        Copy a batch into the ring, converting it to the data type of the ring.
 
-    Returns:
-        A python list of length `batch_size` where each list element represents the predicted boxes
-        for one image and contains a Numpy array of shape `(boxes, 6)` where each row is a box prediction for
-        a non-background class for the respective image in the format `[class_id, confidence, xmin, xmax, ymin, ymax]`.
-    '''
-    if normalize_coords and ((img_height is None) or (img_width is None)):
-        raise ValueError("If relative box coordinates are supposed to be converted to absolute coordinates, the decoder needs the image size in order to decode the predictions, but `img_height == {}` and `img_width == {}`".format(img_height, img_width))
-
-    # 1: Convert the classes from one-hot encoding to their class ID
-    y_pred_converted = np.copy(y_pred[:,:,-14:-8]) # Slice out the four offset predictions plus two elements whereto we'll write the class IDs and confidences in the next step
-    y_pred_converted[:,:,0] = np.argmax(y_pred[:,:,:-12], axis=-1) # The indices of the highest confidence values in the one-hot class vectors are the class ID
-    y_pred_converted[:,:,1] = np.amax(y_pred[:,:,:-12], axis=-1) # Store the confidence values themselves, too
-
-    # 2: Convert the box coordinates from the predicted anchor box offsets to predicted absolute coordinates
-    if input_coords == 'centroids':
-        y_pred_converted[:,:,[4,5]] = np.exp(y_pred_converted[:,:,[4,5]] * y_pred[:,:,[-2,-1]]) # exp(ln(w(pred)/w(anchor)) / w_variance * w_variance) == w(pred) / w(anchor), exp(ln(h(pred)/h(anchor)) / h_variance * h_variance) == h(pred) / h(anchor)
-        y_pred_converted[:,:,[4,5]] *= y_pred[:,:,[-6,-5]] # (w(pred) / w(anchor)) * w(anchor) == w(pred), (h(pred) / h(anchor)) * h(anchor) == h(pred)
-        y_pred_converted[:,:,[2,3]] *= y_pred[:,:,[-4,-3]] * y_pred[:,:,[-6,-5]] # (delta_cx(pred) / w(anchor) / cx_variance) * cx_variance * w(anchor) == delta_cx(pred), (delta_cy(pred) / h(anchor) / cy_variance) * cy_variance * h(anchor) == delta_cy(pred)
-        y_pred_converted[:,:,[2,3]] += y_pred[:,:,[-8,-7]] # delta_cx(pred) + cx(anchor) == cx(pred), delta_cy(pred) + cy(anchor) == cy(pred)
-        y_pred_converted = convert_coordinates(y_pred_converted, start_index=-4, conversion='centroids2minmax')
-    elif input_coords == 'minmax':
-        y_pred_converted[:,:,2:] *= y_pred[:,:,-4:] # delta(pred) / size(anchor) / variance * variance == delta(pred) / size(anchor) for all four coordinates, where 'size' refers to w or h, respectively
-        y_pred_converted[:,:,[2,3]] *= np.expand_dims(y_pred[:,:,-7] - y_pred[:,:,-8], axis=-1) # delta_xmin(pred) / w(anchor) * w(anchor) == delta_xmin(pred), delta_xmax(pred) / w(anchor) * w(anchor) == delta_xmax(pred)
-        y_pred_converted[:,:,[4,5]] *= np.expand_dims(y_pred[:,:,-5] - y_pred[:,:,-6], axis=-1) # delta_ymin(pred) / h(anchor) * h(anchor) == delta_ymin(pred), delta_ymax(pred) / h(anchor) * h(anchor) == delta_ymax(pred)
-        y_pred_converted[:,:,2:] += y_pred[:,:,-8:-4] # delta(pred) + anchor == pred for all four coordinates
-    else:
-        raise ValueError("Unexpected value for `coords`. Supported values are 'minmax' and 'centroids'.")
-
-    # 3: If the model predicts normalized box coordinates and they are supposed to be converted back to absolute coordinates, do that
-    if normalize_coords:
-        y_pred_converted[:,:,2:4] *= img_width # Convert xmin, xmax back to absolute coordinates
-        y_pred_converted[:,:,4:] *= img_height # Convert ymin, ymax back to absolute coordinates
-
-    # 4: Decode our huge `(batch, #boxes, 6)` tensor into a list of length `batch` where each list entry is an array containing only the positive predictions
-    y_pred_decoded = []
-    for batch_item in y_pred_converted: # For each image in the batch...
-        boxes = batch_item[np.nonzero(batch_item[:,0])] # ...get all boxes that don't belong to the background class,...
-        boxes = boxes[boxes[:,1] >= confidence_thresh] # ...then filter out those positive boxes for which the prediction confidence is too low and after that...
-        if iou_threshold: # ...if an IoU threshold is set...
-            boxes = _greedy_nms2(boxes, iou_threshold=iou_threshold, coords='minmax') # ...perform NMS on the remaining boxes.
-        if top_k != 'all' and boxes.shape[0] > top_k: # If we have more than `top_k` results left at this point...
-            top_k_indices = np.argpartition(boxes[:,1], kth=boxes.shape[0]-top_k, axis=0)[boxes.shape[0]-top_k:] # ...get the indices of the `top_k` highest-scoring boxes...
-            boxes = boxes[top_k_indices] # ...and keep only those boxes...
-        y_pred_decoded.append(boxes) # ...and now that we're done, append the array of final predictions for this batch item to the output list
-
-    return y_pred_decoded
+        Returns:
+            The copy of the batch in the ring, or if the ring has size 0, the batch converted to the data type of the ring.
+        '''
+        if self.size == 0:
+            return batch if self.dtype is None else batch.astype(self.dtype, copy=False)
+        out = self.get(slot, batch.shape, batch.dtype)
+        out[...] = batch
+        return out
 
 
 class SSDBoxEncoder:
@@ -1597,7 +1291,10 @@ class SSDBoxEncoder:
                  pos_iou_threshold=0.5,
                  neg_iou_threshold=0.3,
                  coords='centroids',
-                 normalize_coords=False):
+                 normalize_coords=False,
+                 vectorized_matching=True,
+                 anchors_cache_dir=None,
+                 lean_output=False):
         '''
         Arguments:
             img_height (int): The height of the input images.
@@ -1658,6 +1355,18 @@ class SSDBoxEncoder:
             normalize_coords (bool, optional): If `True`, the encoder uses relative instead of absolute coordinates.
                 This means instead of using absolute tartget coordinates, the encoder will scale all coordinates to be within [0,1].
                 This way learning becomes independent of the input image size. Defaults to `False`.
+            vectorized_matching (bool, optional): If `True`, `encode_y()` computes the IoU similarities of all ground truth
+                boxes of the batch with all anchor boxes at once and performs the matching with array operations. If `False`,
+                it loops over the batch items and ground truth boxes and matches one ground truth box at a time. Both
+                produce identical output, the vectorized matching is just a lot faster for images with many ground truth
+                boxes. Defaults to `True`.
+            anchors_cache_dir (str, optional): `None` or the path to a directory in which to persist the anchor box table
+                (see `get_anchors()`) as a `.npy` file. The file name is derived from the anchor box configuration, so one
+                directory can hold the tables of any number of configurations, and any other process that constructs an
+                encoder with the same configuration loads the table from there instead of recomputing it. Defaults to `None`.
+            lean_output (bool, optional): If `True`, `encode_y()` encodes the labels for a model built with
+                `lean_output=True`, i.e. without the 8 anchor box and variance columns that the model doesn't output.
+                Defaults to `False`.
         '''
         if variances is None:
             variances = [1.0, 1.0, 1.0, 1.0]
@@ -1706,20 +1415,101 @@ class SSDBoxEncoder:
         self.neg_iou_threshold = neg_iou_threshold
         self.coords = coords
         self.normalize_coords = normalize_coords
+        self.vectorized_matching = vectorized_matching
+        self.anchors_cache_dir = anchors_cache_dir
+        self.lean_output = lean_output
 
         # Compute the number of boxes per cell
         if aspect_ratios_per_layer:
-            self.n_boxes = []
-            for aspect_ratios in aspect_ratios_per_layer:
-                if (1 in aspect_ratios) & two_boxes_for_ar1:
-                    self.n_boxes.append(len(aspect_ratios) + 1)
-                else:
-                    self.n_boxes.append(len(aspect_ratios))
+            self.n_boxes = [n_boxes_per_cell(aspect_ratios, two_boxes_for_ar1) for aspect_ratios in aspect_ratios_per_layer]
+        else:
+            self.n_boxes = n_boxes_per_cell(aspect_ratios_global, two_boxes_for_ar1)
+
+        # The anchor boxes never change for a given configuration, so compute them only once
+        if self.scales is None:
+            self.scales = np.linspace(self.min_scale, self.max_scale, len(self.predictor_sizes)+1)
+        self.anchors = self.get_anchors()
+        # The template for `y_encoded` for one image, see `generate_encode_template()`
+        self.encode_template = np.concatenate((np.zeros((self.anchors.shape[0], self.n_classes)),
+                                               self.anchors[:,:4],
+                                               self.anchors[:,:4],
+                                               self.anchors[:,4:]), axis=1)
+        self.encode_template.flags.writeable = False
+        # The shape of `y_encoded` for one image
+        self.y_shape = (self.anchors.shape[0], self.n_classes + 4 if lean_output else self.n_classes + 12)
+
+    def anchors_key(self):
+        '''
+        Returns:
+            A tuple of all parameters that determine the anchor boxes. Two encoders with equal keys have identical
+            anchor boxes.
+        '''
+        if self.aspect_ratios_per_layer:
+            aspect_ratios = tuple(tuple(float(ar) for ar in aspect_ratios) for aspect_ratios in self.aspect_ratios_per_layer)
+        else:
+            aspect_ratios = tuple(float(ar) for ar in self.aspect_ratios_global)
+        return (int(self.img_height),
+                int(self.img_width),
+                tuple(tuple(int(size) for size in predictor_size) for predictor_size in self.predictor_sizes),
+                tuple(float(scale) for scale in self.scales),
+                aspect_ratios,
+                bool(self.two_boxes_for_ar1),
+                bool(self.limit_boxes),
+                tuple(float(variance) for variance in self.variances),
+                self.coords,
+                bool(self.normalize_coords))
+
+    def get_anchors(self):
+        '''
+        Compute the anchor box table for one image, i.e. the anchor boxes of all predictor layers concatenated in
+        the same order as in the model output.
+
+        The anchor boxes of each layer are computed by `anchor_boxes()`, the same function that the `AnchorBoxes`
+        layers of the model use. The table is computed only once per process for any given configuration
+        (see `anchors_key()`) and shared between all encoders with that configuration. If `anchors_cache_dir` is set,
+        it is also saved to and loaded from a `.npy` file in that directory.
+
+        Returns:
+            A read-only Numpy array of shape `(#boxes, 8)`, where each row contains the 4 anchor box coordinates in
+            the format given by `coords` followed by the 4 variances, i.e. the same 8 values per box that the
+            anchor box layers of the model output.
+        '''
+        key = self.anchors_key()
+        if key in _anchors_cache:
+            return _anchors_cache[key]
+
+        path = None
+        if self.anchors_cache_dir is not None:
+            path = os.path.join(self.anchors_cache_dir, 'anchors_{}.npy'.format(hashlib.sha1(repr(key).encode()).hexdigest()))
+
+        if path is not None and os.path.exists(path):
+            anchors = np.load(path)
         else:
-            if (1 in aspect_ratios_global) & two_boxes_for_ar1:
-                self.n_boxes = len(aspect_ratios_global) + 1
+            if self.aspect_ratios_per_layer:
+                aspect_ratios = self.aspect_ratios_per_layer
             else:
-                self.n_boxes = len(aspect_ratios_global)
+                aspect_ratios = [self.aspect_ratios_global] * len(self.predictor_sizes)
+            anchors = np.concatenate([np.reshape(anchor_boxes(self.img_height,
+                                                             self.img_width,
+                                                             feature_map_size=self.predictor_sizes[i],
+                                                             aspect_ratios=aspect_ratios[i],
+                                                             this_scale=self.scales[i],
+                                                             next_scale=self.scales[i+1],
+                                                             two_boxes_for_ar1=self.two_boxes_for_ar1,
+                                                             limit_boxes=self.limit_boxes,
+                                                             variances=self.variances,
+                                                             coords=self.coords,
+                                                             normalize_coords=self.normalize_coords), (-1, 8)) for i in range(len(self.predictor_sizes))], axis=0)
+            if path is not None:
+                os.makedirs(self.anchors_cache_dir, exist_ok=True)
+                # Write to a temporary file first so that concurrent processes never load a partially written table
+                tmp_path = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+                np.save(tmp_path, anchors)
+                os.replace(tmp_path, path)
+
+        anchors.flags.writeable = False
+        _anchors_cache[key] = anchors
+        return anchors
 
     def generate_anchor_boxes(self,
                               batch_size,
@@ -1756,72 +1546,17 @@ class SSDBoxEncoder:
             A 4D Numpy tensor of shape `(feature_map_height, feature_map_width, n_boxes_per_cell, 4)` where the
             last dimension contains `(xmin, xmax, ymin, ymax)` for each anchor box in each cell of the feature map.
         '''
-        # Compute box width and height for each aspect ratio
-        # The shorter side of the image will be used to compute `w` and `h` using `scale` and `aspect_ratios`.
-        aspect_ratios = np.sort(aspect_ratios)
-        size = min(self.img_height, self.img_width)
-        # Compute the box widths and and heights for all aspect ratios
-        wh_list = []
-        n_boxes = len(aspect_ratios)
-        for ar in aspect_ratios:
-            if (ar == 1) & self.two_boxes_for_ar1:
-                # Compute the regular anchor box for aspect ratio 1 and...
-                w = this_scale * size * np.sqrt(ar)
-                h = this_scale * size / np.sqrt(ar)
-                wh_list.append((w,h))
-                # ...also compute one slightly larger version using the geometric mean of this scale value and the next
-                w = np.sqrt(this_scale * next_scale) * size * np.sqrt(ar)
-                h = np.sqrt(this_scale * next_scale) * size / np.sqrt(ar)
-                wh_list.append((w,h))
-                # Add 1 to `n_boxes` since we seem to have two boxes for aspect ratio 1
-                n_boxes += 1
-            else:
-                w = this_scale * size * np.sqrt(ar)
-                h = this_scale * size / np.sqrt(ar)
-                wh_list.append((w,h))
-        wh_list = np.array(wh_list)
-
-        # Compute the grid of box center points. They are identical for all aspect ratios
-        cell_height = self.img_height / feature_map_size[0]
-        cell_width = self.img_width / feature_map_size[1]
-        cx = np.linspace(cell_width/2, self.img_width-cell_width/2, feature_map_size[1])
-        cy = np.linspace(cell_height/2, self.img_height-cell_height/2, feature_map_size[0])
-        cx_grid, cy_grid = np.meshgrid(cx, cy)
-        cx_grid = np.expand_dims(cx_grid, -1) # This is necessary for np.tile() to do what we want further down
-        cy_grid = np.expand_dims(cy_grid, -1) # This is necessary for np.tile() to do what we want further down
-
-        # Create a 4D tensor template of shape `(feature_map_height, feature_map_width, n_boxes, 4)`
-        # where the last dimension will contain `(cx, cy, w, h)`
-        boxes_tensor = np.zeros((feature_map_size[0], feature_map_size[1], n_boxes, 4))
-
-        boxes_tensor[:, :, :, 0] = np.tile(cx_grid, (1, 1, n_boxes)) # Set cx
-        boxes_tensor[:, :, :, 1] = np.tile(cy_grid, (1, 1, n_boxes)) # Set cy
-        boxes_tensor[:, :, :, 2] = wh_list[:, 0] # Set w
-        boxes_tensor[:, :, :, 3] = wh_list[:, 1] # Set h
-
-        # Convert `(cx, cy, w, h)` to `(xmin, xmax, ymin, ymax)`
-        boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='centroids2minmax')
-
-        # If `limit_boxes` is enabled, clip the coordinates to lie within the image boundaries
-        if self.limit_boxes:
-            x_coords = boxes_tensor[:,:,:,[0, 1]]
-            x_coords[x_coords >= self.img_width] = self.img_width - 1
-            x_coords[x_coords < 0] = 0
-            boxes_tensor[:,:,:,[0, 1]] = x_coords
-            y_coords = boxes_tensor[:,:,:,[2, 3]]
-            y_coords[y_coords >= self.img_height] = self.img_height - 1
-            y_coords[y_coords < 0] = 0
-            boxes_tensor[:,:,:,[2, 3]] = y_coords
-
-        # `normalize_coords` is enabled, normalize the coordinates to be within [0,1]
-        if self.normalize_coords:
-            boxes_tensor[:, :, :, :2] /= self.img_width
-            boxes_tensor[:, :, :, 2:] /= self.img_height
-
-        if self.coords == 'centroids':
-            # TODO: Implement box limiting directly for `(cx, cy, w, h)` so that we don't have to unnecessarily convert back and forth
-            # Convert `(xmin, xmax, ymin, ymax)` back to `(cx, cy, w, h)`
-            boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='minmax2centroids')
+        boxes_tensor = anchor_boxes(self.img_height,
+                                    self.img_width,
+                                    feature_map_size=feature_map_size,
+                                    aspect_ratios=aspect_ratios,
+                                    this_scale=this_scale,
+                                    next_scale=next_scale,
+                                    two_boxes_for_ar1=self.two_boxes_for_ar1,
+                                    limit_boxes=self.limit_boxes,
+                                    variances=self.variances,
+                                    coords=self.coords,
+                                    normalize_coords=self.normalize_coords)[..., :4]
 
         # Now prepend one dimension to `boxes_tensor` to account for the batch size and tile it along
         # The result will be a 5D tensor of shape `(batch_size, feature_map_height, feature_map_width, n_boxes, 4)`
@@ -1836,7 +1571,8 @@ class SSDBoxEncoder:
         boxes_tensor = np.reshape(boxes_tensor, (batch_size, -1, 4))
 
         if diagnostics:
-            return boxes_tensor, wh_list, (int(cell_height), int(cell_width))
+            wh_list = anchor_sizes(self.img_height, self.img_width, aspect_ratios, this_scale, next_scale, self.two_boxes_for_ar1)
+            return boxes_tensor, wh_list, (int(self.img_height / feature_map_size[0]), int(self.img_width / feature_map_size[1]))
         else:
             return boxes_tensor
 
@@ -1865,56 +1601,38 @@ class SSDBoxEncoder:
             the anchor boxes.
         '''
 
-        # 1: Get the anchor box scaling factors for each conv layer from which we're going to make predictions
-        #    If `scales` is given explicitly, we'll use that instead of computing it from `min_scale` and `max_scale`
-        if self.scales is None:
-            self.scales = np.linspace(self.min_scale, self.max_scale, len(self.predictor_sizes)+1)
+        # 1: The anchor boxes were already computed in the constructor, so unless we need the diagnostic output,
+        #    all there is left to do is to tile the template for one image along the batch axis
+        if not diagnostics:
+            return np.tile(self.encode_template, (batch_size, 1, 1))
 
         # 2: For each conv predictor layer (i.e. for each scale factor) get the tensors for
         #    the anchor box coordinates of shape `(batch, n_boxes_total, 4)`
         boxes_tensor = []
-        if diagnostics:
-            wh_list = [] # List to hold the box widths and heights
-            cell_sizes = [] # List to hold horizontal and vertical distances between any two boxes
-            if self.aspect_ratios_per_layer: # If individual aspect ratios are given per layer, we need to pass them to `generate_anchor_boxes()` accordingly
-                for i in range(len(self.predictor_sizes)):
-                    boxes, wh, cells = self.generate_anchor_boxes(batch_size=batch_size,
-                                                                  feature_map_size=self.predictor_sizes[i],
-                                                                  aspect_ratios=self.aspect_ratios_per_layer[i],
-                                                                  this_scale=self.scales[i],
-                                                                  next_scale=self.scales[i+1],
-                                                                  diagnostics=True)
-                    boxes_tensor.append(boxes)
-                    wh_list.append(wh)
-                    cell_sizes.append(cells)
-            else: # Use the same global aspect ratio list for all layers
-                for i in range(len(self.predictor_sizes)):
-                    boxes, wh, cells = self.generate_anchor_boxes(batch_size=batch_size,
-                                                                  feature_map_size=self.predictor_sizes[i],
-                                                                  aspect_ratios=self.aspect_ratios_global,
-                                                                  this_scale=self.scales[i],
-                                                                  next_scale=self.scales[i+1],
-                                                                  diagnostics=True)
-                    boxes_tensor.append(boxes)
-                    wh_list.append(wh)
-                    cell_sizes.append(cells)
-        else:
-            if self.aspect_ratios_per_layer:
-                for i in range(len(self.predictor_sizes)):
-                    boxes_tensor.append(self.generate_anchor_boxes(batch_size=batch_size,
-                                                                   feature_map_size=self.predictor_sizes[i],
-                                                                   aspect_ratios=self.aspect_ratios_per_layer[i],
-                                                                   this_scale=self.scales[i],
-                                                                   next_scale=self.scales[i+1],
-                                                                   diagnostics=False))
-            else:
-                for i in range(len(self.predictor_sizes)):
-                    boxes_tensor.append(self.generate_anchor_boxes(batch_size=batch_size,
-                                                                   feature_map_size=self.predictor_sizes[i],
-                                                                   aspect_ratios=self.aspect_ratios_global,
-                                                                   this_scale=self.scales[i],
-                                                                   next_scale=self.scales[i+1],
-                                                                   diagnostics=False))
+        wh_list = [] # List to hold the box widths and heights
+        cell_sizes = [] # List to hold horizontal and vertical distances between any two boxes
+        if self.aspect_ratios_per_layer: # If individual aspect ratios are given per layer, we need to pass them to `generate_anchor_boxes()` accordingly
+            for i in range(len(self.predictor_sizes)):
+                boxes, wh, cells = self.generate_anchor_boxes(batch_size=batch_size,
+                                                              feature_map_size=self.predictor_sizes[i],
+                                                              aspect_ratios=self.aspect_ratios_per_layer[i],
+                                                              this_scale=self.scales[i],
+                                                              next_scale=self.scales[i+1],
+                                                              diagnostics=True)
+                boxes_tensor.append(boxes)
+                wh_list.append(wh)
+                cell_sizes.append(cells)
+        else: # Use the same global aspect ratio list for all layers
+            for i in range(len(self.predictor_sizes)):
+                boxes, wh, cells = self.generate_anchor_boxes(batch_size=batch_size,
+                                                              feature_map_size=self.predictor_sizes[i],
+                                                              aspect_ratios=self.aspect_ratios_global,
+                                                              this_scale=self.scales[i],
+                                                              next_scale=self.scales[i+1],
+                                                              diagnostics=True)
+                boxes_tensor.append(boxes)
+                wh_list.append(wh)
+                cell_sizes.append(cells)
 
         boxes_tensor = np.concatenate(boxes_tensor, axis=1) # Concatenate the anchor tensors from the individual layers to one
 
@@ -1933,12 +1651,9 @@ class SSDBoxEncoder:
         #    `boxes_tensor` a second time.
         y_encode_template = np.concatenate((classes_tensor, boxes_tensor, boxes_tensor, variances_tensor), axis=2)
 
-        if diagnostics:
-            return y_encode_template, wh_list, cell_sizes
-        else:
-            return y_encode_template
+        return y_encode_template, wh_list, cell_sizes
 
-    def encode_y(self, ground_truth_labels):
+    def encode_y(self, ground_truth_labels, out=None):
         '''
         Convert ground truth bounding box data into a suitable format to train an SSD model.
 
@@ -1957,29 +1672,65 @@ class SSDBoxEncoder:
                 to the respective image, and the data for each ground truth bounding box has the format
                 `(class_id, xmin, xmax, ymin, ymax)`, and `class_id` must be an integer greater than 0 for all boxes
                 as class_id 0 is reserved for the background class.
+            out (array, optional): A Numpy array of shape `(batch_size,) + self.y_shape` to write `y_encoded` into,
+                e.g. a preallocated float32 array, which takes half the memory. Defaults to `None`, i.e. a new float64 array.
 
         Returns:
-            `y_encoded`, a 3D numpy array of shape `(batch_size, #boxes, #classes + 4 + 4)` that serves as the
+            `y_encoded`, a 3D numpy array of shape `(batch_size, #boxes, #classes + 4 + 4 + 4)` that serves as the
             ground truth label tensor for training, where `#boxes` is the total number of boxes predicted by the
             model per image, and the classes are one-hot-encoded. The four elements after the class vecotrs in
-            the last axis are the box coordinates, and the last four elements are just dummy elements.
+            the last axis are the box coordinates, and the last eight elements are the anchor box coordinates and
+            the variances, which the loss doesn't use. If `lean_output` is `True`, these last eight elements are
+            left out and the shape is `(batch_size, #boxes, #classes + 4)`.
         '''
 
-        # 1: Generate the template for y_encoded
-        y_encode_template = self.generate_encode_template(batch_size=len(ground_truth_labels), diagnostics=False)
-        y_encoded = np.copy(y_encode_template) # We'll write the ground truth box data to this array
+        # 1: Broadcast the template for one image to the batch size. This is a read-only view, no data is copied.
+        y_encode_template = np.broadcast_to(self.encode_template, (len(ground_truth_labels),) + self.encode_template.shape)
+        if out is None:
+            y_encoded = np.copy(y_encode_template[:,:,:self.y_shape[1]]) # We'll write the ground truth box data to this array
+        else:
+            y_encoded = out
+            y_encoded[...] = y_encode_template[:,:,:self.y_shape[1]]
 
         # 2: Match the boxes from `ground_truth_labels` to the anchor boxes in `y_encode_template`
         #    and for each matched box record the ground truth coordinates in `y_encoded`.
         #    Every time there is no match for a anchor box, record `class_id` 0 in `y_encoded` for that anchor box.
+        if self.vectorized_matching:
+            self._match_vectorized(ground_truth_labels, y_encode_template, y_encoded)
+        else:
+            self._match_sequential(ground_truth_labels, y_encode_template, y_encoded)
 
+        # 3: Convert absolute box coordinates to offsets from the anchor boxes and normalize them. The box coordinates
+        #    are in the columns `k` to `k+3` of `y_encoded`, and in the template these columns hold the anchor boxes
+        #    and the last four columns the variances.
+        k = self.n_classes
+        if self.coords == 'centroids':
+            y_encoded[:,:,[k,k+1]] -= y_encode_template[:,:,[k,k+1]] # cx(gt) - cx(anchor), cy(gt) - cy(anchor)
+            y_encoded[:,:,[k,k+1]] /= y_encode_template[:,:,[k+2,k+3]] * y_encode_template[:,:,[-4,-3]] # (cx(gt) - cx(anchor)) / w(anchor) / cx_variance, (cy(gt) - cy(anchor)) / h(anchor) / cy_variance
+            y_encoded[:,:,[k+2,k+3]] /= y_encode_template[:,:,[k+2,k+3]] # w(gt) / w(anchor), h(gt) / h(anchor)
+            y_encoded[:,:,[k+2,k+3]] = np.log(y_encoded[:,:,[k+2,k+3]]) / y_encode_template[:,:,[-2,-1]] # ln(w(gt) / w(anchor)) / w_variance, ln(h(gt) / h(anchor)) / h_variance (ln == natural logarithm)
+        else:
+            y_encoded[:,:,k:k+4] -= y_encode_template[:,:,k:k+4] # (gt - anchor) for all four coordinates
+            y_encoded[:,:,[k,k+1]] /= np.expand_dims(y_encode_template[:,:,k+1] - y_encode_template[:,:,k], axis=-1) # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
+            y_encoded[:,:,[k+2,k+3]] /= np.expand_dims(y_encode_template[:,:,k+3] - y_encode_template[:,:,k+2], axis=-1) # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
+            y_encoded[:,:,k:k+4] /= y_encode_template[:,:,-4:] # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
+
+        return y_encoded
+
+    def _match_sequential(self, ground_truth_labels, y_encode_template, y_encoded):
+        '''
+        Match the ground truth boxes to the anchor boxes one batch item and one ground truth box at a time.
+
+        This is the matching step of `encode_y()`. It writes the matched ground truth boxes and the background
+        class into `y_encoded` in place.
+        '''
         class_vector = np.eye(self.n_classes) # An identity matrix that we'll use as one-hot class vectors
 
         for i in range(y_encode_template.shape[0]): # For each batch item...
             available_boxes = np.ones((y_encode_template.shape[1])) # 1 for all anchor boxes that are not yet matched to a ground truth box, 0 otherwise
             negative_boxes = np.ones((y_encode_template.shape[1])) # 1 for all negative boxes, 0 otherwise
             for true_box in ground_truth_labels[i]: # For each ground truth box belonging to the current batch item...
-                true_box = true_box.astype(np.float)
+                true_box = true_box.astype(np.float64)
                 if (true_box[2] - true_box[1] == 0) or (true_box[4] - true_box[3] == 0): continue # Protect ourselves against bad ground truth data: boxes with width or height equal to zero
                 if self.normalize_coords:
                     true_box[1:3] /= self.img_width # Normalize xmin and xmax to be within [0,1]
@@ -1993,27 +1744,93 @@ class SSDBoxEncoder:
                 available_and_thresh_met[available_and_thresh_met < self.pos_iou_threshold] = 0 # Filter out anchor boxes which don't meet the iou threshold
                 assign_indices = np.nonzero(available_and_thresh_met)[0] # Get the indices of the left-over anchor boxes to which we want to assign this ground truth box
                 if len(assign_indices) > 0: # If we have any matches
-                    y_encoded[i,assign_indices,:-8] = np.concatenate((class_vector[int(true_box[0])], true_box[1:]), axis=0) # Write the ground truth box coordinates and class to all assigned anchor box positions. Remember that the last four elements of `y_encoded` are just dummy entries.
+                    y_encoded[i,assign_indices,:self.n_classes+4] = np.concatenate((class_vector[int(true_box[0])], true_box[1:]), axis=0) # Write the ground truth box coordinates and class to all assigned anchor box positions. Remember that the last eight elements of `y_encoded`, if any, are just dummy entries.
                     available_boxes[assign_indices] = 0 # Make the assigned anchor boxes unavailable for the next ground truth box
                 else: # If we don't have any matches
                     best_match_index = np.argmax(similarities) # Get the index of the best iou match out of all available boxes
-                    y_encoded[i,best_match_index,:-8] = np.concatenate((class_vector[int(true_box[0])], true_box[1:]), axis=0) # Write the ground truth box coordinates and class to the best match anchor box position
+                    y_encoded[i,best_match_index,:self.n_classes+4] = np.concatenate((class_vector[int(true_box[0])], true_box[1:]), axis=0) # Write the ground truth box coordinates and class to the best match anchor box position
                     available_boxes[best_match_index] = 0 # Make the assigned anchor box unavailable for the next ground truth box
                     negative_boxes[best_match_index] = 0 # The assigned anchor box is no longer a negative box
             # Set the classes of all remaining available anchor boxes to class zero
             background_class_indices = np.nonzero(negative_boxes)[0]
             y_encoded[i,background_class_indices,0] = 1
 
-        # 3: Convert absolute box coordinates to offsets from the anchor boxes and normalize them
-        if self.coords == 'centroids':
-            y_encoded[:,:,[-12,-11]] -= y_encode_template[:,:,[-12,-11]] # cx(gt) - cx(anchor), cy(gt) - cy(anchor)
-            y_encoded[:,:,[-12,-11]] /= y_encode_template[:,:,[-10,-9]] * y_encode_template[:,:,[-4,-3]] # (cx(gt) - cx(anchor)) / w(anchor) / cx_variance, (cy(gt) - cy(anchor)) / h(anchor) / cy_variance
-            y_encoded[:,:,[-10,-9]] /= y_encode_template[:,:,[-10,-9]] # w(gt) / w(anchor), h(gt) / h(anchor)
-            y_encoded[:,:,[-10,-9]] = np.log(y_encoded[:,:,[-10,-9]]) / y_encode_template[:,:,[-2,-1]] # ln(w(gt) / w(anchor)) / w_variance, ln(h(gt) / h(anchor)) / h_variance (ln == natural logarithm)
-        else:
-            y_encoded[:,:,-12:-8] -= y_encode_template[:,:,-12:-8] # (gt - anchor) for all four coordinates
-            y_encoded[:,:,[-12,-11]] /= np.expand_dims(y_encode_template[:,:,-11] - y_encode_template[:,:,-12], axis=-1) # (xmin(gt) - xmin(anchor)) / w(anchor), (xmax(gt) - xmax(anchor)) / w(anchor)
-            y_encoded[:,:,[-10,-9]] /= np.expand_dims(y_encode_template[:,:,-9] - y_encode_template[:,:,-10], axis=-1) # (ymin(gt) - ymin(anchor)) / h(anchor), (ymax(gt) - ymax(anchor)) / h(anchor)
-            y_encoded[:,:,-12:-8] /= y_encode_template[:,:,-4:] # (gt - anchor) / size(anchor) / variance for all four coordinates, where 'size' refers to w and h respectively
+    def _match_vectorized(self, ground_truth_labels, y_encode_template, y_encoded):
+        '''
+        Match the ground truth boxes to the anchor boxes for the whole batch at once.
+
+        This is the matching step of `encode_y()`. The IoU similarities of all ground truth boxes with all anchor boxes
+        are computed as one array of shape `(batch_size, #gt_boxes, #boxes)`. Every anchor box that meets
+        `pos_iou_threshold` is assigned to the first ground truth box (in label order) for which it does, and every ground
+        truth box that is left without any anchor box this way gets its best available match instead, exactly as the
+        one-box-at-a-time matching in `_match_sequential()` would assign them. Only those few best-match fallbacks are
+        resolved in a loop. Writes into `y_encoded` in place.
+        '''
+        batch_size = y_encode_template.shape[0]
+        class_vector = np.eye(self.n_classes) # An identity matrix that we'll use as one-hot class vectors
 
-        return y_encoded
+        # 1: Stack the ground truth boxes of all batch items into one zero-padded array of shape `(batch_size, max_n_gt, 5)`
+        n_gt = [len(labels) for labels in ground_truth_labels]
+        max_n_gt = max(n_gt)
+        if max_n_gt == 0: # If there are no ground truth boxes at all, every anchor box is a negative box
+            y_encoded[:,:,0] = 1
+            return
+        gt_boxes = np.zeros((batch_size, max_n_gt, 5))
+        valid = np.zeros((batch_size, max_n_gt), dtype=bool) # True for all real ground truth boxes, False for the padding
+        for i, labels in enumerate(ground_truth_labels):
+            if n_gt[i] > 0:
+                gt_boxes[i,:n_gt[i]] = np.asarray(labels, dtype=np.float64)
+                valid[i,:n_gt[i]] = True
+        # Protect ourselves against bad ground truth data: boxes with width or height equal to zero
+        valid &= (gt_boxes[:,:,2] - gt_boxes[:,:,1] != 0) & (gt_boxes[:,:,4] - gt_boxes[:,:,3] != 0)
+        if self.normalize_coords:
+            gt_boxes[:,:,1:3] /= self.img_width # Normalize xmin and xmax to be within [0,1]
+            gt_boxes[:,:,3:5] /= self.img_height # Normalize ymin and ymax to be within [0,1]
+        if self.coords == 'centroids':
+            gt_boxes = convert_coordinates(gt_boxes, start_index=1, conversion='minmax2centroids')
+
+        # 2: Compute the IoU similarities of all ground truth boxes with all anchor boxes, shape `(batch_size, max_n_gt, #boxes)`
+        similarities = iou_matrix(gt_boxes[:,:,1:], y_encode_template[:,:,-12:-8], coords=self.coords)
+        similarities[~valid] = -1 # The padding and the bad ground truth boxes must neither match nor veto any anchor box
+        # An anchor box is a negative box if its IoU with every ground truth box is below `self.neg_iou_threshold`
+        negative_boxes = ~np.any(similarities >= self.neg_iou_threshold, axis=1) # Shape `(batch_size, #boxes)`
+        thresh_met = similarities >= self.pos_iou_threshold
+        if self.pos_iou_threshold <= 0:
+            thresh_met &= similarities != 0 # Anchor boxes without any overlap never count as matches
+        # Each anchor box that meets the threshold for any ground truth box is claimed by the first one of them
+        owners = np.argmax(thresh_met, axis=1) # Shape `(batch_size, #boxes)`
+        owners[~np.take_along_axis(thresh_met, owners[:,np.newaxis,:], axis=1)[:,0,:]] = -1 # -1 for all anchor boxes that weren't claimed
+
+        for i in range(batch_size): # For each batch item...
+            owner = owners[i]
+            # 3: Ground truth boxes that were left without any anchor box get their best available match. Going through them
+            #    in label order, an anchor box is available to ground truth box `j` if it isn't claimed by an earlier
+            #    ground truth box. Taking an anchor box away from a later ground truth box can leave that box without
+            #    any anchor box, too, which is why the unmatched boxes are recomputed after every assignment.
+            start = 0
+            while True:
+                counts = np.bincount(owner[owner >= 0], minlength=max_n_gt)
+                unmatched = np.nonzero(valid[i,start:] & (counts[start:] == 0))[0]
+                if len(unmatched) == 0: break
+                j = start + unmatched[0]
+                available_boxes = (owner < 0) | (owner >= j)
+                best_match_index = np.argmax(similarities[i,j] * available_boxes) # Get the index of the best iou match out of all available boxes
+                owner[best_match_index] = j
+                negative_boxes[i,best_match_index] = False # The assigned anchor box is no longer a negative box
+                start = j + 1
+
+            # 4: Write the ground truth box coordinates and class to all assigned anchor box positions
+            assign_indices = np.nonzero(owner >= 0)[0]
+            if len(assign_indices) > 0:
+                matched_boxes = gt_boxes[i,owner[assign_indices]]
+                y_encoded[i,assign_indices,:self.n_classes+4] = np.concatenate((class_vector[matched_boxes[:,0].astype(np.int64)], matched_boxes[:,1:]), axis=1)
+            # Set the classes of all negative anchor boxes to class zero
+            y_encoded[i,negative_boxes[i],0] = 1
+
+
+def __getattr__(name):
+    # `BatchSequence` used to live here. Importing it from here still works, but imports Keras
+    if name == 'BatchSequence':
+        from singleshot.sequence import BatchSequence
+        return BatchSequence
+    raise AttributeError("module 'singleshot.util' has no attribute '{}'".format(name))
@@ -0,0 +1,91 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from singleshot.anchors import anchor_boxes
+from singleshot.boxes import convert_coordinates
+
+
+def reference_anchor_boxes(img_height, img_width, feature_map_size, aspect_ratios, this_scale, next_scale,
+                           two_boxes_for_ar1, limit_boxes, coords, normalize_coords):
+    '''
+    The anchor box generator of `SSDBoxEncoder.generate_anchor_boxes()` that `anchor_boxes()` replaced, for one image.
+    Returns an array of shape `(feature_map_height * feature_map_width * n_boxes, 4)`.
+    '''
+    aspect_ratios = np.sort(aspect_ratios)
+    size = min(img_height, img_width)
+    wh_list = []
+    n_boxes = len(aspect_ratios)
+    for ar in aspect_ratios:
+        if (ar == 1) & two_boxes_for_ar1:
+            wh_list.append((this_scale * size * np.sqrt(ar), this_scale * size / np.sqrt(ar)))
+            wh_list.append((np.sqrt(this_scale * next_scale) * size * np.sqrt(ar), np.sqrt(this_scale * next_scale) * size / np.sqrt(ar)))
+            n_boxes += 1
+        else:
+            wh_list.append((this_scale * size * np.sqrt(ar), this_scale * size / np.sqrt(ar)))
+    wh_list = np.array(wh_list)
+
+    cell_height = img_height / feature_map_size[0]
+    cell_width = img_width / feature_map_size[1]
+    cx = np.linspace(cell_width/2, img_width-cell_width/2, feature_map_size[1])
+    cy = np.linspace(cell_height/2, img_height-cell_height/2, feature_map_size[0])
+    cx_grid, cy_grid = np.meshgrid(cx, cy)
+    cx_grid = np.expand_dims(cx_grid, -1)
+    cy_grid = np.expand_dims(cy_grid, -1)
+
+    boxes_tensor = np.zeros((feature_map_size[0], feature_map_size[1], n_boxes, 4))
+    boxes_tensor[:, :, :, 0] = np.tile(cx_grid, (1, 1, n_boxes))
+    boxes_tensor[:, :, :, 1] = np.tile(cy_grid, (1, 1, n_boxes))
+    boxes_tensor[:, :, :, 2] = wh_list[:, 0]
+    boxes_tensor[:, :, :, 3] = wh_list[:, 1]
+    boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='centroids2minmax')
+
+    if limit_boxes:
+        x_coords = boxes_tensor[:,:,:,[0, 1]]
+        x_coords[x_coords >= img_width] = img_width - 1
+        x_coords[x_coords < 0] = 0
+        boxes_tensor[:,:,:,[0, 1]] = x_coords
+        y_coords = boxes_tensor[:,:,:,[2, 3]]
+        y_coords[y_coords >= img_height] = img_height - 1
+        y_coords[y_coords < 0] = 0
+        boxes_tensor[:,:,:,[2, 3]] = y_coords
+
+    if normalize_coords:
+        boxes_tensor[:, :, :, :2] /= img_width
+        boxes_tensor[:, :, :, 2:] /= img_height
+
+    if coords == 'centroids':
+        boxes_tensor = convert_coordinates(boxes_tensor, start_index=0, conversion='minmax2centroids')
+
+    return np.reshape(boxes_tensor, (-1, 4))
+
+
+@pytest.mark.parametrize('coords, limit_boxes, normalize_coords, two_boxes_for_ar1',
+                         list(itertools.product(['centroids', 'minmax'], [False, True], [False, True], [False, True])))
+def test_anchor_boxes_equal_reference(coords, limit_boxes, normalize_coords, two_boxes_for_ar1):
+    variances = [0.1, 0.1, 0.2, 0.2]
+    for feature_map_size, aspect_ratios, this_scale, next_scale in [((38, 38), [1.0, 2.0, 0.5], 0.1, 0.2),
+                                                                    ((7, 9), [1.0/3.0, 0.5, 1.0, 2.0, 3.0], 0.6, 0.9),
+                                                                    ((1, 1), [2.0, 0.5], 0.9, 1.05)]:
+        anchors = anchor_boxes(300, 400, feature_map_size, aspect_ratios, this_scale, next_scale,
+                               two_boxes_for_ar1=two_boxes_for_ar1, limit_boxes=limit_boxes, variances=variances,
+                               coords=coords, normalize_coords=normalize_coords)
+        expected = reference_anchor_boxes(300, 400, feature_map_size, aspect_ratios, this_scale, next_scale,
+                                          two_boxes_for_ar1, limit_boxes, coords, normalize_coords)
+
+        np.testing.assert_array_equal(np.reshape(anchors[..., :4], (-1, 4)), expected)
+        np.testing.assert_array_equal(np.reshape(anchors[..., 4:], (-1, 4)), np.tile(variances, (len(expected), 1)))
+
+
+def test_anchor_boxes_are_cached_read_only():
+    kwargs = dict(img_height=300, img_width=300, feature_map_size=(10, 10), aspect_ratios=[0.5, 1.0, 2.0],
+                  this_scale=0.2, next_scale=0.4, variances=[0.1, 0.1, 0.2, 0.2])
+    anchors = anchor_boxes(**kwargs)
+
+    assert anchor_boxes(**kwargs) is anchors
+    assert anchor_boxes(**dict(kwargs, feature_map_size=[10, 10], aspect_ratios=(0.5, 1, 2))) is anchors  # Equal arguments of other types
+    assert anchor_boxes(**dict(kwargs, this_scale=0.3)) is not anchors
+    assert not anchors.flags.writeable
+    with pytest.raises(ValueError):
+        anchors[0, 0, 0, 0] = 1.0
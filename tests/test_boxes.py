@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+
+from singleshot.boxes import iou, greedy_nms, decode_y, _nms_indices
+from singleshot.util import SSDBoxEncoder
+
+
+def reference_greedy_nms(predictions, iou_threshold=0.45, coords='minmax'):
+    '''
+    The greedy non-maximum suppression that `_nms_indices()` replaced, which repeatedly picks the box with the highest
+    score and deletes it and all boxes that overlap it too much. Each row of `predictions` has the format
+    `[class_id, score, xmin, xmax, ymin, ymax]`.
+    '''
+    boxes_left = np.copy(predictions)
+    maxima = []
+    while boxes_left.shape[0] > 0:
+        maximum_index = np.argmax(boxes_left[:,1])
+        maximum_box = np.copy(boxes_left[maximum_index])
+        maxima.append(maximum_box)
+        boxes_left = np.delete(boxes_left, maximum_index, axis=0)
+        if boxes_left.shape[0] == 0: break
+        similarities = iou(boxes_left[:,2:], maximum_box[2:], coords=coords)
+        boxes_left = boxes_left[similarities <= iou_threshold]
+    return np.array(maxima).reshape(-1, predictions.shape[1])
+
+
+def random_predictions(rng, n_boxes, n_classes=4, n_clusters=8, coords='minmax'):
+    '''
+    Random predictions in the format `[class_id, score, xmin, xmax, ymin, ymax]` or `[class_id, score, cx, cy, w, h]`,
+    clustered around a few objects so that many of them overlap, and with rounded scores so that there are ties.
+    '''
+    centers = rng.uniform(50, 250, size=(n_clusters, 2))
+    cluster = rng.randint(n_clusters, size=n_boxes)
+    cx, cy = (centers[cluster] + rng.normal(0, 8, size=(n_boxes, 2))).T
+    w, h = rng.uniform(10, 60, size=(2, n_boxes))
+    scores = np.round(rng.uniform(0, 1, size=n_boxes), 2)
+    class_ids = rng.randint(1, n_classes, size=n_boxes)
+    if coords == 'centroids':
+        return np.stack([class_ids, scores, cx, cy, w, h], axis=1)
+    return np.stack([class_ids, scores, cx - w / 2, cx + w / 2, cy - h / 2, cy + h / 2], axis=1)
+
+
+@pytest.mark.parametrize('coords', ['minmax', 'centroids'])
+@pytest.mark.parametrize('iou_threshold', [0.0, 0.3, 0.45, 1.0])
+def test_greedy_nms_equals_reference(coords, iou_threshold):
+    rng = np.random.RandomState(0)
+    for n_boxes in [0, 1, 2, 50, 400]:
+        predictions = random_predictions(rng, n_boxes, coords=coords)
+        result, = greedy_nms([predictions], iou_threshold=iou_threshold, coords=coords)
+        np.testing.assert_array_equal(np.reshape(result, (-1, 6)), reference_greedy_nms(predictions, iou_threshold=iou_threshold, coords=coords))
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 128, 1000])
+def test_nms_indices_block_size_and_top_k(block_size):
+    rng = np.random.RandomState(1)
+    predictions = random_predictions(rng, 300)
+    expected = reference_greedy_nms(predictions, iou_threshold=0.4)
+
+    keep = _nms_indices(predictions[:,2:], predictions[:,1], iou_threshold=0.4, block_size=block_size)
+    np.testing.assert_array_equal(predictions[keep], expected)
+
+    # Stopping at `top_k` boxes gives the first `top_k` boxes of the full result
+    keep = _nms_indices(predictions[:,2:], predictions[:,1], iou_threshold=0.4, block_size=block_size, top_k=5)
+    np.testing.assert_array_equal(predictions[keep], expected[:5])
+
+
+@pytest.mark.parametrize('block_size', [1, 16, 128])
+def test_nms_indices_groups_equal_nms_per_group(block_size):
+    rng = np.random.RandomState(2)
+    predictions = random_predictions(rng, 500, n_classes=6)
+    groups = predictions[:,0].astype(np.int64)
+
+    keep = _nms_indices(predictions[:,2:], predictions[:,1], iou_threshold=0.45, block_size=block_size, groups=groups)
+
+    expected = np.concatenate([reference_greedy_nms(predictions[groups == group], iou_threshold=0.45) for group in np.unique(groups)])
+    np.testing.assert_array_equal(predictions[keep], expected)
+
+
+def random_model_output(rng, batch_size, n_boxes, n_classes, coords='minmax'):
+    '''
+    Random raw SSD model output of shape `(batch_size, n_boxes, n_classes + 12)` with softmax confidences, small
+    offsets and anchor boxes that overlap each other a lot, in the coordinate format `coords`.
+    '''
+    logits = rng.normal(0, 2, size=(batch_size, n_boxes, n_classes))
+    confidences = np.exp(logits) / np.sum(np.exp(logits), axis=-1, keepdims=True)
+    offsets = rng.normal(0, 0.5, size=(batch_size, n_boxes, 4))
+    cx, cy = rng.uniform(50, 250, size=(2, n_boxes))
+    w, h = rng.uniform(20, 80, size=(2, n_boxes))
+    anchors = np.stack([cx, cy, w, h] if coords == 'centroids' else [cx - w / 2, cx + w / 2, cy - h / 2, cy + h / 2], axis=-1)
+    variances = np.tile([0.1, 0.1, 0.2, 0.2], (n_boxes, 1))
+    return np.concatenate([confidences, offsets, np.broadcast_to(np.concatenate([anchors, variances], axis=-1), (batch_size, n_boxes, 8))], axis=-1)
+
+
+@pytest.mark.parametrize('input_coords', ['minmax', 'centroids'])
+@pytest.mark.parametrize('top_k', [5, 200])
+def test_batched_decode_equals_per_class_decode(input_coords, top_k):
+    rng = np.random.RandomState(3)
+    y_pred = random_model_output(rng, batch_size=4, n_boxes=300, n_classes=5, coords=input_coords)
+    kwargs = dict(confidence_thresh=0.2, iou_threshold=0.45, top_k=top_k, input_coords=input_coords)
+
+    batched = decode_y(y_pred, batched_nms=True, **kwargs)
+    per_class = decode_y(y_pred, batched_nms=False, **kwargs)
+
+    assert len(batched) == len(per_class)
+    for batched_item, per_class_item in zip(batched, per_class):
+        assert len(per_class_item) > 0
+        np.testing.assert_array_equal(batched_item, per_class_item)
+
+
+def test_batched_decode_image_without_predictions():
+    rng = np.random.RandomState(4)
+    y_pred = random_model_output(rng, batch_size=2, n_boxes=50, n_classes=3)
+    y_pred[1,:,:3] = [1, 0, 0]  # The second image only has background predictions
+
+    y_pred_decoded = decode_y(y_pred, confidence_thresh=0.2, input_coords='minmax')
+
+    assert len(y_pred_decoded[0]) > 0
+    assert y_pred_decoded[1].shape == (0, 6)
+
+
+@pytest.mark.parametrize('input_coords', ['minmax', 'centroids'])
+def test_decode_lean_output_with_anchors(input_coords):
+    rng = np.random.RandomState(5)
+    encoder = SSDBoxEncoder(img_height=300, img_width=300, n_classes=4, predictor_sizes=[(10, 10), (5, 5)],
+                            aspect_ratios_global=[0.5, 1.0, 2.0], coords=input_coords, lean_output=True)
+    y_pred = random_model_output(rng, batch_size=3, n_boxes=len(encoder.anchors), n_classes=4)
+    y_pred[..., -8:] = encoder.anchors  # The full model output contains the encoder's anchor boxes
+    kwargs = dict(confidence_thresh=0.2, iou_threshold=0.45, top_k=200, input_coords=input_coords)
+
+    full = decode_y(y_pred, **kwargs)
+    lean = decode_y(y_pred[..., :-8], anchors=encoder.anchors, **kwargs)
+
+    for full_item, lean_item in zip(full, lean):
+        assert len(full_item) > 0
+        np.testing.assert_array_equal(lean_item, full_item)
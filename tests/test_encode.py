@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from singleshot.util import SSDBoxEncoder
+
+
+def random_labels(rng, batch_size, n_classes, img_size=300, max_boxes=12):
+    '''
+    A batch of random ground truth labels in the format `(class_id, xmin, xmax, ymin, ymax)`, including images
+    without boxes, boxes of zero width and duplicate boxes that compete for the same anchor boxes.
+    '''
+    labels = []
+    for i in range(batch_size):
+        n = rng.randint(0, max_boxes + 1)
+        xmin, ymin = rng.randint(0, img_size - 10, size=(2, n))
+        w, h = rng.randint(5, 120, size=(2, n))
+        boxes = np.stack([rng.randint(1, n_classes, size=n), xmin, np.minimum(xmin + w, img_size), ymin, np.minimum(ymin + h, img_size)], axis=1)
+        if n > 2:
+            boxes[1] = boxes[0]  # Two identical boxes
+            boxes[2, 2] = boxes[2, 1]  # A box of zero width
+        labels.append(boxes.astype(np.float64))
+    return labels
+
+
+@pytest.mark.parametrize('coords', ['centroids', 'minmax'])
+@pytest.mark.parametrize('normalize_coords', [False, True])
+@pytest.mark.parametrize('pos_iou_threshold', [0.5, 0.2])
+def test_vectorized_matching_equals_sequential(coords, normalize_coords, pos_iou_threshold):
+    rng = np.random.RandomState(0)
+    kwargs = dict(img_height=300, img_width=300, n_classes=4, predictor_sizes=[(19, 19), (10, 10), (5, 5), (3, 3)],
+                  min_scale=0.1, max_scale=0.9, aspect_ratios_global=[0.5, 1.0, 2.0], pos_iou_threshold=pos_iou_threshold,
+                  neg_iou_threshold=0.1, coords=coords, normalize_coords=normalize_coords)
+    vectorized = SSDBoxEncoder(vectorized_matching=True, **kwargs)
+    sequential = SSDBoxEncoder(vectorized_matching=False, **kwargs)
+
+    for _ in range(5):
+        labels = random_labels(rng, batch_size=6, n_classes=4)
+        y_encoded = vectorized.encode_y(labels)
+        assert np.any(y_encoded[:,:,1:4] == 1)  # Some anchor boxes were matched
+        np.testing.assert_array_equal(y_encoded, sequential.encode_y(labels))
+
+
+def test_vectorized_matching_without_boxes():
+    encoder = SSDBoxEncoder(img_height=300, img_width=300, n_classes=3, predictor_sizes=[(10, 10), (5, 5)], aspect_ratios_global=[1.0])
+    sequential = SSDBoxEncoder(img_height=300, img_width=300, n_classes=3, predictor_sizes=[(10, 10), (5, 5)], aspect_ratios_global=[1.0], vectorized_matching=False)
+    labels = [np.zeros((0, 5)), np.zeros((0, 5))]
+    np.testing.assert_array_equal(encoder.encode_y(labels), sequential.encode_y(labels))
+
+
+@pytest.mark.parametrize('coords', ['centroids', 'minmax'])
+def test_lean_output_encoding_drops_anchor_columns(coords):
+    rng = np.random.RandomState(1)
+    kwargs = dict(img_height=300, img_width=300, n_classes=4, predictor_sizes=[(10, 10), (5, 5)],
+                  aspect_ratios_global=[0.5, 1.0, 2.0], coords=coords)
+    full = SSDBoxEncoder(**kwargs)
+    lean = SSDBoxEncoder(lean_output=True, **kwargs)
+
+    labels = random_labels(rng, batch_size=4, n_classes=4)
+    y_full = full.encode_y(labels)
+    y_lean = lean.encode_y(labels)
+
+    assert y_lean.shape == y_full.shape[:2] + (4 + 4,)
+    np.testing.assert_array_equal(y_lean, y_full[..., :-8])
+    # The dropped columns are the anchor boxes and the variances
+    np.testing.assert_array_equal(y_full[0, :, -8:], lean.anchors)
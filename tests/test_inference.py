@@ -0,0 +1,47 @@
+import threading
+
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+
+from singleshot.inference import load_batches
+
+
+def write_images(tmp_path, n_images, rng):
+    filenames, images = [], []
+    for i in range(n_images):
+        filename = str(tmp_path / 'img{}.tif'.format(i))
+        image = rng.randint(256, size=(3, 5, 4)).astype(np.uint8)
+        with rasterio.open(filename, 'w', driver='GTiff', height=5, width=4, count=3, dtype='uint8') as img:
+            img.write(image)
+        filenames.append(filename)
+        images.append(image.transpose([1, 2, 0]))
+    return filenames, images
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 7])
+def test_load_batches(tmp_path, batch_size):
+    filenames, images = write_images(tmp_path, 7, np.random.RandomState(0))
+    batches = list(load_batches(filenames, batch_size=batch_size, bands=[3, 1]))
+
+    assert [filename for batch_filenames, batch_X in batches for filename in batch_filenames] == filenames
+    np.testing.assert_array_equal(np.concatenate([batch_X for batch_filenames, batch_X in batches]), np.stack(images)[..., [2, 0]])
+
+
+def test_load_batches_stops_loader(tmp_path):
+    filenames, images = write_images(tmp_path, 20, np.random.RandomState(1))
+    n_threads = threading.active_count()
+
+    # Stopping after the first batch leaves the loader blocked on the full queue until the generator is closed
+    batches = load_batches(filenames, batch_size=1, prefetch=1)
+    batch_filenames, batch_X = next(batches)
+    np.testing.assert_array_equal(batch_X[0], images[0])
+    batches.close()
+    assert threading.active_count() == n_threads
+
+
+def test_load_batches_raises_loader_errors(tmp_path):
+    filenames, images = write_images(tmp_path, 2, np.random.RandomState(2))
+    with pytest.raises(rasterio.errors.RasterioIOError):
+        list(load_batches(filenames + [str(tmp_path / 'missing.tif')], batch_size=1))
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+
+from keras import Input, backend as K
+from keras.engine import Model
+from keras.layers import Dense
+
+from singleshot.boxes import decode_y
+from singleshot.model import VGG_LAYER_NAMES, DecodeDetections, LossScaledAdam, has_vgg_weights
+
+
+def random_model_output(rng, batch_size, n_boxes, n_classes, coords='minmax'):
+    '''
+    Random raw SSD model output of shape `(batch_size, n_boxes, n_classes + 12)` in float32.
+    '''
+    logits = rng.normal(0, 2, size=(batch_size, n_boxes, n_classes))
+    confidences = np.exp(logits) / np.sum(np.exp(logits), axis=-1, keepdims=True)
+    offsets = rng.normal(0, 0.5, size=(batch_size, n_boxes, 4))
+    cx, cy = rng.uniform(50, 250, size=(2, n_boxes))
+    w, h = rng.uniform(20, 80, size=(2, n_boxes))
+    anchors = np.stack([cx, cy, w, h] if coords == 'centroids' else [cx - w / 2, cx + w / 2, cy - h / 2, cy + h / 2], axis=-1)
+    variances = np.tile([0.1, 0.1, 0.2, 0.2], (n_boxes, 1))
+    anchors = np.broadcast_to(np.concatenate([anchors, variances], axis=-1), (batch_size, n_boxes, 8))
+    return np.concatenate([confidences, offsets, anchors], axis=-1).astype(np.float32)
+
+
+def sort_detections(detections):
+    '''
+    Sort detections by class and by descending confidence, so that both decoders' outputs can be compared.
+    '''
+    detections = np.reshape(detections, (-1, 6))
+    return detections[np.lexsort((-detections[:,1], detections[:,0]))]
+
+
+@pytest.mark.parametrize('coords', ['minmax', 'centroids'])
+@pytest.mark.parametrize('top_k', [10, 200])
+def test_decode_detections_equals_decode_y(coords, top_k):
+    rng = np.random.RandomState(0)
+    y_pred = random_model_output(rng, batch_size=3, n_boxes=200, n_classes=4, coords=coords)
+
+    inputs = Input(shape=y_pred.shape[1:])
+    model = Model(inputs=inputs, outputs=DecodeDetections(confidence_thresh=0.3, iou_threshold=0.45, top_k=top_k, coords=coords)(inputs))
+    y_pred_layer = model.predict(y_pred)
+    y_pred_numpy = decode_y(y_pred.astype(np.float64), confidence_thresh=0.3, iou_threshold=0.45, top_k=top_k, input_coords=coords)
+
+    assert y_pred_layer.shape == (3, top_k, 6)
+    for layer_item, numpy_item in zip(y_pred_layer, y_pred_numpy):
+        assert len(numpy_item) > 0
+        # The layer pads its output with rows of class ID 0
+        assert np.all(layer_item[len(numpy_item):] == 0)
+        np.testing.assert_allclose(sort_detections(layer_item[:len(numpy_item)]), sort_detections(numpy_item), rtol=1e-4, atol=1e-3)
+
+
+def loss_scaled_model(growth_interval):
+    K.clear_session()
+    inputs = Input(shape=(3,))
+    model = Model(inputs=inputs, outputs=Dense(2)(inputs))
+    optimizer = LossScaledAdam(initial_scale=2.0**10, growth_interval=growth_interval, lr=0.01)
+    model.compile(optimizer=optimizer, loss='mse')
+    return model, optimizer
+
+
+def test_loss_scaled_adam_skips_non_finite_steps():
+    model, optimizer = loss_scaled_model(growth_interval=1000)
+    x = np.ones((4, 3), dtype=np.float32)
+    y = np.zeros((4, 2), dtype=np.float32)
+    model.train_on_batch(x, y)  # Creates the optimizer state
+
+    weights = model.get_weights()
+    state = K.batch_get_value(optimizer.weights)
+    model.train_on_batch(x, np.full((4, 2), np.inf, dtype=np.float32))
+
+    for before, after in zip(weights, model.get_weights()):
+        np.testing.assert_array_equal(before, after)
+    for before, after in zip(state, K.batch_get_value(optimizer.weights)):  # The iterations and the moments
+        np.testing.assert_array_equal(before, after)
+    assert K.get_value(optimizer.loss_scale) == 2.0**9
+    assert K.get_value(optimizer.good_steps) == 0
+
+    # A finite step after the skipped one updates the weights again
+    model.train_on_batch(x, y)
+    assert K.get_value(optimizer.iterations) == 2
+    assert not np.array_equal(weights[0], model.get_weights()[0])
+
+
+def test_loss_scaled_adam_grows_scale_after_growth_interval():
+    model, optimizer = loss_scaled_model(growth_interval=3)
+    x = np.ones((4, 3), dtype=np.float32)
+    y = np.zeros((4, 2), dtype=np.float32)
+
+    for _ in range(2):
+        model.train_on_batch(x, y)
+    assert K.get_value(optimizer.loss_scale) == 2.0**10
+    model.train_on_batch(x, y)
+    assert K.get_value(optimizer.loss_scale) == 2.0**11
+    assert K.get_value(optimizer.good_steps) == 0
+
+
+@pytest.mark.parametrize('save', ['save', 'save_weights'])
+def test_has_vgg_weights(tmp_path, save):
+    pytest.importorskip('h5py')
+
+    def checkpoint(layer_names):
+        x = Input(shape=(2,))
+        y = x
+        for name in layer_names:
+            y = Dense(2, name=name)(y)
+        path = str(tmp_path / 'checkpoint.h5')
+        getattr(Model(x, y), save)(path)
+        return path
+
+    assert has_vgg_weights(checkpoint(VGG_LAYER_NAMES + ('fc6',)))
+    # A checkpoint without all VGG-16 layers doesn't overwrite them, e.g. one of another base network
+    assert not has_vgg_weights(checkpoint(VGG_LAYER_NAMES[:-1]))
+    assert not has_vgg_weights(checkpoint(('fc6', 'fc7')))
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+rasterio = pytest.importorskip('rasterio')
+
+from singleshot.sequence import BatchSequence
+from singleshot.util import BatchGenerator, SSDBoxEncoder
+
+
+def write_dataset(tmp_path, n_images=10):
+    '''
+    Write `n_images` small images, each with a distinct constant value, and a labels CSV file with one box per image.
+    '''
+    labels_path = str(tmp_path / 'labels.csv')
+    with open(labels_path, 'w') as f:
+        f.write('frame,xmin,xmax,ymin,ymax,class_id\n')
+        for i in range(n_images):
+            filename = str(tmp_path / 'img{:02d}.tif'.format(i))
+            with rasterio.open(filename, 'w', driver='GTiff', height=30, width=40, count=3, dtype='uint8') as img:
+                img.write(np.full((3, 30, 40), 10 * i, dtype=np.uint8))
+            f.write('{}, 4, {}, 5, 20, {}\n'.format(filename, 10 + i, 1 + i % 3))
+            f.write('{}, 20, 35, 10, 25, 1\n'.format(filename))
+    return labels_path
+
+
+def batch_sequence(tmp_path, seed):
+    generator = BatchGenerator(include_classes=[1, 2, 3])
+    generator.parse_csv(write_dataset(tmp_path), ['image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id'],
+                        checkpoints_path=str(tmp_path))
+    encoder = SSDBoxEncoder(img_height=30, img_width=40, n_classes=4, predictor_sizes=[(3, 4)], aspect_ratios_global=[1.0])
+    return BatchSequence(generator, batch_size=4, ssd_box_encoder=encoder, seed=seed, flip=0.5)
+
+
+def test_batch_sequence_is_deterministic(tmp_path):
+    sequence = batch_sequence(tmp_path, seed=3)
+    assert len(sequence) == 3
+
+    # The batches don't depend on the order in which the workers produce them
+    batches = [sequence[index] for index in range(len(sequence))]
+    for index in reversed(range(len(sequence))):
+        batch_X, y_true = sequence[index]
+        np.testing.assert_array_equal(batch_X, batches[index][0])
+        np.testing.assert_array_equal(y_true, batches[index][1])
+
+    # Every epoch covers every image once, identified by its constant value
+    values = np.concatenate([batch_X[:, 0, 0, 0] for batch_X, y_true in batches])
+    assert [len(batch_X) for batch_X, y_true in batches] == [4, 4, 2]
+    assert sorted(values) == [10 * i for i in range(10)]
+
+    sequence.on_epoch_end()
+    assert not all(np.array_equal(sequence[index][0], batches[index][0]) for index in range(len(sequence)))
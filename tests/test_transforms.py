@@ -0,0 +1,211 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+
+from singleshot.transforms import Compose, AffineChain, Flip, Translate, Scale, RandomCrop, Crop, Resize, RGBToGray, GrayToRGB, MultispectralToRGB
+
+
+BOX_OUTPUT_FORMAT = ['class_id', 'xmin', 'xmax', 'ymin', 'ymax']
+
+
+class MaxRandomState:
+    '''
+    A stand-in for `np.random.RandomState` that always draws the largest value of `uniform()` and `choice()` and
+    the smallest value of `randint()`, so that every transform is applied with known parameters.
+    '''
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return np.full(size, high, dtype=np.float64)
+
+    def randint(self, low, high=None, size=None):
+        return np.full(size, low, dtype=np.int64)
+
+    def choice(self, values, size=None):
+        return np.full(size, values[-1])
+
+
+def random_images(rng, n_images=3, height=6, width=10, channels=3):
+    return rng.randint(256, size=(n_images, height, width, channels)).astype(np.uint8)
+
+
+def test_compose_packs_and_unpacks_labels():
+    # The coordinates are not the first columns, and the second image has no boxes
+    box_output_format = ['ymin', 'class_id', 'xmax', 'xmin', 'ymax']
+    labels = [np.array([[1, 3, 5, 2, 4], [0, 1, 9, 7, 6]], dtype=np.float32),
+              np.zeros((0, 5), dtype=np.float32),
+              np.array([[2, 2, 8, 3, 5]], dtype=np.float32)]
+    images = random_images(np.random.RandomState(0))
+
+    batch_X, batch_y = Compose([Crop(top=1, left=2, limit_boxes=False)], box_output_format)(list(images), labels)
+
+    np.testing.assert_array_equal(batch_X, images[:, 1:, 2:])
+    assert len(batch_y) == 3
+    # Only the coordinates move, `xmin` and `xmax` by the left crop and `ymin` and `ymax` by the top crop
+    np.testing.assert_array_equal(batch_y[0], [[0, 3, 3, 0, 3], [-1, 1, 7, 5, 5]])
+    assert batch_y[1].shape == (0, 5)
+    np.testing.assert_array_equal(batch_y[2], [[1, 2, 6, 1, 4]])
+    # The arguments are not modified
+    np.testing.assert_array_equal(labels[0], [[1, 3, 5, 2, 4], [0, 1, 9, 7, 6]])
+
+
+def test_compose_transforms_images_of_different_sizes():
+    rng = np.random.RandomState(1)
+    images = [random_images(rng, 1, 6, 10)[0], random_images(rng, 1, 8, 12)[0]]
+    labels = [np.array([[1, 0, 10, 0, 6]]), np.array([[2, 0, 12, 0, 8]])]
+
+    batch_X, batch_y = Compose([Resize(5, 4)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    assert batch_X.shape == (2, 4, 5, 3)
+    np.testing.assert_array_equal(batch_y[0], [[1, 0, 5, 0, 4]])
+    np.testing.assert_array_equal(batch_y[1], [[2, 0, 5, 0, 4]])
+
+
+def test_crop_limits_boxes():
+    images = random_images(np.random.RandomState(2), n_images=1)
+    # After cropping 3 pixels off the left, the boxes keep 1/2, 1/4 and 0 of their widths
+    labels = [np.array([[1, 1, 5, 0, 2], [2, 0, 4, 0, 2], [3, 0, 3, 0, 2]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([Crop(left=3, include_thresh=0.3)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    np.testing.assert_array_equal(batch_X, images[:, :, 3:])
+    np.testing.assert_array_equal(batch_y[0], [[1, 0, 2, 0, 2]])
+
+    batch_X, batch_y = Compose([Crop(left=3, include_thresh=0.2)], BOX_OUTPUT_FORMAT)(images, labels)
+    np.testing.assert_array_equal(batch_y[0], [[1, 0, 2, 0, 2], [2, 0, 1, 0, 2]])
+
+
+def test_random_crop_removes_images_without_boxes():
+    images = random_images(np.random.RandomState(3))
+    labels = [np.array([[1, 1, 4, 1, 3]], dtype=np.float32),
+              np.array([[2, 6, 9, 4, 6]], dtype=np.float32), # Outside of every patch at the top left corner
+              np.array([[3, 1, 4, 0, 3], [4, 2, 6, 1, 4]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([RandomCrop(4, 5, min_1_object=1, max_trials=3)], BOX_OUTPUT_FORMAT)(images, labels, rng=MaxRandomState())
+
+    np.testing.assert_array_equal(batch_X, images[[0, 2], :4, :5])
+    assert len(batch_y) == 2
+    np.testing.assert_array_equal(batch_y[0], [[1, 1, 4, 1, 3]])
+    # The second box keeps 1/3 of its area inside the patch and is limited to the patch boundaries
+    np.testing.assert_array_equal(batch_y[1], [[3, 1, 4, 0, 3], [4, 2, 4, 1, 3]])
+
+
+def test_random_crop_places_small_images_on_canvas():
+    images = random_images(np.random.RandomState(4), n_images=2)
+    labels = [np.array([[1, 1, 4, 1, 3]], dtype=np.float32), np.zeros((0, 5), dtype=np.float32)]
+
+    batch_X, batch_y = Compose([RandomCrop(8, 12, min_1_object=0)], BOX_OUTPUT_FORMAT)(images, labels, rng=MaxRandomState())
+
+    # With `min_1_object=0` no image is removed, and every image is placed at the top left corner of the black canvas
+    expected = np.zeros((2, 8, 12, 3), dtype=np.uint8)
+    expected[:, :6, :10] = images
+    np.testing.assert_array_equal(batch_X, expected)
+    np.testing.assert_array_equal(batch_y[0], [[1, 1, 4, 1, 3]])
+    assert batch_y[1].shape == (0, 5)
+
+
+def test_resize_equals_per_image_resize():
+    images = random_images(np.random.RandomState(5), n_images=100, channels=3) # More than one chunk of channels
+    labels = [np.array([[1, 3, 7, 1, 5]], dtype=np.float32)] * len(images)
+
+    batch_X, batch_y = Compose([Resize(25, 9)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    np.testing.assert_array_equal(batch_X, np.stack([cv2.resize(image, dsize=(25, 9)) for image in images]))
+    # The coordinates are scaled by 2.5 and 1.5 and truncated
+    for image_labels in batch_y:
+        np.testing.assert_array_equal(image_labels, [[1, 7, 17, 1, 7]])
+
+
+def test_channel_conversions():
+    rng = np.random.RandomState(6)
+    labels = [np.array([[1, 3, 7, 1, 5]], dtype=np.float32)] * 3
+
+    images = random_images(rng)
+    batch_X, batch_y = Compose([RGBToGray()], BOX_OUTPUT_FORMAT)(images, labels)
+    np.testing.assert_array_equal(batch_X, np.stack([cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)[..., np.newaxis] for image in images]))
+    np.testing.assert_array_equal(batch_y[0], labels[0])
+
+    images = random_images(rng, channels=1)
+    batch_X, batch_y = Compose([GrayToRGB()], BOX_OUTPUT_FORMAT)(images, labels)
+    np.testing.assert_array_equal(batch_X, np.stack([cv2.cvtColor(image, cv2.COLOR_BayerGR2RGB) for image in images]))
+
+    # The red, green and blue bands of 8-band images are the fifth, third and second band
+    images = random_images(rng, channels=8)
+    batch_X, batch_y = Compose([MultispectralToRGB()], BOX_OUTPUT_FORMAT)(images, labels)
+    np.testing.assert_array_equal(batch_X, images[..., [4, 2, 1]])
+
+
+def test_flip():
+    images = random_images(np.random.RandomState(7))
+    labels = [np.array([[1, 2, 5, 1, 3]], dtype=np.float32)] * 3
+
+    batch_X, batch_y = Compose([Flip(1.0)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    # The pixel `x` moves to `9 - x` and the box edge `x` to `10 - x`, so `xmin` and `xmax` swap
+    np.testing.assert_array_equal(batch_X, images[:, :, ::-1])
+    for image_labels in batch_y:
+        np.testing.assert_array_equal(image_labels, [[1, 5, 8, 1, 3]])
+
+
+@pytest.mark.parametrize('include_thresh, kept', [(0.3, [0, 1]), (0.2, [0, 1, 2]), (0, [0, 1, 2])])
+def test_translate(include_thresh, kept):
+    images = random_images(np.random.RandomState(8), n_images=1)
+    # Moved 3 pixels to the right and 2 down, the boxes keep all, 1/2, 1/4 and 0 of their areas within the image
+    labels = [np.array([[1, 2, 5, 1, 3], [2, 4, 8, 0, 2], [3, 5, 9, 0, 2], [4, 7, 9, 0, 2]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([Translate((3, 3), (2, 2), 1.0, include_thresh=include_thresh)], BOX_OUTPUT_FORMAT)(images, labels, rng=MaxRandomState())
+
+    expected = np.zeros_like(images)
+    expected[:, 2:, 3:] = images[:, :-2, :-3]
+    np.testing.assert_array_equal(batch_X, expected)
+    expected_labels = np.array([[1, 5, 8, 3, 5], [2, 7, 9, 2, 4], [3, 8, 9, 2, 4]])
+    np.testing.assert_array_equal(batch_y[0], expected_labels[kept])
+
+
+def test_translate_without_limiting():
+    images = random_images(np.random.RandomState(9), n_images=1)
+    labels = [np.array([[4, 7, 9, 0, 2]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([Translate((3, 3), (2, 2), 1.0, limit_boxes=False)], BOX_OUTPUT_FORMAT)(images, labels, rng=MaxRandomState())
+
+    np.testing.assert_array_equal(batch_y[0], [[4, 10, 12, 2, 4]])
+
+
+def test_scale():
+    images = random_images(np.random.RandomState(10), n_images=1)
+    labels = [np.array([[1, 4, 6, 2, 4], [2, 0, 4, 0, 2]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([Scale(2.0, 2.0, 1.0)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    # Scaling by 2 about the pixel `(5, 3)` maps the pixel `x` to `2 * x - 5` and the box edge `x` to `2 * x - 5.5`
+    np.testing.assert_array_equal(batch_X[0], cv2.warpAffine(images[0], np.array([[2., 0, -5], [0, 2, -3]]), (10, 6)))
+    # The second box keeps only 1.25 of its 32 pixels within the image after limiting and is removed
+    np.testing.assert_array_equal(batch_y[0], [[1, 2.5, 6.5, 0.5, 4.5]])
+
+
+def test_shrinking_does_not_limit_boxes():
+    images = random_images(np.random.RandomState(11), n_images=1)
+    labels = [np.array([[1, -12, 2, 0, 2]], dtype=np.float32)]
+
+    batch_X, batch_y = Compose([Scale(0.5, 0.5, 1.0)], BOX_OUTPUT_FORMAT)(images, labels)
+
+    # The box edge `x` moves to `0.5 * x + 2.75` and `y` to `0.5 * y + 1.75`, the box stays partly outside the image
+    np.testing.assert_array_equal(batch_y[0], [[1, -3.25, 3.75, 1.75, 2.75]])
+
+
+def test_affine_chain_fuses_transforms():
+    images = random_images(np.random.RandomState(12), n_images=2)
+    labels = [np.array([[1, 6, 9, 0, 2]], dtype=np.float32), np.array([[2, 4, 8, 1, 3], [3, 0, 1, 0, 1]], dtype=np.float32)]
+
+    transforms = Compose([Resize(10, 6), Flip(1.0), Translate((3, 3), (2, 2), 1.0), Scale(2.0, 2.0, 1.0)], BOX_OUTPUT_FORMAT)
+    assert isinstance(transforms.transforms[1], AffineChain) and len(transforms.transforms[1].transforms) == 3
+    batch_X, batch_y = transforms(images, labels, rng=MaxRandomState())
+
+    # The flip, the translation and the scaling are one warp with the product of their matrices
+    matrix = np.array([[2., 0, -5], [0, 2, -3], [0, 0, 1]]) @ np.array([[1., 0, 3], [0, 1, 2], [0, 0, 1]]) @ np.array([[-1., 0, 9], [0, 1, 0], [0, 0, 1]])
+    for image, expected_image in zip(batch_X, images):
+        np.testing.assert_array_equal(image, cv2.warpAffine(expected_image, matrix[:2], (10, 6)))
+    # The box edge `x` moves to `2 * (13 - x) - 5.5` and `y` to `2 * (y + 2) - 3.5`, and the boxes are limited once
+    # at the end: The second box keeps 11.25 of its 32 pixels, the last box is pushed out of the image
+    np.testing.assert_array_equal(batch_y[0], [[1, 2.5, 8.5, 0.5, 4.5]])
+    np.testing.assert_array_equal(batch_y[1], [[2, 4.5, 9, 2.5, 5]])
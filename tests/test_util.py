@@ -0,0 +1,333 @@
+import csv
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from singleshot.util import BatchGenerator, split_shard
+
+
+INPUT_FORMAT = ['image_name', 'xmin', 'xmax', 'ymin', 'ymax', 'class_id']
+
+
+def write_labels_csv(path, rng, n_rows=500, n_images=60):
+    '''
+    Write a labels CSV file with spaces after the commas, duplicate rows, boxes of zero width or height,
+    and images whose boxes are all faulty.
+    '''
+    with open(path, 'w') as f:
+        f.write('frame,xmin,xmax,ymin,ymax,class_id\n')
+        for _ in range(n_rows):
+            xmin, ymin = rng.randint(0, 250, size=2)
+            xmax, ymax = xmin + rng.randint(0, 40), ymin + rng.randint(0, 40)
+            f.write('img{:03d}.png, {}, {}, {}, {}, {}\n'.format(rng.randint(n_images), xmin, xmax, ymin, ymax, rng.randint(1, 5)))
+        f.write('bad.png, 10, 10, 5, 20, 1\n')
+
+
+def reference_parse_csv(generator, labels_path):
+    '''
+    The row-by-row CSV parser that `_parse_csv_labels()` replaced. Returns the filenames and labels before shuffling.
+    '''
+    generator.filenames = []
+    generator.labels = []
+    data = []
+    with open(labels_path, newline='') as csvfile:
+        csv_reader = csv.reader(csvfile, delimiter=',')
+        next(csv_reader)  # Skip the header row
+        for row in csv_reader:
+            if int(row[INPUT_FORMAT.index('class_id')].strip()) in generator.include_classes:
+                obj = [row[INPUT_FORMAT.index('image_name')].strip()]
+                for item in generator.box_output_format:
+                    val = int(row[INPUT_FORMAT.index(item)].strip())
+                    obj.append(generator.class_map[val] if item == 'class_id' and generator.class_map else val)
+                data.append(obj)
+    data = sorted(data)
+
+    current_file = ''
+    current_labels = []
+    bad_boxes = []
+    bad_files = []
+    for idx, row in enumerate(data):
+        if current_file == '':
+            current_file = row[0]
+            generator.append_label_to_list(current_labels, row[1:], bad_boxes)
+            if len(data) == 1:
+                generator.append_entry_to_dataset(generator.filenames, current_file, generator.labels, current_labels, bad_files)
+        elif row[0] == current_file:
+            generator.append_label_to_list(current_labels, row[1:], bad_boxes)
+            if idx == len(data) - 1:
+                generator.append_entry_to_dataset(generator.filenames, current_file, generator.labels, current_labels, bad_files)
+        else:
+            generator.append_entry_to_dataset(generator.filenames, current_file, generator.labels, current_labels, bad_files)
+            current_labels = []
+            current_file = row[0]
+            generator.append_label_to_list(current_labels, row[1:], bad_boxes)
+    return generator.filenames, generator.labels
+
+
+def assert_same_dataset(filenames, labels, expected_filenames, expected_labels):
+    assert list(filenames) == list(expected_filenames)
+    assert len(labels) == len(expected_labels)
+    for image_labels, expected_image_labels in zip(labels, expected_labels):
+        np.testing.assert_array_equal(image_labels, expected_image_labels)
+
+
+@pytest.mark.parametrize('include_classes', [[1, 2, 3, 4], [1, 3]])
+@pytest.mark.parametrize('n_rows', [1, 2, 500])
+def test_parse_csv_equals_reference(tmp_path, include_classes, n_rows):
+    labels_path = str(tmp_path / 'labels.csv')
+    write_labels_csv(labels_path, np.random.RandomState(n_rows), n_rows=n_rows)
+
+    expected_filenames, expected_labels = reference_parse_csv(BatchGenerator(include_classes=include_classes), labels_path)
+
+    generator = BatchGenerator(include_classes=include_classes)
+    generator.labels_path, generator.input_format = labels_path, INPUT_FORMAT
+    generator._parse_csv_labels()
+    assert_same_dataset(generator.filenames, generator.labels, expected_filenames, expected_labels)
+
+
+def test_parse_csv_split_covers_dataset(tmp_path):
+    labels_path = str(tmp_path / 'labels.csv')
+    write_labels_csv(labels_path, np.random.RandomState(0))
+    expected_filenames, expected_labels = reference_parse_csv(BatchGenerator(include_classes=[1, 2, 3, 4]), labels_path)
+    expected = dict(zip(expected_filenames, expected_labels))
+
+    generator = BatchGenerator(include_classes=[1, 2, 3, 4])
+    generator.parse_csv(labels_path, INPUT_FORMAT, split_ratio=0.75, seed=0)
+
+    assert sorted(generator.train_filenames + generator.val_filenames) == sorted(expected_filenames)
+    for filename, labels in zip(generator.train_filenames + generator.val_filenames, generator.train_labels + generator.val_labels):
+        np.testing.assert_array_equal(labels, expected[filename])
+
+
+def parse_shard(labels_path, index_path=None, rank=0, world_size=1, include_classes=(1, 2, 3, 4)):
+    generator = BatchGenerator(include_classes=list(include_classes))
+    generator.parse_csv(labels_path, INPUT_FORMAT, split_ratio=0.8, seed=5, rank=rank, world_size=world_size, stratify=True, index_path=index_path)
+    return generator
+
+
+def test_parse_csv_index_equals_parse(tmp_path):
+    labels_path = str(tmp_path / 'labels.csv')
+    index_path = str(tmp_path / 'index')
+    write_labels_csv(labels_path, np.random.RandomState(0))
+    expected = parse_shard(labels_path)
+
+    for _ in range(2):  # The first call saves the index, the second loads it
+        generator = parse_shard(labels_path, index_path)
+        assert (tmp_path / 'index' / 'index.json').exists()
+        assert_same_dataset(generator.train_filenames, generator.train_labels, expected.train_filenames, expected.train_labels)
+        assert_same_dataset(generator.val_filenames, generator.val_labels, expected.val_filenames, expected.val_labels)
+
+    # The index of other classes doesn't replace the parsing either
+    generator = parse_shard(labels_path, index_path, include_classes=[2, 4])
+    expected = parse_shard(labels_path, include_classes=[2, 4])
+    assert_same_dataset(generator.train_filenames, generator.train_labels, expected.train_filenames, expected.train_labels)
+
+
+def test_parse_csv_index_is_rebuilt_when_csv_changes(tmp_path):
+    labels_path = str(tmp_path / 'labels.csv')
+    index_path = str(tmp_path / 'index')
+    write_labels_csv(labels_path, np.random.RandomState(0))
+    parse_shard(labels_path, index_path)
+
+    write_labels_csv(labels_path, np.random.RandomState(1), n_rows=300)
+    generator = parse_shard(labels_path, index_path)
+    expected = parse_shard(labels_path)
+    assert_same_dataset(generator.train_filenames, generator.train_labels, expected.train_filenames, expected.train_labels)
+
+
+@pytest.mark.parametrize('n_samples', [0, 1, 10, 1001])
+@pytest.mark.parametrize('world_size', [1, 3, 8])
+@pytest.mark.parametrize('split_ratio', [1.0, 0.8])
+@pytest.mark.parametrize('stratified', [False, True])
+def test_split_shard_disjoint_and_complete(n_samples, world_size, split_ratio, stratified):
+    strata = np.random.RandomState(0).randint(4, size=n_samples) if stratified else None
+    shards = [split_shard(n_samples, split_ratio, seed=7, rank=rank, world_size=world_size, strata=strata) for rank in range(world_size)]
+
+    train = np.concatenate([train for train, val in shards])
+    val = np.concatenate([val for train, val in shards])
+    samples = np.concatenate([train, val])
+    assert len(samples) == n_samples
+    assert np.array_equal(np.sort(samples), np.arange(n_samples))
+    # The shard sizes differ by at most one sample
+    assert max(len(train) for train, val in shards) - min(len(train) for train, val in shards) <= 1
+    assert max(len(val) for train, val in shards) - min(len(val) for train, val in shards) <= 1
+
+    # Every process computes the same shards
+    again = split_shard(n_samples, split_ratio, seed=7, rank=world_size - 1, world_size=world_size, strata=strata)
+    assert all(np.array_equal(a, b) for a, b in zip(again, shards[-1]))
+
+
+def test_split_shard_stratified_shares():
+    strata = np.repeat([0, 1, 2], [600, 300, 60])
+    for rank in range(3):
+        train, val = split_shard(len(strata), 0.5, seed=1, rank=rank, world_size=3, strata=strata)
+        assert np.array_equal(np.bincount(strata[train], minlength=3), [100, 50, 10])
+        assert np.array_equal(np.bincount(strata[val], minlength=3), [100, 50, 10])
+
+
+def test_split_shard_requires_seed():
+    with pytest.raises(ValueError):
+        split_shard(10, world_size=2)
+
+
+def test_parse_csv_shards_share_one_index(tmp_path):
+    labels_path = str(tmp_path / 'labels.csv')
+    index_path = str(tmp_path / 'index')
+    write_labels_csv(labels_path, np.random.RandomState(0))
+    world_size = 3
+
+    # The ranks other than 0 wait for rank 0 to save the index
+    shards = {}
+    def parse(rank):
+        shards[rank] = parse_shard(labels_path, index_path, rank=rank, world_size=world_size)
+    threads = [threading.Thread(target=parse, args=(rank,)) for rank in range(1, world_size)]
+    for thread in threads:
+        thread.start()
+    parse(0)
+    for thread in threads:
+        thread.join()
+
+    expected = parse_shard(labels_path)
+    expected_labels = dict(zip(expected.filenames, expected.labels))
+    filenames = [filename for rank in range(world_size) for filename in shards[rank].filenames]
+    assert sorted(filenames) == sorted(expected.filenames)
+    for rank in range(world_size):
+        for filename, labels in zip(shards[rank].filenames, shards[rank].labels):
+            np.testing.assert_array_equal(labels, expected_labels[filename])
+
+
+def write_images(filenames, rng):
+    rasterio = pytest.importorskip('rasterio')
+    for filename in filenames:
+        with rasterio.open(filename, 'w', driver='GTiff', height=8, width=6, count=3, dtype='uint8') as img:
+            img.write(rng.randint(256, size=(3, 8, 6)).astype(np.uint8))
+
+
+def parse_packed(labels_path, pack_path, **kwargs):
+    generator = BatchGenerator(include_classes=[1, 2])
+    generator.parse_csv(labels_path, INPUT_FORMAT, split_ratio=0.5, seed=3, pack_path=pack_path, **kwargs)
+    return generator
+
+
+def test_pack(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    filenames = ['img{}.tif'.format(i) for i in range(6)]
+    write_images(filenames, np.random.RandomState(0))
+    with open('labels.csv', 'w') as f:
+        f.write('frame,xmin,xmax,ymin,ymax,class_id\n')
+        for i, filename in enumerate(filenames):
+            f.write('{}, 1, 4, 2, {}, {}\n{}, 0, 3, 1, 7, 2\n'.format(filename, 3 + i % 4, 1 + i % 2, filename))
+
+    generator = parse_packed('labels.csv', 'pack')
+    expected = BatchGenerator(include_classes=[1, 2])
+    expected.parse_csv('labels.csv', INPUT_FORMAT, split_ratio=0.5, seed=3)
+    assert_same_dataset(generator.train_filenames, generator.train_labels, expected.train_filenames, expected.train_labels)
+    assert_same_dataset(generator.val_filenames, generator.val_labels, expected.val_filenames, expected.val_labels)
+    # The images are sliced out of the pack, and are the same as the images on disk
+    assert sorted(generator.pack_index) == filenames
+    for image, expected_image in zip(generator.load_images(generator.filenames), expected.load_images(generator.filenames)):
+        np.testing.assert_array_equal(image, expected_image)
+
+    # An unchanged dataset reuses the pack
+    packed_at = os.path.getmtime('pack/images.npy')
+    key = BatchGenerator._load_pack_key('pack')
+    parse_packed('labels.csv', 'pack')
+    assert os.path.getmtime('pack/images.npy') == packed_at
+    assert BatchGenerator._load_pack_key('pack') == key
+
+    # A modified image makes the pack out of date, even though the filenames are the same
+    write_images(filenames[:1], np.random.RandomState(1))
+    os.utime(filenames[0], (packed_at + 10, packed_at + 10))
+    generator = parse_packed('labels.csv', 'pack')
+    assert BatchGenerator._load_pack_key('pack') != key
+    np.testing.assert_array_equal(generator.load_images(filenames[:1])[0], expected.load_images(filenames[:1])[0])
+
+
+def test_pack_wait_timeout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_images(['img.tif'], np.random.RandomState(0))
+    with open('labels.csv', 'w') as f:
+        f.write('frame,xmin,xmax,ymin,ymax,class_id\nimg.tif, 1, 4, 2, 5, 1\n')
+
+    # Only rank 0 packs the images, the other ranks give up after `pack_timeout` seconds
+    with pytest.raises(TimeoutError):
+        parse_packed('labels.csv', 'pack', rank=1, world_size=2, pack_timeout=0.1)
+    assert not os.path.exists('pack/pack.json')
+
+
+VOC_CLASSES = ['background', 'car', 'person', 'dog']
+
+
+def write_voc_dataset(root, rng, n_images=12):
+    '''
+    Write Pascal VOC style annotation files and an image set file. Returns the expected filenames and labels for
+    `box_output_format == ['class_id', 'xmin', 'xmax', 'ymin', 'ymax']`, before any class or flag filtering,
+    with the truncated and difficult flags of each box.
+    '''
+    (root / 'Annotations').mkdir()
+    (root / 'ImageSets').mkdir()
+    image_ids = ['{:06d}'.format(i) for i in range(n_images)]
+    expected = []
+    for image_id in image_ids:
+        objects = []
+        boxes = []
+        for _ in range(rng.randint(0, 5)):
+            class_id = rng.randint(1, len(VOC_CLASSES))
+            xmin, ymin = rng.randint(0, 200, size=2)
+            xmax, ymax = xmin + rng.randint(1, 100), ymin + rng.randint(1, 100)
+            truncated, difficult = rng.randint(2, size=2)
+            objects.append('<object><name>{}</name><pose>Left</pose><truncated>{}</truncated><difficult>{}</difficult>'
+                           '<bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax></bndbox></object>'.format(VOC_CLASSES[class_id], truncated, difficult, xmin, ymin, xmax, ymax))
+            boxes.append([class_id, xmin, xmax, ymin, ymax, truncated, difficult])
+        (root / 'Annotations' / (image_id + '.xml')).write_text('<annotation><folder>VOC</folder><filename>{}.jpg</filename>'
+                                                                '<size><width>300</width><height>300</height></size>{}</annotation>'.format(image_id, ''.join(objects)))
+        expected.append((image_id + '.jpg', np.array(boxes, dtype=np.int64).reshape(-1, 7)))
+    (root / 'ImageSets' / 'train.txt').write_text('\n'.join(image_ids) + '\n')
+    return expected
+
+
+def parse_voc(root, n_workers, index_path=None, include_classes=None, exclude_truncated=False, exclude_difficult=False):
+    generator = BatchGenerator(include_classes=include_classes)
+    generator.parse_xml(annotations_path=str(root / 'Annotations'), image_set_path=str(root / 'ImageSets'), image_set='train.txt',
+                        classes=VOC_CLASSES, exclude_truncated=exclude_truncated, exclude_difficult=exclude_difficult,
+                        n_workers=n_workers, index_path=index_path)
+    return generator
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_parse_xml(tmp_path, n_workers):
+    pytest.importorskip('lxml')
+    expected = write_voc_dataset(tmp_path, np.random.RandomState(0))
+
+    generator = parse_voc(tmp_path, n_workers)
+    assert_same_dataset(generator.filenames, generator.labels, [filename for filename, boxes in expected], [boxes[:,:5] for filename, boxes in expected])
+
+    # The class and flag filters drop boxes, but keep the images
+    generator = parse_voc(tmp_path, n_workers, include_classes=[1, 3], exclude_truncated=True, exclude_difficult=True)
+    expected_labels = [boxes[np.isin(boxes[:,0], [1, 3]) & (boxes[:,5] == 0) & (boxes[:,6] == 0), :5] for filename, boxes in expected]
+    assert_same_dataset(generator.filenames, generator.labels, [filename for filename, boxes in expected], expected_labels)
+
+
+def test_parse_xml_index(tmp_path):
+    pytest.importorskip('lxml')
+    expected = write_voc_dataset(tmp_path, np.random.RandomState(1))
+    index_path = str(tmp_path / 'index')
+
+    for _ in range(2):  # The first call saves the index, the second loads it
+        generator = parse_voc(tmp_path, 2, index_path=index_path)
+        assert (tmp_path / 'index' / 'index.json').exists()
+        assert_same_dataset(generator.filenames, generator.labels, [filename for filename, boxes in expected], [boxes[:,:5] for filename, boxes in expected])
+
+    # Other options don't reuse the index
+    generator = parse_voc(tmp_path, 2, index_path=index_path, exclude_difficult=True)
+    assert_same_dataset(generator.filenames, generator.labels, [filename for filename, boxes in expected], [boxes[boxes[:,6] == 0, :5] for filename, boxes in expected])
+
+
+def test_parse_xml_rejects_text_fields(tmp_path):
+    write_voc_dataset(tmp_path, np.random.RandomState(2), n_images=1)
+    generator = BatchGenerator(box_output_format=['class_name', 'xmin', 'xmax', 'ymin', 'ymax'])
+    with pytest.raises(ValueError, match='class_name'):
+        generator.parse_xml(annotations_path=str(tmp_path / 'Annotations'), image_set_path=str(tmp_path / 'ImageSets'),
+                            image_set='train.txt', classes=VOC_CLASSES, n_workers=1)